@@ -1,3 +1,41 @@
 from django.contrib import admin
+from django.db.models import F
 
-# Register your models here.
+from .models import CardRoutingRule, ClientWebhook, ClientWorkbook, HotFolderJob, WebhookDelivery
+
+
+@admin.register(CardRoutingRule)
+class CardRoutingRuleAdmin(admin.ModelAdmin):
+    list_display = ("__str__", "updated_at")
+    search_fields = ("client_name",)
+
+
+@admin.register(ClientWebhook)
+class ClientWebhookAdmin(admin.ModelAdmin):
+    list_display = ("client_name", "url", "active", "updated_at")
+    search_fields = ("client_name",)
+
+
+@admin.register(WebhookDelivery)
+class WebhookDeliveryAdmin(admin.ModelAdmin):
+    list_display = ("id", "event", "run", "status", "attempts", "last_status_code", "next_attempt_at")
+    list_filter = ("status", "event")
+
+
+@admin.register(ClientWorkbook)
+class ClientWorkbookAdmin(admin.ModelAdmin):
+    list_display = ("client_name", "spreadsheet_id", "synced_at", "synced_run")
+    search_fields = ("client_name", "spreadsheet_id")
+    readonly_fields = ("synced_at", "synced_run")
+    actions = ["forget_snapshot"]
+
+    @admin.action(description="Read the sheet again on the next sync (after manual edits)")
+    def forget_snapshot(self, request, queryset):
+        queryset.update(snapshot={}, version=F("version") + 1)
+
+
+@admin.register(HotFolderJob)
+class HotFolderJobAdmin(admin.ModelAdmin):
+    list_display = ("client_name", "pair_key", "status", "status_code", "run", "created_at", "finished_at")
+    list_filter = ("status", "client_name")
+    search_fields = ("client_name", "bank_path", "hotel_path")
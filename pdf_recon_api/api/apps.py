@@ -1,5 +1,14 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from .card_rules import invalidate
+        from .models import CardRoutingRule
+
+        # Compiled card routing is cached per process
+        post_save.connect(invalidate, sender=CardRoutingRule, dispatch_uid="card_rules_saved")
+        post_delete.connect(invalidate, sender=CardRoutingRule, dispatch_uid="card_rules_deleted")
@@ -0,0 +1,136 @@
+"""
+Native async variant of POST /api/reconcile/ for ASGI deployments
+(``pdf_recon_api.asgi:application`` under uvicorn, daphne, ...).
+
+The pipeline is the one ReconciliationAPIView runs; only the waiting
+differs. Both uploads are hashed and saved concurrently, Google credentials
+are loaded while the statements are extracted and matched, CPU stages run in
+worker threads (stage slots still apply, and large matches still fan out to
+the matching process pool), and the Excel report, the HTML preview, the
+Parquet results and the Google Sheet are produced together by the
+rendering stage (see rendering.py). While a request
+waits, the event loop serves other clients, so one ASGI process can hold
+many requests that are blocked on I/O.
+"""
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.response import Response
+
+from .events import track_progress
+from .idempotency import store_response
+from .run_lock import claim_run, finish_run, run_content_hash, upload_sha256
+from .scheduler import SchedulerBusy, get_scheduler
+from .views import (
+    attach_to_run, build_report, get_google_services, idempotent_replay, parse_reconcile_request, render_outputs,
+    report_response, save_uploaded_file, scheduler_busy_response, start_shadow_run,
+)
+
+
+def in_thread(func, *args):
+    # Not thread-sensitive: stages of different requests must not queue
+    # behind each other on Django's single sync thread
+    return sync_to_async(func, thread_sensitive=False)(*args)
+
+
+def as_json(response):
+    """Render a DRF Response from the shared pipeline as a plain JsonResponse."""
+    json_response = JsonResponse(response.data, status=response.status_code)
+    for header, value in response.items():
+        if header.lower() != "content-type":
+            json_response[header] = value
+    return json_response
+
+
+def _read_form(request):
+    if request.content_type == "application/json":
+        # Resumable upload ids only, no files
+        try:
+            return json.loads(request.body or b"{}"), {}
+        except ValueError:
+            return {}, {}
+    # Multipart parsing spools large uploads to disk
+    return request.POST, request.FILES
+
+
+class AsyncReconciliationView(View):
+    http_method_names = ["post", "options"]
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Like APIView: API clients post without a CSRF token
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def post(self, request, *args, **kwargs):
+        data, files = await in_thread(_read_form, request)
+        # Looks up resumable upload ids in the database
+        parsed = await sync_to_async(parse_reconcile_request)(data, files)
+        if isinstance(parsed, Response):
+            return as_json(parsed)
+        bank_file_obj, hotel_file_obj, client_name, threshold_minutes = parsed
+
+        bank_digest, hotel_digest = await asyncio.gather(
+            in_thread(upload_sha256, bank_file_obj), in_thread(upload_sha256, hotel_file_obj)
+        )
+        content_hash = run_content_hash(bank_digest, hotel_digest, threshold_minutes)
+        # A replay needs no scheduler slot, so a retry is answered under load too
+        cache_key, replay = await in_thread(idempotent_replay, request, client_name, content_hash)
+        if replay:
+            return as_json(replay)
+        try:
+            with get_scheduler().admit(client_name):
+                response = await self.reconcile(request, data, parsed, content_hash, cache_key)
+        except SchedulerBusy as e:
+            response = scheduler_busy_response(e)
+        return as_json(response)
+
+    async def reconcile(self, request, data, parsed, content_hash, cache_key):
+        bank_file_obj, hotel_file_obj, client_name, threshold_minutes = parsed
+        run, claimed = await sync_to_async(claim_run)(
+            client_name, content_hash, bank_file_obj.name, hotel_file_obj.name
+        )
+        if not claimed:
+            response = await in_thread(attach_to_run, run)
+        else:
+            response = None
+            try:
+                # Worker threads inherit the context, so stages publish progress
+                with track_progress(run):
+                    response = await self.run_reconciliation(
+                        request, data, run, client_name, threshold_minutes, bank_file_obj, hotel_file_obj
+                    )
+            finally:
+                await sync_to_async(finish_run)(run, response)
+
+        if cache_key:
+            await in_thread(store_response, cache_key, response)
+        return response
+
+    async def run_reconciliation(self, request, data, run, client_name, threshold_minutes,
+                                 bank_file_obj, hotel_file_obj):
+        bank_file_path, hotel_file_path = await asyncio.gather(
+            in_thread(save_uploaded_file, bank_file_obj), in_thread(save_uploaded_file, hotel_file_obj)
+        )
+
+        # Credentials and API discovery do not depend on the result
+        google_services = asyncio.ensure_future(in_thread(get_google_services))
+        try:
+            report = await in_thread(
+                build_report, run, client_name, threshold_minutes, bank_file_path, hotel_file_path,
+                bank_file_obj, hotel_file_obj, data.get("streaming"),
+            )
+        except BaseException:
+            google_services.cancel()
+            raise
+        if isinstance(report, Response):
+            google_services.cancel()
+            return report
+
+        await in_thread(start_shadow_run, report)
+        services = await google_services
+        google_sheet_link = await in_thread(render_outputs, report, lambda: services)
+        return report_response(request, report, google_sheet_link)
@@ -0,0 +1,75 @@
+"""
+Per-client card routing rules (CardRoutingRule rows) compiled into the
+CardRules lookup tables the parsers and the report use.
+
+Compiling happens once per process and client. Each run checks the
+``updated_at`` stamps of the rows that apply, which is one indexed query.
+A saved or deleted rule clears this process's cache straight away. Other
+worker processes see the new stamp on their next run and compile again.
+"""
+import threading
+
+from .models import CardRoutingRule
+from .parsers import (
+    DEFAULT_CARD_ALIASES, DEFAULT_CARD_RULES, DEFAULT_EXCLUDED_CARD_TYPES, DEFAULT_MANDATORY_CARD_TYPES,
+    GCCNET_CARD_LAST_4_DIGITS, CardRules,
+)
+
+ALL_CLIENTS = ""
+
+# client name -> (stamp, CardRules)
+_compiled = {}
+_lock = threading.Lock()
+
+
+def _layer(base, row):
+    """Rule fields of ``row`` applied on top of the ``base`` field dict."""
+    merged = dict(base)
+    for field in ("last4_routes", "bin_routes", "aliases"):
+        merged[field] = {**base[field], **getattr(row, field)}
+    for field in ("excluded_types", "mandatory_types", "attachment_order"):
+        merged[field] = getattr(row, field) or base[field]
+    return merged
+
+
+def compile_rules(rows):
+    """
+    CardRules for the given rows, layered in order on top of the built-in
+    routing (GCCNET last-4 digits, MASTER alias, AMEX/DINERS/JCB excluded).
+    """
+    fields = {
+        "last4_routes": {last4: "GCCNET" for last4 in GCCNET_CARD_LAST_4_DIGITS},
+        "bin_routes": {},
+        "aliases": dict(DEFAULT_CARD_ALIASES),
+        "excluded_types": DEFAULT_EXCLUDED_CARD_TYPES,
+        "mandatory_types": DEFAULT_MANDATORY_CARD_TYPES,
+        "attachment_order": [],
+    }
+    for row in rows:
+        fields = _layer(fields, row)
+    return CardRules(**fields)
+
+
+def card_rules_for(client_name):
+    """Compiled CardRules for ``client_name``, cached per process."""
+    names = [ALL_CLIENTS] if client_name == ALL_CLIENTS else [ALL_CLIENTS, client_name]
+    stamp = tuple(sorted(
+        CardRoutingRule.objects.filter(client_name__in=names).values_list("client_name", "updated_at")
+    ))
+    cached = _compiled.get(client_name)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    if not stamp:
+        rules = DEFAULT_CARD_RULES
+    else:
+        rows = {row.client_name: row for row in CardRoutingRule.objects.filter(client_name__in=names)}
+        rules = compile_rules([rows[name] for name in names if name in rows])
+    with _lock:
+        _compiled[client_name] = (stamp, rules)
+    return rules
+
+
+def invalidate(sender=None, **kwargs):
+    """Signal receiver: forget every compiled rule set in this process."""
+    with _lock:
+        _compiled.clear()
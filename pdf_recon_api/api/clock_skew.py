@@ -0,0 +1,291 @@
+"""
+Clock-skew calibration between the bank terminals and the PMS.
+
+A card terminal's clock and the hotel's PMS clock rarely agree. Until now a
+skew of a few minutes had to be absorbed by a wide ``threshold_time``,
+which also lets a bank row pair with the wrong hotel row of the same
+amount. Before matching, the skew is measured from the statements
+themselves:
+
+- Anchors are card rows whose (card last-4, amount) pair has exactly one
+  candidate on the other side within RECON_CLOCK_SKEW_MAX_MINUTES, and
+  the other way round. Such a pair is almost certainly the same payment.
+- The anchors' time differences (bank minus PMS) are binned into a
+  histogram of RECON_CLOCK_SKEW_BIN_SECONDS bins. The offset is the median
+  of the deltas in the peak bin and its two neighbours. It counts only with
+  at least RECON_CLOCK_SKEW_MIN_ANCHORS anchors, of which at least
+  RECON_CLOCK_SKEW_MIN_SHARE fall around the peak.
+- An offset is estimated for each terminal on each day, each terminal and
+  the whole statement. Every bank row takes the most specific one there is.
+
+Matching then runs twice. Calibrated bank rows, shifted by their offset,
+are matched first within RECON_CLOCK_SKEW_WINDOW minutes. Every row left
+over, calibrated or not, is then matched on its own times with the
+request's threshold, as it would be without calibration. The pairs taken
+in the first pass are gone by then, so the result can differ from plain
+matching either way. The report keeps the statement's own times. The
+streaming path does not calibrate.
+
+RECON_CLOCK_SKEW is off by default. Try it on live runs first as the
+"clock_skew" shadow engine (see shadow.py).
+"""
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+from .matching import match_transactions_sharded
+from .progress import publish
+
+TERMINAL_COLUMN = "Terminal ID"
+
+
+def _skew_settings():
+    return {
+        "max_skew": pd.Timedelta(minutes=getattr(settings, "RECON_CLOCK_SKEW_MAX_MINUTES", 180)),
+        "bin_seconds": max(1, getattr(settings, "RECON_CLOCK_SKEW_BIN_SECONDS", 60)),
+        "min_anchors": max(1, getattr(settings, "RECON_CLOCK_SKEW_MIN_ANCHORS", 10)),
+        "min_share": getattr(settings, "RECON_CLOCK_SKEW_MIN_SHARE", 0.6),
+        "window": getattr(settings, "RECON_CLOCK_SKEW_WINDOW", 2),
+    }
+
+
+def _terminals(bank):
+    if TERMINAL_COLUMN not in bank:
+        return pd.Series("", index=bank.index)
+    return bank[TERMINAL_COLUMN].fillna("").astype(str).str.strip()
+
+
+def find_anchors(bank, hotel, max_skew):
+    """
+    Anchor pairs as a frame of ``bank`` and ``hotel`` labels, ``terminal``,
+    ``day`` (of the bank row) and ``delta`` (bank DT minus hotel DT, in
+    seconds).
+    """
+    bank_rows = bank[
+        (bank["Card Type (On us/Off us)"] != 'GCCNET') & bank["DT"].notna() & bank["Gross Amount"].notna()
+    ]
+    refs = hotel["Card Reference"]
+    hotel_rows = hotel[
+        (refs.str.len() >= 4).fillna(False).astype(bool) & hotel["DT"].notna() & hotel["Amount"].notna()
+    ]
+    if bank_rows.empty or hotel_rows.empty:
+        return pd.DataFrame(columns=["bank", "hotel", "terminal", "day", "delta"])
+
+    pairs = pd.DataFrame({
+        "bank": bank_rows.index,
+        "bank_dt": bank_rows["DT"].to_numpy(),
+        "terminal": _terminals(bank_rows).to_numpy(),
+        "amount": bank_rows["Gross Amount"].to_numpy(),
+        "last4": bank_rows["Card Number"].astype(str).str[-4:].to_numpy(),
+    }).merge(pd.DataFrame({
+        "hotel": hotel_rows.index,
+        "hotel_dt": hotel_rows["DT"].to_numpy(),
+        "amount": hotel_rows["Amount"].to_numpy(),
+        "last4": hotel_rows["Card Reference"].str[-4:].to_numpy(),
+    }), on=["amount", "last4"])
+    delta = pairs["bank_dt"] - pairs["hotel_dt"]
+    pairs = pairs[delta.abs() <= max_skew].assign(delta=delta.dt.total_seconds())
+    # A row with two candidates could belong to either: not an anchor
+    pairs = pairs[~pairs["bank"].duplicated(keep=False) & ~pairs["hotel"].duplicated(keep=False)]
+    pairs = pairs.assign(day=pairs["bank_dt"].dt.normalize())
+    return pairs[["bank", "hotel", "terminal", "day", "delta"]].reset_index(drop=True)
+
+
+def histogram_peak(deltas, bin_seconds, max_seconds):
+    """``(offset in seconds, deltas around the peak)`` of a set of time deltas."""
+    deltas = np.asarray(deltas, dtype=float)
+    edges = np.arange(-max_seconds, max_seconds + 2 * bin_seconds, bin_seconds, dtype=float)
+    counts, _ = np.histogram(deltas, bins=edges)
+    # Ties go to the bin nearest zero, so a statement without skew is not shifted
+    peaks = np.flatnonzero(counts == counts.max())
+    peak = peaks[np.argmin(np.abs(edges[peaks] + bin_seconds / 2))]
+    low, high = edges[max(peak - 1, 0)], edges[min(peak + 2, len(edges) - 1)]
+    near = deltas[(deltas >= low) & (deltas < high)]
+    return float(np.round(np.median(near))), len(near)
+
+
+class SkewEstimate:
+    """Offset (bank clock minus PMS clock) of one terminal on one day; None for either means all of them."""
+
+    def __init__(self, terminal, day, offset_seconds, anchors, peak_anchors):
+        self.terminal = terminal
+        self.day = day
+        self.offset_seconds = offset_seconds
+        self.anchors = anchors
+        self.peak_anchors = peak_anchors
+
+    @property
+    def offset(self):
+        return pd.Timedelta(seconds=self.offset_seconds)
+
+    def as_dict(self):
+        return {
+            "terminal": self.terminal,
+            "day": self.day.strftime("%Y-%m-%d") if self.day is not None else None,
+            "offsetSeconds": self.offset_seconds,
+            "anchors": self.anchors,
+            "peakAnchors": self.peak_anchors,
+        }
+
+
+def format_offset(seconds):
+    sign = "-" if seconds < 0 else "+"
+    minutes, secs = divmod(int(round(abs(seconds))), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{sign}{hours}:{minutes:02d}:{secs:02d}"
+
+
+class ClockSkew:
+    """The estimates of one statement pair and the window calibrated rows are matched in."""
+
+    def __init__(self, estimates, anchors, window_minutes, bin_seconds):
+        self.estimates = estimates  # {(terminal, day): SkewEstimate}
+        self.anchors = anchors
+        self.window_minutes = window_minutes
+        self.bin_seconds = bin_seconds
+
+    @property
+    def applied(self):
+        return bool(self.estimates)
+
+    def offsets(self, bank):
+        """Offset of every bank row (NaT where nothing was estimated for it)."""
+        offsets = pd.Series(pd.NaT, index=bank.index, dtype="timedelta64[ns]")
+        if not self.applied or bank.empty:
+            return offsets
+        terminals = _terminals(bank)
+        days = bank["DT"].dt.normalize()
+        # Least specific first: the statement's, then each terminal's, then each day's
+        for est in sorted(self.estimates.values(), key=lambda e: (e.terminal is not None) + (e.day is not None)):
+            rows = bank["DT"].notna()
+            if est.terminal is not None:
+                rows &= terminals == est.terminal
+            if est.day is not None:
+                rows &= days == est.day
+            offsets[rows] = est.offset
+        return offsets
+
+    def reported(self):
+        """
+        The estimates worth showing: the statement's and each terminal's,
+        plus the days on which a terminal drifted from its usual offset by
+        more than a bin.
+        """
+        shown = []
+        for (terminal, day), est in sorted(self.estimates.items(), key=lambda item: _sort_key(*item[0])):
+            if day is not None:
+                usual = self.estimates.get((terminal, None)) or self.estimates.get((None, None))
+                if usual and abs(est.offset_seconds - usual.offset_seconds) <= self.bin_seconds:
+                    continue
+            shown.append(est)
+        return shown
+
+    def as_dict(self):
+        return {
+            "applied": self.applied,
+            "anchors": self.anchors,
+            "windowMinutes": self.window_minutes if self.applied else None,
+            "offsets": [est.as_dict() for est in self.reported()],
+        }
+
+    def summary_rows(self):
+        """Rows for the Bank Account summary (nine columns, like the rest of it)."""
+        blank = [""] * 9
+        rows = [["Clock Skew (Bank vs PMS)", "", "Terminal", "Day", "Anchors", "Offset", "", "", ""]]
+        if not self.applied:
+            rows.append(["Not calibrated", "", "-", "-", self.anchors, "-", "", "", ""])
+            return rows + [blank]
+        for est in self.reported():
+            rows.append([
+                "", "",
+                est.terminal if est.terminal is not None else "All terminals",
+                est.day.strftime("%d-%b-%Y") if est.day is not None else "All days",
+                est.anchors,
+                format_offset(est.offset_seconds),
+                "", "", "",
+            ])
+        rows.append(["Calibrated Match Window", "", "", "", "", f"{self.window_minutes} min", "", "", ""])
+        return rows + [blank]
+
+
+def _sort_key(terminal, day):
+    return (terminal is not None, terminal or "", day is not None, day if day is not None else pd.Timestamp(0))
+
+
+def estimate_clock_skew(bank, hotel):
+    """ClockSkew of a bank and hotel frame (with their ``DT`` columns)."""
+    options = _skew_settings()
+    max_seconds = options["max_skew"].total_seconds()
+    anchors = find_anchors(bank, hotel, options["max_skew"])
+
+    def estimate(group, terminal, day):
+        if len(group) < options["min_anchors"]:
+            return None
+        offset, near = histogram_peak(group["delta"], options["bin_seconds"], max_seconds)
+        if near < options["min_share"] * len(group):
+            return None
+        return SkewEstimate(terminal, day, offset, len(group), near)
+
+    estimates = {}
+    candidates = [(None, None, anchors)]
+    candidates += [(terminal, None, group) for terminal, group in anchors.groupby("terminal", sort=True)]
+    candidates += [(terminal, day, group) for (terminal, day), group in anchors.groupby(["terminal", "day"], sort=True)]
+    for terminal, day, group in candidates:
+        est = estimate(group, terminal, day)
+        if est is not None:
+            estimates[(terminal, day)] = est
+    return ClockSkew(estimates, len(anchors), options["window"], options["bin_seconds"])
+
+
+def _labels(rows):
+    return [row.name for row in rows]
+
+
+def match_with_clock_skew(bank, hotel, threshold_minutes, enabled=None):
+    """
+    ``(result, ClockSkew or None)``, the result in the same shape and order
+    as ``match_transactions`` returns it. ``enabled`` overrides
+    RECON_CLOCK_SKEW. When it is off, or nothing could be estimated, this is
+    plain matching.
+    """
+    if enabled is None:
+        enabled = getattr(settings, "RECON_CLOCK_SKEW", False)
+    if not enabled or bank.empty or hotel.empty:
+        return match_transactions_sharded(bank, hotel, threshold_minutes), None
+
+    skew = estimate_clock_skew(bank, hotel)
+    publish("match.calibrated", **skew.as_dict())
+    if not skew.applied:
+        print(f"Clock skew: not calibrated ({skew.anchors} anchor pair(s)).")
+        return match_transactions_sharded(bank, hotel, threshold_minutes), skew
+    print("Clock skew: " + ", ".join(
+        f"{est.terminal or 'all terminals'}/{est.day.date() if est.day is not None else 'all days'} "
+        f"{format_offset(est.offset_seconds)}"
+        for est in skew.reported()
+    ) + f" from {skew.anchors} anchor pair(s).")
+
+    offsets = skew.offsets(bank)
+    calibrated = offsets.notna()
+    shifted = bank[calibrated].assign(DT=bank.loc[calibrated, "DT"] - offsets[calibrated])
+    rec_bank, rec_hotel, _, _ = match_transactions_sharded(
+        shifted, hotel, min(threshold_minutes, skew.window_minutes)
+    )
+    pairs = list(zip(_labels(rec_bank), _labels(rec_hotel)))
+
+    # Everything left, calibrated or not, is matched on its own times
+    taken_bank = {b for b, _ in pairs}
+    taken_hotel = {h for _, h in pairs}
+    rec_bank, rec_hotel, _, _ = match_transactions_sharded(
+        bank[~bank.index.isin(taken_bank)], hotel[~hotel.index.isin(taken_hotel)], threshold_minutes
+    )
+    pairs += zip(_labels(rec_bank), _labels(rec_hotel))
+
+    bank_pos = pd.Series(np.arange(len(bank)), index=bank.index)
+    pairs.sort(key=lambda p: bank_pos[p[0]])
+    matched_bank = {b for b, _ in pairs}
+    return (
+        [bank.loc[b] for b, _ in pairs],
+        [hotel.loc[h] for _, h in pairs],
+        [row for label, row in bank.iterrows() if label not in matched_bank],
+        hotel.drop(index=[h for _, h in pairs]),
+    ), skew
@@ -0,0 +1,198 @@
+"""
+Report downloads: ``GET /media/<run folder>/<file>``.
+
+Replaces Django's ``static()`` helper, which only works with DEBUG on. The
+view serves report files from run folders only, and adds:
+
+- ``ETag`` / ``If-None-Match`` and ``Last-Modified`` / ``If-Modified-Since``
+  (304 responses).
+- Single byte ranges (``Range``, ``If-Range``), so big downloads can resume.
+- The ``.br`` / ``.gz`` variant written at render time, when the client
+  accepts it.
+- Cold files the storage job compressed to ``.zst``, decompressed on the fly.
+- Optional hand-off to the front server: ``X-Sendfile`` (Apache, lighttpd)
+  or ``X-Accel-Redirect`` (nginx, with an ``internal`` location for
+  RECON_ACCEL_REDIRECT_PREFIX aliased to MEDIA_ROOT). Django then only
+  checks the path and sets the headers.
+"""
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+from django.views import View
+
+from .storage import CHUNK_SIZE, RUN_FOLDER_PATTERN, ZSTD_SUFFIX, open_artifact
+
+# Preferred first
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def accepted_encodings(request):
+    accepted = set()
+    for part in request.headers.get("Accept-Encoding", "").split(","):
+        coding, _, params = part.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def resolve_report_file(folder, file_name):
+    """Absolute path of a file in a run folder; 404 for anything else."""
+    if not RUN_FOLDER_PATTERN.search(folder) or file_name in ("", ".", "..") or "/" in file_name:
+        raise Http404("Report not found.")
+    media_root = os.path.realpath(settings.MEDIA_ROOT)
+    path = os.path.realpath(os.path.join(media_root, folder, file_name))
+    if os.path.dirname(os.path.dirname(path)) != media_root:
+        raise Http404("Report not found.")
+    return path
+
+
+def select_variant(request, path):
+    """
+    ``(file to send, Content-Encoding or None, decompress)``. A compressed
+    variant wins when accepted; a file only kept as ``.zst`` is decompressed.
+    """
+    accepted = accepted_encodings(request)
+    for encoding, suffix in ENCODINGS:
+        if (encoding in accepted or "*" in accepted) and os.path.isfile(path + suffix):
+            return path + suffix, encoding, False
+    if os.path.isfile(path):
+        return path, None, False
+    if os.path.isfile(path + ZSTD_SUFFIX):
+        return path + ZSTD_SUFFIX, None, True
+    raise Http404("Report not found.")
+
+
+def make_etag(st, encoding):
+    # Report files never change in place (they are replaced by new links),
+    # so inode, size and mtime identify the content
+    tag = f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+    return f'"{tag}-{encoding}"' if encoding else f'"{tag}"'
+
+
+def _etag_matches(header, etag):
+    if header.strip() == "*":
+        return True
+    tags = [t.strip() for t in header.split(",")]
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    return etag in tags or f"W/{etag}" in tags
+
+
+def parse_range(header, size):
+    """
+    ``(start, end)`` inclusive for a single satisfiable byte range, None to
+    send the whole file (no header, or several ranges), or ``"unsatisfiable"``.
+    """
+    match = RANGE_PATTERN.match(header.replace(" ", ""))
+    if not match:
+        return None
+    first, last = match.groups()
+    if first == "" and last == "":
+        return None
+    if first == "":
+        length = int(last)
+        if length == 0 or size == 0:
+            return "unsatisfiable"
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return "unsatisfiable"
+    return start, end
+
+
+def _file_range(path, start, length):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _decompressed(path):
+    with open_artifact(path) as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            yield chunk
+
+
+def _offload(response, path):
+    mode = getattr(settings, "RECON_DOWNLOAD_OFFLOAD", None)
+    if mode == "sendfile":
+        response["X-Sendfile"] = path
+    elif mode == "accel":
+        prefix = getattr(settings, "RECON_ACCEL_REDIRECT_PREFIX", "/protected-media/")
+        relative = os.path.relpath(path, os.path.realpath(settings.MEDIA_ROOT))
+        response["X-Accel-Redirect"] = prefix.rstrip("/") + "/" + relative.replace(os.sep, "/")
+    else:
+        return False
+    return True
+
+
+class ReportDownloadView(View):
+    http_method_names = ["get", "head", "options"]
+
+    def get(self, request, folder, file_name):
+        path = resolve_report_file(folder, file_name)
+        send_path, encoding, decompress = select_variant(request, path)
+        st = os.stat(send_path)
+        etag = make_etag(st, encoding)
+        last_modified = http_date(st.st_mtime)
+
+        content_type, _ = mimetypes.guess_type(path)
+        headers = {
+            "Content-Type": content_type or "application/octet-stream",
+            "ETag": etag,
+            "Last-Modified": last_modified,
+            "Vary": "Accept-Encoding",
+        }
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        if not decompress:
+            headers["Accept-Ranges"] = "bytes"
+
+        if_none_match = request.headers.get("If-None-Match")
+        if_modified_since = parse_http_date_safe(request.headers.get("If-Modified-Since", ""))
+        if (if_none_match and _etag_matches(if_none_match, etag)) or (
+            not if_none_match and if_modified_since and int(st.st_mtime) <= if_modified_since
+        ):
+            response = HttpResponseNotModified()
+            for header in ("ETag", "Last-Modified", "Vary"):
+                response[header] = headers[header]
+            return response
+
+        if decompress:
+            # Cold file: length unknown until decompressed, so no ranges
+            return StreamingHttpResponse(_decompressed(path), headers=headers)
+
+        response = HttpResponse(headers=headers)
+        if _offload(response, send_path):
+            # The front server handles Range itself
+            return response
+
+        size = st.st_size
+        byte_range = None
+        if_range = request.headers.get("If-Range")
+        if "Range" in request.headers and (not if_range or if_range.strip() in (etag, last_modified)):
+            byte_range = parse_range(request.headers["Range"], size)
+        if byte_range == "unsatisfiable":
+            return HttpResponse(status=416, headers={"Content-Range": f"bytes */{size}"})
+        if byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                _file_range(send_path, start, end - start + 1), status=206, headers=headers
+            )
+            response["Content-Range"] = f"bytes {start}-{end}/{size}"
+            response["Content-Length"] = str(end - start + 1)
+            return response
+
+        # Whole file: FileResponse lets the WSGI server use sendfile()
+        return FileResponse(open(send_path, "rb"), filename=os.path.basename(path), headers=headers)
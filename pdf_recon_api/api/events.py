@@ -0,0 +1,211 @@
+"""
+Per-run progress events, streamed with Server-Sent Events.
+
+    GET /api/runs/<id>/events/               one run; ends after its last event
+    GET /api/runs/events/?client_name=<name> every run of a client, as they start
+
+The client stream can be opened before the upload is POSTed. Its
+``run.started`` event carries the new run's id. It carries progress only:
+its ``run.completed`` / ``run.failed`` events have no ``result`` or
+``error``, which the run's own stream has. Every event has an
+``id:``; a reconnecting EventSource sends it back as Last-Event-ID, so the
+stream resumes where it left off. Streams close after
+RECON_EVENT_STREAM_MAX seconds, and the browser reconnects on its own.
+
+Event kinds:
+
+- ``run.started``
+- ``stage.started`` / ``stage.finished`` (stage, seconds)
+- ``extract.pages`` (document, page, pages)
+- ``rows.parsed``
+- ``match.progress`` (shards done)
+- ``rows.matched``
+- ``artifact.finished``
+- ``run.completed`` / ``run.failed``
+
+Events are rows in RunEvent, so any worker process can serve any run.
+Code deep in the pipeline publishes through the hooks in progress.py.
+"""
+import asyncio
+import json
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.views import View
+
+from .models import ReconciliationRecord, RunEvent
+from .progress import current_progress
+
+TERMINAL_EVENTS = ("run.completed", "run.failed")
+
+# Left out of the client stream, which anyone naming the client can open
+CLIENT_STREAM_HIDDEN = ("result", "error")
+
+
+class RunProgress:
+    """Publishes one run's events. Never fails the run."""
+
+    def __init__(self, run):
+        self.run_id = run.pk
+        self.client_name = run.client_name
+        # Stored upload path -> "bank" / "hotel", for page events
+        self.documents = {}
+        self._last_pages = {}
+
+    def publish(self, kind, **data):
+        try:
+            RunEvent.objects.create(run_id=self.run_id, client_name=self.client_name, kind=kind, data=data)
+        except Exception as e:
+            print(f"Error publishing {kind} event for run {self.run_id}: {e}")
+
+    def pages(self, document, page, pages):
+        """Page ``page`` of ``pages`` extracted; throttled per document."""
+        now = time.monotonic()
+        interval = getattr(settings, "RECON_PROGRESS_INTERVAL", 1.0)
+        if page < pages and now - self._last_pages.get(document, 0.0) < interval:
+            return
+        self._last_pages[document] = now
+        self.publish("extract.pages", document=self.documents.get(document, document), page=page, pages=pages)
+
+
+@contextmanager
+def track_progress(run):
+    """Make ``run`` the target of the progress hooks in this context."""
+    token = current_progress.set(RunProgress(run))
+    try:
+        yield current_progress.get()
+    finally:
+        current_progress.reset(token)
+
+
+def publish_run_finished(run, status_code, data):
+    """
+    Terminal event of a run, published by finish_run. Returns its
+    ``(kind, fields)``, which are also the body of the webhook.
+    """
+    completed = run.status == ReconciliationRecord.Status.COMPLETED
+    kind = "run.completed" if completed else "run.failed"
+    fields = {"status": run.status, "statusCode": status_code, "durationSeconds": run.duration_seconds}
+    if completed:
+        fields["result"] = data
+    elif isinstance(data, dict) and data.get("error"):
+        fields["error"] = data["error"]
+    RunProgress(run).publish(kind, **fields)
+    return kind, fields
+
+
+def prune_events(dry_run=False, now=None):
+    """Delete events older than RECON_EVENT_TTL seconds; returns how many."""
+    cutoff = (now or timezone.now()) - timedelta(seconds=getattr(settings, "RECON_EVENT_TTL", 7 * 86400))
+    stale = RunEvent.objects.filter(created_at__lt=cutoff)
+    count = stale.count()
+    if not dry_run:
+        stale.delete()
+    return count
+
+
+def _format(event, hidden=()):
+    payload = {"runId": event.run_id, "clientName": event.client_name, "at": event.created_at.isoformat(),
+               **{key: value for key, value in event.data.items() if key not in hidden}}
+    return f"id: {event.pk}\nevent: {event.kind}\ndata: {json.dumps(payload, default=str)}\n\n"
+
+
+class _Stream:
+    """Polling state of one SSE connection; ``poll`` returns (chunks, done)."""
+
+    def __init__(self, filters, after, run_id=None, hidden=()):
+        self.filters = filters
+        self.after = after
+        self.run_id = run_id
+        self.hidden = hidden
+        self.deadline = time.monotonic() + getattr(settings, "RECON_EVENT_STREAM_MAX", 300)
+        self.keepalive = getattr(settings, "RECON_EVENT_KEEPALIVE", 15)
+        self.interval = getattr(settings, "RECON_EVENT_POLL", 0.5)
+        self.last_sent = time.monotonic()
+
+    def poll(self):
+        events = list(RunEvent.objects.filter(id__gt=self.after, **self.filters).order_by("id")[:200])
+        chunks = []
+        for event in events:
+            chunks.append(_format(event, self.hidden))
+            self.after = event.pk
+            if self.run_id is not None and event.kind in TERMINAL_EVENTS:
+                return chunks, True
+        now = time.monotonic()
+        if chunks:
+            self.last_sent = now
+            return chunks, False
+        if self.run_id is not None and self._finished_long_ago():
+            # Finished without a terminal event (e.g. before events existed)
+            return [], True
+        if now >= self.deadline:
+            return [], True
+        if now - self.last_sent >= self.keepalive:
+            self.last_sent = now
+            return [": keepalive\n\n"], False
+        return [], False
+
+    def _finished_long_ago(self):
+        # The terminal event is written just after the status; give it time
+        status, finished_at = ReconciliationRecord.objects.filter(pk=self.run_id).values_list(
+            "status", "finished_at"
+        ).first() or (None, None)
+        if status == ReconciliationRecord.Status.RUNNING:
+            return False
+        return finished_at is None or timezone.now() - finished_at > timedelta(seconds=5)
+
+    def __iter__(self):
+        yield f"retry: {int(getattr(settings, 'RECON_EVENT_RETRY_MS', 3000))}\n\n"
+        while True:
+            chunks, done = self.poll()
+            yield from chunks
+            if done:
+                return
+            if not chunks:
+                time.sleep(self.interval)
+
+    async def __aiter__(self):
+        yield f"retry: {int(getattr(settings, 'RECON_EVENT_RETRY_MS', 3000))}\n\n"
+        poll = sync_to_async(self.poll, thread_sensitive=False)
+        while True:
+            chunks, done = await poll()
+            for chunk in chunks:
+                yield chunk
+            if done:
+                return
+            if not chunks:
+                await asyncio.sleep(self.interval)
+
+
+class RunEventsView(View):
+    """SSE stream of one run's events, or of the progress of all runs of ``?client_name=``."""
+
+    def get(self, request, run_id=None):
+        try:
+            after = int(request.headers.get("Last-Event-ID") or request.GET.get("after") or 0)
+        except ValueError:
+            return JsonResponse({"error": "Last-Event-ID / after must be an event id."}, status=400)
+
+        if run_id is not None:
+            if not ReconciliationRecord.objects.filter(pk=run_id).exists():
+                return JsonResponse({"error": "Unknown run."}, status=404)
+            stream = _Stream({"run_id": run_id}, after, run_id)
+        else:
+            client_name = (request.GET.get("client_name") or "").strip()
+            if not client_name:
+                return JsonResponse({"error": "client_name is required."}, status=400)
+            stream = _Stream({"client_name": client_name}, after, hidden=CLIENT_STREAM_HIDDEN)
+
+        # Each server type needs its own iterator kind, or Django buffers the stream
+        content = stream.__aiter__() if isinstance(request, ASGIRequest) else iter(stream)
+        response = StreamingHttpResponse(content, content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        # Tell nginx not to buffer the stream
+        response["X-Accel-Buffering"] = "no"
+        return response
@@ -0,0 +1,263 @@
+import pdfplumber
+from pdf2image import pdfinfo_from_path
+from pdf2image.exceptions import (
+    PDFInfoNotInstalledError, PDFPageCountError, PDFPopplerTimeoutError, PopplerNotInstalledError,
+    PDFSyntaxError as PopplerSyntaxError,
+)
+from pdfminer.pdfexceptions import PDFException
+from pdfminer.pdfparser import PDFSyntaxError
+from pdfplumber.utils.exceptions import PdfminerException
+from pytesseract import TesseractError, TesseractNotFoundError
+
+from .ocr import ocr_page_lines
+from .progress import report_pages
+from .scheduler import stage_slot
+
+# Extraction paths chosen by probe_pdf
+TEXT, OCR, MIXED = "text", "ocr", "mixed"
+
+PROBE_SAMPLE_PAGES = 3
+MIN_TEXT_CHARS = 20  # fewer characters than this and a page counts as having no text layer
+MIN_IMAGE_COVERAGE = 0.5  # share of the page area covered by images for a scanned page
+
+# pdfplumber has no PDFSyntaxError attribute; it wraps pdfminer errors instead
+PDF_READ_ERRORS = (PDFSyntaxError, PdfminerException)
+
+# Rendering (poppler) or recognition (tesseract) failing; anything else is a bug
+OCR_ERRORS = (
+    TesseractError, TesseractNotFoundError, PDFInfoNotInstalledError, PDFPageCountError,
+    PDFPopplerTimeoutError, PopplerNotInstalledError, PopplerSyntaxError,
+)
+
+
+class UnreadablePDF(ValueError):
+    """The upload is not a PDF we can open (malformed, encrypted, empty)."""
+
+
+class ProbeResult:
+    def __init__(self, path, page_count, text_pages, image_pages, sampled):
+        self.path = path
+        self.page_count = page_count
+        self.text_pages = text_pages
+        self.image_pages = image_pages
+        self.sampled = sampled
+
+    def __repr__(self):
+        return (
+            f"<ProbeResult {self.path} pages={self.page_count} sampled={self.sampled} "
+            f"text={self.text_pages} image={self.image_pages}>"
+        )
+
+
+def _sample_indexes(page_count, sample_pages):
+    # First, last and evenly spaced pages in between
+    if page_count <= sample_pages:
+        return list(range(page_count))
+    step = (page_count - 1) / (sample_pages - 1)
+    return sorted({round(i * step) for i in range(sample_pages)})
+
+
+def _image_coverage(page):
+    page_area = float(page.width * page.height) or 1.0
+    covered = sum(
+        max(0.0, float(img["x1"] - img["x0"])) * max(0.0, float(img["bottom"] - img["top"]))
+        for img in page.images
+    )
+    return min(1.0, covered / page_area)
+
+
+def _has_text_layer(page):
+    return len(page.chars) >= MIN_TEXT_CHARS
+
+
+def probe_pdf(pdf, sample_pages=PROBE_SAMPLE_PAGES):
+    """
+    Decide how a PDF should be read by looking at a few sampled pages only:
+    character objects mean a usable text layer, large image coverage without
+    characters means a scan. Returns a ProbeResult whose ``path`` is TEXT,
+    OCR or MIXED; raises UnreadablePDF for anything pdfplumber cannot open.
+    """
+    with open(pdf, "rb") as f:
+        if b"%PDF" not in f.read(1024):
+            raise UnreadablePDF("File is not a PDF.")
+
+    try:
+        with pdfplumber.open(pdf) as p:
+            page_count = len(p.pages)
+            if not page_count:
+                raise UnreadablePDF("PDF has no pages.")
+            text_pages = image_pages = 0
+            indexes = _sample_indexes(page_count, sample_pages)
+            for idx in indexes:
+                page = p.pages[idx]
+                if _has_text_layer(page):
+                    text_pages += 1
+                elif _image_coverage(page) >= MIN_IMAGE_COVERAGE:
+                    image_pages += 1
+                page.close()
+    except (*PDF_READ_ERRORS, PDFException) as e:
+        # pdfminer's syntax, password and encryption errors all derive from PDFException
+        raise UnreadablePDF(f"PDF could not be opened (encrypted or malformed): {e.__class__.__name__}")
+
+    if text_pages == len(indexes):
+        path = TEXT
+    elif text_pages == 0:
+        path = OCR
+    else:
+        path = MIXED
+    return ProbeResult(path, page_count, text_pages, image_pages, len(indexes))
+
+
+def _split_lines(txt):
+    for l in txt.split("\n"):
+        l = l.strip()
+        if l:
+            yield l
+
+
+def _region_lines(region, page_no, read_box, read_positioned, read_above=None):
+    """
+    Lines of one page read through a TableRegion: the cropped read when the
+    region has a box for the page and the read can be trusted (see
+    ``TableRegion.crop_problem``), otherwise a full read with line
+    positions, which (re)learns the band. ``read_above(bbox)`` reads the
+    strip above the box, for pages where that is cheap.
+    """
+    bbox = region.bbox_for(page_no)
+    if bbox:
+        lines = list(_split_lines(read_box(bbox) or ""))
+        above = (lambda: read_above(bbox)) if read_above and bbox[1] > 0 else None
+        problem = region.crop_problem(lines, above)
+        if problem is None:
+            return lines
+        print(f"Page {page_no} re-read in full: {problem}.")
+        region.forget()
+    return region.learn(page_no, read_positioned())
+
+
+def _crop_page(page, bbox):
+    x0, top, x1, bottom = page.bbox
+    width, height = x1 - x0, bottom - top
+    return page.within_bbox((
+        x0 + bbox[0] * width, top + bbox[1] * height,
+        x0 + bbox[2] * width, top + bbox[3] * height,
+    ))
+
+
+def _positioned_text_lines(page):
+    top, height = float(page.bbox[1]), float(page.height) or 1.0
+    return [
+        (line["text"], (float(line["top"]) - top) / height, (float(line["bottom"]) - top) / height)
+        for line in page.extract_text_lines(return_chars=False)
+        if line["text"].strip()
+    ]
+
+
+def _text_page_lines(page, page_no, region=None):
+    if region is None:
+        return list(_split_lines(page.extract_text() or ""))
+    return _region_lines(
+        region, page_no,
+        lambda bbox: _crop_page(page, bbox).extract_text(),
+        lambda: _positioned_text_lines(page),
+        lambda bbox: _crop_page(page, (bbox[0], 0.0, bbox[2], bbox[1])).extract_text(),
+    )
+
+
+def _ocr_page(pdf, page_no, region=None):
+    """
+    Lines of one page read by OCR (see ocr.py); a region limits OCR to
+    its part of the page.
+    """
+    with stage_slot("ocr"):
+        if region is None:
+            return [text for text, _, _ in ocr_page_lines(pdf, page_no)]
+        return _region_lines(
+            region, page_no,
+            lambda bbox: "\n".join(text for text, _, _ in ocr_page_lines(pdf, page_no, bbox)),
+            lambda: ocr_page_lines(pdf, page_no),
+        )
+
+
+def _iter_ocr_lines(pdf, page_numbers=None, region=None, page_count=None):
+    try:
+        if page_numbers is None:
+            page_numbers = range(1, pdfinfo_from_path(pdf)["Pages"] + 1)
+            page_count = len(page_numbers)
+        for page_no in page_numbers:
+            lines = _ocr_page(pdf, page_no, region)
+            report_pages(pdf, page_no, page_count or page_no)
+            yield from lines
+    except OCR_ERRORS as e:
+        print(f"Error during OCR for {pdf}: {e}")
+
+
+def iter_text_lines(pdf, path=None, region=None):
+    """
+    Yield the stripped, non-empty text lines of a PDF one page at a time.
+
+    ``path`` comes from probe_pdf (probed here when not given): TEXT reads
+    the text layer, OCR renders and OCRs every page without trying
+    pdfplumber first, MIXED decides per page. Only one rendered page image
+    is alive at a time. A TableRegion (see regions.py) limits both paths to
+    the statement's table area.
+    """
+    if path is None:
+        path = probe_pdf(pdf).path
+
+    if path == OCR:
+        yield from _iter_ocr_lines(pdf, region=region)
+        return
+
+    found_text = False
+    try:
+        with pdfplumber.open(pdf) as p:
+            page_count = len(p.pages)
+            for page_no, page in enumerate(p.pages, start=1):
+                if path == MIXED and not _has_text_layer(page):
+                    page.close()
+                    yield from _iter_ocr_lines(pdf, [page_no], region, page_count)
+                    continue
+                # Slots are taken per page so concurrent runs interleave
+                with stage_slot("extraction"):
+                    lines = _text_page_lines(page, page_no, region)
+                # Drop the page's parsed objects before moving on
+                page.close()
+                report_pages(pdf, page_no, page_count)
+                for l in lines:
+                    found_text = True
+                    yield l
+    except PDF_READ_ERRORS:
+        pass
+
+    if path == TEXT and not found_text:
+        # The sampled pages lied; keep the old whole-document OCR fallback
+        yield from _iter_ocr_lines(pdf, region=region)
+
+
+def extract_text_lines(pdf, path=None, region=None):
+    return list(iter_text_lines(pdf, path, region))
+
+
+def first_page_text(pdf, path=None):
+    """
+    Text of the first page only, for format detection. Documents probed as
+    OCR go straight to OCR of that single page.
+    """
+    if path != OCR:
+        try:
+            with pdfplumber.open(pdf) as p:
+                if not p.pages:
+                    return ""
+                with stage_slot("extraction"):
+                    txt = p.pages[0].extract_text()
+                if txt and txt.strip():
+                    return txt
+        except PDF_READ_ERRORS:
+            return ""
+
+    try:
+        return "\n".join(_ocr_page(pdf, 1))
+    except OCR_ERRORS as e:
+        print(f"Error during first-page OCR for {pdf}: {e}")
+        return ""
@@ -0,0 +1,118 @@
+"""
+Registry of known statement layouts.
+
+Each format declares cheap fingerprint patterns that are searched in the
+text of the first page only, together with the compiled parser for the
+whole document. The format is picked before the full document is
+extracted. A statement that no registered format recognises is rejected
+without a full extraction or OCR pass.
+"""
+import re
+
+from .parsers import (
+    BANK_DT_FORMAT, HOTEL_DT_FORMAT,
+    bank_pattern, card_type_header_pattern, hotel_txn_pattern, card_num_pattern, check_ref_pattern,
+    bank_df, hotel_df, iter_bank_rows, iter_hotel_rows,
+)
+
+
+def _multiline(pattern):
+    """Line-anchored pattern reused for searching a whole page of text."""
+    return re.compile(pattern.pattern, pattern.flags | re.MULTILINE)
+
+
+class StatementFormat:
+    def __init__(self, name, kind, fingerprints, row_parser, frame_parser, dt_format, min_hits=1,
+                 region_patterns=(), table_region=None):
+        self.name = name
+        self.kind = kind
+        self.fingerprints = fingerprints
+        self.min_hits = min_hits
+        # row_parser: lines, rules -> iterable of rows (used by streaming mode)
+        # frame_parser: lines, rules -> typed DataFrame with DT; rules is
+        # the client's CardRules (None for the defaults)
+        self.row_parser = row_parser
+        self.frame_parser = frame_parser
+        self.dt_format = dt_format
+        # region_patterns: lines the parser uses, for learning the table
+        # region (see regions.py); table_region: fixed (x0, top, x1, bottom)
+        # box in page fractions instead
+        self.region_patterns = region_patterns
+        self.table_region = table_region
+
+    def matches(self, first_page_text):
+        hits = 0
+        for fingerprint in self.fingerprints:
+            if fingerprint.search(first_page_text):
+                hits += 1
+                if hits >= self.min_hits:
+                    return True
+        return False
+
+    def iter_rows(self, lines, rules=None):
+        return self.row_parser(lines, rules=rules)
+
+    def parse(self, lines, rules=None):
+        return self.frame_parser(lines, rules=rules)
+
+    def __repr__(self):
+        return f"<StatementFormat {self.kind}:{self.name}>"
+
+
+_registry = {"bank": [], "hotel": []}
+
+
+def register_format(fmt):
+    """Add a format; formats are tried in registration order."""
+    _registry[fmt.kind].append(fmt)
+    return fmt
+
+
+def get_formats(kind):
+    return list(_registry[kind])
+
+
+def detect_format(first_page_text, kind):
+    """First registered format of ``kind`` that recognises the page, or None."""
+    if not first_page_text:
+        return None
+    for fmt in _registry[kind]:
+        if fmt.matches(first_page_text):
+            return fmt
+    return None
+
+
+# ===============================
+# Built-in formats
+# ===============================
+ACQUIRER_SETTLEMENT = register_format(StatementFormat(
+    name="acquirer_settlement",
+    kind="bank",
+    fingerprints=[
+        re.compile(r"TERMINAL ID \S+"),
+        card_type_header_pattern,
+        _multiline(bank_pattern),
+    ],
+    min_hits=2,
+    row_parser=iter_bank_rows,
+    frame_parser=bank_df,
+    dt_format=BANK_DT_FORMAT,
+    # Rows, card-type headers and the MERCHANT ID / TERMINAL ID lines
+    region_patterns=[bank_pattern, card_type_header_pattern, re.compile(r"ID \S+")],
+))
+
+OPERA_CASHIER_REPORT = register_format(StatementFormat(
+    name="opera_cashier_report",
+    kind="hotel",
+    fingerprints=[
+        _multiline(hotel_txn_pattern),
+        re.compile(r"\bQAR\b"),
+        _multiline(card_num_pattern),
+    ],
+    min_hits=2,
+    row_parser=iter_hotel_rows,
+    frame_parser=hotel_df,
+    dt_format=HOTEL_DT_FORMAT,
+    # Rows and their CHECK# / masked card continuation lines
+    region_patterns=[hotel_txn_pattern, card_num_pattern, check_ref_pattern],
+))
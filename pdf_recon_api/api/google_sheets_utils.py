@@ -1,16 +1,38 @@
 from django.conf import settings
 from datetime import datetime
+from google.auth.credentials import AnonymousCredentials
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 
+# Path of each API under its root URL, kept when GOOGLE_API_ENDPOINT is set
+SERVICE_PATHS = {"drive": "drive/v3/", "sheets": ""}
+
+
+def build_service(api, version, creds=None):
+    """
+    ``build()`` that honours GOOGLE_API_ENDPOINT. When it is set (a local
+    stand-in such as ``manage.py fake_google``), requests go there without
+    credentials.
+    """
+    endpoint = getattr(settings, "GOOGLE_API_ENDPOINT", None)
+    if not endpoint:
+        return build(api, version, credentials=creds, cache_discovery=False)
+    return build(
+        api, version, credentials=AnonymousCredentials(), cache_discovery=False,
+        client_options={"api_endpoint": f"{endpoint.rstrip('/')}/{SERVICE_PATHS.get(api, '')}"},
+    )
+
+
 # 1️⃣ Sheets API service create karne ka function
 def get_sheets_service():
+    if getattr(settings, "GOOGLE_API_ENDPOINT", None):
+        return build_service('sheets', 'v4')
     creds = Credentials.from_service_account_file(
         settings.GOOGLE_SERVICE_ACCOUNT_FILE, scopes=SCOPES
     )
-    service = build('sheets', 'v4', credentials=creds)
+    service = build_service('sheets', 'v4', creds)
     return service
 
 # 2️⃣ New tab create karne ka function
@@ -0,0 +1,221 @@
+"""
+Run history: per-card-type totals and stage timings recorded on each run,
+and the per-client daily rollups that the history API reads.
+
+Rollups are incremented once, when a run completes, so time series over
+thousands of runs are a handful of indexed rows per day instead of a scan
+of the run table.
+"""
+import time
+from contextlib import contextmanager
+from datetime import date
+
+from django.db import transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncMonth, TruncWeek
+from django.utils import timezone
+
+from .progress import publish
+from .models import ClientRollup, ReconciliationRecord
+
+GRANULARITIES = {"day": None, "week": TruncWeek, "month": TruncMonth}
+MAX_HISTORY_RUNS = 500
+
+ROLLUP_FIELDS = (
+    "runs", "transactions",
+    "reconciled_count", "reconciled_amount",
+    "unreconciled_bank_count", "unreconciled_bank_amount",
+    "unreconciled_hotel_count", "unreconciled_hotel_amount",
+    "total_duration_seconds",
+)
+
+
+class InvalidHistoryQuery(ValueError):
+    pass
+
+
+class StageTimer:
+    """
+    Accumulates wall time per pipeline stage into ``run.stage_timings``.
+    ``mark(stage)`` charges the time since the previous mark; ``stage(name)``
+    times a block, and is safe for stages running in parallel threads.
+    Both publish stage progress events for the run being tracked.
+    """
+
+    def __init__(self, run):
+        if not isinstance(run.stage_timings, dict):
+            run.stage_timings = {}
+        self.timings = run.stage_timings
+        self._last = time.monotonic()
+
+    def _add(self, stage, seconds):
+        self.timings[stage] = round(self.timings.get(stage, 0.0) + seconds, 3)
+
+    def mark(self, stage):
+        now = time.monotonic()
+        seconds = now - self._last
+        self._add(stage, seconds)
+        self._last = now
+        publish("stage.finished", stage=stage, seconds=round(seconds, 3))
+
+    @contextmanager
+    def stage(self, stage):
+        publish("stage.started", stage=stage)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - started
+            self._add(stage, seconds)
+            publish("stage.finished", stage=stage, seconds=round(seconds, 3))
+
+
+def card_type_totals(final_card_types, totals):
+    """
+    Per-card-type counts and amounts from ``totals``
+    (``{category: {card_type: (entries, amount)}}``). Reconciled amounts are
+    bank gross amounts; the hotel side of a pair is the same.
+    """
+    result = {}
+    for card_type in final_card_types:
+        rec = totals["rec_bank"].get(card_type, (0, 0.0))
+        ub = totals["un_bank"].get(card_type, (0, 0.0))
+        uh = totals["un_hotel"].get(card_type, (0, 0.0))
+        result[card_type] = {
+            "reconciledCount": rec[0],
+            "reconciledAmount": round(float(rec[1]), 2),
+            "unreconciledBankCount": ub[0],
+            "unreconciledBankAmount": round(float(ub[1]), 2),
+            "unreconciledHotelCount": uh[0],
+            "unreconciledHotelAmount": round(float(uh[1]), 2),
+        }
+    return result
+
+
+def _increments(totals):
+    return {
+        "reconciled_count": totals.get("reconciledCount", 0),
+        "reconciled_amount": totals.get("reconciledAmount", 0.0),
+        "unreconciled_bank_count": totals.get("unreconciledBankCount", 0),
+        "unreconciled_bank_amount": totals.get("unreconciledBankAmount", 0.0),
+        "unreconciled_hotel_count": totals.get("unreconciledHotelCount", 0),
+        "unreconciled_hotel_amount": totals.get("unreconciledHotelAmount", 0.0),
+    }
+
+
+def update_rollups(record):
+    """Add one completed run to its client's rollups for the day it finished."""
+    day = timezone.localdate(record.finished_at or timezone.now())
+    duration = record.duration_seconds or 0.0
+    per_card = {card_type: _increments(t) for card_type, t in (record.card_type_totals or {}).items()}
+
+    overall = {field: 0 for field in _increments({})}
+    for inc in per_card.values():
+        for field, value in inc.items():
+            overall[field] += value
+        # Bank transactions of this card type, and the run they came from
+        inc.update(
+            runs=1,
+            transactions=inc["reconciled_count"] + inc["unreconciled_bank_count"],
+            total_duration_seconds=duration,
+        )
+    overall.update(runs=1, transactions=record.total_transactions, total_duration_seconds=duration)
+    per_card[ClientRollup.ALL_CARD_TYPES] = overall
+
+    with transaction.atomic():
+        for card_type, inc in per_card.items():
+            rollup, _ = ClientRollup.objects.get_or_create(
+                client_name=record.client_name, day=day, card_type=card_type
+            )
+            # F() increments: concurrent runs finishing the same day both count
+            ClientRollup.objects.filter(pk=rollup.pk).update(
+                **{field: F(field) + value for field, value in inc.items()}
+            )
+
+
+def _parse_date(value, name):
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise InvalidHistoryQuery(f"{name} must be a date (YYYY-MM-DD).")
+
+
+def rollup_series(client_name=None, granularity="day", date_from=None, date_to=None, card_type=None):
+    """
+    Time series of rollup totals, one point per period (and per client when
+    no client is given). ``card_type`` defaults to the all-card-types row.
+    """
+    if granularity not in GRANULARITIES:
+        raise InvalidHistoryQuery(f"granularity must be one of: {', '.join(GRANULARITIES)}.")
+    date_from = _parse_date(date_from, "date_from")
+    date_to = _parse_date(date_to, "date_to")
+
+    rollups = ClientRollup.objects.filter(card_type=(card_type or ClientRollup.ALL_CARD_TYPES).upper())
+    if client_name:
+        rollups = rollups.filter(client_name=client_name)
+    if date_from:
+        rollups = rollups.filter(day__gte=date_from)
+    if date_to:
+        rollups = rollups.filter(day__lte=date_to)
+
+    trunc = GRANULARITIES[granularity]
+    period = trunc("day") if trunc else F("day")
+    rows = (
+        rollups.annotate(period=period)
+        .values("client_name", "period")
+        .annotate(**{field: Sum(field) for field in ROLLUP_FIELDS})
+        .order_by("client_name", "period")
+    )
+    return [
+        {
+            "clientName": row["client_name"],
+            "period": row["period"],
+            "runs": row["runs"],
+            "transactions": row["transactions"],
+            "reconciledCount": row["reconciled_count"],
+            "reconciledAmount": round(row["reconciled_amount"], 2),
+            "unreconciledBankCount": row["unreconciled_bank_count"],
+            "unreconciledBankAmount": round(row["unreconciled_bank_amount"], 2),
+            "unreconciledHotelCount": row["unreconciled_hotel_count"],
+            "unreconciledHotelAmount": round(row["unreconciled_hotel_amount"], 2),
+            "avgDurationSeconds": round(row["total_duration_seconds"] / row["runs"], 2) if row["runs"] else None,
+        }
+        for row in rows
+    ]
+
+
+def run_history(client_name=None, limit=50, before=None):
+    """
+    Most recent runs first, with their card-type totals and stage timings.
+    Pass the last ``id`` of a page as ``before`` to get the next one.
+    """
+    try:
+        limit = max(1, min(int(limit), MAX_HISTORY_RUNS))
+        before = int(before) if before not in (None, "") else None
+    except (TypeError, ValueError):
+        raise InvalidHistoryQuery("limit and before must be integers.")
+
+    runs = ReconciliationRecord.objects.all()
+    if client_name:
+        runs = runs.filter(client_name=client_name)
+    if before is not None:
+        runs = runs.filter(pk__lt=before)
+    runs = runs.order_by("-pk").defer("result")[:limit]
+    return [
+        {
+            "id": run.pk,
+            "clientName": run.client_name,
+            "status": run.status,
+            "processedAt": run.processed_at,
+            "finishedAt": run.finished_at,
+            "minDate": run.min_date,
+            "maxDate": run.max_date,
+            "totalTransactions": run.total_transactions,
+            "durationSeconds": run.duration_seconds,
+            "cardTypes": run.card_type_totals,
+            "stageTimings": run.stage_timings,
+        }
+        for run in runs
+    ]
@@ -0,0 +1,360 @@
+"""
+Hot folders: unattended reconciliation of statements dropped into
+directories (``python manage.py recon_hotfolder``).
+
+Each entry of RECON_HOT_FOLDERS is a dict:
+
+    {
+        "path": "/srv/drop/grand",      # required
+        "client_name": "grand",         # default: the pattern's "client" group
+        "bank_pattern": r"...",         # default: BANK_PATTERN
+        "hotel_pattern": r"...",        # default: HOTEL_PATTERN
+        "threshold_time": 30,           # minutes, as in POST /api/reconcile/
+    }
+
+Patterns are matched against file names, case-insensitively. A bank file
+and a hotel file with the same client and ``date`` group form a pair:
+``grand_bank_2025-06.pdf`` goes with ``grand_hotel_2025-06.pdf``. When a
+key has several files, the newest one is used.
+
+- Debouncing: a file must keep the same size and mtime for
+  RECON_HOT_FOLDER_SETTLE seconds, so a copy still in progress is never
+  read.
+- At most once: a pair is claimed by inserting its HotFolderJob row, which
+  is unique per client and the two files' SHA-256. A pair dropped again
+  unchanged, or picked up by a second daemon, is skipped. A run cut short
+  by a crash is not repeated; delete its job in the admin to run it again.
+- Each pair goes through the same pipeline as POST /api/reconcile/ (run
+  claim, scheduler admission, stage slots, progress events, webhooks) on a
+  pool of RECON_HOT_FOLDER_WORKERS threads.
+- Results are written next to the inputs: ``<client>_<date>_reconciliation``
+  ``.xlsx`` and ``.html``, plus a ``.json`` with the API response (or the
+  error).
+"""
+import json
+import os
+import re
+import shutil
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from rest_framework.response import Response
+
+from .events import track_progress
+from .models import HotFolderJob
+from .run_lock import claim_run, finish_run, run_content_hash
+from .scheduler import SchedulerBusy, get_scheduler
+from .storage import CHUNK_SIZE, file_sha256
+from .views import (
+    attach_to_run, build_report, render_outputs, report_response, save_uploaded_files, start_shadow_run,
+)
+
+STATEMENT_EXTENSIONS = r"\.(?:pdf|csv|xlsx|xls)$"
+BANK_PATTERN = r"^(?P<client>.+?)[ _.-]+bank[ _.-]+(?P<date>\d{4}-?\d{2}(?:-?\d{2})?)" + STATEMENT_EXTENSIONS
+HOTEL_PATTERN = r"^(?P<client>.+?)[ _.-]+(?:hotel|pms)[ _.-]+(?P<date>\d{4}-?\d{2}(?:-?\d{2})?)" + STATEMENT_EXTENSIONS
+RESULT_SUFFIX = "_reconciliation"
+
+
+class HotFolderConfigError(ValueError):
+    pass
+
+
+class FolderFile:
+    """A statement in a hot folder, standing in for an uploaded file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.sha256 = file_sha256(path)
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        with open(self.path, "rb") as f:
+            yield from iter(lambda: f.read(chunk_size), b"")
+
+
+class HotFolder:
+    def __init__(self, path, client_name=None, bank_pattern=BANK_PATTERN, hotel_pattern=HOTEL_PATTERN,
+                 threshold_time=30):
+        if not path:
+            raise HotFolderConfigError("Every hot folder needs a path.")
+        self.path = os.path.abspath(str(path))
+        self.client_name = (client_name or "").strip() or None
+        try:
+            self.patterns = {
+                "bank": re.compile(bank_pattern, re.IGNORECASE),
+                "hotel": re.compile(hotel_pattern, re.IGNORECASE),
+            }
+        except re.error as e:
+            raise HotFolderConfigError(f"Hot folder {self.path}: bad pattern: {e}")
+        for kind, pattern in self.patterns.items():
+            if self.client_name is None and "client" not in pattern.groupindex:
+                raise HotFolderConfigError(
+                    f"Hot folder {self.path}: set client_name or give the {kind} pattern a 'client' group."
+                )
+        try:
+            self.threshold_time = int(threshold_time)
+        except (TypeError, ValueError):
+            raise HotFolderConfigError(f"Hot folder {self.path}: threshold_time must be whole minutes.")
+
+    def classify(self, name):
+        """``(kind, client, key)`` of a statement file name, or None."""
+        for kind, pattern in self.patterns.items():
+            match = pattern.search(name)
+            if match:
+                groups = match.groupdict()
+                client = self.client_name or groups.get("client", "").strip()
+                return kind, client, groups.get("date") or ""
+        return None
+
+
+def load_hot_folders(entries=None):
+    entries = getattr(settings, "RECON_HOT_FOLDERS", []) if entries is None else entries
+    folders = []
+    for entry in entries:
+        if isinstance(entry, (str, os.PathLike)):
+            entry = {"path": entry}
+        try:
+            folders.append(HotFolder(**entry))
+        except TypeError as e:
+            raise HotFolderConfigError(f"Hot folder {entry!r}: {e}")
+    return folders
+
+
+class FolderWatcher:
+    """
+    Scans the hot folders and returns pairs whose files have settled. A pair
+    is returned once per version (mtime) of its two files.
+    """
+
+    def __init__(self, folders, settle=None):
+        self.folders = folders
+        self.settle = getattr(settings, "RECON_HOT_FOLDER_SETTLE", 30) if settle is None else settle
+        # path -> (size, mtime_ns, first seen with them)
+        self._seen = {}
+        # (bank path, hotel path) -> (bank mtime, hotel mtime) last returned
+        self._returned = {}
+
+    def _settled(self, path, now):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        version = (stat.st_size, stat.st_mtime_ns)
+        seen = self._seen.get(path)
+        if seen is None or seen[:2] != version:
+            self._seen[path] = (*version, now)
+            return False
+        return bool(stat.st_size) and now - seen[2] >= self.settle
+
+    def scan(self, now=None):
+        """``[(folder, client, key, bank path, hotel path)]`` ready to process."""
+        now = time.monotonic() if now is None else now
+        ready, present = [], set()
+        for folder in self.folders:
+            # (client, key) -> {kind: (mtime, path)} of the newest file
+            candidates = {}
+            try:
+                entries = list(os.scandir(folder.path))
+            except OSError as e:
+                print(f"Hot folder {folder.path} cannot be read: {e}")
+                continue
+            for entry in entries:
+                found = None if entry.name.startswith(".") else folder.classify(entry.name)
+                if not found or not entry.is_file():
+                    continue
+                kind, client, key = found
+                try:
+                    mtime = entry.stat().st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                present.add(entry.path)
+                newest = candidates.setdefault((client, key), {}).get(kind)
+                if newest is None or mtime > newest[0]:
+                    candidates[(client, key)][kind] = (mtime, entry.path)
+
+            for (client, key), files in candidates.items():
+                if len(files) < 2:
+                    continue
+                (bank_mtime, bank_path), (hotel_mtime, hotel_path) = files["bank"], files["hotel"]
+                # Both are looked at, so each one's settle time starts now
+                settled = [self._settled(bank_path, now), self._settled(hotel_path, now)]
+                if not all(settled) or self._returned.get((bank_path, hotel_path)) == (bank_mtime, hotel_mtime):
+                    continue
+                self._returned[(bank_path, hotel_path)] = (bank_mtime, hotel_mtime)
+                ready.append((folder, client, key, bank_path, hotel_path))
+
+        # Forget files that went away
+        self._seen = {path: seen for path, seen in self._seen.items() if path in present}
+        self._returned = {
+            paths: version for paths, version in self._returned.items() if paths[0] in present and paths[1] in present
+        }
+        return ready
+
+    def retry(self, bank_path, hotel_path):
+        """Return the pair again on the next scan."""
+        self._returned.pop((bank_path, hotel_path), None)
+
+
+def _result_base(folder, client_name, key):
+    stem = re.sub(r"[^\w.-]+", "_", f"{client_name}_{key}" if key else client_name).strip("_")
+    return os.path.join(folder.path, stem + RESULT_SUFFIX)
+
+
+def _place(src, dest):
+    """Hard link (or copy) ``src`` to ``dest``, replacing it."""
+    tmp = f"{dest}.tmp"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
+def _write_json(path, payload):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(payload, f, indent=2, default=str)
+    os.replace(tmp, path)
+
+
+def _run_pair(job, folder, bank, hotel):
+    """The reconcile pipeline for a claimed pair; returns ``(response, report)``."""
+    report = None
+    run, claimed = claim_run(
+        job.client_name, run_content_hash(bank.sha256, hotel.sha256, folder.threshold_time), bank.name, hotel.name,
+    )
+    HotFolderJob.objects.filter(pk=job.pk).update(run=run)
+    if not claimed:
+        return attach_to_run(run), None
+
+    response = None
+    try:
+        with track_progress(run):
+            bank_file_path, hotel_file_path = save_uploaded_files(bank, hotel)
+            report = build_report(
+                run, job.client_name, folder.threshold_time, bank_file_path, hotel_file_path, bank, hotel,
+            )
+            if isinstance(report, Response):
+                response, report = report, None
+            else:
+                start_shadow_run(report)
+                response = report_response(None, report, render_outputs(report))
+    finally:
+        finish_run(run, response)
+    return response, report
+
+
+def process_pair(job, folder, bank, hotel):
+    """Run a claimed pair and write its results next to the inputs."""
+    base = _result_base(folder, job.client_name, job.pair_key)
+    status, error, response = HotFolderJob.Status.FAILED, "", None
+    try:
+        with get_scheduler().admit(job.client_name):
+            response, report = _run_pair(job, folder, bank, hotel)
+        if report is not None:
+            _place(report.report_path, base + ".xlsx")
+            _place(report.html_path, base + ".html")
+        if response.status_code == 200:
+            status = HotFolderJob.Status.DONE
+        else:
+            error = str(response.data.get("error", "")) if isinstance(response.data, dict) else ""
+        _write_json(base + ".json", {"statusCode": response.status_code, **(response.data or {})})
+    except SchedulerBusy:
+        # Nothing ran: release the claim so a later scan tries again
+        HotFolderJob.objects.filter(pk=job.pk).delete()
+        print(f"Hot folder pair {job.client_name} {job.pair_key} deferred: server busy.")
+        return None
+    except Exception as e:
+        error = str(e)
+        print(f"Error reconciling hot folder pair {job.client_name} {job.pair_key}: {e}")
+        try:
+            _write_json(base + ".json", {"statusCode": 500, "error": error})
+        except OSError:
+            pass
+    HotFolderJob.objects.filter(pk=job.pk).update(
+        status=status, error=error, status_code=response.status_code if response is not None else None,
+        result_path=base + ".json", finished_at=timezone.now(),
+    )
+    print(f"Hot folder pair {job.client_name} {job.pair_key}: {status}"
+          + (f" ({error})" if error else "") + f" -> {base}.json")
+    return status
+
+
+def claim_pair(folder, client_name, key, bank_path, hotel_path):
+    """
+    The HotFolderJob and both files for a new pair, or None when the same
+    files were claimed before (here or by another daemon).
+    """
+    bank, hotel = FolderFile(bank_path), FolderFile(hotel_path)
+    try:
+        # Its own savepoint, so a lost claim leaves any outer transaction usable
+        with transaction.atomic():
+            job = HotFolderJob.objects.create(
+                folder=folder.path, client_name=client_name, pair_key=key,
+                bank_path=bank_path, hotel_path=hotel_path, bank_sha256=bank.sha256, hotel_sha256=hotel.sha256,
+                worker=f"{socket.gethostname()}:{os.getpid()}",
+            )
+    except IntegrityError:
+        return None
+    return job, bank, hotel
+
+
+class HotFolderDaemon:
+    def __init__(self, folders, workers=None, poll=None, settle=None):
+        self.watcher = FolderWatcher(folders, settle)
+        self.poll = getattr(settings, "RECON_HOT_FOLDER_POLL", 10) if poll is None else poll
+        workers = workers or getattr(settings, "RECON_HOT_FOLDER_WORKERS", 2)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="hotfolder")
+        self.stopping = threading.Event()
+        self.futures = set()
+
+    def _job(self, folder, client_name, key, bank_path, hotel_path):
+        try:
+            claimed = claim_pair(folder, client_name, key, bank_path, hotel_path)
+            if claimed is None:
+                return None
+            job, bank, hotel = claimed
+            status = process_pair(job, folder, bank, hotel)
+            if status is None:
+                self.watcher.retry(bank_path, hotel_path)
+            return status
+        except Exception as e:
+            print(f"Error in hot folder job {bank_path} + {hotel_path}: {e}")
+        finally:
+            connection.close()
+
+    def scan_once(self):
+        """Submit every settled new pair; returns the futures."""
+        submitted = []
+        for folder, client_name, key, bank_path, hotel_path in self.watcher.scan():
+            future = self.executor.submit(self._job, folder, client_name, key, bank_path, hotel_path)
+            self.futures.add(future)
+            future.add_done_callback(self.futures.discard)
+            submitted.append(future)
+        return submitted
+
+    def run(self, once=False):
+        """Scan every ``poll`` seconds until stop(); ``once`` waits for files to settle, then returns."""
+        try:
+            if once:
+                # Two looks, a settle period apart, tell which files are complete
+                self.scan_once()
+                self.stopping.wait(self.watcher.settle)
+                if not self.stopping.is_set():
+                    self.scan_once()
+                return
+            while not self.stopping.is_set():
+                self.scan_once()
+                self.stopping.wait(self.poll)
+        finally:
+            # Running pairs are finished, not abandoned
+            self.executor.shutdown(wait=True)
+
+    def stop(self):
+        self.stopping.set()
@@ -0,0 +1,39 @@
+"""
+``Idempotency-Key`` support for POST /api/reconcile/.
+
+Successful responses are cached under the client's key combined with the
+run's content hash (both uploads plus parameters), so a retried request is
+answered from the cache without recomputing or writing another run folder.
+Entries expire after RECON_IDEMPOTENCY_TTL seconds.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+
+def get_idempotency_cache():
+    try:
+        return caches["idempotency"]
+    except InvalidCacheBackendError:
+        return caches["default"]
+
+
+def idempotency_cache_key(idempotency_key, client_name, content_hash):
+    raw = f"{idempotency_key}:{client_name}:{content_hash}"
+    return "recon-idem:" + hashlib.sha256(raw.encode()).hexdigest()
+
+
+def get_cached_response(cache_key):
+    """Return ``(data, status)`` stored for ``cache_key``, or None."""
+    return get_idempotency_cache().get(cache_key)
+
+
+def store_response(cache_key, response):
+    if response.status_code != 200:
+        return
+    ttl = getattr(settings, "RECON_IDEMPOTENCY_TTL", 24 * 60 * 60)
+    get_idempotency_cache().set(cache_key, (response.data, response.status_code), ttl)
@@ -0,0 +1,290 @@
+"""
+Statement ingestion: turns an uploaded file into the typed bank or hotel
+frame that the matcher expects.
+
+PDFs go through text extraction and the line parsers. CSV and XLSX exports
+(bank portals, Opera PMS) are read directly with pandas and mapped onto
+``BANK_COLUMNS`` / ``HOTEL_COLUMNS`` column by column, so no regex runs per
+row. Each tabular format declares the source header for every target column;
+formats are tried in order and the first whose required headers are present
+is used. Extra formats can be added through RECON_TABULAR_FORMATS.
+
+Anything that cannot be read as the detected type (a ZIP that is not a
+workbook, a damaged workbook, a CSV in an unknown encoding) is rejected
+with UnsupportedStatementFormat, which the view turns into a 400.
+"""
+import csv
+import os
+import zipfile
+from itertools import islice
+from xml.etree.ElementTree import ParseError
+
+import pandas as pd
+from django.conf import settings
+from openpyxl.utils.exceptions import InvalidFileException
+
+from .extraction import extract_text_lines, first_page_text
+from .formats import detect_format
+from .regions import region_for
+from .parsers import BANK_COLUMNS, HOTEL_COLUMNS, DEFAULT_CARD_RULES
+
+PDF, CSV, XLSX = "pdf", "csv", "xlsx"
+
+# Display formats the PDF parsers produce, so reports look the same
+BANK_DATE_DISPLAY = "%d/%m/%Y"
+HOTEL_DATE_DISPLAY = "%d/%m/%y"
+TIME_DISPLAY = "%H:%M"
+
+HEADER_SCAN_ROWS = 30
+
+# Tried in order; bank portals and older Opera versions export Windows-1252
+CSV_ENCODINGS = ("utf-8-sig", "cp1252")
+
+# What pandas/openpyxl raise for a damaged workbook or a malformed CSV
+READ_ERRORS = (zipfile.BadZipFile, KeyError, ValueError, ParseError, InvalidFileException, csv.Error)
+
+# kind -> format name -> spec. "columns" maps target column -> source header
+# (None = not present in this export). Dates are parsed from "date"/"time"
+# or a combined "datetime" source with the given format.
+TABULAR_FORMATS = {
+    "bank": {
+        "acquirer_export": {
+            "columns": {
+                "Merchant ID": "Merchant ID",
+                "Invoice No / RRN": "RRN",
+                "Card Number": "Card Number",
+                "Card Type (On us/Off us)": "Card Type",
+                "Gross Amount": "Gross Amount",
+                "Commission": "Commission",
+                "Net Amount": "Net Amount",
+                "Terminal ID": "Terminal ID",
+            },
+            "date": "Transaction Date",
+            "time": "Transaction Time",
+            "datetime_format": "%d/%m/%Y %H:%M",
+        },
+        # Our own attachment layout, e.g. re-ingesting an earlier report
+        "recon_report": {
+            "columns": {col: col for col in BANK_COLUMNS if col not in ("Transaction Date", "Time")},
+            "date": "Transaction Date",
+            "time": "Time",
+            "datetime_format": "%d/%m/%Y %H:%M",
+        },
+    },
+    "hotel": {
+        "opera_export": {
+            "columns": {
+                "Room No": "Room",
+                "Name": "Guest Name",
+                "Card Reference": "Card Number",
+                "Card Type": "Payment Method",
+                "Amount": "Credit",
+                "Cashier ID": "Cashier",
+            },
+            "date": "Date",
+            "time": "Time",
+            "datetime_format": "%d/%m/%Y %H:%M",
+        },
+        "recon_report": {
+            "columns": {col: col for col in HOTEL_COLUMNS if col not in ("Transaction Date", "Time")},
+            "date": "Transaction Date",
+            "time": "Time",
+            "datetime_format": "%d/%m/%y %H:%M",
+        },
+    },
+}
+
+
+class UnsupportedStatementFormat(ValueError):
+    pass
+
+
+def detect_upload_type(path):
+    """Sniff the first bytes; fall back to the extension for text files."""
+    with open(path, "rb") as f:
+        head = f.read(8)
+    if head.startswith(b"%PDF"):
+        return PDF
+    if head.startswith(b"PK\x03\x04"):
+        if not _is_workbook(path):
+            raise UnsupportedStatementFormat(
+                f"{os.path.basename(path)} is a ZIP archive but not an XLSX workbook."
+            )
+        return XLSX
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".csv", ".txt"):
+        return CSV
+    if ext == ".pdf":
+        return PDF
+    raise UnsupportedStatementFormat(f"Unsupported file type for {os.path.basename(path)}.")
+
+
+def _is_workbook(path):
+    try:
+        with zipfile.ZipFile(path) as z:
+            return "xl/workbook.xml" in z.namelist()
+    except zipfile.BadZipFile:
+        return False
+
+
+def csv_encoding(path):
+    """The first of CSV_ENCODINGS that decodes the whole file."""
+    for encoding in CSV_ENCODINGS:
+        try:
+            with open(path, encoding=encoding, newline="") as f:
+                while f.read(1 << 20):
+                    pass
+        except UnicodeDecodeError:
+            continue
+        return encoding
+    raise UnsupportedStatementFormat(
+        f"{os.path.basename(path)} is not UTF-8 or Windows-1252 text."
+    )
+
+
+def get_tabular_formats(kind):
+    formats = dict(TABULAR_FORMATS[kind])
+    formats.update(getattr(settings, "RECON_TABULAR_FORMATS", {}).get(kind, {}))
+    return formats
+
+
+def _required_headers(spec):
+    headers = [src for src in spec["columns"].values() if src]
+    headers += [spec[k] for k in ("date", "time", "datetime") if spec.get(k)]
+    return headers
+
+
+def _normalize_header(value):
+    return " ".join(str(value).split()).lower()
+
+
+def _read_raw(path, file_type, encoding=None, **kwargs):
+    try:
+        if file_type == CSV:
+            return pd.read_csv(path, dtype=str, keep_default_na=False, skipinitialspace=True,
+                               encoding=encoding or csv_encoding(path), **kwargs)
+        return pd.read_excel(path, dtype=str, keep_default_na=False, engine="openpyxl", **kwargs)
+    except READ_ERRORS as e:
+        raise UnsupportedStatementFormat(
+            f"Could not read {os.path.basename(path)} as {file_type.upper()}: {e}"
+        ) from e
+
+
+def _locate_format(path, file_type, kind, encoding=None):
+    """
+    Find the header row and the first format whose headers it contains.
+    Exports often carry a few preamble lines, so the first rows are scanned.
+    """
+    if file_type == CSV:
+        # Preamble lines rarely have as many fields as the table itself
+        try:
+            with open(path, newline="", encoding=encoding or csv_encoding(path)) as f:
+                preview = list(islice(csv.reader(f), HEADER_SCAN_ROWS))
+        except csv.Error as e:
+            raise UnsupportedStatementFormat(f"Could not read {os.path.basename(path)} as CSV: {e}") from e
+    else:
+        preview = _read_raw(path, file_type, header=None, nrows=HEADER_SCAN_ROWS).values.tolist()
+
+    formats = get_tabular_formats(kind)
+    for row_idx, row in enumerate(preview):
+        present = {_normalize_header(v) for v in row if str(v).strip()}
+        for name, spec in formats.items():
+            if all(_normalize_header(h) in present for h in _required_headers(spec)):
+                return row_idx, name, spec
+    raise UnsupportedStatementFormat(
+        f"No {kind} column mapping matches {os.path.basename(path)}."
+    )
+
+
+def _to_amount(series):
+    # Same result as safe_float, vectorized: unparseable -> 0.0
+    cleaned = series.astype(str).str.replace(",", "", regex=False).str.strip()
+    return pd.to_numeric(cleaned, errors="coerce").fillna(0.0)
+
+
+def read_tabular_statement(path, kind, file_type, rules=None):
+    """
+    Read a CSV/XLSX export into the typed bank or hotel frame. Bank card
+    types are routed with ``rules`` (a CardRules) column-wise.
+    """
+    rules = rules or DEFAULT_CARD_RULES
+    encoding = csv_encoding(path) if file_type == CSV else None
+    header_row, name, spec = _locate_format(path, file_type, kind, encoding)
+    if file_type == CSV:
+        raw = _read_raw(path, file_type, encoding, skiprows=header_row)
+    else:
+        raw = _read_raw(path, file_type, header=header_row)
+    raw.columns = [_normalize_header(c) for c in raw.columns]
+
+    def source(header):
+        return raw[_normalize_header(header)].astype(str).str.strip()
+
+    if spec.get("datetime"):
+        dt_text = source(spec["datetime"])
+    else:
+        dt_text = source(spec["date"]) + " " + source(spec["time"])
+    dt = pd.to_datetime(dt_text, format=spec.get("datetime_format"), errors="coerce")
+
+    # Skip blank and subtotal lines: no timestamp and no amount
+    amount_col = "Gross Amount" if kind == "bank" else "Amount"
+    amount_raw = source(spec["columns"][amount_col])
+    keep = dt.notna() | (amount_raw != "")
+    raw, dt = raw[keep], dt[keep]
+
+    columns = BANK_COLUMNS if kind == "bank" else HOTEL_COLUMNS
+    date_display = BANK_DATE_DISPLAY if kind == "bank" else HOTEL_DATE_DISPLAY
+    df = pd.DataFrame(index=raw.index)
+    for col in columns:
+        if col == "Transaction Date":
+            df[col] = dt.dt.strftime(date_display).fillna("")
+        elif col == "Time":
+            df[col] = dt.dt.strftime(TIME_DISPLAY).fillna("")
+        elif spec["columns"].get(col):
+            df[col] = source(spec["columns"][col])
+        else:
+            df[col] = ""
+
+    if kind == "bank":
+        for col in ("Gross Amount", "Commission", "Net Amount"):
+            df[col] = _to_amount(df[col])
+        card_type = (
+            df["Card Type (On us/Off us)"].str.upper()
+            .str.extract(rules.type_pattern, expand=False)
+            .replace(rules.aliases)
+            .fillna("UNKNOWN")
+        )
+        df["Card Type (On us/Off us)"] = rules.route_series(df["Card Number"], card_type)
+    else:
+        df["Amount"] = _to_amount(df["Amount"])
+
+    df["DT"] = dt
+    print(f"Read {len(df)} {kind} rows from {os.path.basename(path)} using tabular format '{name}'.")
+    return df.reset_index(drop=True)
+
+
+def detect_statement_format(path, kind, extraction_path=None):
+    """
+    Registered PDF format for ``path``, chosen from its first page. Raises
+    UnsupportedStatementFormat before anything else is extracted.
+    """
+    fmt = detect_format(first_page_text(path, extraction_path), kind)
+    if fmt is None:
+        raise UnsupportedStatementFormat(
+            f"Unrecognised {kind} statement layout in {os.path.basename(path)}."
+        )
+    print(f"Detected {kind} statement format '{fmt.name}' for {os.path.basename(path)}.")
+    return fmt
+
+
+def load_statement(path, kind, statement_format=None, extraction_path=None, rules=None):
+    """
+    Typed bank or hotel frame for an uploaded statement of any supported
+    type. ``kind`` is "bank" or "hotel"; ``statement_format`` and
+    ``extraction_path`` skip detection and probing when already known.
+    ``rules`` is the client's CardRules (default routing when None).
+    """
+    file_type = detect_upload_type(path)
+    if file_type == PDF:
+        fmt = statement_format or detect_statement_format(path, kind, extraction_path)
+        return fmt.parse(extract_text_lines(path, extraction_path, region_for(fmt)), rules)
+    return read_tabular_statement(path, kind, file_type, rules)
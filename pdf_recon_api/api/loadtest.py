@@ -0,0 +1,637 @@
+"""
+Load testing ``POST /api/reconcile/`` against a running server.
+
+- ``FakeGoogleServer`` answers the Drive and Sheets calls the app makes, with
+  a configurable latency and error rate. It keeps spreadsheets in memory.
+  Point the server at it with GOOGLE_API_ENDPOINT.
+- ``load_corpus`` reads recorded bank/hotel pairs, and ``write_synthetic_corpus``
+  writes synthetic PDF pairs in the formats the parsers know.
+- ``run_load`` replays the corpus at a fixed concurrency, either closed loop
+  (each slot sends its next upload as soon as the last one returns) or open
+  loop at an arrival rate. ``RssSampler`` samples the server's processes
+  meanwhile.
+
+Both management commands, ``fake_google`` and ``recon_loadtest``, are thin
+wrappers around this module.
+"""
+import http.client
+import itertools
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, unquote_plus, urlsplit
+
+# Upper bounds of the latency histogram, in seconds
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, math.inf)
+PERCENTILES = (50, 90, 95, 99)
+
+
+# --- Fake Google backend -----------------------------------------------------
+
+class FakeGoogleState:
+    """Spreadsheets by id: tab titles in order and the rows of each tab."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spreadsheets = {}
+        self.calls = {}
+
+    def count(self, route):
+        with self.lock:
+            self.calls[route] = self.calls.get(route, 0) + 1
+
+    def spreadsheet(self, spreadsheet_id):
+        # Unknown ids (MASTER_SHEET_ID) exist with one empty tab
+        return self.spreadsheets.setdefault(spreadsheet_id, {"Sheet1": []})
+
+    def create(self, tabs=("Sheet1",)):
+        spreadsheet_id = uuid.uuid4().hex
+        self.spreadsheets[spreadsheet_id] = {tab: [] for tab in tabs}
+        return spreadsheet_id
+
+
+def _split_range(a1):
+    """``("Tab", first row index)`` of an A1 range such as ``Tab!A5:K``."""
+    tab, _, cells = unquote(a1).rpartition("!")
+    if not tab and not re.fullmatch(r"[A-Za-z]*\d*(:[A-Za-z]*\d*)?", cells):
+        # A bare tab name is the whole tab
+        tab, cells = cells, ""
+    tab = tab.strip("'").replace("''", "'") or "Sheet1"
+    match = re.match(r"[A-Za-z]*(\d+)", cells)
+    return tab, int(match.group(1)) - 1 if match else 0
+
+
+def _sheet_resource(spreadsheet_id, tabs):
+    return {
+        "spreadsheetId": spreadsheet_id,
+        "sheets": [
+            {"properties": {"sheetId": i, "title": title, "index": i}}
+            for i, title in enumerate(tabs)
+        ],
+    }
+
+
+class FakeGoogleHandler(BaseHTTPRequestHandler):
+    """Routes on the end of the path, so any API endpoint prefix works."""
+
+    protocol_version = "HTTP/1.1"
+    state = None
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+
+    ROUTES = [
+        ("POST", re.compile(r"/files$"), "drive.files.create"),
+        ("GET", re.compile(r"/files$"), "drive.files.list"),
+        ("POST", re.compile(r"/files/[^/]+/permissions$"), "drive.permissions.create"),
+        ("PATCH", re.compile(r"/files/([^/]+)$"), "drive.files.update"),
+        ("DELETE", re.compile(r"/files/([^/]+)$"), "drive.files.delete"),
+        ("POST", re.compile(r"/v4/spreadsheets$"), "sheets.create"),
+        ("GET", re.compile(r"/v4/spreadsheets/([^/:]+)$"), "sheets.get"),
+        ("POST", re.compile(r"/v4/spreadsheets/([^/:]+):batchUpdate$"), "sheets.batchUpdate"),
+        ("GET", re.compile(r"/v4/spreadsheets/([^/:]+)/values:batchGet$"), "sheets.values.batchGet"),
+        ("POST", re.compile(r"/v4/spreadsheets/([^/:]+)/values:batchUpdate$"), "sheets.values.batchUpdate"),
+        ("POST", re.compile(r"/v4/spreadsheets/([^/:]+)/values:batchClear$"), "sheets.values.batchClear"),
+        ("GET", re.compile(r"/v4/spreadsheets/([^/:]+)/values/([^/:]+)$"), "sheets.values.get"),
+        ("PUT", re.compile(r"/v4/spreadsheets/([^/:]+)/values/([^/:]+)$"), "sheets.values.update"),
+        ("POST", re.compile(r"/v4/spreadsheets/([^/:]+)/values/([^/:]+):append$"), "sheets.values.append"),
+        ("POST", re.compile(r"/v4/spreadsheets/([^/:]+)/values/([^/:]+):clear$"), "sheets.values.clear"),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload=None):
+        body = json.dumps(payload if payload is not None else {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError:
+            # Multipart media uploads: only the metadata matters here
+            body = {}
+
+        for method, pattern, route in self.ROUTES:
+            match = pattern.search(url.path)
+            if method == self.command and match:
+                break
+        else:
+            self.state.count("unknown")
+            return self._send(404, {"error": {"code": 404, "message": f"No fake for {self.command} {url.path}"}})
+
+        self.state.count(route)
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        if self.error_rate and random.random() < self.error_rate:
+            return self._send(503, {"error": {"code": 503, "message": "Injected failure", "status": "UNAVAILABLE"}})
+        with self.state.lock:
+            payload = self._respond(route, match, body, url.query)
+        self._send(200, payload)
+
+    def _respond(self, route, match, body, query):
+        state = self.state
+        if route == "drive.files.create":
+            file_id = state.create()
+            return {"id": file_id, "name": body.get("name", ""), "mimeType": body.get("mimeType", "")}
+        if route == "drive.files.list":
+            return {"files": []}
+        if route in ("drive.permissions.create", "drive.files.update", "drive.files.delete"):
+            return {"id": match.groups()[0] if match.groups() else uuid.uuid4().hex}
+        if route == "sheets.create":
+            tabs = [s["properties"]["title"] for s in body.get("sheets", []) if "properties" in s] or ["Sheet1"]
+            spreadsheet_id = state.create(tabs=tabs)
+            return _sheet_resource(spreadsheet_id, tabs)
+
+        spreadsheet_id = match.group(1)
+        tabs = state.spreadsheet(spreadsheet_id)
+        if route == "sheets.get":
+            return _sheet_resource(spreadsheet_id, tabs)
+        if route == "sheets.batchUpdate":
+            replies = []
+            for request in body.get("requests", []):
+                if "addSheet" in request:
+                    title = request["addSheet"].get("properties", {}).get("title") or f"Sheet{len(tabs) + 1}"
+                    tabs.setdefault(title, [])
+                    replies.append({"addSheet": {"properties": {"sheetId": list(tabs).index(title), "title": title}}})
+                    continue
+                kind = next((k for k in ("insertDimension", "deleteDimension") if k in request), None)
+                dimension = request[kind]["range"] if kind else {}
+                if dimension.get("dimension") == "ROWS":
+                    # sheetId is the tab's position, as in _sheet_resource
+                    rows = list(tabs.values())[dimension["sheetId"]]
+                    start, end = dimension["startIndex"], dimension["endIndex"]
+                    if kind == "insertDimension":
+                        rows[start:start] = [[] for _ in range(end - start)]
+                    else:
+                        del rows[start:end]
+                replies.append({})
+            return {"spreadsheetId": spreadsheet_id, "replies": replies}
+        if route == "sheets.values.batchGet":
+            ranges = [unquote_plus(part[len("ranges="):]) for part in query.split("&") if part.startswith("ranges=")]
+            return {"spreadsheetId": spreadsheet_id,
+                    "valueRanges": [self._get_values(tabs, a1) for a1 in ranges]}
+        if route == "sheets.values.batchUpdate":
+            for value_range in body.get("data", []):
+                self._put_values(tabs, value_range["range"], value_range.get("values", []))
+            return {"spreadsheetId": spreadsheet_id, "totalUpdatedRows": sum(len(d.get("values", [])) for d in body.get("data", []))}
+        if route == "sheets.values.batchClear":
+            for a1 in body.get("ranges", []):
+                tabs[_split_range(a1)[0]] = []
+            return {"spreadsheetId": spreadsheet_id, "clearedRanges": body.get("ranges", [])}
+
+        a1 = match.group(2)
+        if route == "sheets.values.get":
+            return self._get_values(tabs, a1)
+        if route == "sheets.values.update":
+            self._put_values(tabs, a1, body.get("values", []))
+            return {"spreadsheetId": spreadsheet_id, "updatedRange": unquote(a1), "updatedRows": len(body.get("values", []))}
+        if route == "sheets.values.append":
+            tab, _ = _split_range(a1)
+            rows = tabs.setdefault(tab, [])
+            rows.extend(body.get("values", []))
+            return {"spreadsheetId": spreadsheet_id, "updates": {"updatedRows": len(body.get("values", []))}}
+        # sheets.values.clear
+        tabs[_split_range(a1)[0]] = []
+        return {"spreadsheetId": spreadsheet_id, "clearedRange": unquote(a1)}
+
+    @staticmethod
+    def _get_values(tabs, a1):
+        tab, first = _split_range(a1)
+        return {"range": unquote(a1), "majorDimension": "ROWS", "values": tabs.get(tab, [])[first:]}
+
+    @staticmethod
+    def _put_values(tabs, a1, values):
+        tab, first = _split_range(a1)
+        rows = tabs.setdefault(tab, [])
+        rows.extend([] for _ in range(first + len(values) - len(rows)))
+        rows[first:first + len(values)] = values
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+
+class FakeGoogleServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.state = FakeGoogleState()
+        handler = type("Handler", (FakeGoogleHandler,), {
+            "state": self.state, "latency": latency, "jitter": jitter, "error_rate": error_rate,
+        })
+        super().__init__(address, handler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve on a daemon thread; returns the thread."""
+        thread = threading.Thread(target=self.serve_forever, name="fake-google", daemon=True)
+        thread.start()
+        return thread
+
+
+def parse_address(address, default_host="127.0.0.1"):
+    host, _, port = address.rpartition(":")
+    return host or default_host, int(port)
+
+
+# --- Corpus ------------------------------------------------------------------
+
+class StatementPair:
+    def __init__(self, name, bank_path, hotel_path):
+        self.name = name
+        self.bank_name = os.path.basename(bank_path)
+        self.hotel_name = os.path.basename(hotel_path)
+        # Read once: the load generator should not measure the local disk
+        with open(bank_path, "rb") as f:
+            self.bank = f.read()
+        with open(hotel_path, "rb") as f:
+            self.hotel = f.read()
+
+
+def _pair_in(folder):
+    files = sorted(e.name for e in os.scandir(folder) if e.is_file())
+    bank = next((f for f in files if "bank" in f.lower()), None)
+    hotel = next((f for f in files if "hotel" in f.lower()), None)
+    if bank and hotel:
+        return os.path.join(folder, bank), os.path.join(folder, hotel)
+    return None
+
+
+def load_corpus(root):
+    """
+    Pairs under ``root``: every folder (``root`` itself or a direct
+    subfolder) with one file named ``*bank*`` and one named ``*hotel*``.
+    """
+    pairs = []
+    for folder in [root] + sorted(e.path for e in os.scandir(root) if e.is_dir()):
+        found = _pair_in(folder)
+        if found:
+            pairs.append(StatementPair(os.path.basename(folder.rstrip(os.sep)) or folder, *found))
+    if not pairs:
+        raise ValueError(f"No bank/hotel pairs found under {root}.")
+    return pairs
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_text_pdf(path, lines, per_page=50, font_size=7):
+    """Minimal text-only PDF (Helvetica, A4), one line per row."""
+    pages = [lines[i:i + per_page] for i in range(0, len(lines), per_page)] or [[]]
+    objects = [None, None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"]
+    page_ids = []
+    for page in pages:
+        ops = [f"BT /F1 {font_size} Tf 14 TL 20 800 Td"]
+        ops += [f"({_pdf_escape(line)}) Tj T*" for line in page]
+        ops.append("ET")
+        stream = "\n".join(ops).encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects)
+        )
+        page_ids.append(len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    kids = " ".join(f"{i} 0 R" for i in page_ids).encode()
+    objects[1] = b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % len(page_ids)
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + obj + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def synthetic_statements(rows, seed, start=datetime(2025, 1, 1, 8, 0), days=20, unmatched=0.1):
+    """
+    Text lines of a bank settlement report and an Opera cashier report with
+    ``rows`` card payments; about ``unmatched`` of them are missing from the
+    hotel side.
+    """
+    rng = random.Random(seed)
+    payments = sorted(
+        (
+            start + timedelta(minutes=rng.randint(0, days * 24 * 60)),
+            rng.choice([75.25, 100.0, 250.5, 300.0, 1200.0, 1875.75]),
+            rng.choice(["1111", "2222", "0580", "3333", "4444"]),
+            rng.choice(["VISA", "MASTERCARD", "NAPS"]),
+        )
+        for _ in range(rows)
+    )
+    bank = ["MERCHANT ID 12345", "TERMINAL ID T999"]
+    hotel = ["Cashier report"]
+    for card_type in ("VISA", "MASTERCARD", "NAPS"):
+        bank.append(f"ON-US {card_type}")
+        for i, (dt, amount, last4, ct) in enumerate(payments):
+            if ct != card_type:
+                continue
+            settled = dt + timedelta(minutes=rng.randint(-5, 5))
+            bank.append(
+                f"{i} {settled:%d/%m/%Y} {settled:%H:%M} 00 REF{seed}{i} 4111XXXXXXXX{last4} "
+                f"{amount:,.2f} 1.00 {amount - 1:,.2f}"
+            )
+    names = {"VISA": "Visa", "MASTERCARD": "Master", "NAPS": "NAPS"}
+    for dt, amount, last4, card_type in payments:
+        if rng.random() < unmatched:
+            continue
+        hotel.append(f"{dt:%d/%m/%y} {dt:%H:%M} 101 John Doe 90001 {names[card_type]} Card QAR 0.00 {amount:,.2f} CASH1")
+        hotel.append(f"4111XXXXXXXX{last4}")
+    return bank, hotel
+
+
+def write_synthetic_corpus(root, pairs, rows, seed=1):
+    """Write ``pairs`` synthetic PDF pairs into subfolders of ``root``."""
+    for n in range(pairs):
+        folder = os.path.join(root, f"synthetic_{rows}_{seed + n}")
+        os.makedirs(folder, exist_ok=True)
+        bank, hotel = synthetic_statements(rows, seed + n)
+        write_text_pdf(os.path.join(folder, "bank.pdf"), bank)
+        write_text_pdf(os.path.join(folder, "hotel.pdf"), hotel)
+    return load_corpus(root)
+
+
+# --- Load generator ----------------------------------------------------------
+
+def _multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        )
+    for name, (filename, content) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n".encode() + content + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+class Sample:
+    __slots__ = ("pair", "scheduled", "started", "finished", "status", "error", "detail")
+
+    def __init__(self, pair, scheduled):
+        self.pair = pair
+        self.scheduled = scheduled
+        self.started = self.finished = None
+        self.status = None
+        self.error = None
+        self.detail = None
+
+    @property
+    def ok(self):
+        return self.error is None and self.status is not None and 200 <= self.status < 300
+
+    @property
+    def latency(self):
+        # From the scheduled arrival: time spent waiting for a free slot counts
+        return self.finished - self.scheduled
+
+
+def send_upload(url, pair, client_name, threshold_minutes, timeout):
+    """One reconciliation request; returns the HTTP status and the body."""
+    target = urlsplit(url)
+    body, content_type = _multipart(
+        {"client_name": client_name, "threshold_time": threshold_minutes},
+        {"bank_file": (pair.bank_name, pair.bank), "hotel_file": (pair.hotel_name, pair.hotel)},
+    )
+    connection_class = http.client.HTTPSConnection if target.scheme == "https" else http.client.HTTPConnection
+    connection = connection_class(target.netloc, timeout=timeout)
+    try:
+        connection.request("POST", target.path or "/", body=body, headers={"Content-Type": content_type})
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def run_load(url, corpus, concurrency, requests=None, duration=None, rate=0.0, client_name="loadtest",
+             unique_clients=True, threshold_minutes=15, timeout=600, seed=None):
+    """
+    Replay ``corpus`` against ``url`` with at most ``concurrency`` requests
+    in flight. ``rate`` > 0 sends Poisson arrivals at that many requests per
+    second (open loop); 0 keeps every slot busy (closed loop). Stops after
+    ``requests`` requests or ``duration`` seconds, whichever comes first.
+
+    With ``unique_clients`` every request gets its own client name, so the
+    run lock does not fold identical uploads into one run.
+    Returns ``(samples, elapsed seconds)``.
+    """
+    if not requests and not duration:
+        raise ValueError("Give a number of requests or a duration.")
+    rng = random.Random(seed)
+    # Unique across calls too: a name reused with the same upload replays its earlier run
+    run_tag = uuid.uuid4().hex[:6]
+    pairs = itertools.cycle(corpus)
+    sequence = itertools.count(1)
+    samples = []
+    lock = threading.Lock()
+
+    def execute(sample):
+        n = next(sequence)
+        sample.started = time.monotonic()
+        try:
+            sample.status, content = send_upload(
+                url, sample.pair, f"{client_name}-{run_tag}-{n}" if unique_clients else client_name,
+                threshold_minutes, timeout,
+            )
+            if not sample.ok:
+                sample.detail = content[:200].decode(errors="replace")
+        except Exception as e:
+            sample.error = f"{e.__class__.__name__}: {e}"
+        sample.finished = time.monotonic()
+        with lock:
+            samples.append(sample)
+
+    started = time.monotonic()
+    deadline = started + duration if duration else math.inf
+    limit = requests or math.inf
+
+    if rate > 0:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            sent, arrival = 0, started
+            while sent < limit:
+                arrival += rng.expovariate(rate)
+                if arrival > deadline:
+                    break
+                time.sleep(max(0.0, arrival - time.monotonic()))
+                executor.submit(execute, Sample(next(pairs), arrival))
+                sent += 1
+    else:
+        issued = itertools.count()
+        pair_lock = threading.Lock()
+
+        def slot():
+            while next(issued) < limit and time.monotonic() < deadline:
+                with pair_lock:
+                    pair = next(pairs)
+                execute(Sample(pair, time.monotonic()))
+
+        threads = [threading.Thread(target=slot, daemon=True) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return samples, time.monotonic() - started
+
+
+# --- Server memory -----------------------------------------------------------
+
+def _children(pid):
+    children = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children += [int(c) for c in f.read().split()]
+        except OSError:
+            continue
+    return children
+
+
+def process_tree(pid):
+    """``pid`` and all its descendants (gunicorn workers, pool processes)."""
+    tree, todo = [], [pid]
+    while todo:
+        current = todo.pop()
+        tree.append(current)
+        try:
+            todo += _children(current)
+        except OSError:
+            continue
+    return tree
+
+
+def read_rss(pid):
+    """Resident set size in bytes from /proc, or None when gone."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def _command_line(pid):
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return f.read().replace(b"\0", b" ").decode(errors="replace").strip()
+    except OSError:
+        return "?"
+
+
+class RssSampler:
+    """Samples the RSS of server processes (and their children) on a thread."""
+
+    def __init__(self, pids, interval=0.5):
+        self.pids = pids
+        self.interval = interval
+        self.peak = {}
+        self.last = {}
+        self.commands = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    @staticmethod
+    def available():
+        return os.path.isdir("/proc/self/task")
+
+    def sample(self):
+        for root in self.pids:
+            for pid in process_tree(root):
+                rss = read_rss(pid)
+                if rss is None:
+                    continue
+                if pid not in self.commands:
+                    self.commands[pid] = _command_line(pid)
+                self.last[pid] = rss
+                self.peak[pid] = max(rss, self.peak.get(pid, 0))
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+    def report(self):
+        return [
+            {"pid": pid, "command": self.commands.get(pid, "?"), "peakRss": self.peak[pid], "lastRss": self.last.get(pid)}
+            for pid in sorted(self.peak)
+        ]
+
+
+# --- Summary -----------------------------------------------------------------
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    lower, upper = math.floor(k), math.ceil(k)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+
+def summarize(samples, elapsed):
+    """Latency percentiles and histogram, throughput and errors of one step."""
+    latencies = sorted(s.latency for s in samples if s.ok)
+    errors, examples = {}, {}
+    for s in samples:
+        if not s.ok:
+            key = s.error.split(":")[0] if s.error else f"HTTP {s.status}"
+            errors[key] = errors.get(key, 0) + 1
+            examples.setdefault(key, s.error or s.detail)
+    histogram, lower = [], 0.0
+    for upper in HISTOGRAM_BUCKETS:
+        histogram.append({"le": upper if upper != math.inf else None, "count": sum(1 for v in latencies if lower < v <= upper)})
+        lower = upper
+    waits = sorted(s.started - s.scheduled for s in samples)
+    return {
+        "requests": len(samples),
+        "ok": len(latencies),
+        "errors": errors,
+        "errorExamples": examples,
+        "errorRate": round(1 - len(latencies) / len(samples), 4) if samples else None,
+        "elapsedSeconds": round(elapsed, 3),
+        "throughputPerMinute": round(len(latencies) / elapsed * 60, 2) if elapsed else None,
+        "latency": {
+            **{f"p{p}": percentile(latencies, p) for p in PERCENTILES},
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "max": latencies[-1] if latencies else None,
+        },
+        "clientQueueP95": percentile(waits, 95),
+        "histogram": histogram,
+    }
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from api.loadtest import FakeGoogleServer, parse_address
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve a local stand-in for the Drive and Sheets APIs, for load tests. "
+        "Point the server under test at it with GOOGLE_API_ENDPOINT."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("address", nargs="?", default="127.0.0.1:8765", help="[host:]port to listen on.")
+        parser.add_argument("--latency-ms", type=float, default=150, help="Delay added to every call.")
+        parser.add_argument("--jitter-ms", type=float, default=100, help="Random extra delay, up to this much.")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Share of calls answered with a 503.")
+
+    def handle(self, *args, **options):
+        server = FakeGoogleServer(
+            parse_address(options["address"]),
+            latency=options["latency_ms"] / 1000,
+            jitter=options["jitter_ms"] / 1000,
+            error_rate=options["error_rate"],
+        )
+        self.stdout.write(f"Fake Google APIs at {server.url} (GOOGLE_API_ENDPOINT = \"{server.url}\"). Ctrl-C to stop.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        self.stdout.write("Calls served:")
+        for route, count in sorted(server.state.calls.items()):
+            self.stdout.write(f"  {route:<28} {count:>8}")
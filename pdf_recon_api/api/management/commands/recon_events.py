@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from api.events import prune_events
+from api.models import WebhookDelivery
+from api.webhooks import deliver_due
+
+
+class Command(BaseCommand):
+    help = (
+        "Send webhook deliveries that are due (retries a restarted worker left "
+        "behind) and delete progress events older than RECON_EVENT_TTL. Run it "
+        "from cron every minute or so."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Count only; send and delete nothing.")
+
+    def handle(self, *args, **options):
+        pending = WebhookDelivery.objects.filter(status=WebhookDelivery.Status.PENDING)
+        if options["dry_run"]:
+            self.stdout.write(f"Webhook deliveries pending: {pending.count()}")
+        else:
+            tried = deliver_due()
+            self.stdout.write(f"Webhook deliveries attempted: {tried}, still pending: {pending.count()}")
+        pruned = prune_events(dry_run=options["dry_run"])
+        self.stdout.write(f"Progress events {'to delete' if options['dry_run'] else 'deleted'}: {pruned}")
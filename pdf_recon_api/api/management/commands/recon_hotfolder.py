@@ -0,0 +1,39 @@
+import signal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.hotfolder import HotFolderConfigError, HotFolderDaemon, load_hot_folders
+
+
+class Command(BaseCommand):
+    help = (
+        "Watch the RECON_HOT_FOLDERS directories, pair the bank and hotel statements "
+        "dropped there and reconcile each pair once, writing the results next to the inputs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true",
+                            help="Process what is there now (after the settle time) and exit, for cron.")
+        parser.add_argument("--folder", action="append", default=[],
+                            help="Watch this directory instead of RECON_HOT_FOLDERS (repeatable).")
+        parser.add_argument("--client", help="Client name for --folder (default: from the file names).")
+        parser.add_argument("--workers", type=int, help="Pairs processed at once (RECON_HOT_FOLDER_WORKERS).")
+        parser.add_argument("--settle", type=float, help="Seconds a file must stay unchanged (RECON_HOT_FOLDER_SETTLE).")
+        parser.add_argument("--poll", type=float, help="Seconds between scans (RECON_HOT_FOLDER_POLL).")
+
+    def handle(self, *args, **options):
+        entries = [{"path": path, "client_name": options["client"]} for path in options["folder"]] or None
+        try:
+            folders = load_hot_folders(entries)
+        except HotFolderConfigError as e:
+            raise CommandError(str(e))
+        if not folders:
+            raise CommandError("No hot folders: set RECON_HOT_FOLDERS or pass --folder.")
+
+        daemon = HotFolderDaemon(folders, options["workers"], options["poll"], options["settle"])
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            # Stop scanning; pairs already running are finished
+            signal.signal(sig, lambda *_: daemon.stop())
+        self.stdout.write("Watching " + ", ".join(folder.path for folder in folders))
+        daemon.run(once=options["once"])
+        self.stdout.write("Hot folder daemon stopped.")
@@ -0,0 +1,159 @@
+import json
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.loadtest import (
+    FakeGoogleServer, RssSampler, load_corpus, parse_address, run_load, summarize, write_synthetic_corpus,
+)
+
+
+def _size(num_bytes):
+    return f"{num_bytes / (1024 * 1024):.1f} MB" if num_bytes is not None else "-"
+
+
+def _ms(seconds):
+    return f"{seconds * 1000:.0f} ms" if seconds is not None else "-"
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test POST /api/reconcile/ on a running server: replay bank/hotel "
+        "pairs at one or more concurrency levels and report latency "
+        "percentiles and histogram, throughput, errors and per-process RSS."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000/api/reconcile/", help="Reconcile endpoint.")
+        parser.add_argument("--corpus", help="Folder of recorded pairs: subfolders holding a *bank* and a *hotel* file.")
+        parser.add_argument("--synthetic", type=int, default=0,
+                            help="Write this many synthetic PDF pairs (into --corpus if given, else a temp folder).")
+        parser.add_argument("--rows", type=int, default=200, help="Payments per synthetic pair.")
+        parser.add_argument("--concurrency", default="5,20,50",
+                            help="Comma-separated concurrency levels, run one after the other.")
+        parser.add_argument("--requests", type=int, default=0, help="Requests per level (default: 4 x concurrency).")
+        parser.add_argument("--duration", type=float, default=0, help="Seconds per level instead of a request count.")
+        parser.add_argument("--rate", type=float, default=0,
+                            help="Open loop: Poisson arrivals per second. 0 = closed loop (every slot always busy).")
+        parser.add_argument("--client-name", default="loadtest", help="Client name prefix.")
+        parser.add_argument("--same-client", action="store_true",
+                            help="Send every request as the same client (repeats then hit the run lock and "
+                                 "the already-reconciled check instead of the pipeline).")
+        parser.add_argument("--threshold", type=int, default=15, help="threshold_time sent with each upload.")
+        parser.add_argument("--timeout", type=float, default=600, help="Per-request timeout in seconds.")
+        parser.add_argument("--server-pid", type=int, action="append", default=[],
+                            help="Server process to sample RSS from, with its children (repeatable).")
+        parser.add_argument("--fake-google", metavar="[HOST:]PORT",
+                            help="Also serve the fake Google APIs here for the length of the test.")
+        parser.add_argument("--google-latency-ms", type=float, default=150)
+        parser.add_argument("--google-error-rate", type=float, default=0.0)
+        parser.add_argument("--json", metavar="PATH", help="Also write the results as JSON.")
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(c) for c in options["concurrency"].split(",") if c.strip()]
+        except ValueError:
+            raise CommandError("--concurrency must be comma-separated integers.")
+        if not levels or min(levels) < 1:
+            raise CommandError("--concurrency must be at least 1.")
+
+        corpus_dir = options["corpus"]
+        try:
+            if options["synthetic"]:
+                corpus_dir = corpus_dir or tempfile.mkdtemp(prefix="recon_loadtest_")
+                corpus = write_synthetic_corpus(corpus_dir, options["synthetic"], options["rows"])
+            elif corpus_dir:
+                corpus = load_corpus(corpus_dir)
+            else:
+                raise CommandError("Give --corpus, --synthetic N, or both.")
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(f"Corpus: {len(corpus)} pair(s) from {os.path.abspath(corpus_dir)}")
+
+        fake = None
+        if options["fake_google"]:
+            fake = FakeGoogleServer(
+                parse_address(options["fake_google"]),
+                latency=options["google_latency_ms"] / 1000,
+                jitter=options["google_latency_ms"] / 2000,
+                error_rate=options["google_error_rate"],
+            )
+            fake.start()
+            self.stdout.write(f"Fake Google APIs at {fake.url}; the server needs GOOGLE_API_ENDPOINT = \"{fake.url}\".")
+
+        if options["server_pid"] and not RssSampler.available():
+            self.stdout.write(self.style.WARNING("RSS sampling needs /proc; skipped."))
+            options["server_pid"] = []
+
+        results = []
+        try:
+            for concurrency in levels:
+                requests = options["requests"] or (0 if options["duration"] else 4 * concurrency)
+                self.stdout.write(f"\nConcurrency {concurrency}: "
+                                  + (f"{requests} requests" if requests else f"{options['duration']:.0f} s")
+                                  + (f" at {options['rate']}/s" if options["rate"] else ", closed loop"))
+                sampler = RssSampler(options["server_pid"])
+                with sampler:
+                    samples, elapsed = run_load(
+                        options["url"], corpus, concurrency,
+                        requests=requests or None, duration=options["duration"] or None, rate=options["rate"],
+                        client_name=options["client_name"], unique_clients=not options["same_client"],
+                        threshold_minutes=options["threshold"], timeout=options["timeout"],
+                    )
+                summary = summarize(samples, elapsed)
+                summary["concurrency"] = concurrency
+                summary["processes"] = sampler.report() if options["server_pid"] else []
+                results.append(summary)
+                self.print_summary(summary)
+        finally:
+            if fake:
+                fake.shutdown()
+                fake.server_close()
+                summary_calls = ", ".join(f"{route} {n}" for route, n in sorted(fake.state.calls.items()))
+                self.stdout.write(f"\nFake Google calls: {summary_calls or 'none'}")
+
+        if len(results) > 1:
+            self.print_levels(results)
+        if options["json"]:
+            with open(options["json"], "w") as f:
+                json.dump({"url": options["url"], "rate": options["rate"], "levels": results}, f, indent=2)
+            self.stdout.write(f"Results written to {options['json']}")
+
+    def print_summary(self, s):
+        latency = s["latency"]
+        self.stdout.write(
+            f"  {s['ok']}/{s['requests']} ok in {s['elapsedSeconds']:.1f} s, "
+            f"{s['throughputPerMinute'] or 0:.1f} runs/min, error rate {(s['errorRate'] or 0) * 100:.1f}%"
+        )
+        for error, count in sorted(s["errors"].items()):
+            self.stdout.write(self.style.WARNING(f"    {error}: {count}  e.g. {s['errorExamples'][error]}"))
+        self.stdout.write("  latency " + "  ".join(
+            f"{key} {_ms(latency[key])}" for key in ("p50", "p90", "p95", "p99", "max")
+        ) + f"  (client-side queue p95 {_ms(s['clientQueueP95'])})")
+
+        peak = max((b["count"] for b in s["histogram"]), default=0) or 1
+        lower = "0"
+        for bucket in s["histogram"]:
+            upper = _ms(bucket["le"]) if bucket["le"] is not None else "inf"
+            if bucket["count"]:
+                bar = "#" * max(1, round(40 * bucket["count"] / peak))
+                self.stdout.write(f"    {lower:>9} - {upper:<9} {bucket['count']:>6} {bar}")
+            lower = upper
+
+        for p in s["processes"]:
+            self.stdout.write(f"  pid {p['pid']:<7} peak {_size(p['peakRss']):>9}  end {_size(p['lastRss']):>9}  "
+                              f"{p['command'][:70]}")
+        if s["processes"]:
+            total = sum(p["peakRss"] for p in s["processes"])
+            self.stdout.write(f"  sum of peaks {_size(total)}")
+
+    def print_levels(self, results):
+        self.stdout.write("\nconcurrency  runs/min     p50       p99    errors")
+        best = max(results, key=lambda r: r["throughputPerMinute"] or 0)
+        for r in results:
+            mark = "  <- peak throughput" if r is best else ""
+            self.stdout.write(
+                f"{r['concurrency']:>11} {r['throughputPerMinute'] or 0:>9.1f} {_ms(r['latency']['p50']):>9} "
+                f"{_ms(r['latency']['p99']):>9} {(r['errorRate'] or 0) * 100:>8.1f}%{mark}"
+            )
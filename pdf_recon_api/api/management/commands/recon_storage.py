@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand
+
+from api.storage import collect_garbage, storage_report
+from api.uploads import expire_upload_sessions
+
+
+def _size(num_bytes):
+    if abs(num_bytes) < 1024:
+        return f"{num_bytes} B"
+    for unit in ("KB", "MB", "GB"):
+        num_bytes /= 1024
+        if abs(num_bytes) < 1024 or unit == "GB":
+            return f"{num_bytes:.1f} {unit}"
+
+
+class Command(BaseCommand):
+    help = (
+        "Report space used by uploads and reports, and apply retention: compress "
+        "cold run folders, delete expired ones and unused uploads, and remove "
+        "stored objects nothing refers to."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--report", action="store_true", help="Only print the space report.")
+        parser.add_argument("--dry-run", action="store_true", help="Show what would be done without changing anything.")
+        parser.add_argument("--upload-days", type=int, help="Override RECON_UPLOAD_RETENTION_DAYS (0 keeps uploads).")
+        parser.add_argument("--artifact-days", type=int, help="Override RECON_ARTIFACT_RETENTION_DAYS (0 keeps run folders).")
+        parser.add_argument("--compress-days", type=int, help="Override RECON_COMPRESS_AFTER_DAYS (0 disables compression).")
+
+    def print_report(self, title):
+        report = storage_report()
+        self.stdout.write(title)
+        for area in ("uploads", "artifacts"):
+            a = report[area]
+            self.stdout.write(
+                f"  {area:<12} {a['files']:>6} files  {_size(a['bytes']):>10}"
+                f"  (zstd {_size(a['compressedBytes'])}, unreferenced {_size(a['unreferencedBytes'])})"
+            )
+        runs = report["runFolders"]
+        self.stdout.write(
+            f"  {'run folders':<12} {runs['folders']:>6} dirs   {_size(runs['linkedBytes']):>10}"
+            f"  as seen by clients, {_size(runs['unlinkedBytes'])} not in the store"
+        )
+        self.stdout.write(f"  {'old uploads':<12} {'':>6}        {_size(report['legacyUploads']['bytes']):>10}")
+        self.stdout.write(f"  {'partial':<12} {'':>6}        {_size(report['partialUploads']['bytes']):>10}")
+        self.stdout.write(f"  {'results':<12} {'':>6}        {_size(report['results']['bytes']):>10}")
+        self.stdout.write(f"  {'total':<12} {'':>6}        {_size(report['totalBytes']):>10}")
+        return report
+
+    def handle(self, *args, **options):
+        before = self.print_report("Storage:")
+        if options["report"]:
+            return
+
+        stats = collect_garbage(
+            upload_days=options["upload_days"],
+            artifact_days=options["artifact_days"],
+            compress_days=options["compress_days"],
+            dry_run=options["dry_run"],
+        )
+        prefix = "Would" if options["dry_run"] else "Did"
+        self.stdout.write(f"{prefix} delete {stats['runFoldersDeleted']} run folder(s) "
+                          f"({_size(stats['runFolderBytesDeleted'])} outside the store)")
+        self.stdout.write(f"{prefix} compress {stats['filesCompressed']} file(s)"
+                          + (f", saving {_size(stats['bytesSavedByCompression'])}" if not options["dry_run"] else ""))
+        self.stdout.write(f"{prefix} delete {stats['uploadsDeleted']} upload(s) ({_size(stats['uploadBytesDeleted'])})")
+        self.stdout.write(f"{prefix} delete {stats['objectsDeleted']} unreferenced object(s) "
+                          f"({_size(stats['objectBytesDeleted'])})")
+        expired = expire_upload_sessions(dry_run=options["dry_run"])
+        self.stdout.write(f"{prefix} expire {expired} unfinished resumable upload(s)")
+        if options["dry_run"]:
+            return
+
+        after = self.print_report("Storage after cleanup:")
+        self.stdout.write(self.style.SUCCESS(f"Freed {_size(before['totalBytes'] - after['totalBytes'])}."))
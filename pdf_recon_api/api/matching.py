@@ -0,0 +1,371 @@
+import multiprocessing
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+from .progress import publish
+
+
+def match_transactions(bank, hotel, threshold_minutes):
+    """
+    Match every bank row against the still-unreconciled hotel rows.
+
+    GCCNET rows match on amount and time window only; every other card type
+    first looks for a hotel row with the same card last-4, then falls back to
+    amount and time window. The first qualifying hotel row (in frame order)
+    wins. Returns ``(rec_bank_list, rec_hotel_list, un_bank_list, un_hotel_df)``.
+    """
+    rec_bank_list = []
+    rec_hotel_list = []
+    un_bank_list = []
+    un_hotel_df = hotel # drop() below never mutates the caller's frame
+
+    if not bank.empty and not un_hotel_df.empty:
+        for i, b in bank.iterrows():
+            match = pd.DataFrame()
+
+            if b["Card Type (On us/Off us)"] == 'GCCNET':
+                match = un_hotel_df[
+                    (un_hotel_df["Amount"] == b["Gross Amount"]) &
+                    (abs(un_hotel_df["DT"] - b["DT"]) <= timedelta(minutes=threshold_minutes))
+                ]
+            else:
+                bank_card_last_4 = str(b["Card Number"])[-4:]
+                potential_matches = un_hotel_df[
+                    (un_hotel_df["Card Reference"].str.len() >= 4) &
+                    (un_hotel_df["Card Reference"].str[-4:] == bank_card_last_4) &
+                    (un_hotel_df["Amount"] == b["Gross Amount"]) &
+                    (abs(un_hotel_df["DT"] - b["DT"]) <= timedelta(minutes=threshold_minutes))
+                ]
+                match = potential_matches
+
+                if match.empty:
+                    match = un_hotel_df[
+                        (un_hotel_df["Amount"] == b["Gross Amount"]) &
+                        (abs(un_hotel_df["DT"] - b["DT"]) <= timedelta(minutes=threshold_minutes))
+                    ]
+
+            if not match.empty:
+                rec_bank_list.append(b)
+                rec_hotel_list.append(match.iloc[0])
+                un_hotel_df = un_hotel_df.drop(match.index[0])
+            else:
+                un_bank_list.append(b)
+    elif not bank.empty:
+        # Nothing to match against: every bank row stays unreconciled
+        un_bank_list = [b for _, b in bank.iterrows()]
+    return rec_bank_list, rec_hotel_list, un_bank_list, un_hotel_df
+
+
+# ===============================
+# Optimal (nearest-time) assignment
+# ===============================
+def window_assignment(bank_times, hotel_times, threshold):
+    """
+    Pairs ``(i, j)`` of positions into two sorted time lists (integers) so
+    that every pair is at most ``threshold`` apart, as many rows as possible
+    are paired, and then the total time difference is as small as possible.
+
+    On a line an optimal assignment never crosses (swapping two crossing
+    pairs keeps both inside the window and never costs more), so a DP over
+    the sorted lists is exact. Bank row ``i`` only sees the hotel rows in its
+    window ``[lo_i, hi_i]``, and both bounds only move forward. The DP
+    therefore touches only those cells: ``O(n log n + sum of window sizes)``.
+    Ties are broken the same way every time.
+    """
+    n, m = len(bank_times), len(hotel_times)
+    if not n or not m:
+        return []
+    empty = (0, 0)
+    best = [empty] * m  # best[j] = score of the latest row that reached column j
+    top = -1  # highest column reached so far
+    bands = []
+
+    def prev(j):
+        # Score of (previous row, j): columns past `top` are unused so far
+        if j < 0 or top < 0:
+            return empty
+        return best[min(j, top)]
+
+    for t in bank_times:
+        lo = bisect_left(hotel_times, t - threshold)
+        hi = bisect_right(hotel_times, t + threshold) - 1
+        if lo > hi:
+            bands.append((lo, hi, None))
+            continue
+        choices, values = [], []
+        left = prev(lo - 1)
+        for j in range(lo, hi + 1):
+            diag = prev(j - 1)
+            value, choice = (diag[0] + 1, diag[1] - abs(t - hotel_times[j])), "match"
+            up = prev(j)
+            if up > value:
+                value, choice = up, "skip_bank"
+            if left > value:
+                value, choice = left, "skip_hotel"
+            values.append(value)
+            choices.append(choice)
+            left = value
+        if lo - 1 > top:
+            # Columns between the last row's window and this one keep its score
+            frozen = prev(top)
+            for j in range(max(top + 1, 0), lo):
+                best[j] = frozen
+        best[lo:hi + 1] = values
+        top = hi
+        bands.append((lo, hi, choices))
+
+    pairs = []
+    i, j = n - 1, top
+    while i >= 0 and j >= 0:
+        lo, hi, choices = bands[i]
+        if choices is None or j < lo:
+            i -= 1
+        elif j > hi:
+            j = hi
+        else:
+            choice = choices[j - lo]
+            if choice == "match":
+                pairs.append((i, j))
+                i, j = i - 1, j - 1
+            elif choice == "skip_bank":
+                i -= 1
+            else:
+                j -= 1
+    pairs.reverse()
+    return pairs
+
+
+def _sorted_times(frame):
+    # Ties in time keep statement order, so the result is deterministic
+    order = np.argsort(frame["DT"].to_numpy(dtype="datetime64[ns]").astype("int64"), kind="stable")
+    frame = frame.iloc[order]
+    return frame.index.tolist(), frame["DT"].to_numpy(dtype="datetime64[ns]").astype("int64").tolist()
+
+
+def _assign_buckets(bank, hotel, keys, threshold_ns):
+    """Optimal pairs (bank label, hotel label) within each bucket of ``keys``."""
+    pairs = []
+    hotel_groups = {key: group for key, group in hotel.groupby(keys, sort=False)}
+    for key, bank_group in bank.groupby(keys, sort=True):
+        hotel_group = hotel_groups.get(key)
+        if hotel_group is None:
+            continue
+        bank_labels, bank_times = _sorted_times(bank_group)
+        hotel_labels, hotel_times = _sorted_times(hotel_group)
+        pairs.extend(
+            (bank_labels[i], hotel_labels[j])
+            for i, j in window_assignment(bank_times, hotel_times, threshold_ns)
+        )
+    return pairs
+
+
+def match_transactions_optimal(bank, hotel, threshold_minutes):
+    """
+    Same rules and return value as ``match_transactions``, but each bank row
+    is paired with the hotel row nearest in time instead of the first one in
+    frame order, solved over the whole statement:
+
+    1. Card rows (all but GCCNET) are assigned within each
+       (amount, card last-4) bucket, against hotel rows with a card reference.
+    2. GCCNET rows and the card rows left over are assigned within each
+       amount bucket, against the hotel rows left over.
+
+    Each step reconciles as many rows as possible and then minimises the
+    total time difference (see ``window_assignment``).
+    """
+    if bank.empty or hotel.empty:
+        return [], [], [r for _, r in bank.iterrows()], hotel
+
+    threshold_ns = int(pd.Timedelta(minutes=threshold_minutes).value)
+    bank_rows = bank[bank["DT"].notna() & bank["Gross Amount"].notna()]
+    hotel_rows = hotel[hotel["DT"].notna() & hotel["Amount"].notna()]
+
+    card_bank = bank_rows[bank_rows["Card Type (On us/Off us)"] != 'GCCNET']
+    card_bank = pd.DataFrame({
+        "DT": card_bank["DT"],
+        "amount": card_bank["Gross Amount"],
+        "last4": card_bank["Card Number"].astype(str).str[-4:],
+    })
+    refs = hotel_rows["Card Reference"]
+    with_ref = hotel_rows[(refs.str.len() >= 4).fillna(False).astype(bool)]
+    card_hotel = pd.DataFrame({
+        "DT": with_ref["DT"],
+        "amount": with_ref["Amount"],
+        "last4": with_ref["Card Reference"].str[-4:],
+    })
+    pairs = _assign_buckets(card_bank, card_hotel, ["amount", "last4"], threshold_ns)
+
+    taken_bank = {b for b, _ in pairs}
+    taken_hotel = {h for _, h in pairs}
+    rest_bank = bank_rows[~bank_rows.index.isin(taken_bank)]
+    rest_hotel = hotel_rows[~hotel_rows.index.isin(taken_hotel)]
+    pairs += _assign_buckets(
+        pd.DataFrame({"DT": rest_bank["DT"], "amount": rest_bank["Gross Amount"]}),
+        pd.DataFrame({"DT": rest_hotel["DT"], "amount": rest_hotel["Amount"]}),
+        ["amount"], threshold_ns,
+    )
+
+    # Same layout as the first-fit matcher: bank statement order
+    bank_pos = pd.Series(np.arange(len(bank)), index=bank.index)
+    pairs.sort(key=lambda p: bank_pos[p[0]])
+    matched_bank = {b for b, _ in pairs}
+    rec_bank_list = [bank.loc[b] for b, _ in pairs]
+    rec_hotel_list = [hotel.loc[h] for _, h in pairs]
+    un_bank_list = [row for label, row in bank.iterrows() if label not in matched_bank]
+    un_hotel_df = hotel.drop(index=[h for _, h in pairs])
+    return rec_bank_list, rec_hotel_list, un_bank_list, un_hotel_df
+
+
+MATCHERS = {
+    "first": match_transactions,
+    "optimal": match_transactions_optimal,
+}
+
+
+def get_matcher(mode=None):
+    """Serial matcher for ``mode`` (default RECON_MATCH_MODE)."""
+    mode = mode or getattr(settings, "RECON_MATCH_MODE", "first")
+    try:
+        return MATCHERS[mode]
+    except KeyError:
+        raise ValueError(f"Unknown match mode {mode!r}; expected one of {', '.join(MATCHERS)}.")
+
+
+# ===============================
+# Sharded parallel matching
+# ===============================
+def time_segments(bank, hotel, threshold_minutes):
+    """
+    Label every row with the time segment it belongs to. A new segment starts
+    wherever the combined bank + hotel timeline has a gap wider than the
+    threshold, so no bank row can have a candidate outside its own segment
+    and segments can be matched independently. Rows without a DT get -1.
+    """
+    threshold = pd.Timedelta(minutes=threshold_minutes)
+    times = pd.concat([bank["DT"], hotel["DT"]]).dropna().sort_values().to_numpy()
+    if not len(times):
+        return pd.Series(-1, index=bank.index), pd.Series(-1, index=hotel.index)
+
+    gaps = np.diff(times) > threshold.to_timedelta64()
+    starts = times[np.concatenate(([True], gaps))]
+
+    def label(dt):
+        seg = np.searchsorted(starts, dt.to_numpy(), side="right") - 1
+        return pd.Series(seg, index=dt.index).where(dt.notna(), -1).astype(int)
+
+    return label(bank["DT"]), label(hotel["DT"])
+
+
+def plan_shards(bank_seg, hotel_seg, shard_count):
+    """
+    Pack consecutive segments into at most ``shard_count`` shards of roughly
+    equal row count. Returns a segment -> shard mapping.
+    """
+    sizes = pd.concat([bank_seg, hotel_seg])
+    sizes = sizes[sizes >= 0].value_counts().sort_index()
+    target = max(1, int(np.ceil(sizes.sum() / shard_count)))
+
+    mapping = {}
+    shard = filled = 0
+    for seg, size in sizes.items():
+        if filled and filled + size > target and shard < shard_count - 1:
+            shard += 1
+            filled = 0
+        mapping[seg] = shard
+        filled += size
+    return mapping
+
+
+def _match_shard(bank, hotel, threshold_minutes, mode=None):
+    """Process-pool entry point: serial matching on one shard, as index labels."""
+    rec_bank_list, rec_hotel_list, un_bank_list, _ = get_matcher(mode)(bank, hotel, threshold_minutes)
+    return (
+        [b.name for b in rec_bank_list],
+        [h.name for h in rec_hotel_list],
+        [b.name for b in un_bank_list],
+    )
+
+
+_pool = None
+
+
+def _get_pool(workers):
+    global _pool
+    if _pool is None:
+        # spawn: forking a threaded web worker is not safe
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+
+
+def match_transactions_sharded(bank, hotel, threshold_minutes, workers=None, min_rows=None, mode=None):
+    """
+    Same result, in the same shape, as the serial matcher for ``mode`` (see
+    ``get_matcher``), computed over independent time shards on a process
+    pool. The merge is deterministic: matched and unmatched rows are put back
+    in original statement order, so the output is identical to the serial
+    run. Small inputs and ``workers <= 1`` run serially.
+
+    Shards are cut at gaps in the combined timeline, not by terminal x day:
+    hotel rows carry no terminal, so terminal shards would compete for the
+    same hotel rows, and a day boundary inside a busy hour would split rows
+    that can still match each other.
+    """
+    workers = workers if workers is not None else getattr(settings, "RECON_MATCH_WORKERS", 0)
+    min_rows = min_rows if min_rows is not None else getattr(settings, "RECON_PARALLEL_MATCH_MIN_ROWS", 5000)
+    mode = mode or getattr(settings, "RECON_MATCH_MODE", "first")
+    matcher = get_matcher(mode)
+
+    if workers <= 1 or bank.empty or hotel.empty or len(bank) + len(hotel) < min_rows:
+        return matcher(bank, hotel, threshold_minutes)
+
+    bank_seg, hotel_seg = time_segments(bank, hotel, threshold_minutes)
+    shard_of = plan_shards(bank_seg, hotel_seg, workers * 4)
+    bank_shard = bank_seg.map(shard_of).fillna(-1).astype(int)
+    hotel_shard = hotel_seg.map(shard_of).fillna(-1).astype(int)
+    shards = sorted(set(shard_of.values()))
+    if len(shards) <= 1:
+        return matcher(bank, hotel, threshold_minutes)
+
+    pool = _get_pool(workers)
+    futures = [
+        pool.submit(
+            _match_shard,
+            bank[bank_shard == shard],
+            hotel[hotel_shard == shard],
+            threshold_minutes,
+            mode,
+        )
+        for shard in shards
+    ]
+
+    pairs = []
+    un_bank_idx = list(bank.index[bank_shard == -1])  # no DT: never matches
+    for done, future in enumerate(futures, start=1):
+        rec_b, rec_h, un_b = future.result()
+        pairs.extend(zip(rec_b, rec_h))
+        un_bank_idx.extend(un_b)
+        publish("match.progress", shards=len(futures), shardsDone=done, rowsMatched=len(pairs))
+
+    # Serial order: bank rows in statement order, hotel rows in the order
+    # their bank row claimed them, leftovers in hotel statement order
+    bank_pos = pd.Series(np.arange(len(bank)), index=bank.index)
+    pairs.sort(key=lambda p: bank_pos[p[0]])
+    un_bank_idx.sort(key=lambda i: bank_pos[i])
+
+    rec_bank_list = [bank.loc[b] for b, _ in pairs]
+    rec_hotel_list = [hotel.loc[h] for _, h in pairs]
+    un_bank_list = [bank.loc[b] for b in un_bank_idx]
+    un_hotel_df = hotel.drop(index=[h for _, h in pairs])
+    return rec_bank_list, rec_hotel_list, un_bank_list, un_hotel_df
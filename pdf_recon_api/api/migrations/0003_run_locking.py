@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_add_client_name_to_reconciliationrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reconciliationrecord',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='reconciliationrecord',
+            name='result',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reconciliationrecord',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reconciliationrecord',
+            name='status',
+            field=models.CharField(choices=[('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='completed', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='reconciliationrecord',
+            name='max_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='reconciliationrecord',
+            name='min_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='reconciliationrecord',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['running', 'completed']), models.Q(('content_hash', ''), _negated=True)), fields=('client_name', 'content_hash'), name='unique_active_run_per_client_content'),
+        ),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:45
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_rollups(apps, schema_editor):
+    # Earlier runs have no per-card totals; only the run-level row is known
+    ReconciliationRecord = apps.get_model('api', 'ReconciliationRecord')
+    ClientRollup = apps.get_model('api', 'ClientRollup')
+    rollups = {}
+    for record in ReconciliationRecord.objects.filter(status='completed').iterator():
+        key = (record.client_name, timezone.localdate(record.processed_at))
+        rollup = rollups.setdefault(key, ClientRollup(client_name=key[0], day=key[1], card_type='ALL'))
+        rollup.runs += 1
+        rollup.transactions += record.total_transactions
+    ClientRollup.objects.bulk_create(rollups.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_run_locking'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClientRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('client_name', models.CharField(max_length=255)),
+                ('day', models.DateField()),
+                ('card_type', models.CharField(max_length=32)),
+                ('runs', models.IntegerField(default=0)),
+                ('transactions', models.IntegerField(default=0)),
+                ('reconciled_count', models.IntegerField(default=0)),
+                ('reconciled_amount', models.FloatField(default=0.0)),
+                ('unreconciled_bank_count', models.IntegerField(default=0)),
+                ('unreconciled_bank_amount', models.FloatField(default=0.0)),
+                ('unreconciled_hotel_count', models.IntegerField(default=0)),
+                ('unreconciled_hotel_amount', models.FloatField(default=0.0)),
+                ('total_duration_seconds', models.FloatField(default=0.0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='reconciliationrecord',
+            name='card_type_totals',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='reconciliationrecord',
+            name='duration_seconds',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reconciliationrecord',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reconciliationrecord',
+            name='stage_timings',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddIndex(
+            model_name='reconciliationrecord',
+            index=models.Index(fields=['client_name', '-id'], name='recon_client_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reconciliationrecord',
+            index=models.Index(fields=['client_name', 'min_date', 'max_date'], name='recon_client_range_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='clientrollup',
+            index=models.Index(fields=['card_type', 'day'], name='rollup_card_day_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='clientrollup',
+            constraint=models.UniqueConstraint(fields=('client_name', 'card_type', 'day'), name='unique_rollup_per_client_card_day'),
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
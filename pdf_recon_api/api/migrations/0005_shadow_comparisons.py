@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_run_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShadowComparison',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('client_name', models.CharField(max_length=255)),
+                ('engine', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('primary_seconds', models.FloatField(blank=True, null=True)),
+                ('candidate_seconds', models.FloatField(blank=True, null=True)),
+                ('diverged', models.BooleanField(default=False)),
+                ('counts', models.JSONField(blank=True, default=dict)),
+                ('diffs', models.JSONField(blank=True, default=dict)),
+                ('error', models.TextField(blank=True, default='')),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shadow_comparisons', to='api.reconciliationrecord')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['client_name', 'engine', '-id'], name='shadow_client_recent_idx')],
+            },
+        ),
+    ]
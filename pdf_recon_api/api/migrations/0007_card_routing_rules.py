@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_upload_sessions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CardRoutingRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('client_name', models.CharField(blank=True, default='', max_length=255, unique=True)),
+                ('last4_routes', models.JSONField(blank=True, default=dict)),
+                ('bin_routes', models.JSONField(blank=True, default=dict)),
+                ('aliases', models.JSONField(blank=True, default=dict)),
+                ('excluded_types', models.JSONField(blank=True, default=list)),
+                ('mandatory_types', models.JSONField(blank=True, default=list)),
+                ('attachment_order', models.JSONField(blank=True, default=list)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_run_events_webhooks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClientWorkbook',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('client_name', models.CharField(max_length=255, unique=True)),
+                ('spreadsheet_id', models.CharField(blank=True, default='', max_length=128)),
+                ('snapshot', models.JSONField(blank=True, default=dict, editable=False)),
+                ('version', models.PositiveIntegerField(default=0, editable=False)),
+                ('synced_at', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('synced_run', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.reconciliationrecord')),
+            ],
+        ),
+    ]
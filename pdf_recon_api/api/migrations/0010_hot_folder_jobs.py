@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_client_workbooks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HotFolderJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('folder', models.CharField(max_length=1024)),
+                ('client_name', models.CharField(max_length=255)),
+                ('pair_key', models.CharField(blank=True, default='', max_length=255)),
+                ('bank_path', models.CharField(max_length=1024)),
+                ('hotel_path', models.CharField(max_length=1024)),
+                ('bank_sha256', models.CharField(max_length=64)),
+                ('hotel_sha256', models.CharField(max_length=64)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='running', max_length=16)),
+                ('worker', models.CharField(blank=True, default='', max_length=255)),
+                ('status_code', models.IntegerField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                ('result_path', models.CharField(blank=True, default='', max_length=1024)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('run', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='hot_folder_jobs', to='api.reconciliationrecord')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('client_name', 'bank_sha256', 'hotel_sha256'), name='unique_hot_folder_pair')],
+            },
+        ),
+    ]
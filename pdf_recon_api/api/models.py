@@ -1,16 +1,325 @@
+import uuid
+
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Q
 
 class ReconciliationRecord(models.Model):
+    class Status(models.TextChoices):
+        RUNNING = "running", "Running"
+        COMPLETED = "completed", "Completed"
+        FAILED = "failed", "Failed"
+
     processed_at = models.DateTimeField(auto_now_add=True)
     client_name = models.CharField(max_length=255, default="client")
-    min_date = models.DateField()
-    max_date = models.DateField()
+    # Filled in once the bank statement has been parsed
+    min_date = models.DateField(blank=True, null=True)
+    max_date = models.DateField(blank=True, null=True)
     total_transactions = models.IntegerField(default=0)
     bank_filename = models.CharField(max_length=255, blank=True, null=True)
     hotel_filename = models.CharField(max_length=255, blank=True, null=True)
+    # SHA-256 over both uploads and the matching parameters
+    content_hash = models.CharField(max_length=64, blank=True, default="")
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.COMPLETED)
+    started_at = models.DateTimeField(blank=True, null=True)
+    result = models.JSONField(blank=True, null=True)
+    # Written when the run is released
+    finished_at = models.DateTimeField(blank=True, null=True)
+    duration_seconds = models.FloatField(blank=True, null=True)
+    # {card type: {"reconciledCount": ..., "reconciledAmount": ..., ...}}
+    card_type_totals = models.JSONField(blank=True, default=dict)
+    # {stage: seconds}
+    stage_timings = models.JSONField(blank=True, default=dict)
+
+    class Meta:
+        indexes = [
+            # History listing and the duplicate-range check
+            models.Index(fields=["client_name", "-id"], name="recon_client_recent_idx"),
+            models.Index(fields=["client_name", "min_date", "max_date"], name="recon_client_range_idx"),
+        ]
+        constraints = [
+            # One live run per client and input: a second identical upload
+            # fails to insert and attaches to the existing run instead
+            models.UniqueConstraint(
+                fields=["client_name", "content_hash"],
+                condition=Q(status__in=["running", "completed"]) & ~Q(content_hash=""),
+                name="unique_active_run_per_client_content",
+            ),
+        ]
 
     def __str__(self):
         return (
             f"Recon {self.client_name} {self.min_date} to {self.max_date} "
             f"({self.total_transactions} txns)"
         )
+
+
+class ClientRollup(models.Model):
+    """
+    Totals of completed runs per client, day and card type, updated when a
+    run finishes so history queries never scan the run table. The row with
+    card_type ALL_CARD_TYPES holds the run-level numbers (runs, duration).
+    """
+    ALL_CARD_TYPES = "ALL"
+
+    client_name = models.CharField(max_length=255)
+    day = models.DateField()
+    card_type = models.CharField(max_length=32)
+    runs = models.IntegerField(default=0)
+    transactions = models.IntegerField(default=0)
+    reconciled_count = models.IntegerField(default=0)
+    reconciled_amount = models.FloatField(default=0.0)
+    unreconciled_bank_count = models.IntegerField(default=0)
+    unreconciled_bank_amount = models.FloatField(default=0.0)
+    unreconciled_hotel_count = models.IntegerField(default=0)
+    unreconciled_hotel_amount = models.FloatField(default=0.0)
+    total_duration_seconds = models.FloatField(default=0.0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["client_name", "card_type", "day"],
+                name="unique_rollup_per_client_card_day",
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["card_type", "day"], name="rollup_card_day_idx"),
+        ]
+
+    def __str__(self):
+        return f"Rollup {self.client_name} {self.day} {self.card_type} ({self.runs} runs)"
+
+
+class ShadowComparison(models.Model):
+    """
+    A candidate engine's result for a completed run, compared row by row
+    with what the client got (see shadow.py).
+    """
+    run = models.ForeignKey(ReconciliationRecord, on_delete=models.CASCADE, related_name="shadow_comparisons")
+    client_name = models.CharField(max_length=255)
+    engine = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Extraction + matching time of the primary run and of the candidate
+    primary_seconds = models.FloatField(blank=True, null=True)
+    candidate_seconds = models.FloatField(blank=True, null=True)
+    diverged = models.BooleanField(default=False)
+    # {table: {"primary": n, "candidate": n, "onlyPrimary": n, "onlyCandidate": n}}
+    counts = models.JSONField(blank=True, default=dict)
+    # {table: {"onlyPrimary": [row, ...], "onlyCandidate": [row, ...]}}, capped
+    diffs = models.JSONField(blank=True, default=dict)
+    error = models.TextField(blank=True, default="")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["client_name", "engine", "-id"], name="shadow_client_recent_idx"),
+        ]
+
+    def __str__(self):
+        state = "diverged" if self.diverged else "identical"
+        return f"Shadow {self.engine} run {self.run_id} ({state})"
+
+
+class UploadSession(models.Model):
+    """
+    A resumable upload (see uploads.py). Chunks are appended to a partial
+    file until ``offset`` reaches ``size``. Finalizing verifies the checksum
+    and moves the file into the content-addressed upload store.
+    """
+    class Status(models.TextChoices):
+        OPEN = "open", "Open"
+        COMPLETE = "complete", "Complete"
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    # SHA-256 the client announced (optional) and the one of the stored file
+    expected_sha256 = models.CharField(max_length=64, blank=True, default="")
+    sha256 = models.CharField(max_length=64, blank=True, default="")
+    # Object path in the upload store once complete
+    path = models.CharField(max_length=1024, blank=True, default="")
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.OPEN)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "updated_at"], name="upload_status_updated_idx"),
+        ]
+
+    def __str__(self):
+        return f"Upload {self.id} {self.filename} ({self.offset}/{self.size}, {self.status})"
+
+
+class CardRoutingRule(models.Model):
+    """
+    Card routing for one client (see card_rules.py). The row with an empty
+    client_name applies to every client; a client's own row is layered on
+    top of it. Empty lists inherit; routes and aliases are merged, and a
+    route or alias mapped to "" removes an inherited one.
+    """
+    client_name = models.CharField(max_length=255, unique=True, blank=True, default="")
+    # {"0580": "GCCNET"}: last 4 digits of the card number -> card type
+    last4_routes = models.JSONField(blank=True, default=dict)
+    # {"4847": "NAPS"}: BIN prefix (longest wins) -> card type
+    bin_routes = models.JSONField(blank=True, default=dict)
+    # {"MASTER": "MASTERCARD"}: header / hotel card type name -> canonical name
+    aliases = models.JSONField(blank=True, default=dict)
+    excluded_types = models.JSONField(blank=True, default=list)
+    mandatory_types = models.JSONField(blank=True, default=list)
+    attachment_order = models.JSONField(blank=True, default=list)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def clean(self):
+        errors = {}
+        for field, width in (("last4_routes", 4), ("bin_routes", None)):
+            routes = getattr(self, field)
+            if not isinstance(routes, dict):
+                errors[field] = "Expected an object of card number digits -> card type."
+                continue
+            for digits, card_type in routes.items():
+                if not digits.isdigit() or (width and len(digits) != width) or len(digits) > 8:
+                    errors[field] = f"'{digits}' is not {'4 digits' if width else 'a BIN prefix of up to 8 digits'}."
+                elif not isinstance(card_type, str):
+                    errors[field] = f"Card type for '{digits}' must be a string."
+        if not isinstance(self.aliases, dict) or not all(isinstance(v, str) for v in self.aliases.values()):
+            errors["aliases"] = "Expected an object of card type name -> canonical name."
+        for field in ("excluded_types", "mandatory_types", "attachment_order"):
+            value = getattr(self, field)
+            if not isinstance(value, list) or not all(isinstance(v, str) and v.strip() for v in value):
+                errors[field] = "Expected a list of card type names."
+        if errors:
+            raise ValidationError(errors)
+
+    def __str__(self):
+        return f"Card routing for {self.client_name or 'all clients'}"
+
+
+class RunEvent(models.Model):
+    """
+    A progress event of a run, streamed to clients over Server-Sent Events
+    (see events.py). Stored so any worker process can serve the stream.
+    """
+    run = models.ForeignKey(ReconciliationRecord, on_delete=models.CASCADE, related_name="events")
+    client_name = models.CharField(max_length=255)
+    kind = models.CharField(max_length=32)
+    data = models.JSONField(blank=True, default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["run", "id"], name="event_run_idx"),
+            models.Index(fields=["client_name", "id"], name="event_client_idx"),
+            models.Index(fields=["created_at"], name="event_created_idx"),
+        ]
+
+    def __str__(self):
+        return f"Event {self.kind} run {self.run_id}"
+
+
+class ClientWebhook(models.Model):
+    """Where a client's run completions are POSTed, and the signing secret."""
+    client_name = models.CharField(max_length=255, unique=True)
+    url = models.URLField(max_length=1024)
+    secret = models.CharField(max_length=255)
+    active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Webhook for {self.client_name} -> {self.url}"
+
+
+class WebhookDelivery(models.Model):
+    """One webhook notification and its delivery attempts (see webhooks.py)."""
+    class Status(models.TextChoices):
+        PENDING = "pending", "Pending"
+        DELIVERED = "delivered", "Delivered"
+        FAILED = "failed", "Failed"
+
+    # Sent as X-Recon-Delivery so receivers can drop duplicates
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    webhook = models.ForeignKey(ClientWebhook, on_delete=models.CASCADE, related_name="deliveries")
+    run = models.ForeignKey(ReconciliationRecord, on_delete=models.CASCADE, related_name="webhook_deliveries")
+    event = models.CharField(max_length=32)
+    payload = models.JSONField()
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(blank=True, null=True)
+    last_status_code = models.IntegerField(blank=True, null=True)
+    last_error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    delivered_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "next_attempt_at"], name="delivery_due_idx"),
+        ]
+
+    def __str__(self):
+        return f"Delivery {self.event} run {self.run_id} ({self.status}, {self.attempts} attempts)"
+
+
+class ClientWorkbook(models.Model):
+    """
+    A client's living Google Sheet, updated in place by every run (see
+    sheet_sync.py) when RECON_GOOGLE_SHEET_MODE is "workbook".
+    """
+    client_name = models.CharField(max_length=255, unique=True)
+    # Blank: a spreadsheet is created on the first sync
+    spreadsheet_id = models.CharField(max_length=128, blank=True, default="")
+    # {"spreadsheetId", "tabs": {tab: {"rows": [row hash, ...], ...}}}: what the
+    # last sync wrote; empty = read the sheet
+    snapshot = models.JSONField(blank=True, default=dict, editable=False)
+    # Bumped by every sync; a sync that loses the race drops the snapshot
+    version = models.PositiveIntegerField(default=0, editable=False)
+    synced_run = models.ForeignKey(
+        ReconciliationRecord, null=True, blank=True, on_delete=models.SET_NULL, related_name="+", editable=False,
+    )
+    synced_at = models.DateTimeField(null=True, blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Workbook for {self.client_name}"
+
+
+class HotFolderJob(models.Model):
+    """
+    A bank/hotel pair found in a hot folder (see hotfolder.py). The row is
+    inserted before the pair is processed, and the unique constraint makes
+    that insert the claim, so a pair is reconciled at most once. Delete
+    the row to have it processed again.
+    """
+    class Status(models.TextChoices):
+        RUNNING = "running", "Running"
+        DONE = "done", "Done"
+        FAILED = "failed", "Failed"
+
+    folder = models.CharField(max_length=1024)
+    client_name = models.CharField(max_length=255)
+    # The pair's date (or other key) from the file name pattern
+    pair_key = models.CharField(max_length=255, blank=True, default="")
+    bank_path = models.CharField(max_length=1024)
+    hotel_path = models.CharField(max_length=1024)
+    bank_sha256 = models.CharField(max_length=64)
+    hotel_sha256 = models.CharField(max_length=64)
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.RUNNING)
+    run = models.ForeignKey(
+        ReconciliationRecord, null=True, blank=True, on_delete=models.SET_NULL, related_name="hot_folder_jobs",
+    )
+    # hostname:pid of the daemon that claimed the pair
+    worker = models.CharField(max_length=255, blank=True, default="")
+    status_code = models.IntegerField(null=True, blank=True)
+    error = models.TextField(blank=True, default="")
+    result_path = models.CharField(max_length=1024, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["client_name", "bank_sha256", "hotel_sha256"], name="unique_hot_folder_pair",
+            ),
+        ]
+
+    def __str__(self):
+        return f"Hot folder {self.client_name} {self.pair_key} ({self.status})"
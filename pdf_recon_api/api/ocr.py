@@ -0,0 +1,235 @@
+"""
+Adaptive-resolution OCR with a cache of the recognized text.
+
+Pages are first rendered at RECON_OCR_DPI. That is fast, and most lines
+read cleanly at it. Tesseract gives a confidence for every word, and a
+line's confidence is that of its weakest word. Lines below
+RECON_OCR_MIN_CONFIDENCE are the ones where an amount or a time is likely
+garbled and the parser's patterns would silently miss the row. Only those
+lines are read again:
+
+- When few lines are weak, each one is cut from a RECON_OCR_RETRY_DPI
+  render of the page and read as a single line. The better reading wins.
+- When more than RECON_OCR_RETRY_PAGE_SHARE of the lines are weak, the
+  whole page (or region) is read again at RECON_OCR_RETRY_DPI.
+
+The recognized lines are cached in the ``ocr`` cache. The key is the
+page's hash (its raw content streams and images, not the file name) plus
+the settings above. A statement sent again, or a page read once for
+format detection and again for its rows, is not rendered or OCRed twice.
+Page renders are never cached: they are pictures of the statement, card
+numbers included, and are dropped as soon as the page is read.
+"""
+import hashlib
+import os
+import threading
+
+import pdfplumber
+import pytesseract
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+from pdf2image import convert_from_path
+from pdfminer.pdftypes import PDFStream, resolve1
+
+from .storage import file_sha256
+
+# Bump when the reading logic changes, so cached results are not reused
+CACHE_VERSION = 1
+LINE_PADDING = 0.5  # share of the line height kept around a weak line when it is cut out
+SINGLE_LINE_CONFIG = "--psm 7"
+
+# (path, size, mtime) -> page hashes, for the documents this process read last
+_page_hashes = {}
+_page_hashes_lock = threading.Lock()
+MAX_HASHED_DOCUMENTS = 32
+
+
+def get_ocr_cache():
+    try:
+        return caches["ocr"]
+    except InvalidCacheBackendError:
+        return caches["default"]
+
+
+def _ocr_settings():
+    low = getattr(settings, "RECON_OCR_DPI", 150)
+    return (
+        low,
+        max(low, getattr(settings, "RECON_OCR_RETRY_DPI", 300)),
+        getattr(settings, "RECON_OCR_MIN_CONFIDENCE", 60),
+        getattr(settings, "RECON_OCR_RETRY_PAGE_SHARE", 0.5),
+    )
+
+
+def _xobjects(resources):
+    return resolve1((resolve1(resources) or {}).get("XObject")) or {}
+
+
+def _hash_stream(digest, obj, seen, depth=0):
+    obj = resolve1(obj)
+    if not isinstance(obj, PDFStream) or id(obj) in seen:
+        return
+    seen.add(id(obj))
+    digest.update(obj.get_rawdata() or b"")
+    if depth < 3:
+        # Form XObjects carry their own images
+        xobjects = _xobjects(obj.attrs.get("Resources"))
+        for name in sorted(xobjects):
+            _hash_stream(digest, xobjects[name], seen, depth + 1)
+
+
+def _hash_page(page):
+    page_obj = page.page_obj
+    digest = hashlib.sha256(repr((page_obj.mediabox, page_obj.cropbox, page_obj.rotate)).encode())
+    seen = set()
+    for stream in page_obj.contents:
+        _hash_stream(digest, stream, seen)
+    xobjects = _xobjects(page_obj.resources)
+    for name in sorted(xobjects):
+        _hash_stream(digest, xobjects[name], seen)
+    return digest.hexdigest()
+
+
+def page_hashes(pdf):
+    """
+    Content hash of every page of ``pdf``, computed once per file version.
+    A page that cannot be hashed falls back to the file's hash and page
+    number.
+    """
+    stat = os.stat(pdf)
+    key = (os.path.abspath(pdf), stat.st_size, stat.st_mtime_ns)
+    with _page_hashes_lock:
+        if key in _page_hashes:
+            return _page_hashes[key]
+
+    hashes = []
+    with pdfplumber.open(pdf) as p:
+        for page_no, page in enumerate(p.pages, start=1):
+            try:
+                hashes.append(_hash_page(page))
+            except Exception:
+                hashes.append(None)
+    if None in hashes:
+        file_hash = file_sha256(pdf)
+        hashes = [h or f"{file_hash}:{page_no}" for page_no, h in enumerate(hashes, start=1)]
+
+    with _page_hashes_lock:
+        if len(_page_hashes) >= MAX_HASHED_DOCUMENTS:
+            _page_hashes.pop(next(iter(_page_hashes)))
+        _page_hashes[key] = hashes
+    return hashes
+
+
+def page_image(pdf, page_no, dpi):
+    """Page ``page_no`` rendered at ``dpi``; kept in memory only."""
+    return convert_from_path(pdf, dpi=dpi, first_page=page_no, last_page=page_no)[0]
+
+
+class OcrLine:
+    """One line read by Tesseract; the box is in pixels of the image it was read from."""
+
+    def __init__(self, words, left, top, right, bottom, confidence):
+        self.words = words
+        self.left, self.top, self.right, self.bottom = left, top, right, bottom
+        self.confidence = confidence
+
+    @property
+    def text(self):
+        return " ".join(self.words)
+
+
+def _read_lines(img, config=""):
+    """Tesseract's lines of ``img`` with boxes and the confidence of each line's weakest word."""
+    data = pytesseract.image_to_data(img, config=config, output_type=pytesseract.Output.DICT)
+    lines = {}
+    for i, word in enumerate(data["text"]):
+        word = word.strip()
+        if not word:
+            continue
+        left, top = data["left"][i], data["top"][i]
+        right, bottom = left + data["width"][i], top + data["height"][i]
+        # Stray table rules and dots read as punctuation do not count against a line
+        confidence = float(data["conf"][i]) if any(c.isalnum() for c in word) else 100.0
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        line = lines.get(key)
+        if line is None:
+            lines[key] = OcrLine([word], left, top, right, bottom, confidence)
+            continue
+        line.words.append(word)
+        line.left, line.top = min(line.left, left), min(line.top, top)
+        line.right, line.bottom = max(line.right, right), max(line.bottom, bottom)
+        line.confidence = min(line.confidence, confidence)
+    return list(lines.values())
+
+
+def _crop(img, bbox):
+    if bbox is None:
+        return img
+    width, height = img.size
+    return img.crop((
+        round(bbox[0] * width), round(bbox[1] * height),
+        round(bbox[2] * width), round(bbox[3] * height),
+    ))
+
+
+def _reread_line(img, line, scale):
+    """``line`` (read at 1/``scale`` of ``img``'s resolution) read again from ``img``."""
+    pad = (line.bottom - line.top) * LINE_PADDING
+    width, height = img.size
+    box = (
+        max(0, round((line.left - pad) * scale)), max(0, round((line.top - pad) * scale)),
+        min(width, round((line.right + pad) * scale)), min(height, round((line.bottom + pad) * scale)),
+    )
+    reread = _read_lines(img.crop(box), SINGLE_LINE_CONFIG)
+    if not reread:
+        return line
+    words = [w for l in reread for w in l.words]
+    confidence = min(l.confidence for l in reread)
+    if confidence <= line.confidence:
+        return line
+    return OcrLine(words, line.left, line.top, line.right, line.bottom, confidence)
+
+
+def _positions(lines, img, bbox):
+    """``(text, top, bottom)`` with positions as fractions of the whole page."""
+    height = float(img.size[1]) or 1.0
+    top, span = (bbox[1], bbox[3] - bbox[1]) if bbox else (0.0, 1.0)
+    return [(l.text, top + l.top / height * span, top + l.bottom / height * span) for l in lines]
+
+
+def ocr_page_lines(pdf, page_no, bbox=None):
+    """
+    Lines of page ``page_no`` (1-based) as ``(text, top, bottom)``, positions
+    in page fractions. ``bbox`` (page fractions) limits OCR to that part of
+    the page.
+    """
+    low_dpi, retry_dpi, min_confidence, retry_share = _ocr_settings()
+    cache = get_ocr_cache()
+    ttl = getattr(settings, "RECON_OCR_CACHE_TTL", 7 * 24 * 60 * 60)
+    page_hash = page_hashes(pdf)[page_no - 1]
+    box = tuple(round(v, 4) for v in bbox) if bbox else None
+    key = "recon-ocr:" + hashlib.sha256(repr(
+        (CACHE_VERSION, page_hash, box, low_dpi, retry_dpi, min_confidence, retry_share)
+    ).encode()).hexdigest()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    img = _crop(page_image(pdf, page_no, low_dpi), box)
+    lines = _read_lines(img)
+    weak = [i for i, line in enumerate(lines) if line.confidence < min_confidence]
+    if weak and retry_dpi > low_dpi:
+        print(f"OCR page {page_no} of {os.path.basename(pdf)}: {len(weak)} of {len(lines)} line(s) "
+              f"below confidence {min_confidence}; reading them again at {retry_dpi} dpi.")
+        fine = _crop(page_image(pdf, page_no, retry_dpi), box)
+        if len(weak) > retry_share * len(lines):
+            lines, img = _read_lines(fine), fine
+        else:
+            scale = fine.size[0] / (img.size[0] or 1)
+            for i in weak:
+                lines[i] = _reread_line(fine, lines[i], scale)
+
+    result = _positions(lines, img, box)
+    cache.set(key, result, ttl)
+    return result
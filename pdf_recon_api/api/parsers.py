@@ -0,0 +1,337 @@
+import re
+from collections import deque
+from datetime import datetime
+from itertools import chain, islice
+
+import pandas as pd
+
+BANK_COLUMNS = ["Transaction Date","Time","Merchant ID","Invoice No / RRN",
+                "Card Number","Card Type (On us/Off us)","Gross Amount","Commission","Net Amount","Terminal ID"]
+HOTEL_COLUMNS = ["Transaction Date","Time","Room No","Name","Card Reference","Card Type","Amount","Cashier ID"]
+
+BANK_DT_FORMAT = "%d-%m-%Y %H:%M"
+HOTEL_DT_FORMAT = "%d-%m-%y %H:%M"
+
+bank_pattern = re.compile(
+    r"^\d+\s+"
+    r"(\d{2}/\d{2}/\d{4})\s+"
+    r"(\d{2}:\d{2})\s+"
+    r"(?:\d{2})\s+"
+    r"(\S+)\s+"
+    r"(\S+)\s+"
+    r"([\d,]+\.\d{2})\s+"
+    r"([\d,]+\.\d{2})\s+"
+    r"([\d,]+\.\d{2})"
+    r"$"
+)
+
+CARD_TYPES = ("VISA", "MASTERCARD", "NAPS", "GCCNET", "AMEX", "DINERS", "JCB")
+
+card_type_header_pattern = re.compile(r"(ON-US|OFF-US)\s+(VISA|MASTERCARD|NAPS|GCCNET|AMEX|DINERS|JCB)", re.IGNORECASE)
+
+# Header lines that open a new merchant/terminal section
+section_merchant_pattern = re.compile(r"MERCHANT ID (\S+)")
+section_terminal_pattern = re.compile(r"TERMINAL ID (\S+)")
+# The document header (first HEADER_SCAN_LINES lines) may label the merchant
+# with just "... ID <id>"
+header_merchant_pattern = re.compile(r"ID (\S+)")
+
+HEADER_SCAN_LINES = 20
+
+GCCNET_CARD_LAST_4_DIGITS = {"0580", "8628", "8134"}
+
+# Routing every client gets unless its rules say otherwise (see card_rules.py)
+DEFAULT_CARD_ALIASES = {"MASTER": "MASTERCARD"}
+DEFAULT_EXCLUDED_CARD_TYPES = ["AMEX", "DINERS", "JCB"]
+DEFAULT_MANDATORY_CARD_TYPES = ["VISA", "MASTERCARD", "NAPS", "GCCNET"]
+
+hotel_txn_pattern = re.compile(
+    r"^"
+    r"(\d{2}/\d{2}/\d{2})\s+"
+    r"(\d{2}:\d{2})\s+"
+    r"(\S+)\s+"
+    r"(.*?)\s*"
+    r"(?P<txn_code>\d{5})\s+"
+    r"((?:POS - )?(?:Visa|Master|Amex|NAPS|GCCNET|Other)(?: Card)?)\s+"
+    r"(?:(\S+)\s*)?" # Corrected: Removed 'standardised' and ensured regex termination
+    r"(QAR)\s+"
+    r"([\d,]+\.\d{2})\s*(?:-?\s*)?"
+    r"([\d,]+\.\d{2})\s*"
+    r"(\S+)"
+    r"$"
+)
+
+card_num_pattern = re.compile(r"^(\S{4}X+\d{4})")
+check_ref_pattern = re.compile(r"CHECK#\s*(\d+)\s*\[(\d+)\]")
+
+
+def safe_float(x):
+    try:
+        return float(str(x).replace(",", "").strip())
+    except:
+        return 0.0
+
+
+def _strip_card_type(card_type_str):
+    return card_type_str.replace(' Card', '').replace('POS - ', '').upper().strip()
+
+
+class CardRules:
+    """
+    One client's card routing, compiled into plain lookup tables.
+
+    ``last4_routes`` and ``bin_routes`` map the last four digits or a BIN
+    prefix of the card number to the card type the row is filed under,
+    whatever its section header says (last 4 first, then the longest BIN
+    prefix). ``aliases`` map header and hotel card type names to canonical
+    ones. Types in ``excluded_types`` get no attachments; the
+    ``mandatory_types`` always do. ``attachment_order`` lists the types
+    whose attachments come first; the rest follow alphabetically.
+    """
+
+    def __init__(self, last4_routes=None, bin_routes=None, aliases=None, excluded_types=(),
+                 mandatory_types=(), attachment_order=()):
+        # An empty target drops an inherited route
+        self.last4_routes = {str(k): str(v).upper() for k, v in (last4_routes or {}).items() if v}
+        self.bin_routes = {str(k): str(v).upper() for k, v in (bin_routes or {}).items() if v}
+        self.aliases = {str(k).upper(): str(v).upper() for k, v in (aliases or {}).items() if v}
+        self.excluded_types = {t.upper() for t in excluded_types}
+        self.mandatory_types = [t.upper() for t in mandatory_types]
+        self.attachment_order = [t.upper() for t in attachment_order]
+
+        # BIN prefixes grouped by length, longest first
+        lengths = sorted({len(prefix) for prefix in self.bin_routes}, reverse=True)
+        self._bin_tables = [
+            (n, {prefix: t for prefix, t in self.bin_routes.items() if len(prefix) == n}) for n in lengths
+        ]
+        names = sorted(set(CARD_TYPES) | set(self.aliases), key=len, reverse=True)
+        alternation = "|".join(re.escape(name) for name in names)
+        # Bank section headers, aliases included
+        self.header_pattern = re.compile(rf"(ON-US|OFF-US)\s+({alternation})", re.IGNORECASE)
+        # For ``Series.str.extract`` over upper-cased card type cells
+        self.type_pattern = rf"({alternation})"
+
+    def canonical(self, card_type):
+        """Canonical name for an upper-cased card type."""
+        return self.aliases.get(card_type, card_type)
+
+    def route(self, card_number, card_type):
+        """Card type one bank row is filed under."""
+        routed = self.last4_routes.get(card_number[-4:])
+        if routed:
+            return routed
+        for length, table in self._bin_tables:
+            routed = table.get(card_number[:length])
+            if routed:
+                return routed
+        return card_type
+
+    def route_series(self, card_numbers, card_types):
+        """Vectorized ``route`` over whole columns."""
+        card_numbers = card_numbers.fillna("").astype(str)
+        routed = card_numbers.str[-4:].map(self.last4_routes)
+        for length, table in self._bin_tables:
+            routed = routed.fillna(card_numbers.str[:length].map(table))
+        return routed.fillna(card_types)
+
+    def normalize(self, card_type_str):
+        if isinstance(card_type_str, str):
+            return self.canonical(_strip_card_type(card_type_str))
+        return card_type_str
+
+    def normalize_series(self, card_types):
+        """Vectorized ``normalize``: hotel labels such as "POS - Visa Card"."""
+        stripped = (
+            card_types.str.replace(' Card', '', regex=False)
+            .str.replace('POS - ', '', regex=False)
+            .str.upper().str.strip()
+        )
+        return stripped.replace(self.aliases) if self.aliases else stripped
+
+    def attachment_types(self, card_types):
+        """Card types that get attachments, in attachment order."""
+        types = {t.strip() for t in card_types if isinstance(t, str) and t.strip()}
+        types = (types - self.excluded_types) | set(self.mandatory_types)
+        rank = {t: i for i, t in enumerate(self.attachment_order)}
+        return sorted(types, key=lambda t: (rank.get(t, len(rank)), t))
+
+    def __repr__(self):
+        return (f"<CardRules {len(self.last4_routes)} last-4 / {len(self.bin_routes)} BIN routes, "
+                f"{len(self.aliases)} aliases>")
+
+
+DEFAULT_CARD_RULES = CardRules(
+    last4_routes={last4: "GCCNET" for last4 in GCCNET_CARD_LAST_4_DIGITS},
+    aliases=DEFAULT_CARD_ALIASES,
+    excluded_types=DEFAULT_EXCLUDED_CARD_TYPES,
+    mandatory_types=DEFAULT_MANDATORY_CARD_TYPES,
+)
+
+
+def normalize_card_type(card_type_str, rules=None):
+    """
+    Normalize card type strings to standard names.
+    """
+    return (rules or DEFAULT_CARD_RULES).normalize(card_type_str)
+
+
+def parse_row_dt(date_str, time_str, fmt):
+    """
+    Row-at-a-time equivalent of the vectorized ``DT`` column: returns NaT
+    for anything ``pd.to_datetime(..., errors="coerce")`` would reject.
+    """
+    try:
+        return datetime.strptime(date_str.replace('/', '-') + " " + time_str, fmt)
+    except (TypeError, ValueError):
+        return pd.NaT
+
+
+def section_ids(line, in_header=False):
+    """
+    ``(merchant ID, terminal ID)`` a header line sets, None for either it
+    does not. ``in_header`` also accepts the document header's looser
+    merchant label.
+    """
+    tid = section_terminal_pattern.search(line)
+    mid = section_merchant_pattern.search(line)
+    if not mid and not tid and in_header:
+        mid = header_merchant_pattern.search(line)
+    return (mid.group(1) if mid else None), (tid.group(1) if tid else None)
+
+
+def iter_bank_rows(lines, rules=None):
+    """
+    Yield bank statement rows (in ``BANK_COLUMNS`` order) from an iterable of
+    text lines. Only the first 20 lines are buffered for the header scan.
+    Card types are routed with ``rules`` (a CardRules) as rows are read.
+
+    Statements covering several terminals repeat the MERCHANT ID / TERMINAL
+    ID header before each terminal's section; every row carries the IDs of
+    the last header above it. Rows above every header take the first IDs of
+    the document header.
+    """
+    rules = rules or DEFAULT_CARD_RULES
+    header_pattern = rules.header_pattern
+    lines = iter(lines)
+    head = list(islice(lines, HEADER_SCAN_LINES))
+
+    merchant_id = ""
+    terminal_id = ""
+    for l in head:
+        mid, tid = section_ids(l, in_header=True)
+        merchant_id = merchant_id or mid or ""
+        terminal_id = terminal_id or tid or ""
+
+    current_card_type = "UNKNOWN"
+
+    for line_no, l in enumerate(chain(head, lines)):
+        card_header_match = header_pattern.search(l)
+        if card_header_match:
+            current_card_type = rules.canonical(card_header_match.group(2).upper())
+            continue
+
+        match = bank_pattern.match(l)
+        if not match:
+            mid, tid = section_ids(l, in_header=line_no < HEADER_SCAN_LINES)
+            if mid:
+                merchant_id = mid
+            if tid:
+                terminal_id = tid
+            continue
+
+        if match:
+            (date_str, time_str, ref_num, card_num,
+             gross_amount_str, commission_str, net_amount_str) = match.groups()
+
+            card_type_display = rules.route(card_num, current_card_type)
+
+            yield [
+                date_str, time_str,
+                merchant_id, ref_num, card_num, card_type_display,
+                safe_float(gross_amount_str), safe_float(commission_str), safe_float(net_amount_str),
+                terminal_id
+            ]
+
+
+def bank_df(lines, rules=None):
+    df=pd.DataFrame(iter_bank_rows(lines, rules),columns=BANK_COLUMNS)
+    df["DT"]=pd.to_datetime(df["Transaction Date"].str.replace('/','-')+" "+df["Time"], format=BANK_DT_FORMAT, errors="coerce")
+    return df
+
+
+def iter_hotel_rows(lines, unmatched_lines=None, rules=None):
+    """
+    Yield hotel settlement rows (in ``HOTEL_COLUMNS`` order) from an iterable
+    of text lines, with one line of lookahead for the CHECK# and masked card
+    continuation lines. Lines that look like neither are appended to
+    ``unmatched_lines`` when a list is given. Card type labels are kept as
+    printed; ``rules`` normalize them when the report is laid out.
+    """
+    lines = iter(lines)
+    lookahead = deque()
+
+    def peek():
+        if not lookahead:
+            nxt = next(lines, None)
+            if nxt is None:
+                return None
+            lookahead.append(nxt)
+        return lookahead[0]
+
+    while True:
+        l = lookahead.popleft() if lookahead else next(lines, None)
+        if l is None:
+            break
+        match = hotel_txn_pattern.match(l)
+        if match:
+            (date_str, time_str, room_no, name_desc, txn_code, card_type_full, check_ref_num, currency, debit_amount_str, credit_amount_str, cashier_id) = match.groups()
+
+            card_ref_parts = []
+
+            if check_ref_num:
+                check_match_in_ref_num = check_ref_pattern.search(check_ref_num)
+                if check_match_in_ref_num:
+                    card_ref_parts.append(f"CHECK# {check_match_in_ref_num.group(1)} [{check_match_in_ref_num.group(2)}]") # Fixed typo here
+                else:
+                    card_ref_parts.append(check_ref_num)
+
+            next_line_content = peek()
+            if next_line_content is not None:
+                next_line_content = next_line_content.strip()
+                if check_ref_pattern.search(next_line_content):
+                    card_ref_parts.append(next_line_content)
+                    lookahead.popleft()
+
+            next_line_content = peek()
+            if next_line_content is not None:
+                card_num_match_next_line = card_num_pattern.match(next_line_content.strip())
+                if card_num_match_next_line:
+                    card_ref_parts.append(card_num_match_next_line.group(1))
+                    lookahead.popleft()
+
+            card_ref = " / ".join(card_ref_parts)
+
+            yield [
+                date_str, time_str,
+                room_no, name_desc.strip(), card_ref, card_type_full,
+                safe_float(credit_amount_str), cashier_id
+            ]
+        else:
+            if unmatched_lines is not None and l.strip() and not check_ref_pattern.match(l) and not card_num_pattern.match(l):
+                unmatched_lines.append(l.strip())
+
+
+# ===============================
+# HOTEL PDF -> VISA SETTLEMENTS (Attachment 6)
+# ===============================
+def hotel_df(lines, rules=None):
+    unmatched_lines = []
+    df=pd.DataFrame(iter_hotel_rows(lines, unmatched_lines, rules),columns=HOTEL_COLUMNS)
+
+    if unmatched_lines:
+        print("\n--- Unmatched lines from HOTEL PDF (potential missing transactions) ---")
+        for ul in unmatched_lines:
+            print(ul)
+
+    df["DT"]=pd.to_datetime(df["Transaction Date"].str.replace('/','-')+" "+df["Time"], format=HOTEL_DT_FORMAT, errors="coerce")
+    return df
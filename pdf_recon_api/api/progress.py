@@ -0,0 +1,31 @@
+"""
+Publishing hooks for per-run progress events (see events.py).
+
+The run being processed sets its RunProgress in a context variable, so
+extraction, matching and rendering publish without passing it along.
+Outside a tracked run (process pool workers, management commands) the
+hooks do nothing. Nothing here touches the database directly, so modules
+loaded in bare worker processes can import it.
+"""
+from contextvars import ContextVar
+
+current_progress = ContextVar("recon_run_progress", default=None)
+
+
+def publish(kind, **data):
+    progress = current_progress.get()
+    if progress is not None:
+        progress.publish(kind, **data)
+
+
+def report_pages(document, page, pages):
+    progress = current_progress.get()
+    if progress is not None:
+        progress.pages(document, page, pages)
+
+
+def watch_documents(**paths):
+    """Name stored uploads in page events: ``watch_documents(bank=path, ...)``."""
+    progress = current_progress.get()
+    if progress is not None:
+        progress.documents.update({path: name for name, path in paths.items()})
@@ -0,0 +1,110 @@
+"""
+Table regions: the part of a statement page that holds the transaction
+table, so extraction and OCR skip logos, page headers, footers and summary
+boxes.
+
+A region is a box in page fractions ``(x0, top, x1, bottom)``, so the same
+box crops pdfplumber pages (points) and rendered page images (pixels).
+Formats either declare one, or learn one per document:
+- The first page carries the statement header, so it is always read in
+  full. Only the lines from its first table line down to the footer are
+  kept.
+- The first continuation page with table lines is also read in full. Its
+  band (first table line down to the footer) then crops every later page.
+- A cropped page is read again in full, and the band learned again from
+  it, when the crop yields no table line, fewer table lines than the page
+  the band was learned from, or (text pages, where looking is cheap) when
+  the strip above the band holds a table line. A band that starts too low
+  would otherwise drop rows silently. Each re-read is logged.
+"""
+from django.conf import settings
+
+PADDING = 0.005  # page fraction kept around the learned band
+# A learned band never cuts more than these shares of a page, so a short page
+# (end of a section) cannot teach a band that hides rows on the next ones
+MAX_HEADER_CUT = 0.25
+MAX_FOOTER_CUT = 0.15
+
+
+class TableRegion:
+    """
+    Per-document region state. ``patterns`` recognise the lines the format's
+    parser uses (rows and the section/continuation lines around them).
+    """
+
+    def __init__(self, patterns, bbox=None, learn=True, padding=PADDING):
+        self.patterns = patterns
+        self.fixed = tuple(bbox) if bbox else None
+        self.learn_enabled = learn and not self.fixed
+        self.padding = padding
+        self.band = None
+        self.expected_rows = 0
+
+    def is_table_line(self, text):
+        return any(p.search(text) for p in self.patterns)
+
+    def bbox_for(self, page_no):
+        """Crop box for a page, or None when the page must be read in full."""
+        if self.fixed:
+            return self.fixed
+        return self.band if page_no > 1 else None
+
+    def crop_problem(self, lines, read_above=None):
+        """
+        Why the cropped read ``lines`` (texts) of a page cannot be trusted,
+        or None. ``read_above`` returns the text above the band; it is only
+        given where that read is cheap.
+        """
+        rows = sum(1 for text in lines if self.is_table_line(text))
+        if not rows:
+            return "no table line inside the band"
+        if rows < self.expected_rows:
+            return f"{rows} table line(s) inside the band, {self.expected_rows} on the page it was learned from"
+        if read_above is not None and any(self.is_table_line(l) for l in (read_above() or "").split("\n")):
+            return "table lines above the band"
+        return None
+
+    def learn(self, page_no, lines):
+        """
+        Learn from a fully read page. ``lines`` are ``(text, top, bottom)``
+        with positions as page fractions. Returns the texts of the lines
+        inside the page's band. All lines are returned when none is a table
+        line, or when the region is fixed.
+        """
+        table = [i for i, (text, _, _) in enumerate(lines) if self.is_table_line(text)]
+        if not table or not self.learn_enabled:
+            return [text for text, _, _ in lines]
+
+        first, last = table[0], table[-1]
+        top = min(max(0.0, lines[first][1] - self.padding), MAX_HEADER_CUT)
+        # Anything below the last table line is footer (or a closing summary)
+        footer = [t for _, t, _ in lines[last + 1:] if t > lines[last][2]]
+        bottom = max(min(footer) - self.padding, lines[last][2]) if footer else 1.0
+        bottom = max(bottom, 1.0 - MAX_FOOTER_CUT)
+
+        if page_no > 1:
+            self.band = (0.0, top, 1.0, bottom)
+            self.expected_rows = len(table)
+        return [text for text, t, b in lines if t >= top and b <= bottom]
+
+    def forget(self):
+        """Drop the learned band after a cropped read could not be trusted."""
+        self.band = None
+        self.expected_rows = 0
+
+
+def region_for(statement_format):
+    """
+    Fresh TableRegion for one document of ``statement_format``, or None.
+    RECON_TABLE_REGIONS maps ``"<kind>:<name>"`` to a fixed box and
+    overrides the format's own; RECON_LEARN_TABLE_REGIONS = False turns
+    learning off.
+    """
+    if statement_format is None or not statement_format.region_patterns:
+        return None
+    key = f"{statement_format.kind}:{statement_format.name}"
+    bbox = getattr(settings, "RECON_TABLE_REGIONS", {}).get(key, statement_format.table_region)
+    learn = getattr(settings, "RECON_LEARN_TABLE_REGIONS", True)
+    if not bbox and not learn:
+        return None
+    return TableRegion(statement_format.region_patterns, bbox=bbox, learn=learn)
@@ -0,0 +1,155 @@
+"""
+Rendering stage: writes a finished run's artifacts at the same time.
+
+All writers read the same result frames (or a streamed run's spill files)
+and none of them changes them, so they can run side by side:
+
+- The Excel workbook and the HTML preview are CPU-bound. Their bodies run
+  on a process pool (RECON_RENDER_WORKERS) so they do not compete for the
+  GIL with each other or with the request threads.
+- The Parquet export and the Google calls are mostly I/O and run on
+  threads.
+
+Each artifact succeeds or fails on its own. The response waits for the
+local files only. Background artifacts (Google) get RECON_GOOGLE_WAIT more
+seconds and then carry on unobserved, so a Drive outage never holds back
+the local download URLs.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextvars import copy_context
+
+import django
+from django.conf import settings
+from django.db import connection
+
+from .progress import publish
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: forking a threaded web worker is not safe
+            _pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=django.setup,
+            )
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
+
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def run_in_render_process(fn, *args):
+    """
+    ``fn(*args)`` on the render pool; ``fn`` must be a module-level function
+    and its arguments picklable. Runs in this process when
+    RECON_RENDER_WORKERS is 0, or when a pool worker died (the pool is
+    replaced for the next call).
+    """
+    workers = getattr(settings, "RECON_RENDER_WORKERS", 0)
+    if workers < 1:
+        return fn(*args)
+    pool = _get_pool(workers)
+    try:
+        return pool.submit(fn, *args).result()
+    except BrokenProcessPool:
+        print(f"Render worker died while running {fn.__name__}; rendering in-process instead.")
+        _discard_pool(pool)
+        return fn(*args)
+
+
+def _tracked(name, fn):
+    try:
+        result = fn()
+    except Exception as e:
+        publish("artifact.finished", artifact=name, ok=False, error=str(e))
+        raise
+    else:
+        publish("artifact.finished", artifact=name, ok=True)
+        return result
+    finally:
+        # The writer's thread goes away with the executor
+        connection.close()
+
+
+def _when_all_done(futures, fn):
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def finished(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            fn()
+
+    for future in futures:
+        future.add_done_callback(finished)
+
+
+def render_artifacts(local, background=None, background_wait=None, on_done=None):
+    """
+    Run the writers in ``local`` and ``background`` (``{name: callable}``)
+    together, each on its own thread. Waits for every local writer, then
+    up to ``background_wait`` seconds (RECON_GOOGLE_WAIT by default) for
+    the background ones. ``on_done`` is called once every writer has
+    finished, background ones included, e.g. to remove what they read.
+
+    Returns ``(results, errors)``: ``{name: return value}`` for the writers
+    that finished and ``{name: exception}`` for those that raised. A
+    background writer still running is in neither.
+    """
+    background = background or {}
+    if background_wait is None:
+        background_wait = getattr(settings, "RECON_GOOGLE_WAIT", 10)
+    executor = ThreadPoolExecutor(max_workers=len(local) + len(background), thread_name_prefix="render")
+    try:
+        # Each writer runs in a copy of this context (the run's progress events)
+        futures = {
+            name: executor.submit(copy_context().run, _tracked, name, fn)
+            for name, fn in {**local, **background}.items()
+        }
+    finally:
+        # Threads still running (background) finish on their own
+        executor.shutdown(wait=False)
+    if on_done is not None:
+        _when_all_done(list(futures.values()), on_done)
+
+    wait([futures[name] for name in local])
+    pending_background = [futures[name] for name in background]
+    if pending_background:
+        wait(pending_background, timeout=background_wait)
+
+    results, errors = {}, {}
+    for name, future in futures.items():
+        if not future.done():
+            print(f"Artifact '{name}' still running after {background_wait} s; responding without it.")
+            continue
+        error = future.exception()
+        if error is not None:
+            print(f"Error rendering artifact '{name}': {error}")
+            errors[name] = error
+        else:
+            results[name] = future.result()
+    return results, errors
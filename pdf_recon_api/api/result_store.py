@@ -0,0 +1,341 @@
+"""
+Columnar copy of every run's results, for analytics.
+
+Each completed run writes three Parquet files under RECON_RESULTS_DIR:
+``matched`` (one row per reconciled bank/hotel pair, with the match reason
+and the time delta), ``unmatched_bank`` and ``unmatched_hotel``. Files are
+laid out as ``<table>/client_name=<client>/run_<id>.parquet`` so DuckDB can
+scan one client's files or all of them without loading anything into pandas.
+
+``query_results`` answers aggregate queries across runs and clients. Only
+whitelisted dimensions and metrics are accepted, and filter values are bound
+as parameters, so callers never send SQL.
+"""
+import os
+import re
+
+import duckdb
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from django.conf import settings
+
+from .parsers import DEFAULT_CARD_RULES
+
+TABLES = ("matched", "unmatched_bank", "unmatched_hotel")
+
+# Card-number match first, then amount and time only (see match_transactions)
+REASON_CARD = "card_amount_time"
+REASON_AMOUNT = "amount_time"
+
+BANK_FIELDS = {
+    "Merchant ID": "merchant_id",
+    "Terminal ID": "terminal_id",
+    "Invoice No / RRN": "rrn",
+    "Card Number": "card_number",
+    "Commission": "commission",
+    "Net Amount": "net_amount",
+}
+HOTEL_FIELDS = {
+    "Room No": "room_no",
+    "Name": "guest_name",
+    "Card Reference": "card_reference",
+    "Card Type": "pms_card_type",
+    "Cashier ID": "cashier_id",
+}
+
+# name -> SQL expression, per table
+DIMENSIONS = {
+    "client_name": "client_name",
+    "run_id": "run_id",
+    "card_type": "card_type",
+    "day": "CAST(date_trunc('day', {dt}) AS DATE)",
+    "month": "CAST(date_trunc('month', {dt}) AS DATE)",
+    "match_reason": "match_reason",
+    "terminal_id": "terminal_id",
+    "merchant_id": "merchant_id",
+    "cashier_id": "cashier_id",
+}
+TABLE_DIMENSIONS = {
+    "matched": {"client_name", "run_id", "card_type", "day", "month", "match_reason",
+                "terminal_id", "merchant_id", "cashier_id"},
+    "unmatched_bank": {"client_name", "run_id", "card_type", "day", "month", "terminal_id", "merchant_id"},
+    "unmatched_hotel": {"client_name", "run_id", "card_type", "day", "month", "cashier_id"},
+}
+METRICS = {
+    "count": "count(*)",
+    "amount": "round(sum(amount), 2)",
+    "avg_amount": "round(avg(amount), 2)",
+    "avg_time_delta": "round(avg(abs(time_delta_minutes)), 2)",
+    "max_time_delta": "max(abs(time_delta_minutes))",
+    "runs": "count(DISTINCT run_id)",
+}
+TABLE_METRICS = {
+    "matched": set(METRICS),
+    "unmatched_bank": set(METRICS) - {"avg_time_delta", "max_time_delta"},
+    "unmatched_hotel": set(METRICS) - {"avg_time_delta", "max_time_delta"},
+}
+# Column holding the transaction time, per table
+TIME_COLUMN = {"matched": "bank_dt", "unmatched_bank": "dt", "unmatched_hotel": "dt"}
+
+MAX_QUERY_ROWS = 10000
+
+
+class InvalidResultQuery(ValueError):
+    pass
+
+
+def get_results_dir():
+    return str(getattr(settings, "RECON_RESULTS_DIR", os.path.join(settings.MEDIA_ROOT, "results")))
+
+
+def _partition_value(value):
+    # Hive partition values end up in paths
+    return re.sub(r"[^\w.-]+", "_", str(value)) or "_"
+
+
+def _text(series):
+    return series.fillna("").astype(str)
+
+
+def _dt(df):
+    # Frames built from an empty statement have no DT column
+    if "DT" in df:
+        return pd.to_datetime(df["DT"])
+    return pd.Series(pd.NaT, index=df.index, dtype="datetime64[ns]")
+
+
+def _base_columns(run, client_name, index):
+    return {
+        "run_id": pd.Series(run.pk, index=index, dtype="int64"),
+        "client_name": pd.Series(client_name, index=index, dtype=object),
+        "run_started_at": pd.Series(pd.Timestamp(run.started_at) if run.started_at else pd.NaT, index=index),
+    }
+
+
+def _bank_columns(bank):
+    return {
+        name: bank[col].astype(float) if col in ("Commission", "Net Amount") else _text(bank[col])
+        for col, name in BANK_FIELDS.items()
+    }
+
+
+def _hotel_columns(hotel):
+    return {name: _text(hotel[col]) for col, name in HOTEL_FIELDS.items()}
+
+
+def match_reasons(rec_bank, rec_hotel):
+    """
+    Why each pair matched. A non-GCCNET pair whose last-4 digits agree was
+    found by the card-number pass; everything else by amount and time only.
+    """
+    bank_last_4 = rec_bank["Card Number"].astype(str).str[-4:].to_numpy()
+    card_ref = rec_hotel["Card Reference"].astype(str)
+    hotel_last_4 = card_ref.str[-4:].to_numpy()
+    by_card = (
+        (rec_bank["Card Type (On us/Off us)"].to_numpy() != "GCCNET")
+        & (card_ref.str.len().to_numpy() >= 4)
+        & (bank_last_4 == hotel_last_4)
+    )
+    return pd.Series(by_card, index=rec_bank.index).map({True: REASON_CARD, False: REASON_AMOUNT})
+
+
+def matched_table(run, client_name, rec_bank, rec_hotel):
+    """One row per reconciled pair; the frames are aligned by position."""
+    rec_bank = rec_bank.reset_index(drop=True)
+    rec_hotel = rec_hotel.reset_index(drop=True)
+    columns = _base_columns(run, client_name, rec_bank.index)
+    columns.update({
+        "card_type": _text(rec_bank["Card Type (On us/Off us)"]),
+        "match_reason": match_reasons(rec_bank, rec_hotel),
+        "amount": rec_bank["Gross Amount"].astype(float),
+        "bank_dt": _dt(rec_bank),
+        "hotel_dt": _dt(rec_hotel),
+        "time_delta_minutes": (_dt(rec_hotel) - _dt(rec_bank)).dt.total_seconds() / 60,
+    })
+    columns.update(_bank_columns(rec_bank))
+    columns.update(_hotel_columns(rec_hotel))
+    return pd.DataFrame(columns, index=rec_bank.index)
+
+
+def unmatched_bank_table(run, client_name, un_bank):
+    un_bank = un_bank.reset_index(drop=True)
+    columns = _base_columns(run, client_name, un_bank.index)
+    columns.update({
+        "card_type": _text(un_bank["Card Type (On us/Off us)"]),
+        "amount": un_bank["Gross Amount"].astype(float),
+        "dt": _dt(un_bank),
+    })
+    columns.update(_bank_columns(un_bank))
+    return pd.DataFrame(columns, index=un_bank.index)
+
+
+def unmatched_hotel_table(run, client_name, un_hotel, card_rules=None):
+    un_hotel = un_hotel.reset_index(drop=True)
+    columns = _base_columns(run, client_name, un_hotel.index)
+    columns.update({
+        "card_type": _text((card_rules or DEFAULT_CARD_RULES).normalize_series(un_hotel["Card Type"])),
+        "amount": un_hotel["Amount"].astype(float),
+        "dt": _dt(un_hotel),
+    })
+    columns.update(_hotel_columns(un_hotel))
+    return pd.DataFrame(columns, index=un_hotel.index)
+
+
+def _write_parquet(chunks, path):
+    """
+    Write the non-empty frames of ``chunks`` to one Parquet file, a row group
+    at a time. Returns False, writing nothing, when every frame was empty.
+    """
+    tmp_path = path + ".tmp"
+    writer = None
+    try:
+        for df in chunks:
+            if df.empty:
+                continue
+            table = pa.Table.from_pandas(df, preserve_index=False, schema=writer.schema if writer else None)
+            if writer is None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                writer = pq.ParquetWriter(tmp_path, table.schema, compression="zstd")
+            writer.write_table(table)
+    except BaseException:
+        if writer is not None:
+            writer.close()
+            os.remove(tmp_path)
+        raise
+    if writer is None:
+        return False
+    writer.close()
+    # Readers must never see a half-written file
+    os.replace(tmp_path, path)
+    return True
+
+
+def result_tables(run, client_name, rec_bank, rec_hotel, un_bank, un_hotel, card_rules=None):
+    """
+    The run's matched pairs and unmatched rows in export layout. Built while
+    the frames still carry the ``DT`` helper column.
+    """
+    return {
+        "matched": matched_table(run, client_name, rec_bank, rec_hotel),
+        "unmatched_bank": unmatched_bank_table(run, client_name, un_bank),
+        "unmatched_hotel": unmatched_hotel_table(run, client_name, un_hotel, card_rules),
+    }
+
+
+def streamed_result_tables(run, client_name, stream, card_rules=None):
+    """
+    ``result_tables`` for a StreamingReconciliation: each table is a
+    generator of chunk tables read from the spill files, consumed once by
+    ``export_run`` while the stream is still open.
+    """
+    return {
+        "matched": (matched_table(run, client_name, b, h) for b, h in stream.pair_chunks()),
+        "unmatched_bank": (unmatched_bank_table(run, client_name, c) for c in stream.chunks("un_bank")),
+        "unmatched_hotel": (
+            unmatched_hotel_table(run, client_name, c, card_rules) for c in stream.chunks("un_hotel")
+        ),
+    }
+
+
+def export_run(run, client_name, tables):
+    """
+    Write the tables from ``result_tables`` (or ``streamed_result_tables``)
+    as Parquet; returns the paths written.
+    """
+    root = get_results_dir()
+    partition = f"client_name={_partition_value(client_name)}"
+    file_name = f"run_{run.pk}.parquet"
+    paths = {}
+    for table, chunks in tables.items():
+        if isinstance(chunks, pd.DataFrame):
+            chunks = [chunks]
+        path = os.path.join(root, table, partition, file_name)
+        if _write_parquet(chunks, path):
+            paths[table] = path
+    return paths
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [v.strip() for v in value.split(",") if v.strip()]
+    return list(value)
+
+
+def query_results(table, group_by=None, metrics=None, client_name=None, run_id=None,
+                  card_type=None, date_from=None, date_to=None, limit=1000):
+    """
+    Aggregate one result table across runs with DuckDB. Returns
+    ``{"columns": [...], "rows": [[...], ...]}``; raises InvalidResultQuery
+    for unknown tables, dimensions, metrics or filter values.
+    """
+    if table not in TABLES:
+        raise InvalidResultQuery(f"Unknown table '{table}'. Use one of: {', '.join(TABLES)}.")
+    group_by = _as_list(group_by)
+    metrics = _as_list(metrics) or ["count", "amount"]
+
+    unknown = [d for d in group_by if d not in TABLE_DIMENSIONS[table]]
+    if unknown:
+        raise InvalidResultQuery(f"Unknown dimension(s) for {table}: {', '.join(unknown)}.")
+    unknown = [m for m in metrics if m not in TABLE_METRICS[table]]
+    if unknown:
+        raise InvalidResultQuery(f"Unknown metric(s) for {table}: {', '.join(unknown)}.")
+    try:
+        limit = max(1, min(int(limit), MAX_QUERY_ROWS))
+        run_id = int(run_id) if run_id not in (None, "") else None
+        date_from = pd.Timestamp(date_from) if date_from else None
+        date_to = pd.Timestamp(date_to) if date_to else None
+    except (TypeError, ValueError) as e:
+        raise InvalidResultQuery(f"Invalid filter value: {e}")
+
+    columns = group_by + metrics
+    table_dir = os.path.join(get_results_dir(), table)
+    if not os.path.isdir(table_dir):
+        return {"columns": columns, "rows": []}
+
+    dt = TIME_COLUMN[table]
+    select = [f"{DIMENSIONS[d].format(dt=dt)} AS {d}" for d in group_by]
+    select += [f"{METRICS[m]} AS {m}" for m in metrics]
+
+    where, params = [], []
+    if client_name:
+        where.append("client_name = ?")
+        params.append(client_name)
+    if run_id is not None:
+        where.append("run_id = ?")
+        params.append(run_id)
+    if card_type:
+        where.append("card_type = ?")
+        params.append(card_type.upper())
+    if date_from is not None:
+        where.append(f"{dt} >= ?")
+        params.append(date_from.to_pydatetime())
+    if date_to is not None:
+        # Inclusive of the whole end day
+        where.append(f"{dt} < ?")
+        params.append((date_to.normalize() + pd.Timedelta(days=1)).to_pydatetime())
+
+    # A client filter only needs that client's partition; the WHERE clause
+    # still applies because partition names are sanitized
+    partition = f"client_name={_partition_value(client_name)}" if client_name else "*"
+    source_glob = os.path.join(table_dir, partition, "*.parquet").replace("'", "''")
+    sql = (
+        f"SELECT {', '.join(select)} "
+        f"FROM read_parquet('{source_glob}', hive_partitioning = false, union_by_name = true)"
+    )
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if group_by:
+        positions = ", ".join(str(i + 1) for i in range(len(group_by)))
+        sql += f" GROUP BY {positions} ORDER BY {positions}"
+    sql += f" LIMIT {limit}"
+
+    with duckdb.connect() as con:
+        try:
+            rows = con.execute(sql, params).fetchall()
+        except duckdb.IOException:
+            # No run has been exported yet
+            rows = []
+    return {"columns": columns, "rows": [list(r) for r in rows]}
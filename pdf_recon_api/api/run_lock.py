@@ -0,0 +1,150 @@
+"""
+Atomic claim of a reconciliation run.
+
+A run is claimed by inserting a RUNNING ReconciliationRecord before any
+processing happens. The partial unique constraint on (client_name,
+content_hash) makes the insert the lock: a concurrent identical upload gets
+an IntegrityError, finds the in-flight record and waits for its result
+instead of running the pipeline a second time.
+"""
+import hashlib
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .events import publish_run_finished
+from .history import update_rollups
+from .models import ReconciliationRecord
+from .scheduler import SchedulerBusy
+from .webhooks import queue_run_webhook
+
+ACTIVE_STATUSES = [ReconciliationRecord.Status.RUNNING, ReconciliationRecord.Status.COMPLETED]
+
+
+def upload_sha256(uploaded_file):
+    # Resumable uploads were hashed when they were stored
+    if getattr(uploaded_file, "sha256", None):
+        return uploaded_file.sha256
+    digest = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    # Kept on the upload so storing it does not hash it again
+    uploaded_file.sha256 = digest.hexdigest()
+    return uploaded_file.sha256
+
+
+def run_content_hash(bank_digest, hotel_digest, threshold_minutes):
+    """Identity of a run: both uploads plus the parameters that change its result."""
+    key = f"{bank_digest}:{hotel_digest}:{threshold_minutes}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def claim_run(client_name, content_hash, bank_filename, hotel_filename):
+    """
+    Return ``(record, claimed)``. ``claimed`` is True when this request owns
+    the run; otherwise ``record`` is the RUNNING or COMPLETED run that holds
+    the claim. A RUNNING record older than RECON_RUN_LOCK_TTL seconds is
+    assumed to belong to a dead worker and is taken over.
+    """
+    lock_ttl = getattr(settings, "RECON_RUN_LOCK_TTL", 3600)
+
+    for _ in range(3):
+        try:
+            with transaction.atomic():
+                record = ReconciliationRecord.objects.create(
+                    client_name=client_name,
+                    content_hash=content_hash,
+                    status=ReconciliationRecord.Status.RUNNING,
+                    started_at=timezone.now(),
+                    bank_filename=bank_filename,
+                    hotel_filename=hotel_filename,
+                )
+            return record, True
+        except IntegrityError:
+            pass
+
+        existing = ReconciliationRecord.objects.filter(
+            client_name=client_name,
+            content_hash=content_hash,
+            status__in=ACTIVE_STATUSES,
+        ).first()
+        if existing is None:
+            # The holder failed between our insert and this lookup
+            continue
+
+        stale_before = timezone.now() - timedelta(seconds=lock_ttl)
+        if existing.status == ReconciliationRecord.Status.RUNNING and existing.started_at < stale_before:
+            taken_over = ReconciliationRecord.objects.filter(
+                pk=existing.pk,
+                status=ReconciliationRecord.Status.RUNNING,
+                started_at=existing.started_at,
+            ).update(started_at=timezone.now())
+            if taken_over:
+                existing.refresh_from_db()
+                return existing, True
+            continue
+
+        return existing, False
+
+    raise SchedulerBusy("Could not claim the reconciliation run.", getattr(settings, "RECON_RETRY_AFTER", 30))
+
+
+def wait_for_run(record):
+    """
+    Poll an in-flight run until it leaves RUNNING. Raises SchedulerBusy if
+    it is still running after RECON_RUN_LOCK_WAIT seconds.
+    """
+    poll = getattr(settings, "RECON_RUN_LOCK_POLL", 1.0)
+    deadline = time.monotonic() + getattr(settings, "RECON_RUN_LOCK_WAIT", 600)
+
+    while record.status == ReconciliationRecord.Status.RUNNING:
+        if time.monotonic() >= deadline:
+            raise SchedulerBusy(
+                "An identical reconciliation is still running.",
+                getattr(settings, "RECON_RETRY_AFTER", 30),
+            )
+        time.sleep(poll)
+        record.refresh_from_db(fields=["status", "result"])
+    return record
+
+
+def finish_run(record, response):
+    """
+    Release the claim, keeping the response payload of a successful run.
+    Completed runs are added to the history rollups in the same transaction.
+    """
+    record.finished_at = timezone.now()
+    if record.started_at:
+        record.duration_seconds = round((record.finished_at - record.started_at).total_seconds(), 3)
+    with transaction.atomic():
+        if response is not None and response.status_code == 200:
+            record.status = ReconciliationRecord.Status.COMPLETED
+            record.result = response.data
+        else:
+            record.status = ReconciliationRecord.Status.FAILED
+        record.save(update_fields=[
+            "status", "result", "min_date", "max_date", "total_transactions",
+            "finished_at", "duration_seconds", "card_type_totals", "stage_timings",
+        ])
+        if record.status == ReconciliationRecord.Status.COMPLETED:
+            update_rollups(record)
+    notify_run_finished(record, response)
+
+
+def notify_run_finished(record, response):
+    """Terminal progress event and the client's webhook; never fails the run."""
+    status_code = response.status_code if response is not None else 500
+    try:
+        event, fields = publish_run_finished(record, status_code, getattr(response, "data", None))
+        queue_run_webhook(record, event, {
+            "event": event,
+            "runId": record.pk,
+            "clientName": record.client_name,
+            "finishedAt": record.finished_at.isoformat(),
+            **fields,
+        })
+    except Exception as e:
+        print(f"Error sending completion notifications for run {record.pk}: {e}")
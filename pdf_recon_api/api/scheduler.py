@@ -0,0 +1,256 @@
+"""
+Admission control and per-stage concurrency limits for reconciliation runs.
+
+Every request is admitted (or turned away with 503 when too many are already
+in flight), and the CPU-heavy stages - text extraction, OCR and Excel
+rendering - each have a fixed number of slots. Waiters for a stage are served
+round-robin across clients and FIFO within a client, so one client uploading
+a batch cannot starve the others.
+
+Admission and the round-robin queue are per process. The stage limits are
+also enforced across all worker processes on the host: a request that got
+its turn in its own process then takes one of the stage's numbered lock
+files in RECON_STAGE_LOCK_DIR (flock, released by the kernel if the worker
+dies). Without a lock directory the limits apply to each process alone.
+"""
+import contextvars
+import fcntl
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+
+from django.conf import settings
+
+DEFAULT_STAGE_LIMITS = {"extraction": 2, "ocr": 1, "excel": 2}
+HOST_SLOT_POLL = 0.05  # seconds between tries for a host-wide slot
+
+current_client = contextvars.ContextVar("recon_client", default="client")
+
+
+class SchedulerBusy(Exception):
+    """Raised when a request cannot be admitted or a stage slot times out."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class StageStats:
+    def __init__(self):
+        self.granted = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, waited):
+        self.granted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+
+class HostSlots:
+    """
+    At most ``limit`` holders of a stage across the processes on this host:
+    slot ``i`` of a stage is an exclusive flock on ``<stage>.<i>.lock``.
+    """
+
+    def __init__(self, directory):
+        self.directory = str(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def acquire(self, stage, limit, deadline):
+        """Descriptor of the lock file held, or None once ``deadline`` has passed."""
+        while True:
+            for i in range(limit):
+                fd = os.open(os.path.join(self.directory, f"{stage}.{i}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(fd)
+                    continue
+                return fd
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(HOST_SLOT_POLL)
+
+    @staticmethod
+    def release(fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+
+class StageScheduler:
+    def __init__(self, stage_limits, max_in_flight, wait_timeout, retry_after, lock_dir=None):
+        self.stage_limits = dict(stage_limits)
+        self.max_in_flight = max_in_flight
+        self.wait_timeout = wait_timeout
+        self.default_retry_after = retry_after
+        self.host_slots = HostSlots(lock_dir) if lock_dir else None
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._rejected = 0
+        self._completed = 0
+        self._total_run_time = 0.0
+        self._running = defaultdict(int)
+        # stage -> {client: deque of waiting tickets}, in round-robin order
+        self._waiting = defaultdict(OrderedDict)
+        self._stats = defaultdict(StageStats)
+
+    @classmethod
+    def from_settings(cls):
+        limits = dict(DEFAULT_STAGE_LIMITS)
+        limits.update(getattr(settings, "RECON_STAGE_LIMITS", {}))
+        return cls(
+            stage_limits=limits,
+            max_in_flight=getattr(settings, "RECON_MAX_IN_FLIGHT", 8),
+            wait_timeout=getattr(settings, "RECON_STAGE_WAIT_TIMEOUT", 300),
+            retry_after=getattr(settings, "RECON_RETRY_AFTER", 30),
+            lock_dir=getattr(settings, "RECON_STAGE_LOCK_DIR", None),
+        )
+
+    def retry_after(self):
+        """Seconds a rejected client should wait: roughly one average run."""
+        with self._cond:
+            if self._completed:
+                return max(1, math.ceil(self._total_run_time / self._completed))
+        return self.default_retry_after
+
+    @contextmanager
+    def admit(self, client):
+        """Admit one request for ``client`` or raise ``SchedulerBusy``."""
+        with self._cond:
+            if self._in_flight >= self.max_in_flight:
+                self._rejected += 1
+                busy = True
+            else:
+                self._in_flight += 1
+                busy = False
+        if busy:
+            raise SchedulerBusy("Reconciliation queue is full.", self.retry_after())
+
+        token = current_client.set(client)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            current_client.reset(token)
+            with self._cond:
+                self._in_flight -= 1
+                self._completed += 1
+                self._total_run_time += time.monotonic() - started
+                self._cond.notify_all()
+
+    def _next_ticket(self, stage):
+        for tickets in self._waiting[stage].values():
+            return tickets[0]
+        return None
+
+    @contextmanager
+    def slot(self, stage, client=None):
+        """
+        Hold one slot of ``stage`` for the duration of the block. Stages
+        without a configured limit run unthrottled.
+        """
+        limit = self.stage_limits.get(stage)
+        if not limit:
+            yield
+            return
+
+        client = client or current_client.get()
+        ticket = object()
+        queued_at = time.monotonic()
+        deadline = queued_at + self.wait_timeout
+
+        with self._cond:
+            self._waiting[stage].setdefault(client, deque()).append(ticket)
+            while not (self._running[stage] < limit and self._next_ticket(stage) is ticket):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._remove_ticket(stage, client, ticket)
+                    self._stats[stage].timeouts += 1
+                    self._cond.notify_all()
+                    raise SchedulerBusy(f"Timed out waiting for a {stage} slot.", self.default_retry_after)
+                self._cond.wait(remaining)
+
+            self._remove_ticket(stage, client, ticket)
+            # Served clients go to the back of the line
+            if client in self._waiting[stage]:
+                self._waiting[stage].move_to_end(client)
+            self._running[stage] += 1
+            if self._running[stage] < limit:
+                # The next ticket is at the head now and a slot is still free
+                self._cond.notify_all()
+
+        host_fd = None
+        try:
+            if self.host_slots is not None:
+                host_fd = self.host_slots.acquire(stage, limit, deadline)
+                if host_fd is None:
+                    with self._cond:
+                        self._stats[stage].timeouts += 1
+                    raise SchedulerBusy(f"Timed out waiting for a {stage} slot.", self.default_retry_after)
+            with self._cond:
+                self._stats[stage].record(time.monotonic() - queued_at)
+            yield
+        finally:
+            if host_fd is not None:
+                self.host_slots.release(host_fd)
+            with self._cond:
+                self._running[stage] -= 1
+                self._cond.notify_all()
+
+    def _remove_ticket(self, stage, client, ticket):
+        tickets = self._waiting[stage][client]
+        tickets.remove(ticket)
+        if not tickets:
+            del self._waiting[stage][client]
+
+    def snapshot(self):
+        """Queue depth, running counts and wait times for monitoring."""
+        with self._cond:
+            stages = {}
+            for stage, limit in self.stage_limits.items():
+                stats = self._stats[stage]
+                waiting = self._waiting[stage]
+                stages[stage] = {
+                    "limit": limit,
+                    "running": self._running[stage],
+                    "queued": sum(len(t) for t in waiting.values()),
+                    "queuedByClient": {c: len(t) for c, t in waiting.items()},
+                    "granted": stats.granted,
+                    "timeouts": stats.timeouts,
+                    "avgWaitMs": round(1000 * stats.total_wait / stats.granted, 1) if stats.granted else 0.0,
+                    "maxWaitMs": round(1000 * stats.max_wait, 1),
+                }
+            return {
+                "hostWideStageLimits": self.host_slots is not None,
+                "inFlight": self._in_flight,
+                "maxInFlight": self.max_in_flight,
+                "rejected": self._rejected,
+                "completed": self._completed,
+                "stages": stages,
+            }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = StageScheduler.from_settings()
+    return _scheduler
+
+
+def stage_slot(stage):
+    """Shorthand used by the pipeline modules: ``with stage_slot("ocr"):``."""
+    return get_scheduler().slot(stage)
@@ -0,0 +1,344 @@
+"""
+Shadow mode: re-run a sample of real reconciliations with a candidate engine
+and record where its result differs from the one the client got.
+
+When RECON_SHADOW_ENGINE is set, a share of runs (RECON_SHADOW_SAMPLE_RATE,
+optionally only for RECON_SHADOW_CLIENTS) is handed to a background process
+after the primary result is built. The process runs the candidate on the
+same uploads and compares the result row by row with the primary's matched,
+unmatched-bank and unmatched-hotel tables. It also compares the extraction
+plus matching time. Each comparison is stored as a ShadowComparison, and
+``divergence_report`` sums them up per client. The response never waits for
+the shadow run; when the queue is full, further samples are skipped.
+
+Candidates are the built-in ENGINES below or a dotted path to a callable
+``engine(job) -> (rec_bank, rec_hotel, un_bank, un_hotel)``.
+"""
+import multiprocessing
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+import django
+import pandas as pd
+from django.conf import settings
+from django.db import connections
+from django.db.models import Avg, Count, Q
+from django.utils.module_loading import import_string
+
+from .clock_skew import match_with_clock_skew
+from .extraction import extract_text_lines
+from .formats import get_formats
+from .ingestion import load_statement
+from .matching import match_transactions, match_transactions_optimal, match_transactions_sharded, shutdown_pool
+from .models import ShadowComparison
+from .regions import region_for
+from .result_store import TABLES, result_tables
+from .streaming import StreamingReconciliation
+
+# Columns that identify a row in each result table (see result_store)
+KEY_COLUMNS = {
+    "matched": ["bank_dt", "amount", "card_type", "rrn", "card_number", "terminal_id",
+                "hotel_dt", "room_no", "guest_name", "card_reference", "cashier_id"],
+    "unmatched_bank": ["dt", "amount", "card_type", "rrn", "card_number", "terminal_id"],
+    "unmatched_hotel": ["dt", "amount", "card_type", "room_no", "guest_name", "card_reference", "cashier_id"],
+}
+# Time the candidate is compared against
+PRIMARY_STAGES = ("extract", "match")
+
+
+class ShadowJob:
+    """The inputs of one primary run, as the candidate needs them."""
+
+    def __init__(self, bank_path, hotel_path, threshold_minutes, bank_format=None, hotel_format=None,
+                 bank_extraction=None, hotel_extraction=None, card_rules=None):
+        self.bank_path = bank_path
+        self.hotel_path = hotel_path
+        self.threshold_minutes = threshold_minutes
+        # Format names: instances are looked up again in the worker
+        self.bank_format = bank_format
+        self.hotel_format = hotel_format
+        self.bank_extraction = bank_extraction
+        self.hotel_extraction = hotel_extraction
+        # The client's compiled CardRules, so the worker needs no database
+        self.card_rules = card_rules
+
+    def format(self, kind):
+        name = self.bank_format if kind == "bank" else self.hotel_format
+        return next((fmt for fmt in get_formats(kind) if fmt.name == name), None)
+
+    def load(self, kind, regions=True):
+        path = self.bank_path if kind == "bank" else self.hotel_path
+        extraction = self.bank_extraction if kind == "bank" else self.hotel_extraction
+        fmt = self.format(kind)
+        if fmt is None:
+            return load_statement(path, kind, rules=self.card_rules)
+        return fmt.parse(extract_text_lines(path, extraction, region_for(fmt) if regions else None), self.card_rules)
+
+
+def _as_frames(bank, hotel, matched):
+    # The matchers return row lists and the leftover hotel frame
+    rec_bank, rec_hotel, un_bank, un_hotel = matched
+    rec_bank = pd.DataFrame(rec_bank, columns=bank.columns)
+    rec_hotel = pd.DataFrame(rec_hotel, columns=hotel.columns)
+    un_bank = pd.DataFrame(un_bank, columns=bank.columns)
+    return rec_bank, rec_hotel, un_bank, un_hotel
+
+
+def reference_engine(job):
+    """Whole pages, serial matching: the pipeline before any speed-up."""
+    bank, hotel = job.load("bank", regions=False), job.load("hotel", regions=False)
+    return _as_frames(bank, hotel, match_transactions(bank, hotel, job.threshold_minutes))
+
+
+def sharded_engine(job):
+    """Table regions and sharded matching, whatever the statement size."""
+    bank, hotel = job.load("bank"), job.load("hotel")
+    try:
+        return _as_frames(bank, hotel, match_transactions_sharded(
+            bank, hotel, job.threshold_minutes, workers=max(2, getattr(settings, "RECON_MATCH_WORKERS", 2)), min_rows=0
+        ))
+    finally:
+        # The shard pool would outlive the job in the shadow worker and
+        # block its exit
+        shutdown_pool()
+
+
+def optimal_engine(job):
+    """Nearest-time assignment (RECON_MATCH_MODE = "optimal")."""
+    bank, hotel = job.load("bank"), job.load("hotel")
+    return _as_frames(bank, hotel, match_transactions_optimal(bank, hotel, job.threshold_minutes))
+
+
+def clock_skew_engine(job):
+    """Clock-skew calibration before matching (RECON_CLOCK_SKEW = True)."""
+    bank, hotel = job.load("bank"), job.load("hotel")
+    try:
+        matched, _ = match_with_clock_skew(bank, hotel, job.threshold_minutes, enabled=True)
+        return _as_frames(bank, hotel, matched)
+    finally:
+        shutdown_pool()
+
+
+def streaming_engine(job):
+    """Bounded-memory streaming path (PDF statements only)."""
+    with StreamingReconciliation(
+        job.bank_path, job.hotel_path, job.threshold_minutes,
+        bank_format=job.format("bank"), hotel_format=job.format("hotel"),
+        bank_extraction=job.bank_extraction, hotel_extraction=job.hotel_extraction, card_rules=job.card_rules,
+    ) as stream:
+        stream.prepare()
+        stream.run()
+        return tuple(stream.frame(name) for name in ("rec_bank", "rec_hotel", "un_bank", "un_hotel"))
+
+
+ENGINES = {
+    "reference": reference_engine,
+    "sharded": sharded_engine,
+    "optimal": optimal_engine,
+    "clock_skew": clock_skew_engine,
+    "streaming": streaming_engine,
+}
+
+
+def get_engine(name):
+    return ENGINES[name] if name in ENGINES else import_string(name)
+
+
+def _row_keys(df, table):
+    if df is None or df.empty:
+        return Counter()
+    keys = pd.DataFrame(index=df.index)
+    for col in KEY_COLUMNS[table]:
+        values = df[col] if col in df else pd.Series("", index=df.index)
+        if pd.api.types.is_datetime64_any_dtype(values):
+            values = values.dt.strftime("%Y-%m-%d %H:%M").fillna("")
+        elif pd.api.types.is_float_dtype(values):
+            values = values.round(2)
+        keys[col] = values
+    return Counter(keys.itertuples(index=False, name=None))
+
+
+def key_frames(tables):
+    """Only the key columns of result tables: what the worker process needs."""
+    return {
+        table: df[[c for c in KEY_COLUMNS[table] if c in df]] if df is not None else None
+        for table, df in (tables or {}).items()
+    }
+
+
+def compare_tables(primary, candidate, max_rows=None):
+    """
+    Row multiset differences per result table. Returns ``(counts, diffs)``
+    with at most ``max_rows`` sample rows per side and table.
+    """
+    max_rows = max_rows if max_rows is not None else getattr(settings, "RECON_SHADOW_MAX_DIFF_ROWS", 100)
+    counts, diffs = {}, {}
+    for table in TABLES:
+        p = _row_keys(primary.get(table), table)
+        c = _row_keys(candidate.get(table), table)
+        only_primary, only_candidate = p - c, c - p
+        counts[table] = {
+            "primary": sum(p.values()),
+            "candidate": sum(c.values()),
+            "onlyPrimary": sum(only_primary.values()),
+            "onlyCandidate": sum(only_candidate.values()),
+        }
+        if only_primary or only_candidate:
+            columns = KEY_COLUMNS[table]
+            diffs[table] = {
+                side: [dict(zip(columns, key)) for key in sorted(rows.elements(), key=str)[:max_rows]]
+                for side, rows in (("onlyPrimary", only_primary), ("onlyCandidate", only_candidate))
+            }
+    return counts, diffs
+
+
+def run_candidate(engine_name, job, primary_tables, run_id, client_name):
+    """Worker process entry point: run the candidate and diff it."""
+    started = time.monotonic()
+    rec_bank, rec_hotel, un_bank, un_hotel = get_engine(engine_name)(job)
+    seconds = time.monotonic() - started
+    run = SimpleNamespace(pk=run_id, started_at=None)
+    candidate = result_tables(run, client_name, rec_bank, rec_hotel, un_bank, un_hotel, job.card_rules)
+    counts, diffs = compare_tables(primary_tables, candidate)
+    return seconds, counts, diffs
+
+
+_executor = None
+_pending = 0
+_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=getattr(settings, "RECON_SHADOW_WORKERS", 1),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=django.setup,
+        )
+    return _executor
+
+
+def pick_shadow_engine(client_name):
+    """Candidate engine name when this run is sampled for shadowing, else None."""
+    engine = getattr(settings, "RECON_SHADOW_ENGINE", None)
+    if not engine:
+        return None
+    clients = getattr(settings, "RECON_SHADOW_CLIENTS", None)
+    if clients and client_name not in clients:
+        return None
+    if random.random() >= getattr(settings, "RECON_SHADOW_SAMPLE_RATE", 0.0):
+        return None
+    return engine
+
+
+def _record(run_id, client_name, engine, primary_seconds, future):
+    global _pending
+    with _lock:
+        _pending -= 1
+    fields = {"primary_seconds": primary_seconds}
+    try:
+        seconds, counts, diffs = future.result()
+        fields.update(
+            candidate_seconds=round(seconds, 3),
+            counts=counts,
+            diffs=diffs,
+            diverged=any(c["onlyPrimary"] or c["onlyCandidate"] for c in counts.values()),
+        )
+    except Exception as e:
+        fields.update(error=f"{e.__class__.__name__}: {e}", diverged=True)
+    try:
+        ShadowComparison.objects.create(run_id=run_id, client_name=client_name, engine=engine, **fields)
+        if fields["diverged"]:
+            print(f"Shadow engine '{engine}' diverged on run {run_id} ({client_name}).")
+    except Exception as e:
+        print(f"Error recording shadow comparison for run {run_id}: {e}")
+    finally:
+        # Runs on the executor's callback thread
+        connections.close_all()
+
+
+def submit_shadow(engine, run, client_name, job, primary_tables, stage_timings):
+    """Queue a candidate run; returns False when the shadow queue is full."""
+    global _pending
+    with _lock:
+        if _pending >= getattr(settings, "RECON_SHADOW_MAX_PENDING", 4):
+            print(f"Shadow queue full, skipping run {run.pk}.")
+            return False
+        _pending += 1
+    primary_seconds = round(sum(stage_timings.get(stage, 0.0) for stage in PRIMARY_STAGES), 3)
+    try:
+        future = _get_executor().submit(
+            run_candidate, engine, job, key_frames(primary_tables), run.pk, client_name
+        )
+    except Exception:
+        with _lock:
+            _pending -= 1
+        raise
+    future.add_done_callback(
+        lambda f: _record(run.pk, client_name, engine, primary_seconds, f)
+    )
+    return True
+
+
+def divergence_report(client_name=None, engine=None, limit=20):
+    """
+    Per client and engine: comparisons, divergences, failures and average
+    primary vs candidate time; plus the most recent divergences with their
+    differing rows.
+    """
+    comparisons = ShadowComparison.objects.all()
+    if client_name:
+        comparisons = comparisons.filter(client_name=client_name)
+    if engine:
+        comparisons = comparisons.filter(engine=engine)
+
+    summary = (
+        comparisons.values("client_name", "engine")
+        .annotate(
+            comparisons=Count("id"),
+            diverged=Count("id", filter=Q(diverged=True)),
+            failed=Count("id", filter=~Q(error="")),
+            avg_primary_seconds=Avg("primary_seconds"),
+            avg_candidate_seconds=Avg("candidate_seconds"),
+        )
+        .order_by("client_name", "engine")
+    )
+    clients = []
+    for row in summary:
+        primary, candidate = row["avg_primary_seconds"], row["avg_candidate_seconds"]
+        clients.append({
+            "clientName": row["client_name"],
+            "engine": row["engine"],
+            "comparisons": row["comparisons"],
+            "diverged": row["diverged"],
+            "failed": row["failed"],
+            "divergenceRate": round(row["diverged"] / row["comparisons"], 4) if row["comparisons"] else None,
+            "avgPrimarySeconds": round(primary, 3) if primary is not None else None,
+            "avgCandidateSeconds": round(candidate, 3) if candidate is not None else None,
+            "speedup": round(primary / candidate, 2) if primary and candidate else None,
+        })
+
+    recent = comparisons.filter(diverged=True).order_by("-id")[:limit]
+    return {
+        "clients": clients,
+        "divergences": [
+            {
+                "id": c.pk,
+                "runId": c.run_id,
+                "clientName": c.client_name,
+                "engine": c.engine,
+                "createdAt": c.created_at,
+                "primarySeconds": c.primary_seconds,
+                "candidateSeconds": c.candidate_seconds,
+                "counts": c.counts,
+                "diffs": c.diffs,
+                "error": c.error,
+            }
+            for c in recent
+        ],
+    }
@@ -0,0 +1,287 @@
+"""
+Diff-based sync of a run's report into the client's living Google Sheet.
+
+With RECON_GOOGLE_SHEET_MODE = "workbook", each client has one
+spreadsheet (ClientWorkbook), updated in place, instead of a new one for
+every run. Each report sheet is one tab. The workbook row keeps a snapshot
+of the last sync: a short hash of every row written to each tab. A sync
+only sends what differs from it:
+
+- The old and new row hashes of each tab are diffed as sequences. Rows
+  that appeared or went away become insertDimension / deleteDimension
+  requests, so an inserted row does not rewrite every row below it.
+- Changed and new rows go out as values in one values.batchUpdate call,
+  one range per run of consecutive rows.
+
+A sync therefore costs a few API calls, and the number of cells written
+follows what changed, not the size of the report. Without a snapshot (a
+workbook set up in the admin, or a failed or concurrent sync) the tabs are
+read once and diffed against what is actually there. Values are written
+RAW and read unformatted, so both sides hash the same.
+"""
+import difflib
+import hashlib
+import json
+import math
+import threading
+from datetime import date, datetime
+
+from django.db.models import F
+from django.utils import timezone
+from googleapiclient.errors import HttpError
+
+from .models import ClientWorkbook
+
+SHEET_URL = "https://docs.google.com/spreadsheets/d/{}"
+DEFAULT_ROWS, DEFAULT_COLUMNS = 1000, 26  # grid of a new tab
+
+# One sync per client at a time in this process
+_client_locks = {}
+_client_locks_lock = threading.Lock()
+
+
+def _client_lock(client_name):
+    with _client_locks_lock:
+        return _client_locks.setdefault(client_name, threading.Lock())
+
+
+def cell_value(value):
+    """A report cell as written to (and read back from) the sheet."""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)) or type(value).__module__ == "numpy":
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return str(value)
+        if math.isnan(number) or math.isinf(number):
+            return ""
+        return int(number) if number.is_integer() else number
+    if isinstance(value, (datetime, date)):
+        return value.isoformat(sep=" ") if isinstance(value, datetime) else value.isoformat()
+    return str(value)
+
+
+def _cells(values):
+    cells = [cell_value(v) for v in values]
+    # The Sheets API leaves out trailing empty cells when reading
+    while cells and cells[-1] == "":
+        cells.pop()
+    return cells
+
+
+def sheet_rows(sheet):
+    """
+    The cells of each row of a report sheet: a frame of rows, or a streamed
+    run's sheet (any iterable of row lists).
+    """
+    rows = sheet.values.tolist() if hasattr(sheet, "values") else sheet
+    return [_cells(row) for row in rows]
+
+
+def row_hash(cells):
+    return hashlib.blake2b(json.dumps(cells, default=str).encode(), digest_size=8).hexdigest()
+
+
+def _tab_range(tab, cells=""):
+    quoted = "'" + tab.replace("'", "''") + "'"
+    return f"{quoted}!{cells}" if cells else quoted
+
+
+class SyncStats:
+    def __init__(self):
+        self.ranges = self.rows_written = self.rows_inserted = self.rows_deleted = 0
+        self.tabs_added = self.tabs_cleared = 0
+
+    def __str__(self):
+        return (f"{self.ranges} range(s), {self.rows_written} row(s) written, {self.rows_inserted} inserted, "
+                f"{self.rows_deleted} deleted, {self.tabs_added} tab(s) added, {self.tabs_cleared} cleared")
+
+
+def diff_tab(sheet_id, tab, old_hashes, new_rows, width, row_count, stats):
+    """
+    ``(requests, value ranges, new hashes)`` that turn a tab holding
+    ``old_hashes`` (in a grid of ``row_count`` rows) into ``new_rows``.
+    Structural requests run bottom-up, so each one's row indexes are still
+    those of the old tab. Values use the new indexes and are written after
+    all of them.
+    """
+    new_hashes = [row_hash(cells) for cells in new_rows]
+    matcher = difflib.SequenceMatcher(None, old_hashes, new_hashes, autojunk=False)
+    requests, data = [], []
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == "equal":
+            continue
+        old_n, new_n = i2 - i1, j2 - j1
+        # Rows below the data are blank already: growing there needs no insert
+        if new_n > old_n and i2 < len(old_hashes):
+            requests.append({"insertDimension": {
+                "range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": i1 + old_n, "endIndex": i1 + new_n},
+                "inheritFromBefore": i1 + old_n > 0,
+            }})
+            row_count += new_n - old_n
+            stats.rows_inserted += new_n - old_n
+        elif old_n > new_n:
+            requests.append({"deleteDimension": {
+                "range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": i1 + new_n, "endIndex": i2},
+            }})
+            row_count -= old_n - new_n
+            stats.rows_deleted += old_n - new_n
+        if new_n:
+            # Padded so a shorter row also blanks the cells the old one used
+            values = [cells + [""] * (width - len(cells)) for cells in new_rows[j1:j2]]
+            data.append({"range": _tab_range(tab, f"A{j1 + 1}"), "values": values})
+            stats.rows_written += new_n
+    if len(new_rows) > row_count:
+        requests.insert(0, {"appendDimension": {
+            "sheetId": sheet_id, "dimension": "ROWS", "length": len(new_rows) - row_count,
+        }})
+    return requests, data, new_hashes
+
+
+def _sheet_properties(sheets_service, spreadsheet_id):
+    """``{title: properties}`` of the spreadsheet's tabs."""
+    spreadsheet = sheets_service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id, fields="sheets.properties",
+    ).execute()
+    return {s["properties"]["title"]: s["properties"] for s in spreadsheet.get("sheets", [])}
+
+
+def _create_spreadsheet(sheets_service, client_name, tabs):
+    spreadsheet = sheets_service.spreadsheets().create(
+        body={
+            "properties": {"title": f"Credit Card Reconciliation - {client_name}"},
+            "sheets": [{"properties": {"title": tab}} for tab in tabs],
+        },
+        fields="spreadsheetId",
+    ).execute()
+    return spreadsheet["spreadsheetId"]
+
+
+def _read_hashes(sheets_service, spreadsheet_id, tabs):
+    """Row hashes and widths of what the given tabs hold now."""
+    if not tabs:
+        return {}
+    response = sheets_service.spreadsheets().values().batchGet(
+        spreadsheetId=spreadsheet_id, ranges=[_tab_range(tab) for tab in tabs],
+        valueRenderOption="UNFORMATTED_VALUE", majorDimension="ROWS",
+    ).execute()
+    read = {}
+    for tab, value_range in zip(tabs, response.get("valueRanges", [])):
+        rows = [_cells(row) for row in value_range.get("values", [])]
+        read[tab] = {"rows": [row_hash(r) for r in rows], "width": max((len(r) for r in rows), default=0)}
+    return read
+
+
+def _sync(sheets_service, workbook, tables, stats):
+    """Bring the workbook's spreadsheet in line with ``tables``; returns the new snapshot."""
+    spreadsheet_id = workbook.spreadsheet_id
+    saved = workbook.snapshot or {}
+    # A snapshot of another spreadsheet (the id was changed in the admin) is useless
+    snapshot = dict(saved.get("tabs", {})) if saved.get("spreadsheetId") == spreadsheet_id else {}
+    properties = None
+    if spreadsheet_id:
+        try:
+            properties = _sheet_properties(sheets_service, spreadsheet_id)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            print(f"Workbook {spreadsheet_id} of {workbook.client_name} is gone; creating a new one.")
+    if properties is None:
+        spreadsheet_id = _create_spreadsheet(sheets_service, workbook.client_name, list(tables))
+        workbook.spreadsheet_id = spreadsheet_id
+        properties = _sheet_properties(sheets_service, spreadsheet_id)
+        # A new spreadsheet is empty: nothing to read
+        snapshot = {tab: {"rows": [], "width": 0, "sheetId": props["sheetId"]} for tab, props in properties.items()}
+
+    # A tab the snapshot does not know (or one deleted and added again) is read as it is
+    unknown = [
+        tab for tab, props in properties.items()
+        if snapshot.get(tab, {}).get("sheetId") != props["sheetId"]
+    ]
+    read = _read_hashes(sheets_service, spreadsheet_id, unknown)
+    for tab in unknown:
+        snapshot[tab] = {**read.get(tab, {"rows": [], "width": 0}), "sheetId": properties[tab]["sheetId"]}
+
+    requests, data, new_snapshot = [], [], {}
+    for tab, rows in tables.items():
+        width = max((len(r) for r in rows), default=0)
+        if tab not in properties:
+            requests.append({"addSheet": {"properties": {"title": tab, "gridProperties": {
+                "rowCount": max(DEFAULT_ROWS, len(rows)), "columnCount": max(DEFAULT_COLUMNS, width),
+            }}}})
+            stats.tabs_added += 1
+            if rows:
+                data.append({"range": _tab_range(tab, "A1"), "values": rows})
+                stats.rows_written += len(rows)
+            new_snapshot[tab] = {"rows": [row_hash(r) for r in rows], "width": width}
+            continue
+
+        props, old = properties[tab], snapshot[tab]
+        grid = props.get("gridProperties", {})
+        columns = grid.get("columnCount", DEFAULT_COLUMNS)
+        if width > columns:
+            requests.append({"appendDimension": {"sheetId": props["sheetId"], "dimension": "COLUMNS",
+                                                 "length": width - columns}})
+        tab_requests, tab_data, hashes = diff_tab(
+            props["sheetId"], tab, old["rows"], rows, max(width, old.get("width", 0)),
+            grid.get("rowCount", DEFAULT_ROWS), stats,
+        )
+        requests.extend(tab_requests)
+        data.extend(tab_data)
+        new_snapshot[tab] = {"rows": hashes, "width": width, "sheetId": props["sheetId"]}
+
+    # Tabs of sheets this report no longer has are emptied, not deleted
+    stale = [tab for tab in properties if tab not in tables and snapshot.get(tab, {}).get("rows")]
+    stats.tabs_cleared = len(stale)
+
+    spreadsheets = sheets_service.spreadsheets()
+    if requests:
+        reply = spreadsheets.batchUpdate(spreadsheetId=spreadsheet_id, body={"requests": requests}).execute()
+        for response in reply.get("replies", []):
+            added = response.get("addSheet", {}).get("properties")
+            if added and added.get("title") in new_snapshot:
+                new_snapshot[added["title"]]["sheetId"] = added.get("sheetId")
+    if data:
+        stats.ranges = len(data)
+        spreadsheets.values().batchUpdate(
+            spreadsheetId=spreadsheet_id, body={"valueInputOption": "RAW", "data": data},
+        ).execute()
+    if stale:
+        spreadsheets.values().batchClear(
+            spreadsheetId=spreadsheet_id, body={"ranges": [_tab_range(tab) for tab in stale]},
+        ).execute()
+        for tab in stale:
+            new_snapshot[tab] = {"rows": [], "width": 0, "sheetId": properties[tab]["sheetId"]}
+    return {"spreadsheetId": spreadsheet_id, "tabs": new_snapshot}
+
+
+def sync_workbook(sheets_service, client_name, tables, run=None):
+    """
+    Write ``tables`` (``{tab: [[cell, ...], ...]}``) to the client's
+    workbook, sending only what changed since the last sync. Returns
+    ``(spreadsheet_id, SyncStats)``.
+    """
+    stats = SyncStats()
+    tables = {tab: [_cells(row) for row in rows] for tab, rows in tables.items()}
+    with _client_lock(client_name):
+        workbook, _ = ClientWorkbook.objects.get_or_create(client_name=client_name)
+        version = workbook.version
+        try:
+            snapshot = _sync(sheets_service, workbook, tables, stats)
+        except Exception:
+            # What the sheet holds now is unknown: the next sync reads it
+            ClientWorkbook.objects.filter(pk=workbook.pk).update(
+                spreadsheet_id=workbook.spreadsheet_id, snapshot={}, version=F("version") + 1,
+            )
+            raise
+        saved = ClientWorkbook.objects.filter(pk=workbook.pk, version=version).update(
+            spreadsheet_id=workbook.spreadsheet_id, snapshot=snapshot, version=version + 1,
+            synced_run=run, synced_at=timezone.now(), updated_at=timezone.now(),
+        )
+        if not saved:
+            # Another process synced meanwhile; neither snapshot can be trusted
+            ClientWorkbook.objects.filter(pk=workbook.pk).update(snapshot={}, version=F("version") + 1)
+    return workbook.spreadsheet_id, stats
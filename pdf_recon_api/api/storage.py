@@ -0,0 +1,329 @@
+"""
+Content-addressed storage for uploads and report artifacts.
+
+Every file is stored once under the SHA-256 of its content:
+
+    <RECON_STORAGE_ROOT>/uploads/ab/abcdef....pdf
+    <RECON_STORAGE_ROOT>/artifacts/ab/abcdef....html[.zst]
+
+An identical upload (a retry, the same statement sent by two clients) reuses
+the existing object. Report files stay at their usual
+``MEDIA_ROOT/{client}_run_{timestamp}/`` URLs, but each one is a hard link
+to its artifact object, so identical files share one copy on disk. An
+object's link count therefore says whether any run folder still uses it.
+
+``collect_garbage`` applies retention and is run by the ``recon_storage``
+management command:
+- It compresses run folders that have gone cold with zstd (``<name>.zst``).
+- It deletes run folders past retention and uploads not used for a while.
+- It then removes objects that nothing links to any more.
+"""
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+import zstandard
+from django.conf import settings
+
+try:
+    import brotli
+except ImportError:  # optional: only .gz variants are written without it
+    brotli = None
+
+UPLOADS, ARTIFACTS = "uploads", "artifacts"
+PARTIAL = "partial"  # resumable uploads still being received
+ZSTD_SUFFIX = ".zst"
+CHUNK_SIZE = 1024 * 1024
+
+# Already compressed: zstd would spend CPU for nothing
+INCOMPRESSIBLE_EXTENSIONS = (".xlsx", ".zip", ".gz", ".br", ".zst", ".parquet", ".png", ".jpg")
+
+RUN_FOLDER_PATTERN = re.compile(r"_run_(\d{8}_\d{6})$")
+
+
+def get_storage_root():
+    return str(getattr(settings, "RECON_STORAGE_ROOT", os.path.join(settings.MEDIA_ROOT, "store")))
+
+
+def _extension(name):
+    ext = os.path.splitext(name or "")[1].lower()
+    # Kept on the object so type sniffing by extension still works
+    return ext if re.fullmatch(r"\.[a-z0-9]{1,8}", ext) else ""
+
+
+def object_path(area, digest, ext=""):
+    return os.path.join(get_storage_root(), area, digest[:2], digest + ext)
+
+
+def _tmp_file(area):
+    tmp_dir = os.path.join(get_storage_root(), "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    return tempfile.NamedTemporaryFile(dir=tmp_dir, prefix=f"{area}_", delete=False)
+
+
+def _commit(tmp_path, area, digest, ext):
+    """Move a fully written temp file into place, or drop it if the object exists."""
+    path = object_path(area, digest, ext)
+    if os.path.exists(path):
+        os.unlink(tmp_path)
+        # Last use: keeps a re-sent upload out of the retention sweep
+        os.utime(path)
+        return path, False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+    return path, True
+
+
+def store_upload(uploaded_file, digest=None):
+    """
+    Store an uploaded file (anything with ``chunks()`` and ``name``) and
+    return the object path. Unless its ``digest`` is already known, hashing
+    happens while the file is written.
+    """
+    sha256 = hashlib.sha256() if digest is None else None
+    with _tmp_file(UPLOADS) as tmp:
+        for chunk in uploaded_file.chunks():
+            if sha256 is not None:
+                sha256.update(chunk)
+            tmp.write(chunk)
+    path, _ = _commit(tmp.name, UPLOADS, digest or sha256.hexdigest(), _extension(uploaded_file.name))
+    return path
+
+
+def partial_upload_path(upload_id):
+    return os.path.join(get_storage_root(), PARTIAL, str(upload_id))
+
+
+def commit_partial_upload(path, name, digest=None):
+    """
+    Move a fully received resumable upload into the upload store (a rename,
+    not a copy) and return the object path.
+    """
+    path, _ = _commit(path, UPLOADS, digest or file_sha256(path), _extension(name))
+    return path
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _replace_with_link(target, path):
+    tmp_link = f"{path}.link"
+    try:
+        os.link(target, tmp_link)
+    except OSError:
+        # Store on another filesystem: keep the plain file
+        return False
+    os.replace(tmp_link, path)
+    return True
+
+
+def store_artifact(path):
+    """
+    Move a freshly written report file into the artifact store and leave a
+    hard link at ``path``. Returns the object path.
+    """
+    obj = object_path(ARTIFACTS, file_sha256(path), _extension(path))
+    if not os.path.exists(obj):
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        try:
+            # New content: the file itself becomes the object, no copy
+            os.link(path, obj)
+            return obj
+        except FileExistsError:
+            pass
+        except OSError:
+            shutil.copyfile(path, obj)
+    _replace_with_link(obj, path)
+    return obj
+
+
+def precompress(path):
+    """
+    Write ``<path>.gz`` (and ``<path>.br`` when brotli is installed) next to
+    a rendered file so downloads can be sent compressed without compressing
+    on every request. The variants are stored like any other artifact.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    variants = [(".gz", lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append((".br", lambda d: brotli.compress(d, quality=11)))
+    for suffix, compress in variants:
+        with open(path + suffix, "wb") as f:
+            f.write(compress(data))
+        store_artifact(path + suffix)
+
+
+def compress_artifact(path):
+    """
+    Replace a run-folder file with ``<path>.zst``, hard-linked to a
+    compressed artifact object. Returns bytes saved in the run folder.
+    """
+    digest = file_sha256(path)
+    zobj = object_path(ARTIFACTS, digest, _extension(path) + ZSTD_SUFFIX)
+    if not os.path.exists(zobj):
+        with _tmp_file(ARTIFACTS) as tmp, open(path, "rb") as src:
+            zstandard.ZstdCompressor(level=19).copy_stream(src, tmp)
+        zobj, _ = _commit(tmp.name, ARTIFACTS, digest, _extension(path) + ZSTD_SUFFIX)
+
+    size = os.path.getsize(path)
+    if not _replace_with_link(zobj, path + ZSTD_SUFFIX):
+        shutil.copyfile(zobj, path + ZSTD_SUFFIX)
+    os.unlink(path)
+    return size - os.path.getsize(path + ZSTD_SUFFIX)
+
+
+def open_artifact(path):
+    """
+    Open a report file for reading, decompressing transparently when only
+    the cold ``.zst`` copy is left. Raises FileNotFoundError otherwise.
+    """
+    if os.path.exists(path):
+        return open(path, "rb")
+    if os.path.exists(path + ZSTD_SUFFIX):
+        return zstandard.ZstdDecompressor().stream_reader(open(path + ZSTD_SUFFIX, "rb"), closefd=True)
+    raise FileNotFoundError(path)
+
+
+def run_folders():
+    """``(path, created)`` of every run folder under MEDIA_ROOT."""
+    media_root = str(settings.MEDIA_ROOT)
+    if not os.path.isdir(media_root):
+        return []
+    folders = []
+    for entry in os.scandir(media_root):
+        match = RUN_FOLDER_PATTERN.search(entry.name)
+        if entry.is_dir() and match:
+            try:
+                created = datetime.strptime(match.group(1), "%Y%m%d_%H%M%S").timestamp()
+            except ValueError:
+                created = entry.stat().st_mtime
+            folders.append((entry.path, created))
+    return folders
+
+
+def _walk_files(root):
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                yield path, os.stat(path)
+            except FileNotFoundError:
+                continue
+
+
+def storage_report():
+    """
+    Space use by area. ``linkedBytes`` is what the run folders would take
+    without deduplication; ``bytes`` is what is actually on disk.
+    """
+    report = {}
+    root = get_storage_root()
+    for area in (UPLOADS, ARTIFACTS):
+        files = total = compressed = unreferenced = 0
+        for path, st in _walk_files(os.path.join(root, area)):
+            files += 1
+            total += st.st_size
+            if path.endswith(ZSTD_SUFFIX):
+                compressed += st.st_size
+            if area == ARTIFACTS and st.st_nlink <= 1:
+                unreferenced += st.st_size
+        report[area] = {"files": files, "bytes": total, "compressedBytes": compressed,
+                        "unreferencedBytes": unreferenced}
+
+    folders = run_folders()
+    linked = own = 0
+    for folder, _ in folders:
+        for _, st in _walk_files(folder):
+            linked += st.st_size
+            if st.st_nlink <= 1:
+                own += st.st_size
+    report["runFolders"] = {"folders": len(folders), "linkedBytes": linked, "unlinkedBytes": own}
+
+    legacy = os.path.join(str(settings.MEDIA_ROOT), "uploads")
+    report["legacyUploads"] = {"bytes": sum(st.st_size for _, st in _walk_files(legacy))}
+    report["partialUploads"] = {"bytes": sum(st.st_size for _, st in _walk_files(os.path.join(root, PARTIAL)))}
+    report["results"] = {"bytes": sum(
+        st.st_size for _, st in _walk_files(str(getattr(settings, "RECON_RESULTS_DIR", "")) or os.devnull)
+    )}
+    report["totalBytes"] = (
+        report[UPLOADS]["bytes"] + report[ARTIFACTS]["bytes"] + own
+        + report["legacyUploads"]["bytes"] + report["partialUploads"]["bytes"] + report["results"]["bytes"]
+    )
+    return report
+
+
+def collect_garbage(upload_days=None, artifact_days=None, compress_days=None, dry_run=False, now=None):
+    """
+    Apply retention and return what was (or, with ``dry_run``, would be)
+    done: counts and bytes per action.
+    """
+    upload_days = upload_days if upload_days is not None else getattr(settings, "RECON_UPLOAD_RETENTION_DAYS", 7)
+    artifact_days = artifact_days if artifact_days is not None else getattr(settings, "RECON_ARTIFACT_RETENTION_DAYS", 90)
+    compress_days = compress_days if compress_days is not None else getattr(settings, "RECON_COMPRESS_AFTER_DAYS", 7)
+    now = now or time.time()
+    day = 24 * 60 * 60
+    stats = {
+        "runFoldersDeleted": 0, "runFolderBytesDeleted": 0,
+        "filesCompressed": 0, "bytesSavedByCompression": 0,
+        "uploadsDeleted": 0, "uploadBytesDeleted": 0,
+        "objectsDeleted": 0, "objectBytesDeleted": 0,
+    }
+
+    # 1. Run folders: delete past retention, compress the cold ones
+    for folder, created in run_folders():
+        age = now - created
+        if artifact_days and age > artifact_days * day:
+            stats["runFoldersDeleted"] += 1
+            stats["runFolderBytesDeleted"] += sum(
+                st.st_size for _, st in _walk_files(folder) if st.st_nlink <= 1
+            )
+            if not dry_run:
+                shutil.rmtree(folder, ignore_errors=True)
+        elif compress_days and age > compress_days * day:
+            for path, st in list(_walk_files(folder)):
+                if path.endswith(INCOMPRESSIBLE_EXTENSIONS):
+                    continue
+                stats["filesCompressed"] += 1
+                if not dry_run:
+                    stats["bytesSavedByCompression"] += compress_artifact(path)
+
+    # 2. Uploads not used within the retention window (and the legacy flat folder)
+    legacy = os.path.join(str(settings.MEDIA_ROOT), "uploads")
+    for root in (os.path.join(get_storage_root(), UPLOADS), legacy):
+        for path, st in list(_walk_files(root)):
+            if upload_days and now - st.st_mtime > upload_days * day:
+                stats["uploadsDeleted"] += 1
+                stats["uploadBytesDeleted"] += st.st_size
+                if not dry_run:
+                    os.unlink(path)
+
+    # 3. Artifact objects no run folder links to any more. In a dry run the
+    # folders above still exist, so this only counts current orphans.
+    for path, st in list(_walk_files(os.path.join(get_storage_root(), ARTIFACTS))):
+        if st.st_nlink <= 1:
+            stats["objectsDeleted"] += 1
+            stats["objectBytesDeleted"] += st.st_size
+            if not dry_run:
+                os.unlink(path)
+
+    # 4. Temp files left by a crashed writer, and resumable uploads nobody
+    # has added to within their session lifetime
+    for path, st in list(_walk_files(os.path.join(get_storage_root(), "tmp"))):
+        if now - st.st_mtime > day and not dry_run:
+            os.unlink(path)
+    session_ttl = getattr(settings, "RECON_UPLOAD_SESSION_TTL", day)
+    for path, st in list(_walk_files(os.path.join(get_storage_root(), PARTIAL))):
+        if now - st.st_mtime > session_ttl and not dry_run:
+            os.unlink(path)
+    return stats
@@ -0,0 +1,350 @@
+"""
+Bounded-memory reconciliation for very large statements.
+
+Pages are extracted and parsed as generators, both sides are put into time
+order with an on-disk merge sort, and bank rows are matched against a rolling
+window of hotel rows no wider than ``threshold_time`` on either side. Rows are
+written to spill files as soon as their fate is final, so the working set is
+the sort buffer plus the window, however many months the statements cover.
+
+Bank rows are matched in DT order, not in statement order. When two bank
+rows compete for the same hotel row, the earlier one in time gets it; the
+in-memory matcher gives it to the one listed first. Statements listed in
+time order reconcile the same either way. The results are spilled in DT
+order too, so the report lists streamed rows by time.
+
+The report is built from the spill files as well: ``split_by_card_type``
+spills each category again per card type with its totals, and the writers
+read those files in chunks.
+"""
+import heapq
+import os
+import pickle
+import tempfile
+from collections import deque
+from datetime import timedelta
+
+import pandas as pd
+from django.conf import settings
+
+from .extraction import iter_text_lines
+from .formats import ACQUIRER_SETTLEMENT, OPERA_CASHIER_REPORT
+from .parsers import BANK_COLUMNS, HOTEL_COLUMNS, parse_row_dt
+from .regions import region_for
+
+BANK_CARD_NUMBER = BANK_COLUMNS.index("Card Number")
+BANK_CARD_TYPE = BANK_COLUMNS.index("Card Type (On us/Off us)")
+BANK_AMOUNT = BANK_COLUMNS.index("Gross Amount")
+HOTEL_CARD_REF = HOTEL_COLUMNS.index("Card Reference")
+HOTEL_AMOUNT = HOTEL_COLUMNS.index("Amount")
+HOTEL_CARD_TYPE = HOTEL_COLUMNS.index("Card Type")
+
+SPILL_CATEGORIES = ("rec_bank", "rec_hotel", "un_bank", "un_hotel")
+BANK_AMOUNT_COLUMNS = ("Gross Amount", "Commission", "Net Amount")
+HOTEL_AMOUNT_COLUMNS = ("Amount",)
+
+
+class SpillFile:
+    """
+    Append-only file of pickled rows that can be re-read as a generator.
+    Once closed it can be pickled, e.g. to hand it to a render process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._fh = open(path, "wb")
+
+    def append(self, row):
+        pickle.dump(row, self._fh, pickle.HIGHEST_PROTOCOL)
+        self.count += 1
+
+    def close(self):
+        if self._fh is not None and not self._fh.closed:
+            self._fh.close()
+
+    def __getstate__(self):
+        self.close()
+        return {**self.__dict__, "_fh": None}
+
+    def __iter__(self):
+        self.close()
+        with open(self.path, "rb") as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+
+class CardTypeSpill(SpillFile):
+    """The rows of one category and card type, with running sums of its amount columns."""
+
+    def __init__(self, path, columns, amount_columns):
+        super().__init__(path)
+        self._amount_idx = {name: columns.index(name) for name in amount_columns}
+        self.totals = dict.fromkeys(amount_columns, 0.0)
+
+    def append(self, row):
+        super().append(row)
+        for name, idx in self._amount_idx.items():
+            if not pd.isna(row[idx]):
+                self.totals[name] += row[idx]
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class StatementStats:
+    """Running totals the view needs once the full frames no longer exist."""
+
+    def __init__(self):
+        self.count = 0
+        self.amount = 0.0
+        self.min_dt = pd.NaT
+        self.max_dt = pd.NaT
+
+    @classmethod
+    def from_frame(cls, df, amount_col):
+        stats = cls()
+        stats.count = len(df)
+        if stats.count:
+            stats.amount = df[amount_col].sum()
+            stats.min_dt = df["DT"].min()
+            stats.max_dt = df["DT"].max()
+        return stats
+
+    def add(self, dt, amount):
+        self.count += 1
+        self.amount += amount
+        if not pd.isna(dt):
+            if pd.isna(self.min_dt) or dt < self.min_dt:
+                self.min_dt = dt
+            if pd.isna(self.max_dt) or dt > self.max_dt:
+                self.max_dt = dt
+
+
+def _sort_key(entry):
+    # (DT, original position): ties keep statement order
+    return entry[1], entry[0]
+
+
+def _sorted_stream(rows, dt_format, amount_idx, stats, undated, spill_dir, prefix, run_size):
+    """
+    External merge sort of parsed rows by DT. Rows are buffered ``run_size``
+    at a time, each sorted run is spilled to disk and the runs are merged
+    lazily. Rows without a usable DT can never match and go straight to
+    ``undated``.
+    """
+    runs = []
+    buf = []
+
+    def flush():
+        run = SpillFile(os.path.join(spill_dir, f"{prefix}_run_{len(runs)}.pkl"))
+        for entry in sorted(buf, key=_sort_key):
+            run.append(entry)
+        run.close()
+        runs.append(run)
+        buf.clear()
+
+    for seq, row in enumerate(rows):
+        dt = parse_row_dt(row[0], row[1], dt_format)
+        stats.add(dt, row[amount_idx])
+        if pd.isna(dt):
+            undated.append(row)
+            continue
+        buf.append((seq, dt, row))
+        if len(buf) >= run_size:
+            flush()
+
+    if buf:
+        flush()
+    return heapq.merge(*runs, key=_sort_key)
+
+
+def _card_ref_matches(hotel_row, last_4):
+    card_ref = hotel_row[HOTEL_CARD_REF]
+    return len(card_ref) >= 4 and card_ref[-4:] == last_4
+
+
+def stream_match(bank_entries, hotel_entries, threshold_minutes, spill):
+    """
+    Rolling-window version of ``matching.match_transactions``.
+
+    Both inputs yield ``(seq, dt, row)`` in DT order. Every hotel row with a
+    DT inside ``[bank DT - threshold, bank DT + threshold]`` is in the window;
+    rows falling behind the window are final and flushed to ``un_hotel``.
+    Among candidates the one earliest in the original statement wins, as in
+    the in-memory matcher. Bank rows take their turn in DT order, though,
+    not in statement order (see the module docstring).
+    """
+    threshold = timedelta(minutes=threshold_minutes)
+    window = deque()
+    hotel_entries = iter(hotel_entries)
+    next_hotel = next(hotel_entries, None)
+
+    for _, b_dt, b in bank_entries:
+        while next_hotel is not None and next_hotel[1] <= b_dt + threshold:
+            window.append(next_hotel)
+            next_hotel = next(hotel_entries, None)
+        while window and window[0][1] < b_dt - threshold:
+            spill["un_hotel"].append(window.popleft()[2])
+
+        amount = b[BANK_AMOUNT]
+        candidates = [e for e in window if e[2][HOTEL_AMOUNT] == amount]
+        if b[BANK_CARD_TYPE] != 'GCCNET':
+            last_4 = str(b[BANK_CARD_NUMBER])[-4:]
+            by_card = [e for e in candidates if _card_ref_matches(e[2], last_4)]
+            candidates = by_card or candidates
+
+        if candidates:
+            chosen = min(candidates, key=lambda e: e[0])
+            window.remove(chosen)
+            spill["rec_bank"].append(b)
+            spill["rec_hotel"].append(chosen[2])
+        else:
+            spill["un_bank"].append(b)
+
+    for entry in window:
+        spill["un_hotel"].append(entry[2])
+    if next_hotel is not None:
+        spill["un_hotel"].append(next_hotel[2])
+    for entry in hotel_entries:
+        spill["un_hotel"].append(entry[2])
+
+
+class StreamingReconciliation:
+    """
+    Runs extraction, parsing and matching for one bank/hotel pair without
+    materializing either statement. Use as a context manager; the spill
+    directory, and every file read from it, is removed on exit.
+    """
+
+    def __init__(self, bank_pdf, hotel_pdf, threshold_minutes, run_size=None,
+                 bank_format=ACQUIRER_SETTLEMENT, hotel_format=OPERA_CASHIER_REPORT,
+                 bank_extraction=None, hotel_extraction=None, card_rules=None):
+        self.bank_pdf = bank_pdf
+        self.hotel_pdf = hotel_pdf
+        self.bank_extraction = bank_extraction
+        self.hotel_extraction = hotel_extraction
+        self.bank_format = bank_format
+        self.hotel_format = hotel_format
+        self.card_rules = card_rules
+        self.threshold_minutes = threshold_minutes
+        self.run_size = run_size or getattr(settings, "RECON_STREAMING_RUN_SIZE", 50000)
+        self.bank_stats = StatementStats()
+        self.hotel_stats = StatementStats()
+        self._tmp = None
+        self.spill = {}
+        self._bank_entries = None
+        self._hotel_entries = None
+
+    def __enter__(self):
+        self._tmp = tempfile.TemporaryDirectory(
+            prefix="recon_spill_", dir=getattr(settings, "RECON_SPILL_DIR", None)
+        )
+        spill_dir = self._tmp.name
+        self.spill = {
+            name: SpillFile(os.path.join(spill_dir, f"{name}.pkl"))
+            for name in SPILL_CATEGORIES
+        }
+        return self
+
+    def __exit__(self, *exc):
+        for f in self.spill.values():
+            f.close()
+        self._tmp.cleanup()
+        return False
+
+    def prepare(self):
+        """
+        Parse both statements into sorted runs. Afterwards ``bank_stats`` and
+        ``hotel_stats`` are complete, so duplicate checks can run before the
+        matching pass.
+        """
+        spill_dir = self._tmp.name
+        bank_rows = self.bank_format.iter_rows(
+            iter_text_lines(self.bank_pdf, self.bank_extraction, region_for(self.bank_format)), self.card_rules
+        )
+        hotel_rows = self.hotel_format.iter_rows(
+            iter_text_lines(self.hotel_pdf, self.hotel_extraction, region_for(self.hotel_format)), self.card_rules
+        )
+        self._bank_entries = _sorted_stream(
+            bank_rows, self.bank_format.dt_format, BANK_AMOUNT, self.bank_stats,
+            self.spill["un_bank"], spill_dir, "bank", self.run_size
+        )
+        self._hotel_entries = _sorted_stream(
+            hotel_rows, self.hotel_format.dt_format, HOTEL_AMOUNT, self.hotel_stats,
+            self.spill["un_hotel"], spill_dir, "hotel", self.run_size
+        )
+
+    def run(self):
+        if self._bank_entries is None:
+            self.prepare()
+        stream_match(self._bank_entries, self._hotel_entries, self.threshold_minutes, self.spill)
+        for f in self.spill.values():
+            f.close()
+
+    def _frame(self, name, rows):
+        is_bank = name.endswith("bank")
+        columns = BANK_COLUMNS if is_bank else HOTEL_COLUMNS
+        dt_format = (self.bank_format if is_bank else self.hotel_format).dt_format
+        df = pd.DataFrame(rows, columns=columns)
+        df["DT"] = pd.to_datetime(
+            [parse_row_dt(d, t, dt_format) for d, t in zip(df["Transaction Date"], df["Time"])]
+        )
+        return df
+
+    def frame(self, name):
+        """Load one finalized category as a DataFrame, with the ``DT`` helper column."""
+        return self._frame(name, iter(self.spill[name]))
+
+    def chunks(self, name, size=None):
+        """One finalized category as DataFrames of at most ``size`` rows, with ``DT``."""
+        for batch in _batches(self.spill[name], size or self.run_size):
+            yield self._frame(name, batch)
+
+    def pair_chunks(self, size=None):
+        """``(rec_bank, rec_hotel)`` chunks; the two spills are aligned pair by pair."""
+        return zip(self.chunks("rec_bank", size), self.chunks("rec_hotel", size))
+
+    def split_by_card_type(self, card_rules, size=None):
+        """
+        Spill each finalized category again, one file per card type, as the
+        in-memory view categorizes frames: bank rows by their card type,
+        hotel rows by the normalized PMS card type. Rows without a card type
+        are left out. Returns ``{category: {card_type: CardTypeSpill}}``.
+        """
+        spill_dir = self._tmp.name
+        parts = {}
+        for name in SPILL_CATEGORIES:
+            is_bank = name.endswith("bank")
+            columns = BANK_COLUMNS if is_bank else HOTEL_COLUMNS
+            amount_columns = BANK_AMOUNT_COLUMNS if is_bank else HOTEL_AMOUNT_COLUMNS
+            by_type = parts[name] = {}
+            for batch in _batches(self.spill[name], size or self.run_size):
+                if is_bank:
+                    card_types = [row[BANK_CARD_TYPE] for row in batch]
+                else:
+                    card_types = card_rules.normalize_series(
+                        pd.Series([row[HOTEL_CARD_TYPE] for row in batch], dtype=object)
+                    )
+                for card_type, row in zip(card_types, batch):
+                    if pd.isna(card_type):
+                        continue
+                    part = by_type.get(card_type)
+                    if part is None:
+                        path = os.path.join(spill_dir, f"{name}_type_{len(by_type)}.pkl")
+                        part = by_type[card_type] = CardTypeSpill(path, columns, amount_columns)
+                    part.append(row)
+            for part in by_type.values():
+                part.close()
+        return parts
@@ -1,3 +1,1808 @@
-from django.test import TestCase
+import base64
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import os
+import pickle
+import re
+import tempfile
+import threading
+import time
+import zipfile
+from types import SimpleNamespace
+from datetime import date, datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+import pytesseract
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from openpyxl import load_workbook
+from PIL import Image
+from pdf2image.exceptions import PopplerNotInstalledError
+from pdfminer.pdfdocument import PDFPasswordIncorrect
+from rest_framework.response import Response
+from rest_framework.test import APIClient
+
+from . import card_rules, extraction, hotfolder, ocr, run_lock, shadow, webhooks
+from .clock_skew import estimate_clock_skew, match_with_clock_skew
+from .events import _Stream, publish_run_finished
+from .extraction import UnreadablePDF, _region_lines, probe_pdf
+from .formats import (
+    ACQUIRER_SETTLEMENT, OPERA_CASHIER_REPORT, StatementFormat, detect_format, get_formats, register_format,
+)
+from .google_sheets_utils import build_service
+from .history import InvalidHistoryQuery, rollup_series, run_history, update_rollups
+from .idempotency import get_idempotency_cache
+from .ingestion import UnsupportedStatementFormat, detect_statement_format, detect_upload_type, load_statement
+from .loadtest import FakeGoogleHandler, FakeGoogleServer, Sample, _split_range, percentile, summarize
+from .models import CardRoutingRule, ClientRollup, ClientWebhook, HotFolderJob, ReconciliationRecord, UploadSession, WebhookDelivery
+from .matching import match_transactions, match_transactions_optimal, match_transactions_sharded, shutdown_pool
+from .parsers import BANK_COLUMNS, DEFAULT_CARD_RULES, HOTEL_COLUMNS, CardRules, iter_bank_rows
+from .regions import TableRegion
+from .result_store import (
+    REASON_AMOUNT, REASON_CARD, InvalidResultQuery, export_run, match_reasons, query_results, result_tables,
+)
+from .scheduler import SchedulerBusy, StageScheduler
+from .sheet_sync import SyncStats, diff_tab, row_hash, sync_workbook
+from .storage import collect_garbage, open_artifact, store_artifact, store_upload
+from .streaming import SPILL_CATEGORIES, CardTypeSpill, StreamingReconciliation, stream_match
+from .uploads import UploadNotReady, stored_upload
+from .views import (
+    ReconciliationAPIView, SpilledAttachment, add_titles_and_total, attach_to_run, parse_reconcile_request,
+    save_uploaded_file, use_streaming_mode, write_excel_report,
+)
+
+
+# ===============================
+# Fixtures
+# ===============================
+def bank_frame(rows):
+    """Bank frame as the parsers build it, from ``(datetime, amount, card number, card type[, terminal])``."""
+    records = []
+    for i, (dt, amount, card, card_type, *terminal) in enumerate(rows):
+        dt = pd.Timestamp(dt)
+        records.append({
+            "Transaction Date": dt.strftime("%d-%m-%Y"), "Time": dt.strftime("%H:%M"),
+            "Merchant ID": "M1", "Invoice No / RRN": f"RRN{i:04d}", "Card Number": card,
+            "Card Type (On us/Off us)": card_type, "Gross Amount": float(amount),
+            "Commission": 0.0, "Net Amount": float(amount), "Terminal ID": terminal[0] if terminal else "T1",
+            "DT": dt,
+        })
+    return pd.DataFrame(records, columns=BANK_COLUMNS + ["DT"])
+
+
+def hotel_frame(rows):
+    """Hotel frame as the parsers build it, from ``(datetime, amount, card reference, card type)``."""
+    records = []
+    for i, (dt, amount, reference, card_type) in enumerate(rows):
+        dt = pd.Timestamp(dt)
+        records.append({
+            "Transaction Date": dt.strftime("%d-%m-%Y"), "Time": dt.strftime("%H:%M"),
+            "Room No": str(100 + i), "Name": f"Guest {i}", "Card Reference": reference,
+            "Card Type": card_type, "Amount": float(amount), "Cashier ID": "C1", "DT": dt,
+        })
+    return pd.DataFrame(records, columns=HOTEL_COLUMNS + ["DT"])
+
+
+def labels(rows):
+    """Index labels of a matcher result (row list or frame)."""
+    if isinstance(rows, pd.DataFrame):
+        return list(rows.index)
+    return [row.name for row in rows]
+
+
+def result_labels(result):
+    rec_bank, rec_hotel, un_bank, un_hotel = result
+    return labels(rec_bank), labels(rec_hotel), labels(un_bank), list(un_hotel.index)
+
+
+def busy_statements(seed=7, clusters=4, rows=18):
+    """
+    Bank and hotel frames with several busy hours hours apart (so sharding
+    has independent segments), repeated amounts and cards (so the first
+    qualifying hotel row is not always the nearest), GCCNET rows, hotel rows
+    without a card reference and rows with no counterpart.
+    """
+    rng = np.random.default_rng(seed)
+    bank_rows, hotel_rows = [], []
+    for cluster in range(clusters):
+        start = pd.Timestamp("2025-02-01 08:00") + pd.Timedelta(hours=6 * cluster)
+        for i in range(rows):
+            minute = int(rng.integers(0, 60))
+            amount = int(rng.choice([100, 150, 200]))
+            last4 = f"{int(rng.choice([1111, 2222, 3333])):04d}"
+            kind = rng.random()
+            if kind < 0.15:
+                bank_rows.append((start + pd.Timedelta(minutes=minute), amount, "GCCNET", "GCCNET"))
+                hotel_rows.append((start + pd.Timedelta(minutes=minute + int(rng.integers(-4, 5))), amount, "", "GCCNET"))
+            elif kind < 0.25:
+                bank_rows.append((start + pd.Timedelta(minutes=minute), amount + 1, f"4111XXXXXXXX{last4}", "VISA"))
+            elif kind < 0.35:
+                hotel_rows.append((start + pd.Timedelta(minutes=minute), amount, "", "VISA"))
+            else:
+                bank_rows.append((start + pd.Timedelta(minutes=minute), amount, f"4111XXXXXXXX{last4}", "VISA"))
+                hotel_rows.append((start + pd.Timedelta(minutes=minute + int(rng.integers(-9, 10))), amount,
+                                   f"XXXXXXXX{last4}", "VISA"))
+    # Statements are not in time order
+    bank = bank_frame(bank_rows).sample(frac=1, random_state=seed).reset_index(drop=True)
+    hotel = hotel_frame(hotel_rows).sample(frac=1, random_state=seed + 1).reset_index(drop=True)
+    return bank, hotel
+
+
+def temp_dirs(test, *names, **extra):
+    """
+    Point each setting in ``names`` at its own temporary directory for the
+    rest of ``test`` (``extra`` settings are overridden too); returns the paths.
+    """
+    paths = []
+    for _ in names:
+        directory = tempfile.TemporaryDirectory()
+        test.addCleanup(directory.cleanup)
+        paths.append(directory.name)
+    overridden = override_settings(**dict(zip(names, paths)), **extra)
+    overridden.enable()
+    test.addCleanup(overridden.disable)
+    return paths
+
+
+def unambiguous_statements():
+    """Every bank row has exactly one hotel candidate (or none)."""
+    bank = bank_frame([
+        ("2025-02-01 09:00", 100, "4111XXXXXXXX1111", "VISA"),
+        ("2025-02-01 09:30", 200, "4111XXXXXXXX2222", "VISA"),
+        ("2025-02-01 10:00", 300, "GCCNET", "GCCNET"),
+        ("2025-02-01 11:00", 400, "4111XXXXXXXX4444", "VISA"),
+        ("2025-02-01 15:00", 500, "4111XXXXXXXX5555", "VISA"),
+    ])
+    hotel = hotel_frame([
+        ("2025-02-01 15:03", 500, "XXXX5555", "VISA"),
+        ("2025-02-01 09:31", 200, "XXXX2222", "VISA"),
+        ("2025-02-01 09:02", 100, "", "VISA"),
+        ("2025-02-01 10:05", 300, "", "GCCNET"),
+        ("2025-02-01 12:00", 999, "XXXX9999", "VISA"),
+    ])
+    return bank, hotel
+
+
+# ===============================
+# Matching
+# ===============================
+class MatcherEquivalenceTests(SimpleTestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutdown_pool()
+        super().tearDownClass()
+
+    def test_sharded_matches_serial_for_each_mode(self):
+        bank, hotel = busy_statements()
+        for mode, serial in (("first", match_transactions), ("optimal", match_transactions_optimal)):
+            with self.subTest(mode=mode):
+                expected = serial(bank, hotel, 10)
+                sharded = match_transactions_sharded(bank, hotel, 10, workers=2, min_rows=0, mode=mode)
+                self.assertEqual(result_labels(sharded), result_labels(expected))
+                self.assertGreater(len(labels(expected[0])), 0)
+
+    def test_sharded_returns_the_serial_shapes(self):
+        bank, hotel = busy_statements()
+        rec_bank, rec_hotel, un_bank, un_hotel = match_transactions_sharded(bank, hotel, 10, workers=2, min_rows=0)
+        self.assertIsInstance(rec_bank, list)
+        self.assertIsInstance(rec_hotel, list)
+        self.assertIsInstance(un_bank, list)
+        self.assertIsInstance(un_hotel, pd.DataFrame)
+        self.assertIsInstance(rec_bank[0], pd.Series)
+
+    def test_optimal_matches_serial_without_ambiguity(self):
+        bank, hotel = unambiguous_statements()
+        self.assertEqual(
+            result_labels(match_transactions_optimal(bank, hotel, 10)),
+            result_labels(match_transactions(bank, hotel, 10)),
+        )
+
+    def test_optimal_reconciles_at_least_as_many_rows(self):
+        bank, hotel = busy_statements()
+        first = match_transactions(bank, hotel, 10)
+        optimal = match_transactions_optimal(bank, hotel, 10)
+        self.assertGreaterEqual(len(optimal[0]), len(first[0]))
+
+    def test_rows_without_a_time_never_match(self):
+        bank, hotel = unambiguous_statements()
+        bank.loc[0, "DT"] = pd.NaT
+        for matched in (match_transactions(bank, hotel, 10),
+                        match_transactions_sharded(bank, hotel, 10, workers=2, min_rows=0)):
+            self.assertIn(0, labels(matched[2]))
+
+
+class EmptySideMatchingTests(SimpleTestCase):
+    def setUp(self):
+        self.bank = bank_frame([
+            ("2025-01-01 10:00", 100, "411111XXXXXX1234", "VISA"),
+            ("2025-01-01 11:00", 250, "GCC", "GCCNET"),
+        ])
+        self.hotel = hotel_frame([("2025-01-01 10:05", 100, "XXXX1234", "VISA")])
+
+    def test_empty_hotel_leaves_every_bank_row_unreconciled(self):
+        empty_hotel = self.hotel.iloc[0:0]
+        for matcher in (match_transactions, match_transactions_optimal):
+            with self.subTest(matcher=matcher.__name__):
+                rec_bank, rec_hotel, un_bank, un_hotel = result_labels(matcher(self.bank, empty_hotel, 15))
+                self.assertEqual(rec_bank, [])
+                self.assertEqual(rec_hotel, [])
+                self.assertEqual(un_bank, [0, 1])
+                self.assertEqual(un_hotel, [])
+
+    def test_optimal_matches_serial_on_empty_sides(self):
+        cases = [(self.bank, self.hotel.iloc[0:0]), (self.bank.iloc[0:0], self.hotel), (self.bank.iloc[0:0], self.hotel.iloc[0:0])]
+        for bank, hotel in cases:
+            with self.subTest(bank=len(bank), hotel=len(hotel)):
+                self.assertEqual(
+                    result_labels(match_transactions_optimal(bank, hotel, 15)),
+                    result_labels(match_transactions(bank, hotel, 15)),
+                )
+
+
+# ===============================
+# Streaming
+# ===============================
+def stream_entries(df, columns):
+    """``(seq, DT, row)`` in DT order, as ``_sorted_stream`` yields them; each row ends with its index label."""
+    entries = [(seq, dt, list(row) + [label])
+               for seq, (label, dt, row) in enumerate(zip(df.index, df["DT"], df[columns].values.tolist()))]
+    return sorted(entries, key=lambda e: (e[1], e[0]))
+
+
+def stream_labels(bank, hotel, threshold):
+    spill = {name: [] for name in SPILL_CATEGORIES}
+    stream_match(stream_entries(bank, BANK_COLUMNS), stream_entries(hotel, HOTEL_COLUMNS), threshold, spill)
+    return {name: [row[-1] for row in rows] for name, rows in spill.items()}
+
+
+class StreamingMatchTests(SimpleTestCase):
+    def test_matches_serial_when_bank_is_in_time_order(self):
+        bank, hotel = busy_statements()
+        bank = bank.sort_values("DT", kind="stable")
+        rec_bank, rec_hotel, un_bank, un_hotel = result_labels(match_transactions(bank, hotel, 10))
+        streamed = stream_labels(bank, hotel, 10)
+        self.assertEqual(
+            sorted(zip(streamed["rec_bank"], streamed["rec_hotel"])), sorted(zip(rec_bank, rec_hotel))
+        )
+        self.assertEqual(sorted(streamed["un_bank"]), sorted(un_bank))
+        self.assertEqual(sorted(streamed["un_hotel"]), sorted(un_hotel))
+        self.assertGreater(len(rec_bank), 0)
+
+    def test_bank_rows_take_their_turn_in_time_order(self):
+        # Both bank rows qualify for the one hotel row; the later one is listed first
+        bank = bank_frame([("2025-02-01 10:05", 300, "GCCNET", "GCCNET"), ("2025-02-01 10:00", 300, "GCCNET", "GCCNET")])
+        hotel = hotel_frame([("2025-02-01 10:02", 300, "", "GCCNET")])
+        self.assertEqual(labels(match_transactions(bank, hotel, 10)[0]), [0])
+        self.assertEqual(stream_labels(bank, hotel, 10)["rec_bank"], [1])
+
+
+class StreamedReportTests(SimpleTestCase):
+    def setUp(self):
+        self.stream = StreamingReconciliation(None, None, 10).__enter__()
+        self.addCleanup(self.stream.__exit__, None, None, None)
+        self.bank = bank_frame([
+            ("2025-02-01 09:00", 100, "4111XXXXXXXX1111", "VISA"),
+            ("2025-02-01 09:30", 200.5, "GCCNET", "GCCNET"),
+            ("2025-02-01 10:00", 300.25, "4111XXXXXXXX3333", "VISA"),
+        ])[BANK_COLUMNS]
+        self.hotel = hotel_frame([
+            ("2025-02-01 09:01", 100, "XXXX1111", "POS - Visa Card"),
+            ("2025-02-01 09:32", 200.5, "", "GCCNET"),
+        ])[HOTEL_COLUMNS]
+        for name, df in (("un_bank", self.bank), ("un_hotel", self.hotel)):
+            for row in df.values.tolist():
+                self.stream.spill[name].append(row)
+        self.parts = self.stream.split_by_card_type(DEFAULT_CARD_RULES, size=2)
+
+    def test_split_by_card_type_totals_each_part(self):
+        visa = self.parts["un_bank"]["VISA"]
+        self.assertEqual(visa.count, 2)
+        self.assertAlmostEqual(visa.totals["Gross Amount"], 400.25)
+        self.assertEqual(self.parts["un_hotel"]["VISA"].count, 1)
+        self.assertEqual(sorted(self.parts["un_hotel"]), ["GCCNET", "VISA"])
+        self.assertEqual(self.parts["rec_bank"], {})
+
+    def test_spilled_sheets_write_like_frames(self):
+        titles = ["Attachment - 1", "VISA Merchant Transactions", "Unreconciled VISA Transactions"]
+        amount_cols = ["Gross Amount", "Commission", "Net Amount"]
+        visa = self.bank[self.bank["Card Type (On us/Off us)"] == "VISA"]
+        empty = pd.DataFrame(columns=BANK_COLUMNS)
+        summary = pd.DataFrame([["Company"], ["Credit Card Reconciliation"], ["Attachment 1"], ["Attachment 2"]])
+        lookup = {("VISA", "Merchant", "Unreconciled"): "1"}
+        spill = pickle.loads(pickle.dumps(self.parts["un_bank"]["VISA"]))  # as handed to a render process
+        empty_spill = CardTypeSpill(f"{self.stream._tmp.name}/empty.pkl", BANK_COLUMNS, amount_cols)
+        spilled = [("Bank Account", summary),
+                   ("Attachment 1", SpilledAttachment(spill, titles, BANK_COLUMNS, amount_cols)),
+                   ("Attachment 2", SpilledAttachment(empty_spill, titles, BANK_COLUMNS, amount_cols))]
+        framed = [("Bank Account", summary),
+                  ("Attachment 1", add_titles_and_total(visa, titles, BANK_COLUMNS, amount_cols)),
+                  ("Attachment 2", add_titles_and_total(empty, titles, BANK_COLUMNS, amount_cols))]
+        workbooks = []
+        with tempfile.TemporaryDirectory() as tmp:
+            for i, sheets in enumerate((spilled, framed)):
+                path = f"{tmp}/report_{i}.xlsx"
+                write_excel_report(path, sheets, ["VISA"], lookup, BANK_COLUMNS, HOTEL_COLUMNS)
+                wb = load_workbook(path)
+                workbooks.append({
+                    name: [[(c.value, c.number_format, c.font.b) for c in row] for row in wb[name].iter_rows()]
+                    for name in wb.sheetnames
+                })
+        self.assertEqual(workbooks[0], workbooks[1])
+        self.assertEqual(workbooks[0]["Attachment 1"][-1][6], (400.25, "#,##0.00", True))
+        self.assertEqual(workbooks[0]["Attachment 2"][-1][0][0], "No Records")
+
+
+# ===============================
+# Clock-skew calibration
+# ===============================
+def skewed_statements(skews, per_terminal=12, start="2025-03-01 09:00", drift=None):
+    """
+    Card payments on each terminal of ``skews`` (seconds, bank minus PMS),
+    every one with its own last-4 and amount. ``drift`` is ``(terminal,
+    day, seconds)`` added on that day.
+    """
+    bank_rows, hotel_rows = [], []
+    n = 0
+    for terminal, skew in skews.items():
+        for i in range(per_terminal):
+            hotel_dt = pd.Timestamp(start) + pd.Timedelta(hours=5 * i)
+            offset = skew
+            if drift and drift[0] == terminal and hotel_dt.normalize() == pd.Timestamp(drift[1]):
+                offset += drift[2]
+            amount, last4 = 100 + 7 * n, f"{1000 + n}"
+            bank_rows.append((hotel_dt + pd.Timedelta(seconds=offset), amount, f"411111XXXXXX{last4}", "VISA", terminal))
+            hotel_rows.append((hotel_dt, amount, f"XXXX{last4}", "VISA"))
+            n += 1
+    return bank_frame(bank_rows), hotel_frame(hotel_rows)
+
+
+@override_settings(RECON_CLOCK_SKEW_MIN_ANCHORS=5, RECON_CLOCK_SKEW_WINDOW=2)
+class ClockSkewTests(SimpleTestCase):
+    def test_estimates_each_terminal_and_a_drifting_day(self):
+        bank, hotel = skewed_statements({"T1": 240, "T2": -120}, per_terminal=30, drift=("T1", "2025-03-04", 600))
+        skew = estimate_clock_skew(bank, hotel)
+        offsets = {(e.terminal, e.day): e.offset_seconds for e in skew.reported()}
+        self.assertEqual(offsets[("T1", None)], 240)
+        self.assertEqual(offsets[("T2", None)], -120)
+        self.assertEqual(offsets[("T1", pd.Timestamp("2025-03-04"))], 840)
+        # The terminals disagree: no offset for the whole statement
+        self.assertNotIn((None, None), offsets)
+
+        row_offsets = skew.offsets(bank).dt.total_seconds()
+        drift_day = bank["DT"].dt.normalize() == pd.Timestamp("2025-03-04")
+        self.assertTrue((row_offsets[(bank["Terminal ID"] == "T1") & drift_day] == 840).all())
+        self.assertTrue((row_offsets[(bank["Terminal ID"] == "T1") & ~drift_day] == 240).all())
+        self.assertTrue((row_offsets[bank["Terminal ID"] == "T2"] == -120).all())
+
+    def test_too_few_anchors_is_not_calibrated(self):
+        bank, hotel = skewed_statements({"T1": 240}, per_terminal=3)
+        skew = estimate_clock_skew(bank, hotel)
+        self.assertFalse(skew.applied)
+        self.assertEqual(skew.anchors, 3)
+        self.assertEqual(skew.summary_rows()[1][0], "Not calibrated")
+
+    def test_ambiguous_pairs_are_not_anchors(self):
+        bank, hotel = skewed_statements({"T1": 240}, per_terminal=6)
+        # A second hotel row with the same card and amount makes the pair ambiguous
+        hotel = pd.concat([hotel, hotel.iloc[[0]].assign(DT=hotel["DT"].iloc[0] + pd.Timedelta(minutes=30))],
+                          ignore_index=True)
+        self.assertEqual(estimate_clock_skew(bank, hotel).anchors, 5)
+
+    @override_settings(RECON_CLOCK_SKEW=False)
+    def test_off_by_default_setting_is_plain_matching(self):
+        bank, hotel = skewed_statements({"T1": 240}, per_terminal=6)
+        matched, skew = match_with_clock_skew(bank, hotel, 15)
+        self.assertIsNone(skew)
+        self.assertEqual(result_labels(matched), result_labels(match_transactions(bank, hotel, 15)))
+
+    def test_calibrated_matching_keeps_statement_times_and_order(self):
+        bank, hotel = skewed_statements({"T1": 240, "T2": -120}, per_terminal=8)
+        hotel = hotel.sample(frac=1, random_state=3)
+        (rec_bank, rec_hotel, un_bank, un_hotel), skew = match_with_clock_skew(bank, hotel, 15, enabled=True)
+        self.assertTrue(skew.applied)
+        self.assertEqual(labels(rec_bank), list(bank.index))
+        self.assertEqual(labels(rec_hotel), list(bank.index))  # rows were built pairwise
+        self.assertEqual(labels(un_bank), [])
+        self.assertTrue(un_hotel.empty)
+        self.assertEqual([row["DT"] for row in rec_bank], list(bank["DT"]))
+
+    def test_uncalibrated_terminal_is_matched_even_with_a_threshold_inside_the_window(self):
+        bank, hotel = skewed_statements({"T1": 240}, per_terminal=8)
+        # T9 has no anchors of its own and takes the statement's offset, but its
+        # clock agrees with the PMS
+        extra_bank = bank_frame([("2025-03-10 12:00", 999, "GCC", "GCCNET", "T9")])
+        extra_hotel = hotel_frame([("2025-03-10 12:00", 999, "", "GCCNET")])
+        bank = pd.concat([bank, extra_bank], ignore_index=True)
+        hotel = pd.concat([hotel, extra_hotel], ignore_index=True)
+        (rec_bank, rec_hotel, un_bank, _), skew = match_with_clock_skew(bank, hotel, 0, enabled=True)
+        self.assertTrue(skew.applied)
+        self.assertIn(len(bank) - 1, labels(rec_bank))
+        self.assertEqual(labels(un_bank), [])
+
+    def test_leftover_rows_are_matched_on_their_own_times(self):
+        bank, hotel = skewed_statements({"T1": 240}, per_terminal=8)
+        # A T1 payment whose receipt time happens to agree with the PMS: shifted
+        # by the terminal's offset it would be 7 minutes off
+        extra_bank = bank_frame([("2025-03-10 11:57", 555, "411111XXXXXX9999", "VISA", "T1")])
+        extra_hotel = hotel_frame([("2025-03-10 12:00", 555, "XXXX9999", "VISA")])
+        bank = pd.concat([bank, extra_bank], ignore_index=True)
+        hotel = pd.concat([hotel, extra_hotel], ignore_index=True)
+        (rec_bank, rec_hotel, un_bank, _), _ = match_with_clock_skew(bank, hotel, 5, enabled=True)
+        self.assertIn(len(bank) - 1, labels(rec_bank))
+        self.assertEqual(labels(un_bank), [])
+
+
+# ===============================
+# Scheduler
+# ===============================
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached in time")
+        time.sleep(0.005)
+
+
+class StageSchedulerTests(SimpleTestCase):
+    def scheduler(self, limit=1, wait_timeout=5, lock_dir=None):
+        return StageScheduler({"ocr": limit}, max_in_flight=8, wait_timeout=wait_timeout, retry_after=7,
+                              lock_dir=lock_dir)
+
+    def queued(self, scheduler):
+        return scheduler.snapshot()["stages"]["ocr"]["queued"]
+
+    def test_waiters_are_served_round_robin_across_clients(self):
+        scheduler = self.scheduler()
+        order, release = [], threading.Event()
+
+        def holder():
+            with scheduler.slot("ocr", client="a"):
+                release.wait()
+
+        def waiter(client, name):
+            with scheduler.slot("ocr", client=client):
+                order.append(name)
+
+        threads = [threading.Thread(target=holder)]
+        threads[0].start()
+        wait_until(lambda: scheduler.snapshot()["stages"]["ocr"]["running"] == 1)
+        for client, name in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")]:
+            thread = threading.Thread(target=waiter, args=(client, name))
+            thread.start()
+            threads.append(thread)
+            wait_until(lambda n=len(threads) - 1: self.queued(scheduler) == n)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, ["a1", "b1", "a2", "a3"])
+
+    def test_waiting_past_the_timeout_raises_busy(self):
+        scheduler = self.scheduler(wait_timeout=0.1)
+        with scheduler.slot("ocr", client="a"):
+            with self.assertRaises(SchedulerBusy) as busy:
+                with scheduler.slot("ocr", client="b"):
+                    pass
+        self.assertEqual(busy.exception.retry_after, 7)
+        stats = scheduler.snapshot()["stages"]["ocr"]
+        self.assertEqual((stats["timeouts"], stats["queued"], stats["running"]), (1, 0, 0))
+
+    def test_unlimited_stages_are_not_throttled(self):
+        scheduler = self.scheduler(wait_timeout=0.1)
+        with scheduler.slot("render"), scheduler.slot("render"):
+            pass
+
+    def test_freed_slots_reach_every_waiter(self):
+        # Both slots free up at once: the second waiter must get the other
+        # slot without waiting for the first one to finish
+        for _ in range(20):
+            scheduler = self.scheduler(limit=2, wait_timeout=3)
+            with scheduler._cond:
+                scheduler._running["ocr"] = 2
+            granted, release = [], threading.Event()
+
+            def waiter(name):
+                with scheduler.slot("ocr", client=name):
+                    granted.append(name)
+                    release.wait(5)
+
+            threads = [threading.Thread(target=waiter, args=(name,)) for name in ("a", "b")]
+            for i, thread in enumerate(threads, start=1):
+                thread.start()
+                wait_until(lambda i=i: self.queued(scheduler) == i)
+            with scheduler._cond:
+                # "a" sleeps first, so it tends to wake first: put "b" at the
+                # head so "a" finds it is not its turn yet
+                scheduler._waiting["ocr"].move_to_end("a")
+                scheduler._running["ocr"] = 0
+                scheduler._cond.notify_all()
+            try:
+                wait_until(lambda: len(granted) == 2, timeout=1)
+            finally:
+                release.set()
+                for thread in threads:
+                    thread.join(5)
+
+    def test_limits_hold_across_processes_sharing_a_lock_dir(self):
+        with tempfile.TemporaryDirectory() as lock_dir:
+            # Two schedulers stand for two worker processes
+            first = self.scheduler(lock_dir=lock_dir)
+            second = self.scheduler(wait_timeout=0.2, lock_dir=lock_dir)
+            with first.slot("ocr", client="a"):
+                with self.assertRaises(SchedulerBusy):
+                    with second.slot("ocr", client="b"):
+                        pass
+                self.assertEqual(second.snapshot()["stages"]["ocr"]["running"], 0)
+            with second.slot("ocr", client="b"):
+                pass
+
+
+# ===============================
+# Parsers
+# ===============================
+def bank_line(n, dt, card, amount):
+    return f"{n} {dt} 00 RRN{n:04d} {card} {amount:,.2f} 1.00 {amount - 1:,.2f}"
+
+
+class BankSectionTests(SimpleTestCase):
+    def test_rows_carry_the_ids_of_their_own_section(self):
+        lines = [
+            "ACQUIRER SETTLEMENT REPORT",
+            "MERCHANT ID 111",
+            "TERMINAL ID T1",
+            "ON-US VISA",
+            bank_line(1, "01/02/2025 10:00", "4111XXXXXXXX1111", 100),
+            bank_line(2, "01/02/2025 10:05", "4111XXXXXXXX2222", 200),
+            "MERCHANT ID 222",
+            "TERMINAL ID T2",
+            bank_line(3, "01/02/2025 11:00", "4111XXXXXXXX3333", 300),
+            "TERMINAL ID T3",
+            bank_line(4, "01/02/2025 12:00", "4111XXXXXXXX4444", 400),
+        ]
+        # Push a fourth section past the header scan
+        lines += ["" for _ in range(20)]
+        lines += ["MERCHANT ID 333 TERMINAL ID T4", bank_line(5, "02/02/2025 09:00", "4111XXXXXXXX5555", 500)]
+        rows = list(iter_bank_rows(lines))
+        ids = [(row[BANK_COLUMNS.index("Merchant ID")], row[BANK_COLUMNS.index("Terminal ID")]) for row in rows]
+        self.assertEqual(ids, [("111", "T1"), ("111", "T1"), ("222", "T2"), ("222", "T3"), ("333", "T4")])
+
+    def test_rows_above_every_header_take_the_document_header(self):
+        lines = [
+            bank_line(1, "01/02/2025 10:00", "4111XXXXXXXX1111", 100),
+            "MERCHANT ID 111",
+            "TERMINAL ID T1",
+            bank_line(2, "01/02/2025 10:05", "4111XXXXXXXX2222", 200),
+            "TERMINAL ID T2",
+        ]
+        ids = [(row[2], row[-1]) for row in iter_bank_rows(lines)]
+        self.assertEqual(ids, [("111", "T1"), ("111", "T1")])
+
+
+# ===============================
+# Ingestion
+# ===============================
+OPERA_CSV = (
+    "Cashier Report\n"
+    "Date,Time,Room,Guest Name,Card Number,Payment Method,Credit,Cashier\n"
+    "01/02/2025,10:00,101,José Müller,XXXX1111,POS - Visa Card,\"1,250.00\",C1\n"
+)
+
+
+class IngestionErrorTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+
+    def write(self, name, data):
+        path = f"{self.dir}/{name}"
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def write_zip(self, name, members):
+        path = f"{self.dir}/{name}"
+        with zipfile.ZipFile(path, "w") as z:
+            for member, data in members.items():
+                z.writestr(member, data)
+        return path
+
+    def test_windows_1252_csv_is_read(self):
+        path = self.write("hotel.csv", OPERA_CSV.encode("cp1252"))
+        hotel = load_statement(path, "hotel")
+        self.assertEqual(list(hotel["Name"]), ["José Müller"])
+        self.assertEqual(list(hotel["Amount"]), [1250.0])
+
+    def test_utf8_csv_is_read(self):
+        path = self.write("hotel.csv", OPERA_CSV.encode("utf-8-sig"))
+        self.assertEqual(list(load_statement(path, "hotel")["Name"]), ["José Müller"])
+
+    def test_zip_that_is_not_a_workbook_is_rejected(self):
+        path = self.write_zip("statement.xlsx", {"statement.csv": OPERA_CSV})
+        with self.assertRaisesRegex(UnsupportedStatementFormat, "not an XLSX workbook"):
+            detect_upload_type(path)
+
+    def test_damaged_workbooks_are_rejected(self):
+        with open(self.write_zip("ok.xlsx", {"xl/workbook.xml": "<workbook/>"}), "rb") as f:
+            truncated = f.read()[:30]
+        cases = {
+            "missing_parts.xlsx": self.write_zip("missing_parts.xlsx", {"xl/workbook.xml": "<workbook/>"}),
+            "bad_xml.xlsx": self.write_zip(
+                "bad_xml.xlsx", {"[Content_Types].xml": "garbage", "xl/workbook.xml": "garbage"}
+            ),
+            "truncated.xlsx": self.write("truncated.xlsx", truncated),
+        }
+        for name, path in cases.items():
+            with self.subTest(name=name), self.assertRaises(UnsupportedStatementFormat):
+                load_statement(path, "hotel")
+
+
+# ===============================
+# Table regions
+# ===============================
+ROW = re.compile(r"^ROW \d+")
+
+
+def page(rows, top=0.3, step=0.05, header=("LOGO", "STATEMENT")):
+    """Positioned lines of a page: header lines at the top, then ``rows`` table lines from ``top``."""
+    lines = [(text, 0.02 + 0.04 * i, 0.05 + 0.04 * i) for i, text in enumerate(header)]
+    lines += [(f"ROW {n}", top + step * i, top + step * i + 0.03) for i, n in enumerate(rows)]
+    return lines + [("PAGE FOOTER", 0.95, 0.98)]
+
+
+def crop(lines, bbox):
+    return "\n".join(text for text, t, b in lines if t >= bbox[1] and b <= bbox[3])
+
+
+class TableRegionTests(SimpleTestCase):
+    def read(self, region, page_no, lines, above=True):
+        full_reads = []
+
+        def read_positioned():
+            full_reads.append(page_no)
+            return lines
+
+        read_above = (lambda bbox: crop(lines, (0.0, 0.0, 1.0, bbox[1]))) if above else None
+        with contextlib.redirect_stdout(io.StringIO()) as log:
+            result = _region_lines(region, page_no, lambda bbox: crop(lines, bbox), read_positioned, read_above)
+        return result, bool(full_reads), log.getvalue()
+
+    def learned_region(self):
+        region = TableRegion([ROW])
+        self.read(region, 1, page(range(1, 11)))
+        self.read(region, 2, page(range(11, 21)))
+        self.assertIsNotNone(region.band)
+        return region
+
+    def test_cropped_page_is_trusted_when_it_has_every_row(self):
+        region = self.learned_region()
+        lines, full, _ = self.read(region, 3, page(range(21, 31)))
+        self.assertFalse(full)
+        self.assertEqual(lines, [f"ROW {n}" for n in range(21, 31)])
+
+    def test_rows_above_the_band_force_a_full_read(self):
+        region = self.learned_region()
+        # The table starts higher on this page and runs on below: the band still
+        # holds as many rows as expected, two more sit above it
+        lines, full, log = self.read(region, 3, page(range(21, 33), top=0.2))
+        self.assertTrue(full)
+        self.assertIn("ROW 21", lines)
+        self.assertIn("Page 3 re-read in full", log)
+
+    def test_fewer_rows_than_expected_force_a_full_read(self):
+        region = self.learned_region()
+        # No cheap look above the band (OCR pages): the row count gives it away
+        lines, full, log = self.read(region, 3, page(range(21, 31), top=0.2), above=False)
+        self.assertTrue(full)
+        self.assertEqual([l for l in lines if l.startswith("ROW")], [f"ROW {n}" for n in range(21, 31)])
+        self.assertIn("table line(s) inside the band", log)
+
+
+class OcrErrorTests(SimpleTestCase):
+    def lines(self, error):
+        with mock.patch.object(extraction, "_ocr_page", side_effect=error), \
+                contextlib.redirect_stdout(io.StringIO()) as out:
+            return list(extraction._iter_ocr_lines("scan.pdf", [1], page_count=1)), out.getvalue()
+
+    def test_tesseract_failure_gives_no_lines(self):
+        lines, log = self.lines(pytesseract.TesseractError(1, "bad image"))
+        self.assertEqual(lines, [])
+        self.assertIn("Error during OCR for scan.pdf", log)
+
+    def test_missing_poppler_gives_no_lines(self):
+        lines, _ = self.lines(PopplerNotInstalledError("no pdftoppm"))
+        self.assertEqual(lines, [])
+
+    def test_other_errors_are_raised(self):
+        with self.assertRaises(KeyError):
+            self.lines(KeyError("bug"))
+
+
+class ProbeErrorTests(SimpleTestCase):
+    def probe(self, data):
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as f:
+            f.write(data)
+            f.flush()
+            return probe_pdf(f.name)
+
+    def test_malformed_pdf_is_unreadable(self):
+        with self.assertRaisesRegex(UnreadablePDF, "encrypted or malformed"):
+            self.probe(b"%PDF-1.4\n1 0 obj << /Type /Catalog")
+
+    def test_not_a_pdf(self):
+        with self.assertRaisesRegex(UnreadablePDF, "not a PDF"):
+            self.probe(b"Date,Amount\n")
+
+    def test_encrypted_pdf_is_unreadable(self):
+        with mock.patch.object(extraction.pdfplumber, "open", side_effect=PDFPasswordIncorrect()):
+            with self.assertRaises(UnreadablePDF):
+                self.probe(b"%PDF-1.4\n")
+
+    def test_other_errors_are_raised(self):
+        with mock.patch.object(extraction.pdfplumber, "open", side_effect=AttributeError("bug")):
+            with self.assertRaises(AttributeError):
+                self.probe(b"%PDF-1.4\n")
+
+
+@override_settings(CACHES={"ocr": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "ocr-tests"}})
+class OcrCacheTests(SimpleTestCase):
+    WORDS = {
+        "text": ["12/05/2024", "1,200.00"], "conf": ["95", "91"], "left": [10, 120], "top": [20, 20],
+        "width": [100, 80], "height": [12, 12], "block_num": [1, 1], "par_num": [1, 1], "line_num": [1, 1],
+    }
+
+    def setUp(self):
+        ocr.get_ocr_cache().clear()
+
+    def read(self):
+        render = mock.Mock(return_value=[Image.new("RGB", (400, 600), "white")])
+        with mock.patch.object(ocr, "page_hashes", return_value=["pagehash"]), \
+                mock.patch.object(ocr, "convert_from_path", render), \
+                mock.patch.object(ocr.pytesseract, "image_to_data", return_value=self.WORDS):
+            return ocr.ocr_page_lines("scan.pdf", 1), render.call_count
+
+    def test_only_the_text_is_cached(self):
+        lines, renders = self.read()
+        self.assertEqual([text for text, _, _ in lines], ["12/05/2024 1,200.00"])
+        self.assertEqual(renders, 1)
+        cache = ocr.get_ocr_cache()
+        # locmem keys are ":<version>:<key>"
+        keys = [key.split(":", 2)[2] for key in cache._cache]
+        self.assertEqual(len(keys), 1)
+        self.assertTrue(keys[0].startswith("recon-ocr:"))
+        self.assertEqual(cache.get(keys[0]), lines)
+
+    def test_cached_page_is_not_rendered_again(self):
+        first, _ = self.read()
+        again, renders = self.read()
+        self.assertEqual(again, first)
+        self.assertEqual(renders, 0)
+
+
+class ClientEventStreamTests(TestCase):
+    def finished_run(self):
+        run = ReconciliationRecord.objects.create(
+            client_name="acme", status=ReconciliationRecord.Status.COMPLETED, finished_at=timezone.now(),
+        )
+        publish_run_finished(run, 200, {"excel_url": "/media/report.xlsx", "reconciled": 3})
+        return run
+
+    def test_client_stream_leaves_out_the_result(self):
+        run = self.finished_run()
+        chunks, _ = _Stream({"client_name": "acme"}, 0, hidden=("result", "error")).poll()
+        self.assertEqual(len(chunks), 1)
+        self.assertIn(f'"runId": {run.pk}', chunks[0])
+        self.assertIn("event: run.completed", chunks[0])
+        self.assertNotIn("report.xlsx", chunks[0])
+
+    def test_run_stream_keeps_the_result(self):
+        run = self.finished_run()
+        chunks, done = _Stream({"run_id": run.pk}, 0, run.pk).poll()
+        self.assertTrue(done)
+        self.assertIn("report.xlsx", chunks[0])
+
+
+class WebhookSenderTests(TestCase):
+    def setUp(self):
+        ClientWebhook.objects.create(client_name="acme", url="https://example.test/hook", secret="s")
+        self.run = ReconciliationRecord.objects.create(client_name="acme")
+
+    def test_queued_delivery_is_stored_and_wakes_the_sender(self):
+        with mock.patch.object(webhooks, "wake_sender") as wake:
+            delivery = webhooks.queue_run_webhook(self.run, "run.completed", {"status": "completed"})
+        wake.assert_called_once()
+        delivery.refresh_from_db()
+        self.assertEqual(delivery.status, WebhookDelivery.Status.PENDING)
+        self.assertLessEqual(delivery.next_attempt_at, timezone.now())
+
+    def test_one_sender_thread_for_many_deliveries(self):
+        release = threading.Event()
+        with mock.patch.object(webhooks, "_send_forever", release.wait), \
+                mock.patch.object(webhooks, "_sender", None):
+            for _ in range(3):
+                webhooks.queue_run_webhook(self.run, "run.completed", {})
+            senders = [t for t in threading.enumerate() if t.name == "webhook-sender"]
+            release.set()
+        self.assertEqual(len(senders), 1)
+        self.assertEqual(WebhookDelivery.objects.count(), 3)
+
+    @override_settings(RECON_WEBHOOK_RETRY_DELAYS=[60])
+    def test_failed_attempt_is_stored_for_a_later_retry(self):
+        with mock.patch.object(webhooks, "wake_sender"):
+            delivery = webhooks.queue_run_webhook(self.run, "run.completed", {})
+        with mock.patch.object(webhooks, "_post", return_value=(503, "HTTP 503")):
+            self.assertEqual(webhooks.deliver_due(), 1)
+            # Not due again until the retry delay has passed
+            self.assertEqual(webhooks.deliver_due(), 0)
+        delivery.refresh_from_db()
+        self.assertEqual(delivery.attempts, 1)
+        self.assertEqual(webhooks._next_due(), delivery.next_attempt_at)
+        WebhookDelivery.objects.filter(pk=delivery.pk).update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        with mock.patch.object(webhooks, "_post", return_value=(200, "")):
+            self.assertEqual(webhooks.deliver_due(), 1)
+        delivery.refresh_from_db()
+        self.assertEqual(delivery.status, WebhookDelivery.Status.DELIVERED)
+        self.assertIsNone(webhooks._next_due())
+
+
+class ResumableUploadTests(TestCase):
+    DATA = b"Date,Amount\n" + b"01/05/2024,100.00\n" * 50
+
+    def setUp(self):
+        temp_dirs(self, "RECON_STORAGE_ROOT")
+        self.client = APIClient()
+
+    def create(self, **extra):
+        response = self.client.post("/api/uploads/", {"filename": "bank.csv", "size": len(self.DATA), **extra},
+                                    format="json")
+        self.assertEqual(response.status_code, 201)
+        return f"/api/uploads/{response.data['id']}/"
+
+    def patch(self, url, offset, chunk, checksum=None):
+        headers = {"HTTP_UPLOAD_OFFSET": str(offset)}
+        if checksum is not None:
+            headers["HTTP_UPLOAD_CHECKSUM"] = f"sha256 {base64.b64encode(checksum).decode()}"
+        return self.client.generic("PATCH", url, chunk, content_type="application/offset+octet-stream", **headers)
+
+    def test_chunks_resume_from_the_reported_offset(self):
+        url = self.create()
+        self.assertEqual(self.patch(url, 0, self.DATA[:100]).data["offset"], 100)
+        # Resending the first chunk (e.g. after a lost response) is refused with the right offset
+        stale = self.patch(url, 0, self.DATA[:100])
+        self.assertEqual(stale.status_code, 409)
+        self.assertEqual(stale.data["offset"], 100)
+        self.assertEqual(self.client.get(url)["Upload-Offset"], "100")
+        self.assertEqual(self.patch(url, 100, self.DATA[100:]).data["offset"], len(self.DATA))
+
+        done = self.client.post(url + "finalize/", {}, format="json")
+        self.assertEqual(done.status_code, 200)
+        self.assertEqual(done.data["status"], UploadSession.Status.COMPLETE)
+        self.assertEqual(done.data["sha256"], hashlib.sha256(self.DATA).hexdigest())
+        with open(UploadSession.objects.get().path, "rb") as f:
+            self.assertEqual(f.read(), self.DATA)
+
+    def test_chunk_with_a_wrong_checksum_is_discarded(self):
+        url = self.create()
+        bad = self.patch(url, 0, self.DATA[:100], checksum=hashlib.sha256(b"other").digest())
+        self.assertEqual(bad.status_code, 400)
+        self.assertEqual(bad.data["offset"], 0)
+        good = self.patch(url, 0, self.DATA[:100], checksum=hashlib.sha256(self.DATA[:100]).digest())
+        self.assertEqual(good.data["offset"], 100)
+
+    def test_chunk_past_the_declared_size_is_refused(self):
+        url = self.create()
+        response = self.patch(url, 0, self.DATA + b"x")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(url).data["offset"], 0)
+
+    def test_finalize_waits_for_every_byte(self):
+        url = self.create()
+        self.patch(url, 0, self.DATA[:100])
+        response = self.client.post(url + "finalize/", {}, format="json")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data["offset"], 100)
+
+    def test_sha256_mismatch_resets_the_upload(self):
+        url = self.create(sha256="0" * 64)
+        self.patch(url, 0, self.DATA)
+        response = self.client.post(url + "finalize/", {}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(url).data["offset"], 0)
+        self.assertEqual(UploadSession.objects.get().status, UploadSession.Status.OPEN)
+
+
+class ReportDownloadTests(SimpleTestCase):
+    BODY = bytes(range(256)) * 40
+    URL = "/media/acme_run_20240501_120000/report.xlsx"
+
+    def setUp(self):
+        media_root, = temp_dirs(self, "MEDIA_ROOT", RECON_DOWNLOAD_OFFLOAD=None)
+        folder = os.path.join(media_root, "acme_run_20240501_120000")
+        os.makedirs(folder)
+        self.path = os.path.join(folder, "report.xlsx")
+        with open(self.path, "wb") as f:
+            f.write(self.BODY)
+        self.client = Client()
+
+    def get(self, **headers):
+        response = self.client.get(self.URL, **headers)
+        body = b"".join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_whole_file_with_validators(self):
+        response, body = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.BODY)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertTrue(response["ETag"].startswith('"'))
+
+    def test_matching_etag_is_not_modified(self):
+        etag = self.get()[0]["ETag"]
+        response, body = self.get(HTTP_IF_NONE_MATCH=f"W/{etag}")
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(body, b"")
+        self.assertEqual(response["ETag"], etag)
+
+    def test_byte_ranges(self):
+        response, body = self.get(HTTP_RANGE="bytes=100-199")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.BODY[100:200])
+        self.assertEqual(response["Content-Range"], f"bytes 100-199/{len(self.BODY)}")
+        response, body = self.get(HTTP_RANGE="bytes=-10")
+        self.assertEqual(body, self.BODY[-10:])
+        response, body = self.get(HTTP_RANGE="bytes=10000-")
+        self.assertEqual(body, self.BODY[10000:])
+
+    def test_unsatisfiable_range(self):
+        response, _ = self.get(HTTP_RANGE=f"bytes={len(self.BODY)}-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(self.BODY)}")
+
+    def test_stale_if_range_sends_the_whole_file(self):
+        response, body = self.get(HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"old"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.BODY)
+        etag = response["ETag"]
+        response, body = self.get(HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+
+    def test_compressed_variant_has_its_own_etag(self):
+        with gzip.open(self.path + ".gz", "wb") as f:
+            f.write(self.BODY)
+        plain = self.get()[0]["ETag"]
+        response, body = self.get(HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(body), self.BODY)
+        self.assertNotEqual(response["ETag"], plain)
+        self.assertIn("Accept-Encoding", response["Vary"])
+
+    def test_files_outside_run_folders_are_not_served(self):
+        self.assertEqual(self.client.get("/media/store/report.xlsx").status_code, 404)
+        self.assertEqual(self.client.get("/media/acme_run_20240501_120000/..").status_code, 404)
+
+
+@override_settings(CACHES={
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "default-tests"},
+    "idempotency": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "idempotency-tests"},
+})
+class IdempotentReconcileTests(TestCase):
+    def setUp(self):
+        get_idempotency_cache().clear()
+        self.client = APIClient()
+        self.pipeline = mock.patch.object(ReconciliationAPIView, "run_reconciliation")
+        self.run_reconciliation = self.pipeline.start()
+        self.addCleanup(self.pipeline.stop)
+
+    def post(self, key=None, bank=b"bank statement", threshold=30):
+        data = {
+            "client_name": "acme", "threshold_time": threshold,
+            "bank_file": SimpleUploadedFile("bank.pdf", bank), "hotel_file": SimpleUploadedFile("hotel.csv", b"hotel"),
+        }
+        headers = {"HTTP_IDEMPOTENCY_KEY": key} if key else {}
+        return self.client.post("/api/reconcile/", data, format="multipart", **headers)
+
+    def test_retry_with_the_same_key_is_replayed(self):
+        self.run_reconciliation.return_value = Response({"reconciledCount": 3})
+        first = self.post("key-1")
+        again = self.post("key-1")
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again.data, first.data)
+        self.assertEqual(again["Idempotent-Replayed"], "true")
+        self.assertEqual(self.run_reconciliation.call_count, 1)
+        self.assertEqual(ReconciliationRecord.objects.count(), 1)
+
+    def test_key_is_bound_to_the_content(self):
+        self.run_reconciliation.return_value = Response({"reconciledCount": 3})
+        self.post("key-1")
+        other = self.post("key-1", threshold=15)
+        self.assertNotIn("Idempotent-Replayed", other)
+        self.assertEqual(self.run_reconciliation.call_count, 2)
+
+    def test_without_a_key_a_repeat_is_refused(self):
+        self.run_reconciliation.return_value = Response({"reconciledCount": 3})
+        self.post()
+        self.assertEqual(self.post().status_code, 400)
+        self.assertEqual(self.run_reconciliation.call_count, 1)
+
+    def test_failures_are_not_replayed(self):
+        self.run_reconciliation.side_effect = [
+            Response({"error": "Unreadable bank statement."}, status=400), Response({"reconciledCount": 3}),
+        ]
+        self.assertEqual(self.post("key-1").status_code, 400)
+        retry = self.post("key-1")
+        self.assertEqual(retry.status_code, 200)
+        self.assertNotIn("Idempotent-Replayed", retry)
+
+    def test_replay_needs_no_scheduler_slot(self):
+        self.run_reconciliation.return_value = Response({"reconciledCount": 3})
+        first = self.post("key-1")
+        busy = mock.Mock()
+        busy.admit.side_effect = SchedulerBusy("Too many reconciliations in flight.", retry_after=5)
+        with mock.patch("api.views.get_scheduler", return_value=busy):
+            again = self.post("key-1")
+            other = self.post("key-2", bank=b"another statement")
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again.data, first.data)
+        self.assertEqual(again["Idempotent-Replayed"], "true")
+        self.assertEqual(other.status_code, 503)
+        self.assertEqual(busy.admit.call_count, 1)
+
+    def test_uploads_are_hashed_once(self):
+        temp_dirs(self, "RECON_STORAGE_ROOT")
+        upload = SimpleUploadedFile("bank.pdf", b"bank statement")
+        digest = run_lock.upload_sha256(upload)
+        with mock.patch("api.storage.hashlib.sha256") as sha256:
+            path = save_uploaded_file(upload)
+        sha256.assert_not_called()
+        self.assertIn(digest, os.path.basename(path))
+
+
+class RunLockTests(TestCase):
+    def claim(self):
+        return run_lock.claim_run("acme", "hash-1", "bank.pdf", "hotel.csv")
+
+    def finish_while_waiting(self, run, status, result=None):
+        """time.sleep stand-in: the holder finishes during the first poll."""
+        def sleep(_):
+            ReconciliationRecord.objects.filter(pk=run.pk).update(status=status, result=result)
+        return mock.patch.object(run_lock.time, "sleep", side_effect=sleep)
+
+    def test_identical_run_attaches_to_the_holder(self):
+        run, claimed = self.claim()
+        other, other_claimed = self.claim()
+        self.assertTrue(claimed)
+        self.assertFalse(other_claimed)
+        self.assertEqual(other.pk, run.pk)
+
+    @override_settings(RECON_RUN_LOCK_TTL=60)
+    def test_stale_run_is_taken_over(self):
+        run, _ = self.claim()
+        ReconciliationRecord.objects.filter(pk=run.pk).update(started_at=timezone.now() - timedelta(hours=1))
+        taken, claimed = self.claim()
+        self.assertTrue(claimed)
+        self.assertEqual(taken.pk, run.pk)
+
+    def test_failed_run_releases_the_claim(self):
+        run, _ = self.claim()
+        run_lock.finish_run(run, Response({"error": "Unreadable bank statement."}, status=400))
+        again, claimed = self.claim()
+        self.assertTrue(claimed)
+        self.assertNotEqual(again.pk, run.pk)
+
+    def test_attached_request_gets_the_holders_result(self):
+        run, _ = self.claim()
+        waiting, _ = self.claim()
+        with self.finish_while_waiting(run, ReconciliationRecord.Status.COMPLETED, {"reconciledCount": 3}):
+            response = attach_to_run(waiting)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {"reconciledCount": 3})
+
+    def test_attached_request_learns_of_a_failed_holder(self):
+        run, _ = self.claim()
+        waiting, _ = self.claim()
+        with self.finish_while_waiting(run, ReconciliationRecord.Status.FAILED):
+            response = attach_to_run(waiting)
+        self.assertEqual(response.status_code, 409)
+
+    @override_settings(RECON_RUN_LOCK_WAIT=0)
+    def test_attached_request_gives_up_after_the_wait(self):
+        self.claim()
+        waiting, _ = self.claim()
+        with self.assertRaises(SchedulerBusy):
+            attach_to_run(waiting)
+
+
+class StorageRetentionTests(TestCase):
+    DAY = 24 * 60 * 60
+    HTML = b"<html>" + b"<tr><td>1,200.00</td></tr>" * 200 + b"</html>"
+
+    def setUp(self):
+        self.media_root, self.store = temp_dirs(self, "MEDIA_ROOT", "RECON_STORAGE_ROOT")
+        self.now = time.time()
+
+    def run_folder(self, days_old, files=None):
+        """A run folder dated ``days_old`` days ago; its files go into the artifact store."""
+        stamp = datetime.fromtimestamp(self.now - days_old * self.DAY).strftime("%Y%m%d_%H%M%S")
+        folder = os.path.join(self.media_root, f"acme_run_{stamp}")
+        os.makedirs(folder)
+        for name, data in (files or {"report.html": self.HTML}).items():
+            with open(os.path.join(folder, name), "wb") as f:
+                f.write(data)
+            store_artifact(os.path.join(folder, name))
+        return folder
+
+    def collect(self, **kwargs):
+        return collect_garbage(upload_days=7, artifact_days=90, compress_days=7, now=self.now, **kwargs)
+
+    def test_identical_artifacts_share_one_object(self):
+        first, second = self.run_folder(1), self.run_folder(2)
+        a, b = os.path.join(first, "report.html"), os.path.join(second, "report.html")
+        self.assertTrue(os.path.samefile(a, b))
+        # The object plus one link per run folder
+        self.assertEqual(os.stat(a).st_nlink, 3)
+
+    def test_cold_folder_is_compressed_and_still_readable(self):
+        folder = self.run_folder(10, {"report.html": self.HTML, "report.xlsx": b"PK workbook"})
+        stats = self.collect()
+        path = os.path.join(folder, "report.html")
+        self.assertEqual(stats["filesCompressed"], 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(path + ".zst"))
+        with open_artifact(path) as f:
+            self.assertEqual(f.read(), self.HTML)
+        # Already compressed formats are left as they are
+        self.assertTrue(os.path.exists(os.path.join(folder, "report.xlsx")))
+
+    def test_expired_folder_is_deleted_but_shared_objects_stay(self):
+        old = self.run_folder(100, {"report.html": self.HTML, "old.html": b"<html>old</html>"})
+        live = self.run_folder(1)
+        stats = self.collect()
+        self.assertFalse(os.path.exists(old))
+        self.assertEqual(stats["runFoldersDeleted"], 1)
+        # old.html's object lost its last link; report.html's is still linked from the live folder
+        self.assertEqual(stats["objectsDeleted"], 1)
+        with open(os.path.join(live, "report.html"), "rb") as f:
+            self.assertEqual(f.read(), self.HTML)
+        self.assertEqual(os.stat(os.path.join(live, "report.html")).st_nlink, 2)
+
+    def test_dry_run_deletes_nothing(self):
+        old, cold = self.run_folder(100), self.run_folder(10, {"cold.html": b"<html>cold</html>"})
+        before = sorted(os.path.relpath(os.path.join(d, f), self.media_root)
+                        for d, _, files in os.walk(self.media_root) for f in files)
+        stats = self.collect(dry_run=True)
+        after = sorted(os.path.relpath(os.path.join(d, f), self.media_root)
+                       for d, _, files in os.walk(self.media_root) for f in files)
+        self.assertEqual(stats["runFoldersDeleted"], 1)
+        self.assertEqual(stats["filesCompressed"], 1)
+        self.assertEqual(after, before)
+        self.assertTrue(os.path.isdir(old) and os.path.isdir(cold))
+
+    def test_finalized_upload_past_retention_has_expired(self):
+        path = store_upload(SimpleUploadedFile("bank.pdf", b"%PDF-1.4 statement"))
+        session = UploadSession.objects.create(
+            filename="bank.pdf", size=18, offset=18, path=path, status=UploadSession.Status.COMPLETE,
+        )
+        old = self.now - 8 * self.DAY
+        os.utime(path, (old, old))
+        self.assertEqual(self.collect()["uploadsDeleted"], 1)
+        self.assertFalse(os.path.exists(path))
+        with self.assertRaisesRegex(UploadNotReady, "has expired"):
+            stored_upload(session.pk)
+        response = parse_reconcile_request({"bank_upload_id": str(session.pk), "hotel_upload_id": ""}, {})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("has expired", response.data["error"])
+
+
+def apply_tab_diff(grid, requests, data):
+    """Apply diff_tab's output to ``grid`` (a list of rows) the way the Sheets API would."""
+    for request in requests:
+        if "appendDimension" in request:
+            grid.extend([] for _ in range(request["appendDimension"]["length"]))
+            continue
+        kind, = request
+        rows = request[kind]["range"]
+        start, end = rows["startIndex"], rows["endIndex"]
+        if kind == "insertDimension":
+            grid[start:start] = [[] for _ in range(end - start)]
+        else:
+            del grid[start:end]
+    for value_range in data:
+        first = int(re.search(r"!A(\d+)$", value_range["range"]).group(1)) - 1
+        for offset, cells in enumerate(value_range["values"]):
+            # Writing below the grid fails on the real API
+            assert first + offset < len(grid), "values written past the grid"
+            grid[first + offset] = cells
+    return grid
+
+
+def trimmed(grid):
+    rows = [list(row) for row in grid]
+    for row in rows:
+        while row and row[-1] == "":
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+class TabDiffTests(SimpleTestCase):
+    HEADER = ["Date", "Amount"]
+
+    def rows(self, *amounts):
+        return [self.HEADER] + [["01-05-2024", amount] for amount in amounts]
+
+    def check(self, old_rows, new_rows, row_count=1000, old_hashes=None):
+        grid = [list(r) for r in old_rows] + [[] for _ in range(row_count - len(old_rows))]
+        stats = SyncStats()
+        hashes = old_hashes if old_hashes is not None else [row_hash(r) for r in old_rows]
+        requests, data, new_hashes = diff_tab(7, "Report", hashes, new_rows, 2, row_count, stats)
+        apply_tab_diff(grid, requests, data)
+        self.assertEqual(trimmed(grid), new_rows)
+        self.assertEqual(new_hashes, [row_hash(r) for r in new_rows])
+        return requests, data, stats
+
+    def test_insert_in_the_middle(self):
+        requests, data, stats = self.check(self.rows(100, 200, 300), self.rows(100, 150, 160, 200, 300))
+        self.assertEqual(stats.rows_inserted, 2)
+        # Only the new rows are written
+        self.assertEqual(stats.rows_written, 2)
+        self.assertEqual(len(data), 1)
+
+    def test_delete_at_the_end(self):
+        requests, data, stats = self.check(self.rows(100, 200, 300, 400), self.rows(100, 200))
+        self.assertEqual(stats.rows_deleted, 2)
+        self.assertEqual(data, [])
+
+    def test_mixed_changes(self):
+        self.check(self.rows(100, 200, 300, 400, 500), self.rows(50, 100, 250, 400, 500, 600, 700))
+
+    def test_grid_smaller_than_the_data(self):
+        requests, _, _ = self.check(self.rows(100), self.rows(100, 200, 300, 400, 500), row_count=3)
+        self.assertIn("appendDimension", requests[0])
+        self.assertEqual(requests[0]["appendDimension"]["length"], 3)
+
+    def test_stale_tab_is_rewritten(self):
+        # The snapshot does not describe what the tab holds: every row differs
+        old = [["Old", "Layout", "x"], ["1", "2", "3"]]
+        _, _, stats = self.check(old, self.rows(100, 200), old_hashes=["stale1", "stale2"])
+        self.assertEqual(stats.rows_written, 3)
+
+    def test_identical_tab_sends_nothing(self):
+        requests, data, _ = self.check(self.rows(100, 200), self.rows(100, 200))
+        self.assertEqual((requests, data), ([], []))
+
+
+class WorkbookSyncTests(TestCase):
+    def setUp(self):
+        self.google = FakeGoogleServer(("127.0.0.1", 0))
+        self.google.start()
+        self.addCleanup(self.google.server_close)
+        self.addCleanup(self.google.shutdown)
+        endpoint = override_settings(GOOGLE_API_ENDPOINT=self.google.url)
+        endpoint.enable()
+        self.addCleanup(endpoint.disable)
+        self.sheets = build_service("sheets", "v4")
+
+    def tables(self, *amounts):
+        return {
+            "Summary": [["Reconciled", len(amounts)]],
+            "VISA": [["Date", "Amount"]] + [["01-05-2024", amount] for amount in amounts],
+        }
+
+    def test_identical_sync_sends_no_values(self):
+        spreadsheet_id, first = sync_workbook(self.sheets, "acme", self.tables(100, 200))
+        self.assertEqual(first.ranges, 2)
+        writes = self.google.state.calls["sheets.values.batchUpdate"]
+        same_id, again = sync_workbook(self.sheets, "acme", self.tables(100, 200))
+        self.assertEqual(same_id, spreadsheet_id)
+        self.assertEqual(again.ranges, 0)
+        self.assertEqual(self.google.state.calls["sheets.values.batchUpdate"], writes)
+
+    def test_changes_and_stale_tabs_reach_the_sheet(self):
+        spreadsheet_id, _ = sync_workbook(self.sheets, "acme", self.tables(100, 200, 300))
+        tables = self.tables(100, 150, 300)
+        del tables["Summary"]
+        _, stats = sync_workbook(self.sheets, "acme", tables)
+        held = self.google.state.spreadsheets[spreadsheet_id]
+        self.assertEqual(trimmed(held["VISA"]), tables["VISA"])
+        self.assertEqual(stats.rows_written, 1)
+        # A tab the report no longer has is emptied
+        self.assertEqual(held["Summary"], [])
+        self.assertEqual(stats.tabs_cleared, 1)
+
+
+class HotFolderTests(TestCase):
+    def setUp(self):
+        drop_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(drop_folder.cleanup)
+        self.path = drop_folder.name
+        self.folder = hotfolder.HotFolder(self.path)
+        self.watcher = hotfolder.FolderWatcher([self.folder], settle=30)
+        self.bank = self.drop("grand_bank_2025-06.pdf", b"%PDF bank")
+        self.hotel = self.drop("grand_hotel_2025-06.csv", b"Date,Amount")
+        self.pair = (self.folder, "grand", "2025-06", self.bank, self.hotel)
+
+    def drop(self, name, data, mtime=None):
+        path = os.path.join(self.path, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_pair_waits_until_its_files_settle(self):
+        self.assertEqual(self.watcher.scan(now=0), [])
+        self.assertEqual(self.watcher.scan(now=29), [])
+        self.assertEqual(self.watcher.scan(now=30), [self.pair])
+
+    def test_file_still_being_written_restarts_the_wait(self):
+        self.watcher.scan(now=0)
+        self.drop("grand_bank_2025-06.pdf", b"%PDF bank, more pages", mtime=time.time() + 5)
+        self.assertEqual(self.watcher.scan(now=30), [])
+        self.assertEqual(self.watcher.scan(now=59), [])
+        self.assertEqual(self.watcher.scan(now=60), [self.pair])
+
+    def test_pair_is_returned_once_per_version(self):
+        self.watcher.scan(now=0)
+        self.assertEqual(self.watcher.scan(now=30), [self.pair])
+        self.assertEqual(self.watcher.scan(now=100), [])
+        # Dropped again with new content
+        self.drop("grand_hotel_2025-06.csv", b"Date,Amount\n", mtime=time.time() + 5)
+        self.assertEqual(self.watcher.scan(now=110), [])
+        self.assertEqual(self.watcher.scan(now=140), [self.pair])
+
+    def test_same_files_are_claimed_once(self):
+        job, bank, hotel = hotfolder.claim_pair(*self.pair)
+        self.assertEqual(bank.sha256, hashlib.sha256(b"%PDF bank").hexdigest())
+        self.assertIsNone(hotfolder.claim_pair(*self.pair))
+        self.assertEqual(HotFolderJob.objects.count(), 1)
+
+    def test_busy_server_releases_the_claim_for_a_retry(self):
+        self.watcher.scan(now=0)
+        self.assertEqual(self.watcher.scan(now=30), [self.pair])
+        job, bank, hotel = hotfolder.claim_pair(*self.pair)
+        with mock.patch.object(hotfolder, "_run_pair", side_effect=SchedulerBusy("Busy.", 5)), \
+                contextlib.redirect_stdout(io.StringIO()):
+            self.assertIsNone(hotfolder.process_pair(job, self.folder, bank, hotel))
+        self.assertFalse(HotFolderJob.objects.exists())
+        self.watcher.retry(self.bank, self.hotel)
+        self.assertEqual(self.watcher.scan(now=31), [self.pair])
+        self.assertIsNotNone(hotfolder.claim_pair(*self.pair))
+
+    def test_result_is_written_next_to_the_inputs(self):
+        job, bank, hotel = hotfolder.claim_pair(*self.pair)
+        response = Response({"reconciledCount": 3})
+        with mock.patch.object(hotfolder, "_run_pair", return_value=(response, None)), \
+                contextlib.redirect_stdout(io.StringIO()):
+            status = hotfolder.process_pair(job, self.folder, bank, hotel)
+        self.assertEqual(status, HotFolderJob.Status.DONE)
+        job.refresh_from_db()
+        self.assertEqual(job.status_code, 200)
+        with open(os.path.join(self.path, "grand_2025-06_reconciliation.json")) as f:
+            self.assertEqual(json.load(f), {"statusCode": 200, "reconciledCount": 3})
+
+
+class HistoryTests(TestCase):
+    def completed_run(self, finished, card_types, client_name="acme", duration=10.0):
+        run = ReconciliationRecord.objects.create(
+            client_name=client_name, status=ReconciliationRecord.Status.COMPLETED,
+            finished_at=timezone.make_aware(datetime.fromisoformat(finished)), duration_seconds=duration,
+            total_transactions=sum(t["reconciledCount"] + t["unreconciledBankCount"] for t in card_types.values()),
+            card_type_totals=card_types,
+        )
+        update_rollups(run)
+        return run
+
+    @staticmethod
+    def totals(reconciled, amount, unreconciled_bank=0, unreconciled_hotel=0):
+        return {
+            "reconciledCount": reconciled, "reconciledAmount": amount,
+            "unreconciledBankCount": unreconciled_bank, "unreconciledBankAmount": 10.0 * unreconciled_bank,
+            "unreconciledHotelCount": unreconciled_hotel, "unreconciledHotelAmount": 20.0 * unreconciled_hotel,
+        }
+
+    def test_runs_of_one_day_share_a_row_per_card_type(self):
+        self.completed_run("2025-06-04 09:00", {"VISA": self.totals(3, 300.0, 1), "MASTER": self.totals(1, 50.0)})
+        self.completed_run("2025-06-04 17:00", {"VISA": self.totals(2, 200.0, 0, 2)}, duration=20.0)
+        rollups = {r.card_type: r for r in ClientRollup.objects.filter(client_name="acme")}
+        self.assertEqual(set(rollups), {"VISA", "MASTER", ClientRollup.ALL_CARD_TYPES})
+        visa = rollups["VISA"]
+        self.assertEqual((visa.runs, visa.reconciled_count, visa.reconciled_amount), (2, 5, 500.0))
+        self.assertEqual((visa.unreconciled_bank_count, visa.unreconciled_hotel_count), (1, 2))
+        self.assertEqual(visa.transactions, 6)
+        overall = rollups[ClientRollup.ALL_CARD_TYPES]
+        self.assertEqual((overall.runs, overall.transactions, overall.reconciled_count), (2, 7, 6))
+        self.assertEqual(overall.total_duration_seconds, 30.0)
+        self.assertEqual(overall.day, date(2025, 6, 4))
+
+    def test_week_and_month_periods(self):
+        # Wednesday and Friday of one week, then the Monday after, which is still June
+        for day in ("2025-06-04", "2025-06-06", "2025-06-09"):
+            self.completed_run(f"{day} 12:00", {"VISA": self.totals(1, 100.0)})
+        self.completed_run("2025-07-01 12:00", {"VISA": self.totals(1, 100.0)})
+
+        weeks = rollup_series("acme", "week")
+        self.assertEqual([(str(p["period"])[:10], p["runs"]) for p in weeks],
+                         [("2025-06-02", 2), ("2025-06-09", 1), ("2025-06-30", 1)])
+        months = rollup_series("acme", "month", card_type="visa")
+        self.assertEqual([(str(p["period"])[:10], p["reconciledCount"]) for p in months],
+                         [("2025-06-01", 3), ("2025-07-01", 1)])
+        self.assertEqual(months[0]["avgDurationSeconds"], 10.0)
+        days = rollup_series("acme", date_from="2025-06-05", date_to="2025-06-30")
+        self.assertEqual([str(p["period"]) for p in days], ["2025-06-06", "2025-06-09"])
+
+    def test_run_history_pages_with_before(self):
+        runs = [self.completed_run(f"2025-06-0{i} 12:00", {"VISA": self.totals(1, 100.0)}) for i in range(1, 6)]
+        self.completed_run("2025-06-01 12:00", {"VISA": self.totals(1, 100.0)}, client_name="other")
+        first = run_history("acme", limit=2)
+        self.assertEqual([r["id"] for r in first], [runs[4].pk, runs[3].pk])
+        second = run_history("acme", limit=2, before=first[-1]["id"])
+        self.assertEqual([r["id"] for r in second], [runs[2].pk, runs[1].pk])
+        last = run_history("acme", limit=2, before=second[-1]["id"])
+        self.assertEqual([r["id"] for r in last], [runs[0].pk])
+        self.assertEqual(last[0]["cardTypes"]["VISA"]["reconciledCount"], 1)
+
+    def test_bad_queries(self):
+        for kwargs in ({"granularity": "year"}, {"date_from": "04/06/2025"}, {"date_to": "2025-13-01"}):
+            with self.subTest(**kwargs), self.assertRaises(InvalidHistoryQuery):
+                rollup_series("acme", **kwargs)
+        with self.assertRaises(InvalidHistoryQuery):
+            run_history(limit="ten")
+        with self.assertRaises(InvalidHistoryQuery):
+            run_history(before="last")
+
+
+class ResultStoreTests(SimpleTestCase):
+    def setUp(self):
+        temp_dirs(self, "RECON_RESULTS_DIR")
+
+    def export(self, run_id, client_name, pairs, un_bank=(), un_hotel=()):
+        """Export a run whose reconciled pairs are ``(bank row, hotel row)``."""
+        run = SimpleNamespace(pk=run_id, started_at=None)
+        bank = bank_frame([b for b, _ in pairs])
+        hotel = hotel_frame([h for _, h in pairs])
+        tables = result_tables(run, client_name, bank, hotel, bank_frame(list(un_bank)),
+                               hotel_frame(list(un_hotel)))
+        return export_run(run, client_name, tables)
+
+    def export_two_runs(self):
+        self.export(1, "acme", [
+            (("2025-02-01 09:00", 100, "4111XXXXXXXX1111", "VISA"), ("2025-02-01 09:04", 100, "XXXX1111", "VISA")),
+            (("2025-02-01 10:00", 300, "GCCNET", "GCCNET"), ("2025-02-01 10:10", 300, "", "GCCNET")),
+        ], un_bank=[("2025-02-01 11:00", 50, "4111XXXXXXXX2222", "VISA")],
+           un_hotel=[("2025-02-01 12:00", 999, "XXXX9999", "POS - Visa Card")])
+        self.export(2, "other", [
+            (("2025-02-02 09:00", 200, "5500XXXXXXXX3333", "MASTER"), ("2025-02-02 09:01", 200, "", "MASTER")),
+        ])
+
+    def test_group_by_and_metrics(self):
+        self.export_two_runs()
+        result = query_results("matched", group_by="client_name", metrics="count,amount,runs")
+        self.assertEqual(result["columns"], ["client_name", "count", "amount", "runs"])
+        self.assertEqual(result["rows"], [["acme", 2, 400.0, 1], ["other", 1, 200.0, 1]])
+        deltas = query_results("matched", group_by=["match_reason"], metrics=["count", "max_time_delta"])
+        self.assertEqual(deltas["rows"], [[REASON_AMOUNT, 2, 10.0], [REASON_CARD, 1, 4.0]])
+
+    def test_filters(self):
+        self.export_two_runs()
+        self.assertEqual(query_results("matched", metrics="count", client_name="acme")["rows"], [[2]])
+        self.assertEqual(query_results("matched", metrics="count", card_type="visa")["rows"], [[1]])
+        self.assertEqual(query_results("matched", metrics="count", run_id="2")["rows"], [[1]])
+        by_day = query_results("matched", group_by="day", metrics="count", date_from="2025-02-02")
+        self.assertEqual([[str(d), n] for d, n in by_day["rows"]], [["2025-02-02", 1]])
+        self.assertEqual(query_results("matched", metrics="count", date_to="2025-02-01")["rows"], [[2]])
+        # Hotel card types are normalized like the report's
+        hotel = query_results("unmatched_hotel", group_by="card_type", metrics="count,amount")
+        self.assertEqual(hotel["rows"], [["VISA", 1, 999.0]])
+        # A client with no exported run has no partition to read
+        self.assertEqual(query_results("matched", metrics="count", client_name="nobody")["rows"], [])
+
+    def test_unknown_names_and_values_are_refused(self):
+        self.export_two_runs()
+        bad = [
+            {"table": "runs"},
+            {"table": "matched", "group_by": "guest_name"},
+            {"table": "matched", "metrics": "sum"},
+            {"table": "unmatched_bank", "metrics": "avg_time_delta"},
+            {"table": "unmatched_hotel", "group_by": "terminal_id"},
+            {"table": "matched", "run_id": "one"},
+            {"table": "matched", "date_from": "not a date"},
+        ]
+        for kwargs in bad:
+            with self.subTest(**kwargs), self.assertRaises(InvalidResultQuery):
+                query_results(**kwargs)
+
+    def test_empty_results_dir_returns_no_rows(self):
+        result = query_results("matched", group_by="client_name", metrics="count")
+        self.assertEqual(result, {"columns": ["client_name", "count"], "rows": []})
+
+    def test_match_reasons(self):
+        bank = bank_frame([
+            ("2025-02-01 09:00", 100, "4111XXXXXXXX1111", "VISA"),
+            ("2025-02-01 09:00", 100, "4111XXXXXXXX1111", "VISA"),
+            ("2025-02-01 09:00", 100, "GCC1111", "GCCNET"),
+            ("2025-02-01 09:00", 100, "4111XXXXXXXX1111", "VISA"),
+        ])
+        hotel = hotel_frame([
+            ("2025-02-01 09:00", 100, "XXXX1111", "VISA"),
+            ("2025-02-01 09:00", 100, "XXXX2222", "VISA"),
+            ("2025-02-01 09:00", 100, "XXXX1111", "GCCNET"),
+            ("2025-02-01 09:00", 100, "111", "VISA"),
+        ])
+        self.assertEqual(list(match_reasons(bank, hotel)), [REASON_CARD, REASON_AMOUNT, REASON_AMOUNT, REASON_AMOUNT])
+
+
+class CardRoutingTests(SimpleTestCase):
+    def test_last4_then_longest_bin_prefix(self):
+        rules = CardRules(
+            last4_routes={"0580": "GCCNET"},
+            bin_routes={"4": "VISA", "4847": "NAPS", "484712": "QPAY"},
+        )
+        numbers = ["484712XXXXXX1111", "484799XXXXXX2222", "411111XXXXXX3333", "484712XXXXXX0580",
+                   "550000XXXXXX4444", ""]
+        types = ["VISA", "VISA", "MASTER", "VISA", "MASTER", "VISA"]
+        expected = ["QPAY", "NAPS", "VISA", "GCCNET", "MASTER", "VISA"]
+        self.assertEqual([rules.route(n, t) for n, t in zip(numbers, types)], expected)
+        # Missing card numbers keep the section's type
+        numbers[-1] = None
+        self.assertEqual(list(rules.route_series(pd.Series(numbers), pd.Series(types))), expected)
+
+
+class CardRuleLayeringTests(TestCase):
+    def setUp(self):
+        card_rules.invalidate()
+        self.addCleanup(card_rules.invalidate)
+
+    def test_client_row_layers_on_the_all_clients_row(self):
+        CardRoutingRule.objects.create(
+            client_name=card_rules.ALL_CLIENTS, last4_routes={"1234": "LOCAL"}, bin_routes={"4847": "NAPS"},
+            excluded_types=["AMEX"], attachment_order=["NAPS"],
+        )
+        CardRoutingRule.objects.create(
+            client_name="acme", last4_routes={"1234": "", "0580": ""}, bin_routes={"5500": "QPAY"},
+            aliases={"MASTER": ""},
+        )
+        acme = card_rules.card_rules_for("acme")
+        # "" removes inherited routes, built-in ones included
+        self.assertNotIn("1234", acme.last4_routes)
+        self.assertNotIn("0580", acme.last4_routes)
+        self.assertEqual(acme.bin_routes, {"4847": "NAPS", "5500": "QPAY"})
+        self.assertNotIn("MASTER", acme.aliases)
+        # Empty lists inherit
+        self.assertEqual(acme.excluded_types, {"AMEX"})
+        self.assertEqual(acme.attachment_order, ["NAPS"])
+
+        other = card_rules.card_rules_for("other")
+        self.assertEqual(other.last4_routes["1234"], "LOCAL")
+        self.assertEqual(other.last4_routes["0580"], "GCCNET")
+        self.assertEqual(other.aliases["MASTER"], "MASTERCARD")
+
+    def test_no_rows_use_the_built_in_rules(self):
+        self.assertIs(card_rules.card_rules_for("acme"), DEFAULT_CARD_RULES)
+
+    def test_compiled_rules_are_reused_until_a_row_changes(self):
+        rule = CardRoutingRule.objects.create(client_name="acme", bin_routes={"4847": "NAPS"})
+        first = card_rules.card_rules_for("acme")
+        self.assertIs(card_rules.card_rules_for("acme"), first)
+
+        # Saved by another process: no signal here, only the new stamp
+        CardRoutingRule.objects.filter(pk=rule.pk).update(
+            bin_routes={"4847": "QPAY"}, updated_at=rule.updated_at + timedelta(seconds=1),
+        )
+        second = card_rules.card_rules_for("acme")
+        self.assertIsNot(second, first)
+        self.assertEqual(second.bin_routes, {"4847": "QPAY"})
+
+        # Saved here: the signal clears the cache
+        rule.refresh_from_db()
+        rule.aliases = {"VISA DEBIT": "VISA"}
+        rule.save()
+        self.assertEqual(card_rules.card_rules_for("acme").aliases["VISA DEBIT"], "VISA")
+        rule.delete()
+        self.assertIs(card_rules.card_rules_for("acme"), DEFAULT_CARD_RULES)
+
+
+def bank_keys(rows):
+    """unmatched_bank key rows from ``(dt, amount, card_number)``."""
+    return pd.DataFrame({
+        "dt": pd.to_datetime([r[0] for r in rows]),
+        "amount": pd.Series([r[1] for r in rows], dtype="float64"),
+        "card_type": "VISA",
+        "card_number": [r[2] for r in rows],
+    })
+
+
+class ShadowCompareTests(SimpleTestCase):
+    def test_duplicate_rows_count_as_a_multiset(self):
+        row = ("2025-02-01 09:00", 100.0, "4111XXXXXXXX1111")
+        counts, diffs = shadow.compare_tables(
+            {"unmatched_bank": bank_keys([row, row, row])}, {"unmatched_bank": bank_keys([row])},
+        )
+        self.assertEqual(counts["unmatched_bank"],
+                         {"primary": 3, "candidate": 1, "onlyPrimary": 2, "onlyCandidate": 0})
+        self.assertEqual(len(diffs["unmatched_bank"]["onlyPrimary"]), 2)
+        self.assertEqual(diffs["unmatched_bank"]["onlyCandidate"], [])
+        # Tables missing on both sides are empty, not divergent
+        self.assertEqual(counts["matched"], {"primary": 0, "candidate": 0, "onlyPrimary": 0, "onlyCandidate": 0})
+        self.assertNotIn("matched", diffs)
+
+    def test_amounts_are_rounded_and_times_compared_to_the_minute(self):
+        primary = bank_keys([("2025-02-01 09:00:10", 100.004, "1111"), (None, 50.0, "2222")])
+        candidate = bank_keys([("2025-02-01 09:00:50", 99.996, "1111"), (None, 50.0, "2222")])
+        counts, diffs = shadow.compare_tables({"unmatched_bank": primary}, {"unmatched_bank": candidate})
+        self.assertEqual(counts["unmatched_bank"]["onlyPrimary"], 0)
+        self.assertEqual(counts["unmatched_bank"]["onlyCandidate"], 0)
+        self.assertEqual(diffs, {})
+        # A missing time keys as "" rather than NaT, which never equals itself
+        keys = shadow._row_keys(primary, "unmatched_bank")
+        self.assertIn(("", 50.0, "VISA", "", "2222", ""), keys)
+
+    def test_sample_rows_are_capped_per_side(self):
+        rows = [(f"2025-02-01 09:{m:02d}", 10.0, "1111") for m in range(5)]
+        counts, diffs = shadow.compare_tables(
+            {"unmatched_bank": bank_keys(rows)}, {"unmatched_bank": bank_keys(rows[:1])}, max_rows=2,
+        )
+        self.assertEqual(counts["unmatched_bank"]["onlyPrimary"], 4)
+        self.assertEqual([r["dt"] for r in diffs["unmatched_bank"]["onlyPrimary"]],
+                         ["2025-02-01 09:01", "2025-02-01 09:02"])
+
+    @override_settings(RECON_SHADOW_MAX_PENDING=2)
+    def test_full_queue_skips_without_submitting(self):
+        run = SimpleNamespace(pk=7)
+        with mock.patch.object(shadow, "_pending", 2), \
+                mock.patch.object(shadow, "_get_executor") as executor:
+            self.assertFalse(shadow.submit_shadow("reference", run, "acme", None, {}, {}))
+            self.assertEqual(shadow._pending, 2)
+        executor.assert_not_called()
+
+
+class StreamingModeTests(SimpleTestCase):
+    large = SimpleNamespace(size=30)
+    small = SimpleNamespace(size=10)
+
+    @override_settings(RECON_STREAMING_MIN_FILE_SIZE=None)
+    def test_streaming_is_opt_in_by_default(self):
+        self.assertFalse(use_streaming_mode(None, self.large, self.large))
+        self.assertTrue(use_streaming_mode("true", self.small, self.small))
+
+    @override_settings(RECON_STREAMING_MIN_FILE_SIZE=20, RECON_MATCH_MODE="first", RECON_CLOCK_SKEW=False)
+    def test_size_rule(self):
+        self.assertTrue(use_streaming_mode(None, self.small, self.large))
+        self.assertFalse(use_streaming_mode("false", self.small, self.small))
+
+    @override_settings(RECON_STREAMING_MIN_FILE_SIZE=20)
+    def test_size_rule_yields_to_matching_the_stream_cannot_do(self):
+        for overrides in ({"RECON_MATCH_MODE": "optimal"}, {"RECON_CLOCK_SKEW": True}):
+            with self.subTest(**overrides), self.settings(**overrides):
+                self.assertFalse(use_streaming_mode(None, self.large, self.large))
+                # An explicit request is still honoured
+                self.assertTrue(use_streaming_mode("1", self.large, self.large))
+
+
+def sample(scheduled, started, finished, status=200, error=None):
+    s = Sample(None, scheduled)
+    s.started, s.finished, s.status, s.error = started, finished, status, error
+    return s
+
+
+class LoadTestHelperTests(SimpleTestCase):
+    def test_percentile_interpolates(self):
+        values = [1.0, 2.0, 3.0, 4.0]
+        self.assertEqual(percentile(values, 0), 1.0)
+        self.assertEqual(percentile(values, 50), 2.5)
+        self.assertAlmostEqual(percentile(values, 90), 3.7)
+        self.assertEqual(percentile(values, 100), 4.0)
+        self.assertEqual(percentile([7.0], 95), 7.0)
+        self.assertIsNone(percentile([], 50))
+
+    def test_summarize(self):
+        samples = [
+            sample(0.0, 0.0, 0.2),
+            sample(0.0, 1.0, 3.0),
+            sample(1.0, 1.0, 1.5, status=503),
+            sample(1.0, 1.0, None, status=None, error="ConnectionResetError: peer closed"),
+        ]
+        summary = summarize(samples, elapsed=30)
+        self.assertEqual((summary["requests"], summary["ok"], summary["errorRate"]), (4, 2, 0.5))
+        self.assertEqual(summary["errors"], {"HTTP 503": 1, "ConnectionResetError": 1})
+        self.assertEqual(summary["errorExamples"]["ConnectionResetError"], "ConnectionResetError: peer closed")
+        self.assertEqual(summary["throughputPerMinute"], 4.0)
+        # Latency counts from the scheduled arrival, queueing included
+        self.assertEqual(summary["latency"]["max"], 3.0)
+        self.assertAlmostEqual(summary["latency"]["mean"], 1.6)
+        self.assertAlmostEqual(summary["clientQueueP95"], 0.85)
+        counts = {bucket["le"]: bucket["count"] for bucket in summary["histogram"]}
+        self.assertEqual((counts[0.25], counts[5]), (1, 1))
+        self.assertEqual(sum(counts.values()), 2)
+
+    def test_summarize_without_samples(self):
+        summary = summarize([], elapsed=0)
+        self.assertIsNone(summary["errorRate"])
+        self.assertIsNone(summary["throughputPerMinute"])
+        self.assertIsNone(summary["latency"]["p50"])
+
+    def test_split_range(self):
+        cases = {
+            "Summary!A5:K": ("Summary", 4),
+            "'Bank Account'!A1": ("Bank Account", 0),
+            "'O''Hara'!B3:C9": ("O'Hara", 2),
+            "Bank Account": ("Bank Account", 0),
+            "A1:K": ("Sheet1", 0),
+            "%27Bank%20Account%27!A2": ("Bank Account", 1),
+        }
+        for a1, expected in cases.items():
+            with self.subTest(a1=a1):
+                self.assertEqual(_split_range(a1), expected)
+
+    def test_put_values_pads_and_overwrites(self):
+        tabs = {"Summary": [["a"], ["b"]]}
+        FakeGoogleHandler._put_values(tabs, "Summary!A4", [["d"], ["e"]])
+        self.assertEqual(tabs["Summary"], [["a"], ["b"], [], ["d"], ["e"]])
+        FakeGoogleHandler._put_values(tabs, "Summary!A2:B", [["B", 1]])
+        self.assertEqual(tabs["Summary"], [["a"], ["B", 1], [], ["d"], ["e"]])
+        FakeGoogleHandler._put_values(tabs, "'New tab'!A1", [["x"]])
+        self.assertEqual(tabs["New tab"], [["x"]])
+
+
+BANK_FIRST_PAGE = "\n".join([
+    "ACQUIRER SETTLEMENT REPORT",
+    "MERCHANT ID 111",
+    "TERMINAL ID T1",
+    "ON-US VISA",
+    bank_line(1, "01/02/2025 10:00", "4111XXXXXXXX1111", 100),
+])
+HOTEL_FIRST_PAGE = "\n".join([
+    "Cashier Report",
+    "01/02/25 10:00 101 John Smith 12345 POS - Visa Card CHK1 QAR 1,250.00 1,250.00 C1",
+    "4111XXXXXXXX1111",
+])
+
+
+class FormatDetectionTests(SimpleTestCase):
+    def test_built_in_formats_are_recognised_from_the_first_page(self):
+        self.assertIs(detect_format(BANK_FIRST_PAGE, "bank"), ACQUIRER_SETTLEMENT)
+        self.assertIs(detect_format(HOTEL_FIRST_PAGE, "hotel"), OPERA_CASHIER_REPORT)
+        # Each kind only tries its own formats
+        self.assertIsNone(detect_format(BANK_FIRST_PAGE, "hotel"))
+        self.assertIsNone(detect_format(HOTEL_FIRST_PAGE, "bank"))
+
+    def test_a_single_fingerprint_is_not_enough(self):
+        near_misses = {
+            "bank": ["TERMINAL ID T1\nDAILY SUMMARY", "ON-US VISA 12 transactions"],
+            "hotel": ["Invoice total QAR 1,250.00", "4111XXXXXXXX1111 charged"],
+        }
+        for kind, pages in near_misses.items():
+            for text in pages:
+                with self.subTest(kind=kind, text=text):
+                    self.assertIsNone(detect_format(text, kind))
+        self.assertIsNone(detect_format("", "bank"))
+
+    def test_unknown_layout_fails_before_extraction(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "bank.pdf")
+        with open(path, "wb") as f:
+            f.write(b"%PDF-1.4\n")
+        with mock.patch("api.ingestion.first_page_text", return_value="Monthly utility bill\nTotal due 42.00"), \
+                mock.patch("api.ingestion.extract_text_lines") as extract:
+            with self.assertRaisesMessage(UnsupportedStatementFormat, "Unrecognised bank statement layout in bank.pdf"):
+                detect_statement_format(path, "bank")
+            with self.assertRaises(UnsupportedStatementFormat):
+                load_statement(path, "bank")
+        extract.assert_not_called()
+
+    def test_registered_formats_are_tried_in_order(self):
+        with mock.patch.dict("api.formats._registry", {"bank": [ACQUIRER_SETTLEMENT]}):
+            other = register_format(StatementFormat(
+                "other_acquirer", "bank", [re.compile(r"TERMINAL ID"), re.compile(r"BATCH NO")],
+                row_parser=None, frame_parser=None, dt_format=None, min_hits=2,
+            ))
+            self.assertIs(detect_format("TERMINAL ID T1\nBATCH NO 7", "bank"), other)
+            # A page both recognise goes to the one registered first
+            self.assertIs(detect_format(BANK_FIRST_PAGE + "\nBATCH NO 7", "bank"), ACQUIRER_SETTLEMENT)
+        self.assertNotIn(other, get_formats("bank"))
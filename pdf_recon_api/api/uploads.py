@@ -0,0 +1,306 @@
+"""
+Resumable uploads for large statements.
+
+    POST   /api/uploads/                  {"filename", "size", "sha256"?} -> 201 {"id", ...}
+    GET    /api/uploads/<id>/             progress (HEAD: Upload-Offset / Upload-Length only)
+    PATCH  /api/uploads/<id>/             raw bytes, written at the Upload-Offset header
+    POST   /api/uploads/<id>/finalize/    {"sha256"?}: verify and store
+    DELETE /api/uploads/<id>/             abandon
+
+Chunks go straight to a partial file in the store, so a dropped connection
+costs only the chunk in flight. Ask for the offset with HEAD/GET and send
+the rest from there. A PATCH whose Upload-Offset is not the current offset
+gets a 409 that carries the right one. A chunk may carry
+``Upload-Checksum: sha256 <base64 digest>``; on a mismatch it is discarded
+whole. Finalizing hashes the file, checks it against the announced SHA-256,
+and moves it into the content-addressed upload store without a copy.
+
+``POST /api/reconcile/`` then takes ``bank_upload_id`` / ``hotel_upload_id``
+in place of the two files.
+"""
+import base64
+import binascii
+import fcntl
+import hashlib
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http.request import UnreadablePostError
+from django.utils import timezone
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from .models import UploadSession
+from .storage import CHUNK_SIZE, commit_partial_upload, file_sha256, partial_upload_path
+
+OFFSET_HEADER = "Upload-Offset"
+LENGTH_HEADER = "Upload-Length"
+CHECKSUM_HEADER = "Upload-Checksum"
+
+
+class UploadNotReady(ValueError):
+    pass
+
+
+class StoredUpload:
+    """
+    A finalized upload, standing in for the UploadedFile the reconcile
+    pipeline otherwise gets from the multipart body.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.name = session.filename
+        self.size = session.size
+        self.path = session.path
+        # Hashed when stored, so the run lock does not read the file again
+        self.sha256 = session.sha256
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        with open(self.path, "rb") as f:
+            yield from iter(lambda: f.read(chunk_size), b"")
+
+
+def stored_upload(upload_id):
+    """StoredUpload for a finalized upload id; None when no id is given."""
+    if not upload_id:
+        return None
+    try:
+        session = UploadSession.objects.get(pk=upload_id)
+    except (UploadSession.DoesNotExist, ValidationError):
+        raise UploadNotReady(f"Unknown upload {upload_id}.")
+    if session.status != UploadSession.Status.COMPLETE:
+        raise UploadNotReady(f"Upload {upload_id} is not finalized ({session.offset} of {session.size} bytes).")
+    if not os.path.exists(session.path):
+        raise UploadNotReady(f"Upload {upload_id} has expired; upload the file again.")
+    # Last use: keeps it out of the upload retention sweep
+    os.utime(session.path)
+    return StoredUpload(session)
+
+
+def _session_payload(session):
+    return {
+        "id": str(session.id),
+        "filename": session.filename,
+        "size": session.size,
+        "offset": session.offset,
+        "status": session.status,
+        "sha256": session.sha256 or None,
+        "chunkSize": getattr(settings, "RECON_UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024),
+        "expiresAt": session.updated_at + timedelta(seconds=getattr(settings, "RECON_UPLOAD_SESSION_TTL", 86400))
+        if session.status == UploadSession.Status.OPEN else None,
+    }
+
+
+def _progress_headers(session):
+    return {OFFSET_HEADER: str(session.offset), LENGTH_HEADER: str(session.size), "Cache-Control": "no-store"}
+
+
+def _parse_checksum(header):
+    """Expected digest bytes from ``sha256 <base64>``."""
+    algorithm, _, value = header.strip().partition(" ")
+    if algorithm.lower() != "sha256":
+        raise ValueError(f"Unsupported checksum algorithm '{algorithm}'; use sha256.")
+    try:
+        return base64.b64decode(value.strip(), validate=True)
+    except binascii.Error:
+        raise ValueError("Upload-Checksum must be 'sha256 <base64 digest>'.")
+
+
+def _open_session(upload_id):
+    session = UploadSession.objects.filter(pk=upload_id).first()
+    if session is None:
+        return None, Response({"error": "Unknown upload."}, status=404)
+    if session.status == UploadSession.Status.OPEN and not os.path.exists(partial_upload_path(session.id)):
+        return None, Response({"error": "Upload expired; start a new one."}, status=404)
+    return session, None
+
+
+def append_chunk(session, offset, read, checksum=None):
+    """
+    Write the bytes ``read(n)`` returns at ``offset`` of the partial file.
+    Returns the new offset. Raises ValueError for a bad chunk (nothing is
+    kept) and LookupError with the current offset when ``offset`` is stale.
+    Bytes received before a dropped connection are kept unless the chunk
+    carries a checksum.
+    """
+    path = partial_upload_path(session.id)
+    with open(path, "r+b") as f:
+        # One writer per upload, across worker processes
+        fcntl.flock(f, fcntl.LOCK_EX)
+        session.refresh_from_db(fields=["offset", "status"])
+        if session.status != UploadSession.Status.OPEN:
+            raise ValueError("Upload is already finalized.")
+        if offset != session.offset:
+            raise LookupError(session.offset)
+
+        f.seek(offset)
+        f.truncate()
+        digest = hashlib.sha256() if checksum is not None else None
+        remaining = session.size - offset
+        written, dropped = 0, False
+        while True:
+            try:
+                chunk = read(min(CHUNK_SIZE, remaining - written + 1))
+            except UnreadablePostError:
+                dropped = True
+                break
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > remaining:
+                f.truncate(offset)
+                raise ValueError(f"Chunk goes past the declared size of {session.size} bytes.")
+            f.write(chunk)
+            if digest:
+                digest.update(chunk)
+
+        if digest and (dropped or digest.digest() != checksum):
+            f.truncate(offset)
+            raise ValueError("Chunk incomplete; send it again." if dropped
+                             else f"Chunk checksum mismatch; send it again from offset {offset}.")
+        f.flush()
+        os.fsync(f.fileno())
+        session.offset, session.updated_at = offset + written, timezone.now()
+        UploadSession.objects.filter(pk=session.pk).update(offset=session.offset, updated_at=session.updated_at)
+        return session.offset
+
+
+def finalize_upload(session, expected_sha256=""):
+    """
+    Verify a fully received upload and move it into the store. A wrong
+    SHA-256 discards the bytes (the upload restarts at offset 0).
+    """
+    path = partial_upload_path(session.id)
+    with open(path, "r+b") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        session.refresh_from_db()
+        if session.offset != session.size:
+            raise LookupError(session.offset)
+        digest = file_sha256(path)
+        expected = (expected_sha256 or session.expected_sha256).lower()
+        if expected and digest != expected:
+            f.truncate(0)
+            UploadSession.objects.filter(pk=session.pk).update(offset=0, updated_at=timezone.now())
+            raise ValueError(f"SHA-256 mismatch: received {digest}, expected {expected}. "
+                             "The upload was reset; send it again from offset 0.")
+        session.path = commit_partial_upload(path, session.filename, digest)
+        session.sha256 = digest
+        session.status = UploadSession.Status.COMPLETE
+        # Still under the lock: a PATCH waiting on it must see the new status
+        session.save(update_fields=["path", "sha256", "status", "updated_at"])
+    return session
+
+
+def expire_upload_sessions(dry_run=False, now=None):
+    """Delete open sessions idle for RECON_UPLOAD_SESSION_TTL; returns how many."""
+    ttl = getattr(settings, "RECON_UPLOAD_SESSION_TTL", 86400)
+    stale = UploadSession.objects.filter(
+        status=UploadSession.Status.OPEN, updated_at__lt=(now or timezone.now()) - timedelta(seconds=ttl)
+    )
+    count = stale.count()
+    if not dry_run:
+        for upload_id in stale.values_list("id", flat=True):
+            try:
+                os.unlink(partial_upload_path(upload_id))
+            except FileNotFoundError:
+                pass
+        stale.delete()
+    return count
+
+
+class UploadCreateAPIView(APIView):
+    parser_classes = [JSONParser, FormParser, MultiPartParser]
+
+    def post(self, request, *args, **kwargs):
+        filename = os.path.basename(str(request.data.get("filename") or "").strip())
+        expected = str(request.data.get("sha256") or "").strip().lower()
+        try:
+            size = int(request.data.get("size"))
+        except (TypeError, ValueError):
+            return Response({"error": "size must be the file size in bytes."}, status=400)
+        max_size = getattr(settings, "RECON_UPLOAD_MAX_SIZE", None)
+        if not filename:
+            return Response({"error": "filename is required."}, status=400)
+        if size <= 0 or (max_size and size > max_size):
+            return Response({"error": f"size must be between 1 and {max_size} bytes."}, status=400)
+        if expected and (len(expected) != 64 or any(c not in "0123456789abcdef" for c in expected)):
+            return Response({"error": "sha256 must be 64 hex digits."}, status=400)
+
+        session = UploadSession.objects.create(filename=filename, size=size, expected_sha256=expected)
+        path = partial_upload_path(session.id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "wb").close()
+        response = Response(_session_payload(session), status=201, headers=_progress_headers(session))
+        response["Location"] = request.build_absolute_uri(f"{request.path.rstrip('/')}/{session.id}/")
+        return response
+
+
+class UploadAPIView(APIView):
+    def get(self, request, upload_id, *args, **kwargs):
+        session, error = _open_session(upload_id)
+        if error:
+            return error
+        return Response(_session_payload(session), headers=_progress_headers(session))
+
+    def patch(self, request, upload_id, *args, **kwargs):
+        session, error = _open_session(upload_id)
+        if error:
+            return error
+        try:
+            offset = int(request.headers.get(OFFSET_HEADER, ""))
+        except ValueError:
+            return Response({"error": f"{OFFSET_HEADER} header is required."}, status=400)
+        try:
+            checksum = request.headers.get(CHECKSUM_HEADER)
+            checksum = _parse_checksum(checksum) if checksum else None
+            # The raw body: never parsed or buffered by DRF
+            append_chunk(session, offset, request._request.read, checksum)
+        except LookupError:
+            return Response(
+                {"error": f"{OFFSET_HEADER} {offset} does not match the upload.", "offset": session.offset},
+                status=409, headers=_progress_headers(session),
+            )
+        except ValueError as e:
+            return Response({"error": str(e), "offset": session.offset}, status=400,
+                            headers=_progress_headers(session))
+        return Response(_session_payload(session), headers=_progress_headers(session))
+
+    def delete(self, request, upload_id, *args, **kwargs):
+        session = UploadSession.objects.filter(pk=upload_id, status=UploadSession.Status.OPEN).first()
+        if session is None:
+            return Response({"error": "Unknown or finalized upload."}, status=404)
+        try:
+            os.unlink(partial_upload_path(session.id))
+        except FileNotFoundError:
+            pass
+        session.delete()
+        return Response(status=204)
+
+
+class UploadFinalizeAPIView(APIView):
+    parser_classes = [JSONParser, FormParser, MultiPartParser]
+
+    def post(self, request, upload_id, *args, **kwargs):
+        session = UploadSession.objects.filter(pk=upload_id).first()
+        if session is None:
+            return Response({"error": "Unknown upload."}, status=404)
+        if session.status == UploadSession.Status.COMPLETE:
+            return Response(_session_payload(session))
+        session, error = _open_session(upload_id)
+        if error:
+            return error
+        try:
+            finalize_upload(session, str(request.data.get("sha256") or "").strip())
+        except LookupError:
+            return Response(
+                {"error": f"Upload incomplete: {session.offset} of {session.size} bytes received.",
+                 "offset": session.offset},
+                status=409, headers=_progress_headers(session),
+            )
+        except ValueError as e:
+            return Response({"error": str(e), "offset": 0}, status=400)
+        return Response(_session_payload(session))
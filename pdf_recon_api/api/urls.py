@@ -1,6 +1,23 @@
 from django.urls import path
-from .views import ReconciliationAPIView
+from .async_views import AsyncReconciliationView
+from .events import RunEventsView
+from .uploads import UploadAPIView, UploadCreateAPIView, UploadFinalizeAPIView
+from .views import (
+    ReconciliationAPIView, ResultQueryAPIView, RollupHistoryAPIView, RunHistoryAPIView, SchedulerStatusAPIView,
+    ShadowReportAPIView,
+)
 
 urlpatterns = [
     path("reconcile/", ReconciliationAPIView.as_view(), name="reconcile-api"),
+    path("reconcile/async/", AsyncReconciliationView.as_view(), name="reconcile-async"),
+    path("uploads/", UploadCreateAPIView.as_view(), name="upload-create"),
+    path("uploads/<uuid:upload_id>/", UploadAPIView.as_view(), name="upload-detail"),
+    path("uploads/<uuid:upload_id>/finalize/", UploadFinalizeAPIView.as_view(), name="upload-finalize"),
+    path("reconcile/status/", SchedulerStatusAPIView.as_view(), name="reconcile-status"),
+    path("results/query/", ResultQueryAPIView.as_view(), name="results-query"),
+    path("history/runs/", RunHistoryAPIView.as_view(), name="history-runs"),
+    path("history/rollups/", RollupHistoryAPIView.as_view(), name="history-rollups"),
+    path("shadow/report/", ShadowReportAPIView.as_view(), name="shadow-report"),
+    path("runs/events/", RunEventsView.as_view(), name="client-run-events"),
+    path("runs/<int:run_id>/events/", RunEventsView.as_view(), name="run-events"),
 ]
@@ -1,15 +1,16 @@
 import re
 import os
+import html
+import math
+from contextlib import ExitStack
+from functools import partial
 import pandas as pd
 import numpy as np
-import pdfplumber
-from pdf2image import convert_from_bytes, convert_from_path
-import pytesseract
-from datetime import datetime, timedelta
-from openpyxl import load_workbook
+from datetime import datetime
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
 from openpyxl.utils import get_column_letter
-from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload
 from googleapiclient.errors import HttpError # Added HttpError for specific error handling
 from google.oauth2.credentials import Credentials
@@ -47,7 +48,7 @@ if not settings.configured:
         ]
     }
 
-from .google_sheets_utils import get_sheets_service, create_new_tab_only
+from .google_sheets_utils import build_service, get_sheets_service, create_new_tab_only
 
 def some_view(request):
     # Sheets service create karo
@@ -60,58 +61,124 @@ def some_view(request):
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from .models import ReconciliationRecord
 from django.utils import timezone
+from .parsers import BANK_COLUMNS, HOTEL_COLUMNS
+from .extraction import UnreadablePDF, probe_pdf
+from .ingestion import (
+    PDF, UnsupportedStatementFormat, detect_statement_format, detect_upload_type, load_statement,
+)
+from .clock_skew import match_with_clock_skew
+from .streaming import StatementStats, StreamingReconciliation
+from .scheduler import SchedulerBusy, get_scheduler, stage_slot
+from .run_lock import claim_run, finish_run, run_content_hash, upload_sha256, wait_for_run
+from .idempotency import IDEMPOTENCY_HEADER, get_cached_response, idempotency_cache_key, store_response
+from .result_store import InvalidResultQuery, export_run, query_results, result_tables, streamed_result_tables
+from .history import InvalidHistoryQuery, StageTimer, card_type_totals, rollup_series, run_history
+from .storage import precompress, store_artifact, store_upload
+from .shadow import ShadowJob, divergence_report, pick_shadow_engine, submit_shadow
+from .uploads import StoredUpload, UploadNotReady, stored_upload
+from .card_rules import card_rules_for
+from .rendering import render_artifacts, run_in_render_process
+from .events import track_progress
+from .progress import publish, watch_documents
+from .sheet_sync import SHEET_URL, sheet_rows, sync_workbook
+
+
+def save_uploaded_file(uploaded_file):
+    """
+    Save one uploaded file to the content-addressed upload store and return
+    its path. Re-sent statements reuse the stored copy.
+    """
+    if isinstance(uploaded_file, StoredUpload):
+        return uploaded_file.path
+    # Set by upload_sha256 when the run's content hash was computed
+    return store_upload(uploaded_file, getattr(uploaded_file, "sha256", None))
+
+
+def upload_error_response(e, *uploads):
+    """400 for a rejected upload, naming files as the client sent them."""
+    message = str(e)
+    for path, uploaded_file in uploads:
+        message = message.replace(os.path.basename(path), uploaded_file.name)
+    return Response({"error": message}, status=400)
 
 
 def save_uploaded_files(bank_file, hotel_file):
     """
     Save uploaded files to Django MEDIA folder and return their paths
     """
-    upload_dir = os.path.join(settings.MEDIA_ROOT, "uploads")
-    os.makedirs(upload_dir, exist_ok=True)
-
-    bank_path = os.path.join(upload_dir, bank_file.name)
-    hotel_path = os.path.join(upload_dir, hotel_file.name)
-
-    # Save bank file
-    with open(bank_path, "wb+") as f:
-        for chunk in bank_file.chunks():
-            f.write(chunk)
+    return save_uploaded_file(bank_file), save_uploaded_file(hotel_file)
 
-    # Save hotel file
-    with open(hotel_path, "wb+") as f:
-        for chunk in hotel_file.chunks():
-            f.write(chunk)
 
-    return bank_path, hotel_path
+def use_streaming_mode(streaming_flag, *uploads):
+    """
+    Streaming is used when the client asks for it or when any upload is at
+    least RECON_STREAMING_MIN_FILE_SIZE bytes. The streaming path matches
+    "first" in time order without clock-skew calibration, so the size rule
+    does not apply when RECON_MATCH_MODE or RECON_CLOCK_SKEW ask for more.
+    """
+    if str(streaming_flag or "").strip().lower() in ("1", "true", "yes", "on"):
+        return True
+    min_size = getattr(settings, "RECON_STREAMING_MIN_FILE_SIZE", None)
+    if not min_size or not any(f.size >= min_size for f in uploads):
+        return False
+    if getattr(settings, "RECON_MATCH_MODE", "first") != "first" or getattr(settings, "RECON_CLOCK_SKEW", False):
+        print("Large upload matched in memory: the configured match mode or clock skew needs the full statements.")
+        return False
+    return True
+
+
+def check_already_reconciled(client_name, bank_stats, run=None):
+    """
+    Return a 400 Response if this client's date range and transaction count
+    have already been reconciled by another completed run, otherwise None.
+    """
+    min_dt, max_dt = bank_stats.min_dt, bank_stats.max_dt
+    if not bank_stats.count or pd.isna(min_dt) or pd.isna(max_dt):
+        return None
+
+    min_date = min_dt.date()
+    max_date = max_dt.date()
+    txn_count = bank_stats.count
+
+    duplicates = ReconciliationRecord.objects.filter(
+        client_name=client_name,
+        min_date=min_date,
+        max_date=max_date,
+        total_transactions=txn_count,
+        status=ReconciliationRecord.Status.COMPLETED,
+    )
+    if run is not None:
+        duplicates = duplicates.exclude(pk=run.pk)
+    if duplicates.exists():
+        return Response(
+            {"error": f"Transactions from {min_date} to {max_date} ({txn_count} entries) have already been reconciled."},
+            status=400
+        )
+    return None
 
 
-def safe_float(x):
-    try:
-        return float(str(x).replace(",", "").strip())
-    except:
-        return 0.0
+def attach_to_run(run):
+    """
+    Response for a request whose identical run is already claimed: wait for
+    an in-flight run and hand back its result.
+    """
+    if run.status == ReconciliationRecord.Status.COMPLETED:
+        return Response(
+            {"error": f"Transactions from {run.min_date} to {run.max_date} ({run.total_transactions} entries) have already been reconciled."},
+            status=400
+        )
 
-def extract_text_lines(pdf):
-    lines=[]
-    try:
-        with pdfplumber.open(pdf) as p:
-            for page in p.pages:
-                txt = page.extract_text()
-                if txt: lines += txt.split("\n")
-    except pdfplumber.PDFSyntaxError:
-        pass
-
-    if not lines:
-        try:
-            for img in convert_from_path(pdf):
-                lines += pytesseract.image_to_string(img).split("\n")
-        except Exception as e:
-            print(f"Error during OCR for {pdf}: {e}")
+    run = wait_for_run(run)
+    if run.status == ReconciliationRecord.Status.COMPLETED and run.result:
+        return Response(run.result)
+    return Response(
+        {"error": "An identical reconciliation running at the same time failed. Please try again."},
+        status=409
+    )
 
-    return [l.strip() for l in lines if l.strip()]
 
 def extract_dt(line):
     d = re.search(r"\d{2}-[A-Za-z]{3}-\d{4}", line)
@@ -133,7 +200,7 @@ def add_titles_and_total(df, titles, column_headers, amount_cols_to_sum=None):
         empty_row = ["No Records"] + [''] * (len(column_headers) - 1)
         sheet_data.append(empty_row)
     else:
-        df_to_export = df.copy()
+        df_to_export = df # concat below builds a new frame, df is never mutated
 
         if amount_cols_to_sum and all(col in df_to_export.columns for col in amount_cols_to_sum):
             total_row_dict = {col: '' for col in df_to_export.columns}
@@ -156,165 +223,53 @@ def add_titles_and_total(df, titles, column_headers, amount_cols_to_sum=None):
     return pd.DataFrame(sheet_data)
 
 
-def bank_df(lines):
-    rows=[]
-    merchant_id = ""
-    terminal_id = ""
-
-    for l in lines[:20]:
-        mid_match = re.search(r"ID (\S+)", l)
-        if mid_match:
-            merchant_id = mid_match.group(1)
-        tid_match = re.search(r"TERMINAL ID (\S+)", l)
-        if tid_match:
-            terminal_id = tid_match.group(1)
-
-    bank_pattern = re.compile(
-        r"^\d+\s+"
-        r"(\d{2}/\d{2}/\d{4})\s+"
-        r"(\d{2}:\d{2})\s+"
-        r"(?:\d{2})\s+"
-        r"(\S+)\s+"
-        r"(\S+)\s+"
-        r"([\d,]+\.\d{2})\s+"
-        r"([\d,]+\.\d{2})\s+"
-        r"([\d,]+\.\d{2})"
-        r"$"
-    )
-
-    card_type_header_pattern = re.compile(r"(ON-US|OFF-US)\s+(VISA|MASTERCARD|NAPS|GCCNET|AMEX|DINERS|JCB)", re.IGNORECASE)
-
-    GCCNET_CARD_LAST_4_DIGITS = {"0580", "8628", "8134"}
-
-    current_card_type = "UNKNOWN"
-
-    for l in lines:
-        card_header_match = card_type_header_pattern.search(l)
-        if card_header_match:
-            current_card_type = card_header_match.group(2).upper()
-            continue
-
-        match = bank_pattern.match(l)
-        if match:
-            (date_str, time_str, ref_num, card_num,
-             gross_amount_str, commission_str, net_amount_str) = match.groups()
-
-            gross_amount = safe_float(gross_amount_str)
-            commission = safe_float(commission_str)
-            net_amount = safe_float(net_amount_str)
-
-            card_type_display = current_card_type
-
-            if card_num[-4:] in GCCNET_CARD_LAST_4_DIGITS:
-                card_type_display = 'GCCNET'
-
-            rows.append([
-                date_str, time_str,
-                merchant_id, ref_num, card_num, card_type_display,
-                gross_amount, commission, net_amount, terminal_id
-            ])
-    df=pd.DataFrame(rows,columns=[
-        "Transaction Date","Time","Merchant ID","Invoice No / RRN",
-        "Card Number","Card Type (On us/Off us)","Gross Amount","Commission","Net Amount","Terminal ID"
-    ])
-    df["DT"]=pd.to_datetime(df["Transaction Date"].str.replace('/','-')+" "+df["Time"], format="%d-%m-%Y %H:%M", errors="coerce")
-    return df
-
-# ===============================
-# HOTEL PDF -> VISA SETTLEMENTS (Attachment 6)
-# ===============================
-def hotel_df(lines):
-    rows=[]
-    unmatched_lines = []
-
-    hotel_txn_pattern = re.compile(
-        r"^"
-        r"(\d{2}/\d{2}/\d{2})\s+"
-        r"(\d{2}:\d{2})\s+"
-        r"(\S+)\s+"
-        r"(.*?)\s*"
-        r"(?P<txn_code>\d{5})\s+"
-        r"((?:POS - )?(?:Visa|Master|Amex|NAPS|GCCNET|Other)(?: Card)?)\s+"
-        r"(?:(\S+)\s*)?" # Corrected: Removed 'standardised' and ensured regex termination
-        r"(QAR)\s+"
-        r"([\d,]+\.\d{2})\s*(?:-?\s*)?"
-        r"([\d,]+\.\d{2})\s*"
-        r"(\S+)"
-        r"$"
-    )
-
-    card_num_pattern = re.compile(r"^(\S{4}X+\d{4})")
-    check_ref_pattern = re.compile(r"CHECK#\s*(\d+)\s*\[(\d+)\]")
-
-    i = 0
-    while i < len(lines):
-        l = lines[i]
-        match = hotel_txn_pattern.match(l)
-        if match:
-            (date_str, time_str, room_no, name_desc, txn_code, card_type_full, check_ref_num, currency, debit_amount_str, credit_amount_str, cashier_id) = match.groups()
-
-            card_ref = ""
-            card_ref_parts = []
-
-            if check_ref_num:
-                check_match_in_ref_num = check_ref_pattern.search(check_ref_num)
-                if check_match_in_ref_num:
-                    card_ref_parts.append(f"CHECK# {check_match_in_ref_num.group(1)} [{check_match_in_ref_num.group(2)}]") # Fixed typo here
-                else:
-                    card_ref_parts.append(check_ref_num)
-
-            current_next_line_idx = i + 1
-            if current_next_line_idx < len(lines):
-                next_line_content = lines[current_next_line_idx].strip()
-                check_match_next_line = check_ref_pattern.search(next_line_content)
-                if check_match_next_line:
-                    card_ref_parts.append(next_line_content)
-                    i += 1
-                    current_next_line_idx = i + 1
-
-            if current_next_line_idx < len(lines):
-                next_line_content = lines[current_next_line_idx].strip()
-                card_num_match_next_line = card_num_pattern.match(next_line_content)
-                if card_num_match_next_line:
-                    card_ref_parts.append(card_num_match_next_line.group(1))
-                    i += 1
-
-            if card_ref_parts:
-                card_ref = " / ".join(card_ref_parts)
-            else:
-                card_ref = ""
-
-            rows.append([
-                date_str, time_str,
-                room_no, name_desc.strip(), card_ref, card_type_full,
-                safe_float(credit_amount_str), cashier_id
-            ])
-        else:
-            if l.strip() and not check_ref_pattern.match(l) and not card_num_pattern.match(l):
-                unmatched_lines.append(l.strip())
-        i += 1
-
-    if unmatched_lines:
-        print("\n--- Unmatched lines from HOTEL PDF (potential missing transactions) ---")
-        for ul in unmatched_lines:
-            print(ul)
-
-    df=pd.DataFrame(rows,columns=[
-        "Transaction Date","Time","Room No","Name","Card Reference","Card Type","Amount","Cashier ID"
-    ])
-    df["DT"]=pd.to_datetime(df["Transaction Date"].str.replace('/','-')+" "+df["Time"], format="%d-%m-%y %H:%M", errors="coerce")
-    return df
+class SpilledAttachment:
+    """
+    An attachment sheet of a streamed run: the rows of its card-type spill
+    file (see streaming.py) laid out as add_titles_and_total lays out a
+    frame. Iterating re-reads the file, so the rows are never all loaded.
+    """
 
+    def __init__(self, spill, titles, column_headers, amount_cols_to_sum=None):
+        self.spill = spill
+        self.titles = titles
+        self.column_headers = list(column_headers)
+        self.amount_cols_to_sum = amount_cols_to_sum
+        self.width = len(self.column_headers)
+
+    def __iter__(self):
+        for t in self.titles:
+            yield [t]
+        yield []
+        yield self.column_headers
+
+        if not self.spill.count:
+            yield ["No Records"] + [''] * (self.width - 1)
+            return
+        for row in self.spill:
+            yield list(row)
+
+        amount_cols = self.amount_cols_to_sum
+        if amount_cols and all(col in self.column_headers for col in amount_cols):
+            total_row = [''] * self.width
+            for amount_col in amount_cols:
+                total_row[self.column_headers.index(amount_col)] = self.spill.totals[amount_col]
+            first_amount_col_idx = self.column_headers.index(amount_cols[0])
+            total_row[max(first_amount_col_idx - 1, 0)] = "TOTAL"
+            yield total_row
+
+
+def category_total(sheet_df, amount_col):
+    """``(entries, amount)`` of one categorized frame or CardTypeSpill."""
+    if isinstance(sheet_df, pd.DataFrame):
+        return len(sheet_df), sheet_df[amount_col].sum() if not sheet_df.empty else 0.0
+    return sheet_df.count, sheet_df.totals[amount_col]
 
 
 rec_bank_list = []
 rec_hotel_list = []
 un_bank_list = []
 
-BANK_COLUMNS = ["Transaction Date","Time","Merchant ID","Invoice No / RRN",
-                "Card Number","Card Type (On us/Off us)","Gross Amount","Commission","Net Amount","Terminal ID"]
-HOTEL_COLUMNS = ["Transaction Date","Time","Room No","Name","Card Reference","Card Type","Amount","Cashier ID"]
-
 bank = pd.DataFrame(columns=BANK_COLUMNS)
 hotel = pd.DataFrame(columns=HOTEL_COLUMNS)
 
@@ -326,17 +281,6 @@ un_bank = pd.DataFrame(columns=BANK_COLUMNS)
 un_hotel = pd.DataFrame(columns=HOTEL_COLUMNS)
 
 
-def normalize_card_type(card_type_str):
-    """
-    Normalize card type strings to standard names.
-    """
-    if isinstance(card_type_str, str):
-        normalized = card_type_str.replace(' Card', '').replace('POS - ', '').upper().strip()
-        if normalized == 'MASTER':
-            return 'MASTERCARD'
-        return normalized
-    return card_type_str
-
 categorized_rec_bank = {}
 categorized_rec_hotel = {}
 categorized_un_bank = {}
@@ -356,13 +300,8 @@ def generate_attachment_info(
     attachment_info = {}
     attachment_counter = 1
 
-    preferred_card_types_order = ['VISA', 'MASTERCARD', 'NAPS', 'GCCNET']
-
-    all_card_types_in_use = set(final_card_types) | set(preferred_card_types_order)
-
-    final_card_types_sorted = sorted(list(all_card_types_in_use))
-
-    for card_type in final_card_types_sorted:
+    # final_card_types is already in attachment order (CardRules.attachment_types)
+    for card_type in final_card_types:
         rec_bank_df = categorized_rec_bank.get(card_type, empty_bank_df.copy())
         titles_rec_bank = [
             f"Attachment - {attachment_counter}",
@@ -438,133 +377,292 @@ def save_df_to_html(dataframes_to_html, file_path, main_report_title="Credit Car
     html_content.append("<body>")
     html_content.append(f"<h1>{main_report_title}</h1>")
 
-    for title, df in dataframes_to_html:
-        html_content.append(f"<h2>{title}</h2>")
-        # Convert DataFrame to HTML, avoiding header=False for better styling control and adding classes
-        df_html = df.to_html(index=False, header=False)
-
-        # Replace default table tag with styled one
-        df_html = df_html.replace('<table border="1" class="dataframe">', '<table>')
-
-        # Identify the header row based on content of add_titles_and_total
-        # The column headers are typically the 3rd row (index 2) in the DataFrame returned by add_titles_and_total
-        # This assumes that the first dataframe in the list has this structure
-        if title == "Bank Account Summary" and len(df) > 10:
-            # The 10th row of the Bank Account Summary is 'Ending Balance...' headers
-            # The 11th row is the actual data
-            # More sophisticated header styling would go here if we were to reconstruct the HTML table more granularly
-            pass
-
-        html_content.append(df_html)
-
-    html_content.append("</body>")
-    html_content.append("</html>")
-
     with open(file_path, "w", encoding="utf-8") as f:
         f.write("\n".join(html_content))
+        for title, df in dataframes_to_html:
+            f.write(f"\n<h2>{title}</h2>\n")
+            if not isinstance(df, pd.DataFrame):
+                # A streamed run's sheet, written row by row
+                write_html_rows(f, df)
+                continue
+            # Convert DataFrame to HTML, avoiding header=False for better styling control and adding classes
+            df_html = df.to_html(index=False, header=False)
+
+            # Replace default table tag with styled one
+            df_html = df_html.replace('<table border="1" class="dataframe">', '<table>')
+
+            # Identify the header row based on content of add_titles_and_total
+            # The column headers are typically the 3rd row (index 2) in the DataFrame returned by add_titles_and_total
+            # This assumes that the first dataframe in the list has this structure
+            if title == "Bank Account Summary" and len(df) > 10:
+                # The 10th row of the Bank Account Summary is 'Ending Balance...' headers
+                # The 11th row is the actual data
+                # More sophisticated header styling would go here if we were to reconstruct the HTML table more granularly
+                pass
+
+            f.write(df_html)
+        f.write("\n</body>\n</html>")
+
+
+def write_html_rows(f, sheet):
+    """The rows of a SpilledAttachment as the preview's table, one row at a time."""
+    f.write("<table>\n  <tbody>\n")
+    for row in sheet:
+        f.write("    <tr>\n")
+        for value in list(row) + [''] * (sheet.width - len(row)):
+            value = excel_value(value)
+            f.write(f"      <td>{html.escape('' if value is None else str(value))}</td>\n")
+        f.write("    </tr>\n")
+    f.write("  </tbody>\n</table>")
+
+
+def excel_value(value):
+    """A report cell as openpyxl writes it: NaN is an empty cell, numpy scalars are plain numbers."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return value
+
+
+def sheet_rows_of(sheet):
+    """``(width, rows)`` of a report sheet: a frame of rows or a SpilledAttachment."""
+    if isinstance(sheet, pd.DataFrame):
+        return sheet.shape[1], sheet.values.tolist()
+    return sheet.width, iter(sheet)
+
+
+def numbered_rows(rows):
+    """``(row number, row, is last row)``, looking one row ahead."""
+    rows = iter(rows)
+    row = next(rows, None)
+    row_num = 1
+    while row is not None:
+        next_row = next(rows, None)
+        yield row_num, row, next_row is None
+        row, row_num = next_row, row_num + 1
+
+
+def write_excel_report(path, sheets, final_card_types, attachment_num_lookup,
+                       BANK_COLUMNS_DYNAMIC, HOTEL_COLUMNS_DYNAMIC):
+    """
+    Write the "Bank Account" summary and attachment sheets to ``path`` with
+    the report styling. ``sheets`` is a list of ``(sheet_name, sheet)`` with
+    the summary first; a sheet is a frame of rows or a SpilledAttachment.
+    The workbook is written in write-only mode and every cell is styled as
+    it is written, so a streamed run's sheets are read one row at a time.
+    """
+    center_aligned_text = Alignment(horizontal="center", vertical="center")
+    header_fill = PatternFill(start_color="D9D9D9", end_color="D9D9D9", fill_type="solid")
+    total_fill = PatternFill(start_color="F2F2F2", end_color="F2F2F2", fill_type="solid")
+    thick_border = Side(border_style="medium", color="000000")
+    cell_border = Border(left=thick_border,right=thick_border,top=thick_border,bottom=thick_border)
+    sheet_names = {sheet_name for sheet_name, _ in sheets}
+
+    # Unreconciled attachments get number formats:
+    # sheet name -> (amount column indexes, index of the column labelled TOTAL)
+    amount_formats = {}
+    for card_type in final_card_types:
+        att_un_bank = attachment_num_lookup.get((card_type, 'Merchant', 'Unreconciled'), None)
+        if att_un_bank:
+            bank_amount_cols = ["Gross Amount", "Commission", "Net Amount"]
+            amount_formats[f"Attachment {att_un_bank}"] = (
+                {BANK_COLUMNS_DYNAMIC.index(c) for c in bank_amount_cols if c in BANK_COLUMNS_DYNAMIC}, 0
+            )
+        att_un_hotel = attachment_num_lookup.get((card_type, 'Settlements', 'Unreconciled'), None)
+        if att_un_hotel:
+            amount_col_idx_hotel = HOTEL_COLUMNS_DYNAMIC.index("Amount") if "Amount" in HOTEL_COLUMNS_DYNAMIC else None
+            amount_formats[f"Attachment {att_un_hotel}"] = (
+                set() if amount_col_idx_hotel is None else {amount_col_idx_hotel},
+                amount_col_idx_hotel - 1 if amount_col_idx_hotel else None,
+            )
 
+    wb = Workbook(write_only=True)
+    for sheet_index, (sheet_name, sheet) in enumerate(sheets):
+        is_summary = sheet_index == 0
+        max_col, rows = sheet_rows_of(sheet)
+        ws = wb.create_sheet(sheet_name)
+        # Widths and merges must be set before the first row is written
+        for col_idx in range(1, (9 if is_summary else max_col) + 1):
+            ws.column_dimensions[get_column_letter(col_idx)].width = 20
+        if is_summary:
+            ws.merged_cells.add("A1:I1"); ws.merged_cells.add("A2:I2")
+        else:
+            ws.merged_cells.add(f"A1:{get_column_letter(max_col)}1")
+        amount_cols, total_label_col = amount_formats.get(sheet_name, (None, None))
+
+        for row_num, values, is_last in numbered_rows(rows):
+            is_total_row = is_last and row_num > 6 and len(values) and values[0] == "TOTAL"
+            cells = []
+            for col_idx in range(max_col):
+                value = excel_value(values[col_idx]) if col_idx < len(values) else None
+                c = WriteOnlyCell(ws, value=value)
+                c.alignment = center_aligned_text
+                c.border = cell_border
+
+                if is_summary:
+                    if row_num in (1, 2) and col_idx == 0:
+                        c.font = Font(bold=True, size=14) if row_num == 1 else Font(bold=True)
+                        c.fill = header_fill
+                    elif row_num in (10, 11) and col_idx < 9:
+                        c.fill = header_fill if row_num == 10 else total_fill
+                        c.font = Font(bold=True)
+                    if isinstance(value, str) and value.startswith("Attachment"):
+                        target_sheet_name = value.replace('Attachment - ', 'Attachment ')
+                        if target_sheet_name in sheet_names:
+                            c.hyperlink = f"#'{target_sheet_name}'!A1"
+                            c.font = Font(color="0000FF", underline="single")
+                else:
+                    if row_num == 1 and col_idx == 0:
+                        c.font = Font(bold=True, size=14)
+                        c.fill = header_fill
+                    elif row_num == 5 or is_total_row:
+                        c.fill = header_fill if row_num == 5 else total_fill
+                        c.font = Font(bold=True)
+                    if amount_cols is not None:
+                        is_number = isinstance(value, (int, float))
+                        if col_idx in amount_cols and row_num >= 6 and is_number:
+                            c.number_format = '#,##0.00'
+                            if is_last:
+                                c.font = Font(bold=True)
+                        if is_last and row_num > 1 and col_idx == total_label_col and value == "TOTAL":
+                            c.font = Font(bold=True)
+                cells.append(c)
+            ws.append(cells)
+
+    wb.save(path)
+
+
+class ReconciliationReport:
+    """What one run produced, handed from build_report to the writers and the response."""
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def build_report(run, client_name, threshold_minutes, bank_file_path, hotel_file_path,
+                 bank_file_obj, hotel_file_obj, streaming_flag=None):
+    """
+    Detection, extraction, matching and report layout for one run. Returns a
+    ReconciliationReport, or a 400 Response when the uploads are rejected or
+    were already reconciled. Nothing is written yet except the run folder.
 
-class ReconciliationAPIView(APIView):
-    parser_classes = [MultiPartParser, FormParser]
-
-    def post(self, request, *args, **kwargs):
-        bank_file_obj = request.FILES.get("bank_file")
-        hotel_file_obj = request.FILES.get("hotel_file")
-        client_name = (request.data.get("client_name") or "client").strip()
-        threshold_time_raw = request.data.get("threshold_time", 30)
-
-        if not bank_file_obj or not hotel_file_obj:
-            return Response({"error": "Please upload both Bank and Hotel files."},
-                            status=400)
-        if not client_name:
-            client_name = "client"
-        try:
-            threshold_minutes = int(threshold_time_raw)
-        except (TypeError, ValueError):
-            return Response({"error": "threshold_time must be an integer number of minutes."},
-                            status=400)
-        if threshold_minutes < 0:
-            return Response({"error": "threshold_time must be a non-negative integer."},
-                            status=400)
+    A streamed run's sheets are still in its spill files; they are removed
+    by ``report.cleanup`` once render_outputs has written every artifact.
+    """
+    with ExitStack() as cleanup:
+        report = _build_report(
+            cleanup, run, client_name, threshold_minutes, bank_file_path, hotel_file_path,
+            bank_file_obj, hotel_file_obj, streaming_flag,
+        )
+        if isinstance(report, ReconciliationReport):
+            report.cleanup = cleanup.pop_all()
+        return report
 
-        bank_file_path, hotel_file_path = save_uploaded_files(bank_file_obj, hotel_file_obj)
 
-        bank_lines = extract_text_lines(bank_file_path)
-        hotel_lines = extract_text_lines(hotel_file_path)
-
-        bank = bank_df(bank_lines)
-        hotel = hotel_df(hotel_lines)
-
-        if not bank.empty:
-            min_dt = bank["DT"].min()
-            max_dt = bank["DT"].max()
-            
-            if pd.isna(min_dt) or pd.isna(max_dt):
-                 pass 
-            else:
-                min_date = min_dt.date()
-                max_date = max_dt.date()
-                txn_count = len(bank)
-
-                if ReconciliationRecord.objects.filter(
-                    client_name=client_name,
-                    min_date=min_date,
-                    max_date=max_date,
-                    total_transactions=txn_count,
-                ).exists():
-                     return Response(
-                        {"error": f"Transactions from {min_date} to {max_date} ({txn_count} entries) have already been reconciled."},
-                        status=400
-                     )
-
-        BANK_COLUMNS_DYNAMIC = bank.columns.tolist() if not bank.empty else ["Transaction Date","Time","Merchant ID","Invoice No / RRN",
-                                                                           "Card Number","Card Type (On us/Off us)","Gross Amount","Commission","Net Amount","Terminal ID"]
-        HOTEL_COLUMNS_DYNAMIC = hotel.columns.tolist() if not hotel.empty else ["Transaction Date","Time","Room No","Name","Card Reference","Card Type","Amount","Cashier ID"]
-
-        empty_bank_df = pd.DataFrame(columns=BANK_COLUMNS_DYNAMIC)
-        empty_hotel_df = pd.DataFrame(columns=HOTEL_COLUMNS_DYNAMIC)
-
-        rec_bank_list = []
-        rec_hotel_list = []
-        un_bank_list = []
-        un_hotel_df = hotel.copy() # Initialize un_hotel_df with all hotel transactions
-
-        if not bank.empty and not un_hotel_df.empty:
-            for i, b in bank.iterrows():
-                match = pd.DataFrame()
-
-                if b["Card Type (On us/Off us)"] == 'GCCNET':
-                    match = un_hotel_df[
-                        (un_hotel_df["Amount"] == b["Gross Amount"]) &
-                        (abs(un_hotel_df["DT"] - b["DT"]) <= timedelta(minutes=threshold_minutes))
-                    ]
-                else:
-                    bank_card_last_4 = str(b["Card Number"])[-4:]
-                    potential_matches = un_hotel_df[
-                        (un_hotel_df["Card Reference"].str.len() >= 4) &
-                        (un_hotel_df["Card Reference"].str[-4:] == bank_card_last_4) &
-                        (un_hotel_df["Amount"] == b["Gross Amount"]) &
-                        (abs(un_hotel_df["DT"] - b["DT"]) <= timedelta(minutes=threshold_minutes))
-                    ]
-                    match = potential_matches
-
-                    if match.empty:
-                        match = un_hotel_df[
-                            (un_hotel_df["Amount"] == b["Gross Amount"]) &
-                            (abs(un_hotel_df["DT"] - b["DT"]) <= timedelta(minutes=threshold_minutes))
-                        ]
-
-                if not match.empty:
-                    rec_bank_list.append(b)
-                    rec_hotel_list.append(match.iloc[0])
-                    un_hotel_df = un_hotel_df.drop(match.index[0])
-                else:
-                    un_bank_list.append(b)
+def _build_report(cleanup, run, client_name, threshold_minutes, bank_file_path, hotel_file_path,
+                  bank_file_obj, hotel_file_obj, streaming_flag):
+    publish("run.started", bankFilename=bank_file_obj.name, hotelFilename=hotel_file_obj.name)
+    watch_documents(bank=bank_file_path, hotel=hotel_file_path)
+    timer = StageTimer(run)
+    card_rules = card_rules_for(client_name)
+    try:
+        bank_type = detect_upload_type(bank_file_path)
+        hotel_type = detect_upload_type(hotel_file_path)
+        # PDFs are probed (text layer vs scan) from a few sampled pages and their
+        # layout is recognised from the first page, before any full extraction
+        bank_probe = probe_pdf(bank_file_path) if bank_type == PDF else None
+        hotel_probe = probe_pdf(hotel_file_path) if hotel_type == PDF else None
+        bank_extraction = bank_probe.path if bank_probe else bank_type
+        hotel_extraction = hotel_probe.path if hotel_probe else hotel_type
+        bank_format = detect_statement_format(bank_file_path, "bank", bank_extraction) if bank_probe else None
+        hotel_format = detect_statement_format(hotel_file_path, "hotel", hotel_extraction) if hotel_probe else None
+    except UnreadablePDF as e:
+        return Response({"error": f"Could not read the uploaded PDF: {e}"}, status=400)
+    except UnsupportedStatementFormat as e:
+        return upload_error_response(e, (bank_file_path, bank_file_obj), (hotel_file_path, hotel_file_obj))
+    print(f"Extraction paths: bank={bank_extraction}, hotel={hotel_extraction}")
+    timer.mark("detect")
+
+    # Tabular exports are already compact; streaming only pays off for PDFs
+    streamed = bool(bank_format and hotel_format and use_streaming_mode(streaming_flag, bank_file_obj, hotel_file_obj))
+    shadow_engine = None
+    tables = {}
+    if streamed:
+        # Bounded-memory path: neither statement nor result is ever held as a
+        # full frame; the sheets are read from the spill files as they are written
+        stream = cleanup.enter_context(StreamingReconciliation(
+            bank_file_path, hotel_file_path, threshold_minutes,
+            bank_format=bank_format, hotel_format=hotel_format,
+            bank_extraction=bank_extraction, hotel_extraction=hotel_extraction, card_rules=card_rules,
+        ))
+        stream.prepare()
+        timer.mark("extract")
+        bank_stats, hotel_stats = stream.bank_stats, stream.hotel_stats
+        publish("rows.parsed", bankRows=bank_stats.count, hotelRows=hotel_stats.count)
+        duplicate_response = check_already_reconciled(client_name, bank_stats, run)
+        if duplicate_response:
+            return duplicate_response
+
+        stream.run()
+        BANK_COLUMNS_DYNAMIC = BANK_COLUMNS
+        HOTEL_COLUMNS_DYNAMIC = HOTEL_COLUMNS
+        result_counts = {name: stream.spill[name].count for name in ("rec_bank", "rec_hotel", "un_bank", "un_hotel")}
+        clock_skew = None
+        timer.mark("match")
+        publish("rows.matched", reconciled=result_counts["rec_bank"], unreconciledBank=result_counts["un_bank"],
+                unreconciledHotel=result_counts["un_hotel"])
+
+        # Parquet chunks are read from the spill files by write_result_files.
+        # Shadow engines compare whole frames, so streamed runs are not sampled.
+        if getattr(settings, "RECON_RESULTS_EXPORT", True):
+            tables = streamed_result_tables(run, client_name, stream, card_rules)
+
+        parts = stream.split_by_card_type(card_rules)
+        card_types = [t for category in parts.values() for t in category]
+        final_card_types = card_rules.attachment_types(card_types)
+        categorized_rec_bank, categorized_rec_hotel, categorized_un_bank, categorized_un_hotel = (
+            {ct: parts[name][ct] for ct in final_card_types if ct in parts[name]}
+            for name in ("rec_bank", "rec_hotel", "un_bank", "un_hotel")
+        )
+    else:
+        try:
+            bank = load_statement(bank_file_path, "bank", bank_format, bank_extraction, card_rules)
+            hotel = load_statement(hotel_file_path, "hotel", hotel_format, hotel_extraction, card_rules)
+        except UnsupportedStatementFormat as e:
+            return upload_error_response(e, (bank_file_path, bank_file_obj), (hotel_file_path, hotel_file_obj))
+        timer.mark("extract")
+
+        bank_stats = StatementStats.from_frame(bank, "Gross Amount")
+        hotel_stats = StatementStats.from_frame(hotel, "Amount")
+        publish("rows.parsed", bankRows=bank_stats.count, hotelRows=hotel_stats.count)
+        duplicate_response = check_already_reconciled(client_name, bank_stats, run)
+        if duplicate_response:
+            return duplicate_response
+
+        BANK_COLUMNS_DYNAMIC = bank.columns.tolist() if not bank.empty else BANK_COLUMNS
+        HOTEL_COLUMNS_DYNAMIC = hotel.columns.tolist() if not hotel.empty else HOTEL_COLUMNS
+
+        # Terminal clocks are calibrated against the PMS before matching
+        (rec_bank_list, rec_hotel_list, un_bank_list, un_hotel), clock_skew = match_with_clock_skew(
+            bank, hotel, threshold_minutes
+        )
+        del bank, hotel
 
         rec_bank = pd.DataFrame(rec_bank_list, columns=BANK_COLUMNS_DYNAMIC)
         rec_hotel = pd.DataFrame(rec_hotel_list, columns=HOTEL_COLUMNS_DYNAMIC)
         un_bank = pd.DataFrame(un_bank_list, columns=BANK_COLUMNS_DYNAMIC)
-        un_hotel = un_hotel_df.copy()
+        del rec_bank_list, rec_hotel_list, un_bank_list
+        result_counts = {"rec_bank": len(rec_bank), "rec_hotel": len(rec_hotel),
+                         "un_bank": len(un_bank), "un_hotel": len(un_hotel)}
+        timer.mark("match")
+        publish("rows.matched", reconciled=len(rec_bank), unreconciledBank=len(un_bank), unreconciledHotel=len(un_hotel))
+
+        # Columnar export and the shadow comparison need the timestamps, so the
+        # result tables are laid out before they go
+        shadow_engine = pick_shadow_engine(client_name)
+        if getattr(settings, "RECON_RESULTS_EXPORT", True) or shadow_engine:
+            tables = result_tables(run, client_name, rec_bank, rec_hotel, un_bank, un_hotel, card_rules)
 
         # Drop helper 'DT' column if exists
         for df_reco in [rec_bank, rec_hotel, un_bank, un_hotel]:
@@ -589,19 +687,12 @@ class ReconciliationAPIView(APIView):
             all_hotel_card_types = pd.concat([all_hotel_card_types, un_hotel['Card Type']])
 
         # Apply normalization to hotel card types
-        norm_hotel_card_types = all_hotel_card_types.apply(normalize_card_type)
+        norm_hotel_card_types = card_rules.normalize_series(all_hotel_card_types)
 
-        # Combine all card types and filter out unwanted
+        # Client's routing decides which types get attachments and in what order:
+        # excluded types are dropped, mandatory ones always included
         unique_card_types = pd.concat([all_bank_card_types, norm_hotel_card_types]).dropna().unique()
-        unique_card_types = [ct.strip() for ct in unique_card_types if ct.strip() != '']
-        unique_card_types = [ct for ct in unique_card_types if ct not in ['AMEX', 'DINERS', 'JCB']]
-
-        # Ensure mandatory card types are included
-        for mandatory in ['VISA', 'MASTERCARD', 'NAPS', 'GCCNET']:
-            if mandatory not in unique_card_types:
-                unique_card_types.append(mandatory)
-
-        final_card_types = sorted(unique_card_types) # Update final_card_types for this run
+        final_card_types = card_rules.attachment_types(unique_card_types) # Update final_card_types for this run
 
         # Initialize categorized DataFrames dictionaries
         categorized_rec_bank = {ct: pd.DataFrame(columns=BANK_COLUMNS_DYNAMIC) for ct in final_card_types}
@@ -610,480 +701,665 @@ class ReconciliationAPIView(APIView):
         categorized_un_hotel = {ct: pd.DataFrame(columns=HOTEL_COLUMNS_DYNAMIC) for ct in final_card_types}
 
         # Categorize transactions by card type
+        rec_hotel_types = card_rules.normalize_series(rec_hotel['Card Type']) if not rec_hotel.empty else None
+        un_hotel_types = card_rules.normalize_series(un_hotel['Card Type']) if not un_hotel.empty else None
         for card_type in final_card_types:
             if not rec_bank.empty:
-                categorized_rec_bank[card_type] = rec_bank[rec_bank['Card Type (On us/Off us)'] == card_type].copy()
+                categorized_rec_bank[card_type] = rec_bank[rec_bank['Card Type (On us/Off us)'] == card_type]
             if not un_bank.empty:
-                categorized_un_bank[card_type] = un_bank[un_bank['Card Type (On us/Off us)'] == card_type].copy()
+                categorized_un_bank[card_type] = un_bank[un_bank['Card Type (On us/Off us)'] == card_type]
 
             if not rec_hotel.empty:
-                categorized_rec_hotel[card_type] = rec_hotel[rec_hotel['Card Type'].apply(normalize_card_type) == card_type].copy()
+                categorized_rec_hotel[card_type] = rec_hotel[rec_hotel_types == card_type]
             if not un_hotel.empty:
-                categorized_un_hotel[card_type] = un_hotel[un_hotel['Card Type'].apply(normalize_card_type) == card_type].copy()
+                categorized_un_hotel[card_type] = un_hotel[un_hotel_types == card_type]
+
+    empty_bank_df = pd.DataFrame(columns=BANK_COLUMNS_DYNAMIC)
+    empty_hotel_df = pd.DataFrame(columns=HOTEL_COLUMNS_DYNAMIC)
+
+    # (entries, amount) per category and card type, for the summary and the run history
+    category_totals = {
+        name: {ct: category_total(categorized[ct], amount_col) for ct in final_card_types if ct in categorized}
+        for name, categorized, amount_col in (
+            ("rec_bank", categorized_rec_bank, "Gross Amount"),
+            ("rec_hotel", categorized_rec_hotel, "Amount"),
+            ("un_bank", categorized_un_bank, "Gross Amount"),
+            ("un_hotel", categorized_un_hotel, "Amount"),
+        )
+    }
 
 
-        # ===============================
-        # Step 6: Generate attachment_info
-        # ===============================
-        attachment_info = generate_attachment_info(
-            categorized_rec_bank,
-            categorized_rec_hotel,
-            categorized_un_bank,
-            categorized_un_hotel,
-            empty_bank_df,
-            empty_hotel_df,
-            final_card_types # Pass final_card_types
+    # ===============================
+    # Step 6: Generate attachment_info
+    # ===============================
+    attachment_info = generate_attachment_info(
+        categorized_rec_bank,
+        categorized_rec_hotel,
+        categorized_un_bank,
+        categorized_un_hotel,
+        empty_bank_df,
+        empty_hotel_df,
+        final_card_types # Pass final_card_types
+    )
+
+    # ===============================
+    # Step 7: Build summary_data_dynamic
+    # ===============================
+    summary_data_dynamic = []
+    attachment_num_lookup = {}
+
+    def get_formatted_amount(amount):
+        return f"{amount:,.2f}" if amount != 0.0 else "-"
+
+    # Map attachment numbers for quick lookup
+    for att_key, (df, titles, cols, amount_cols_to_sum) in attachment_info.items():
+        attachment_num = att_key.split(' ')[1]
+        card_type_from_title = titles[1].split(' ')[0].upper()
+        transaction_type_descriptor = 'Merchant' if 'Merchant' in titles[1] else 'Settlements'
+        reconciliation_status = 'Reconciled' if 'Reconciled' in titles[2] else 'Unreconciled'
+        lookup_key = (card_type_from_title, transaction_type_descriptor, reconciliation_status)
+        attachment_num_lookup[lookup_key] = attachment_num
+
+    # -------------------------------
+    # Reconciled transactions
+    # -------------------------------
+    summary_data_dynamic.append(["Reconciled Transactions:", "", "", "", "", "Reconciled Transactions:", "", "", ""])
+    for card_type in final_card_types:
+        rec_bank_entries, rec_bank_amount = category_totals["rec_bank"].get(card_type, (0, 0.0))
+        att_rec_bank = attachment_num_lookup.get((card_type, 'Merchant', 'Reconciled'), '')
+
+        rec_hotel_entries, rec_hotel_amount = category_totals["rec_hotel"].get(card_type, (0, 0.0))
+        att_rec_hotel = attachment_num_lookup.get((card_type, 'Settlements', 'Reconciled'), '')
+
+        summary_data_dynamic.append(
+            [
+                card_type, "",
+                f"Attachment {att_rec_bank}" if att_rec_bank else "-",
+                rec_bank_entries,
+                get_formatted_amount(rec_bank_amount),
+                card_type,
+                f"Attachment {att_rec_hotel}" if att_rec_hotel else "-",
+                rec_hotel_entries,
+                get_formatted_amount(rec_hotel_amount)
+            ]
         )
 
-        # ===============================
-        # Step 7: Build summary_data_dynamic
-        # ===============================
-        summary_data_dynamic = []
-        attachment_num_lookup = {}
-
-        def get_formatted_amount(amount):
-            return f"{amount:,.2f}" if amount != 0.0 else "-"
-
-        # Map attachment numbers for quick lookup
-        for att_key, (df, titles, cols, amount_cols_to_sum) in attachment_info.items():
-            attachment_num = att_key.split(' ')[1]
-            card_type_from_title = titles[1].split(' ')[0].upper()
-            transaction_type_descriptor = 'Merchant' if 'Merchant' in titles[1] else 'Settlements'
-            reconciliation_status = 'Reconciled' if 'Reconciled' in titles[2] else 'Unreconciled'
-            lookup_key = (card_type_from_title, transaction_type_descriptor, reconciliation_status)
-            attachment_num_lookup[lookup_key] = attachment_num
-
-        # -------------------------------
-        # Reconciled transactions
-        # -------------------------------
-        summary_data_dynamic.append(["Reconciled Transactions:", "", "", "", "", "Reconciled Transactions:", "", "", ""])
-        for card_type in final_card_types:
-            rec_bank_df = categorized_rec_bank.get(card_type, empty_bank_df)
-            rec_hotel_df = categorized_rec_hotel.get(card_type, empty_hotel_df)
-
-            rec_bank_entries = len(rec_bank_df)
-            rec_bank_amount = rec_bank_df['Gross Amount'].sum() if not rec_bank_df.empty else 0.0
-            att_rec_bank = attachment_num_lookup.get((card_type, 'Merchant', 'Reconciled'), '')
-
-            rec_hotel_entries = len(rec_hotel_df)
-            rec_hotel_amount = rec_hotel_df['Amount'].sum() if not rec_hotel_df.empty else 0.0
-            att_rec_hotel = attachment_num_lookup.get((card_type, 'Settlements', 'Reconciled'), '')
-
-            summary_data_dynamic.append(
-                [
-                    card_type, "",
-                    f"Attachment {att_rec_bank}" if att_rec_bank else "-",
-                    rec_bank_entries,
-                    get_formatted_amount(rec_bank_amount),
-                    card_type,
-                    f"Attachment {att_rec_hotel}" if att_rec_hotel else "-",
-                    rec_hotel_entries,
-                    get_formatted_amount(rec_hotel_amount)
-                ]
-            )
+    # -------------------------------
+    # Unreconciled transactions
+    # -------------------------------
+    summary_data_dynamic.append(["", "", "", "", "", "", "", "", ""])
+    summary_data_dynamic.append(["Credited Amounts not Recorded in Opera PMS", "", "", "", "", "Outstanding Amounts not Credited in Bank", "", "", ""])
+    for card_type in final_card_types:
+        un_bank_entries, un_bank_amount = category_totals["un_bank"].get(card_type, (0, 0.0))
+        att_un_bank = attachment_num_lookup.get((card_type, 'Merchant', 'Unreconciled'), '')
+
+        un_hotel_entries, un_hotel_amount = category_totals["un_hotel"].get(card_type, (0, 0.0))
+        att_un_hotel = attachment_num_lookup.get((card_type, 'Settlements', 'Unreconciled'), '')
+
+        summary_data_dynamic.append(
+            [
+                card_type, "",
+                f"Attachment {att_un_bank}" if att_un_bank else "-",
+                un_bank_entries,
+                get_formatted_amount(un_bank_amount),
+                card_type,
+                f"Attachment {att_un_hotel}" if att_un_hotel else "-",
+                un_hotel_entries,
+                get_formatted_amount(un_hotel_amount)
+            ]
+        )
 
-        # -------------------------------
-        # Unreconciled transactions
-        # -------------------------------
-        summary_data_dynamic.append(["", "", "", "", "", "", "", "", ""])
-        summary_data_dynamic.append(["Credited Amounts not Recorded in Opera PMS", "", "", "", "", "Outstanding Amounts not Credited in Bank", "", "", ""])
-        for card_type in final_card_types:
-            un_bank_df = categorized_un_bank.get(card_type, empty_bank_df)
-            un_hotel_df_cat = categorized_un_hotel.get(card_type, empty_hotel_df)
-
-            un_bank_entries = len(un_bank_df)
-            un_bank_amount = un_bank_df['Gross Amount'].sum() if not un_bank_df.empty else 0.0
-            att_un_bank = attachment_num_lookup.get((card_type, 'Merchant', 'Unreconciled'), '')
-
-            un_hotel_entries = len(un_hotel_df_cat)
-            un_hotel_amount = un_hotel_df_cat['Amount'].sum() if not un_hotel_df_cat.empty else 0.0
-            att_un_hotel = attachment_num_lookup.get((card_type, 'Settlements', 'Unreconciled'), '')
-
-            summary_data_dynamic.append(
-                [
-                    card_type, "",
-                    f"Attachment {att_un_bank}" if att_un_bank else "-",
-                    un_bank_entries,
-                    get_formatted_amount(un_bank_amount),
-                    card_type,
-                    f"Attachment {att_un_hotel}" if att_un_hotel else "-",
-                    un_hotel_entries,
-                    get_formatted_amount(un_hotel_amount)
-                ]
+    # Footer rows
+    summary_data_dynamic.append(["", "", "", "", "", "", "", "", ""])
+    summary_data_dynamic.append(["Variance", "", "", "0", "-", "Ending Actual Net Cash Balance", "", "0", "-"])
+    summary_data_dynamic.append(["", "", "", "", "", "", "", "", ""])
+    if clock_skew is not None:
+        summary_data_dynamic.extend(clock_skew.summary_rows())
+    summary_data_dynamic.append(["Reviewed BY", "", "", "", "", "Approved BY", "", "", ""])
+    summary_data_dynamic.append(["______________", "", "", "", "", "______________", "", "", ""])
+
+    summary_data_updated = summary_data_dynamic
+
+    bank_ending_balance = bank_stats.amount
+    hotel_ending_balance = hotel_stats.amount
+
+    rows = [
+        ["Company Name (Update Me)","","","","","","","",""],
+        ["Credit Card Reconciliation","","","","","","","",""],
+        ["","","","","","","","",""],
+        ["Reconciliation Date","", datetime.now().strftime("%d-%b-%Y"),"","","","","",""],
+        ["Account Name:","", "Example Hotel LLC","","","","","",""],
+        ["Account Number:","", "1234-5678-9012-3456","","","","","",""],
+        ["Bank Name:","", "QNB Al-Najada Branch","","","","","",""],
+        ["General Ledger Account #","", "GL-C/C-4001","","","","","",""],
+        ["","","","","","","","",""],
+        ["Ending Balance as per Bank Statement","","Reference","Entries","Amount",
+         "Ending Balance as per General Ledger","Reference","Entries","Amount"],
+        ["", "", "", bank_stats.count, f"{bank_ending_balance:,.2f}", "", "", hotel_stats.count, f"{hotel_ending_balance:,.2f}"],
+    ]
+    rows.extend(summary_data_updated)
+
+    # Convert rows to DataFrame for HTML preview
+    bank_account_df = pd.DataFrame(rows)
+
+    # Generate a timestamp for the filename
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    unique_folder_name = f"{client_name}_run_{timestamp}"
+    unique_folder_path = os.path.join(settings.MEDIA_ROOT, unique_folder_name)
+    os.makedirs(unique_folder_path, exist_ok=True)
+
+    report_file_name = f"Credit_Card_Reconciliation_{timestamp}.xlsx"
+    path = os.path.join(unique_folder_path, report_file_name)
+
+    html_preview_file_name = "Credit_Card_Reconciliation_Report.html"
+    html_preview_file_path = os.path.join(unique_folder_path, html_preview_file_name)
+
+    dataframes_for_html_preview = [
+        ("Bank Account Summary", bank_account_df)
+    ]
+
+    report_sheets = [("Bank Account", bank_account_df)]
+    for name, (df, titles, cols, amount_cols_to_sum) in attachment_info.items():
+        if isinstance(df, pd.DataFrame):
+            df_final = add_titles_and_total(
+                df, titles, cols, amount_cols_to_sum
             )
+        else:
+            df_final = SpilledAttachment(df, titles, cols, amount_cols_to_sum)
+        report_sheets.append((name, df_final))
+        # Add attachment dataframes to the list for HTML preview
+        dataframes_for_html_preview.append((f"Attachment {name.split(' ')[1]} - {titles[1]} ({titles[2]})", df_final))
+
+    # Reconciliation Counts
+    reconciledCount = result_counts["rec_bank"] + result_counts["rec_hotel"]
+    unreconciledCount = result_counts["un_bank"] + result_counts["un_hotel"]
+    totalEntries = bank_stats.count + hotel_stats.count
+
+    # Saved together with the status when the run is released
+    run.card_type_totals = card_type_totals(final_card_types, category_totals)
+    run.total_transactions = bank_stats.count
+    if not pd.isna(bank_stats.min_dt) and not pd.isna(bank_stats.max_dt):
+        run.min_date = bank_stats.min_dt.date()
+        run.max_date = bank_stats.max_dt.date()
+
+    timer.mark("layout")
+    return ReconciliationReport(
+        run=run,
+        timer=timer,
+        client_name=client_name,
+        bank_type=bank_type,
+        hotel_type=hotel_type,
+        bank_format=bank_format,
+        hotel_format=hotel_format,
+        bank_extraction=bank_extraction,
+        hotel_extraction=hotel_extraction,
+        bank_stats=bank_stats,
+        hotel_stats=hotel_stats,
+        report_sheets=report_sheets,
+        final_card_types=final_card_types,
+        attachment_num_lookup=attachment_num_lookup,
+        bank_columns=BANK_COLUMNS_DYNAMIC,
+        hotel_columns=HOTEL_COLUMNS_DYNAMIC,
+        html_sheets=dataframes_for_html_preview,
+        folder_name=unique_folder_name,
+        report_path=path,
+        report_file_name=report_file_name,
+        html_path=html_preview_file_path,
+        html_file_name=html_preview_file_name,
+        reconciled_count=reconciledCount,
+        unreconciled_count=unreconciledCount,
+        total_entries=totalEntries,
+        clock_skew=clock_skew,
+        streamed=streamed,
+        result_tables=tables,
+        shadow_job=ShadowJob(
+            bank_file_path, hotel_file_path, threshold_minutes,
+            bank_format.name if bank_format else None, hotel_format.name if hotel_format else None,
+            bank_extraction, hotel_extraction, card_rules,
+        ) if shadow_engine else None,
+        shadow_engine=shadow_engine,
+    )
 
-        # Footer rows
-        summary_data_dynamic.append(["", "", "", "", "", "", "", "", ""])
-        summary_data_dynamic.append(["Variance", "", "", "0", "-", "Ending Actual Net Cash Balance", "", "0", "-"])
-        summary_data_dynamic.append(["", "", "", "", "", "", "", "", ""])
-        summary_data_dynamic.append(["Reviewed BY", "", "", "", "", "Approved BY", "", "", ""])
-        summary_data_dynamic.append(["______________", "", "", "", "", "______________", "", "", ""])
-
-        summary_data_updated = summary_data_dynamic
-
-        bank_ending_balance = bank['Gross Amount'].sum() if not bank.empty else 0.0
-        hotel_ending_balance = hotel['Amount'].sum() if not hotel.empty else 0.0
-
-        rows = [
-            ["Company Name (Update Me)","","","","","","","",""],
-            ["Credit Card Reconciliation","","","","","","","",""],
-            ["","","","","","","","",""],
-            ["Reconciliation Date","", datetime.now().strftime("%d-%b-%Y"),"","","","","",""],
-            ["Account Name:","", "Example Hotel LLC","","","","","",""],
-            ["Account Number:","", "1234-5678-9012-3456","","","","","",""],
-            ["Bank Name:","", "QNB Al-Najada Branch","","","","","",""],
-            ["General Ledger Account #","", "GL-C/C-4001","","","","","",""],
-            ["","","","","","","","",""],
-            ["Ending Balance as per Bank Statement","","Reference","Entries","Amount",
-             "Ending Balance as per General Ledger","Reference","Entries","Amount"],
-            ["", "", "", len(bank), f"{bank_ending_balance:,.2f}", "", "", len(hotel), f"{hotel_ending_balance:,.2f}"],
-        ]
-        rows.extend(summary_data_updated)
 
-        # Convert rows to DataFrame for HTML preview
-        bank_account_df = pd.DataFrame(rows)
+def write_excel_output(report):
+    with stage_slot("excel"), report.timer.stage("excel"):
+        run_in_render_process(
+            write_excel_report,
+            report.report_path, report.report_sheets, report.final_card_types,
+            report.attachment_num_lookup, report.bank_columns, report.hotel_columns
+        )
+        store_artifact(report.report_path)
 
-        # Generate a timestamp for the filename
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        unique_folder_name = f"{client_name}_run_{timestamp}"
-        unique_folder_path = os.path.join(settings.MEDIA_ROOT, unique_folder_name)
-        os.makedirs(unique_folder_path, exist_ok=True)
 
-        report_file_name = f"Credit_Card_Reconciliation_{timestamp}.xlsx"
-        path = os.path.join(unique_folder_path, report_file_name)
+def render_html_preview(sheets, path):
+    """HTML preview with all sheets, plus its compressed variants."""
+    save_df_to_html(sheets, path, main_report_title='Credit Card Reconciliation Report')
+    precompress(path)
 
-        html_preview_file_name = "Credit_Card_Reconciliation_Report.html"
-        html_preview_file_path = os.path.join(unique_folder_path, html_preview_file_name)
 
-        dataframes_for_html_preview = [
-            ("Bank Account Summary", bank_account_df.copy())
-        ]
+def write_html_output(report):
+    # Generate HTML preview with all sheets
+    with report.timer.stage("html"):
+        run_in_render_process(render_html_preview, report.html_sheets, report.html_path)
+        store_artifact(report.html_path)
 
-        with pd.ExcelWriter(path, engine="openpyxl") as w:
-            bank_account_df.to_excel(w, index=False, header=False, sheet_name="Bank Account")
 
-            for name, (df, titles, cols, amount_cols_to_sum) in attachment_info.items():
-                df_final = add_titles_and_total(
-                    df, titles, cols, amount_cols_to_sum
-                )
-                df_final.to_excel(w, index=False, header=False, sheet_name=name)
-                # Add attachment dataframes to the list for HTML preview
-                dataframes_for_html_preview.append((f"Attachment {name.split(' ')[1]} - {titles[1]} ({titles[2]})", df_final.copy()))
+def write_result_files(report):
+    """Parquet copy of the results for analytics; never fails the run."""
+    if not report.result_tables or not getattr(settings, "RECON_RESULTS_EXPORT", True):
+        return
+    try:
+        with report.timer.stage("results"):
+            export_run(report.run, report.client_name, report.result_tables)
+    except Exception as e:
+        print(f"Error exporting results to Parquet for run {report.run.pk}: {e}")
 
-        # Generate HTML preview with all sheets
-        save_df_to_html(dataframes_for_html_preview, html_preview_file_path, main_report_title='Credit Card Reconciliation Report')
 
+def start_shadow_run(report):
+    """Hand a sampled run to the shadow engine; never fails or delays the run."""
+    if not report.shadow_engine:
+        return
+    try:
+        submit_shadow(
+            report.shadow_engine, report.run, report.client_name, report.shadow_job,
+            report.result_tables, report.timer.timings,
+        )
+    except Exception as e:
+        print(f"Error starting shadow run for run {report.run.pk}: {e}")
 
-        wb=load_workbook(path)
 
-        center_aligned_text = Alignment(horizontal="center", vertical="center")
-        header_fill = PatternFill(start_color="D9D9D9", end_color="D9D9D9", fill_type="solid")
-        total_fill = PatternFill(start_color="F2F2F2", end_color="F2F2F2", fill_type="solid")
-        thick_border = Side(border_style="medium", color="000000")
+def get_google_services():
+    """
+    Drive and Sheets clients from the service account, falling back to
+    token.json. Returns ``(None, None)`` when neither is configured.
+    """
+    # Modify SCOPES for Google Drive
+    SCOPES = ["https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/spreadsheets"]
+    drive_service = None
+    sheets_service = None # Initialize sheets_service here too
+    creds = None # Initialize creds to None
 
-        ws_bank = wb["Bank Account"]
-        ws_bank.merge_cells("A1:I1"); ws_bank.merge_cells("A2:I2")
-        ws_bank["A1"].font=Font(bold=True,size=14)
-        ws_bank["A2"].font=Font(bold=True)
-        ws_bank["A1"].alignment = ws_bank["A2"].alignment = center_aligned_text
+    if getattr(settings, "GOOGLE_API_ENDPOINT", None):
+        # Local stand-in (load tests): no credentials needed
+        return build_service("drive", "v3"), build_service("sheets", "v4")
 
-        ws_bank["A1"].fill = header_fill
-        ws_bank["A2"].fill = header_fill
+    # --- Attempt Service Account Authentication First ---
+    try:
+        # Check if GOOGLE_SERVICE_ACCOUNT_FILE exists and is valid
+        if os.path.exists(settings.GOOGLE_SERVICE_ACCOUNT_FILE):
+            creds = service_account.Credentials.from_service_account_file(
+                settings.GOOGLE_SERVICE_ACCOUNT_FILE,
+                scopes=SCOPES
+            )
+            print("Google Drive and Sheets connected successfully using Service Account authentication.")
+        else:
+            print("GOOGLE_SERVICE_ACCOUNT_FILE not found. Attempting OAuth Client authentication.")
+
+    except HttpError as err:
+        print(f"Service Account authentication failed (HttpError): {err}")
+        creds = None # Ensure creds is None if service account fails
+    except Exception as e:
+        print(f"Service Account authentication failed (General Error): {e}")
+        creds = None # Ensure creds is None if service account fails
+
+    # --- If Service Account failed or not configured, attempt OAuth Client (user-based) from token.json ---
+    if not creds:
+        token_path = os.path.join(os.getcwd(), "token.json") # Assumes token.json is in the current working directory
+        if os.path.exists(token_path):
+            try:
+                creds = Credentials.from_authorized_user_file(token_path, SCOPES)
+                if creds and creds.expired and creds.refresh_token:
+                    creds.refresh(Request())
+                print("Google Drive and Sheets connected successfully using OAuth Client (token.json).")
+            except Exception as e:
+                print(f"OAuth Client authentication from token.json failed: {e}")
+                creds = None # Reset creds if token fails
+        else:
+            print("token.json not found. OAuth client authentication not available (interactive flow not supported in API directly).")
 
-        for col_idx in range(1, 10):
-            cell = ws_bank.cell(row=10, column=col_idx)
-            cell.fill = header_fill
-            cell.font = Font(bold=True)
-            cell.alignment = center_aligned_text
+    # --- Build services if credentials obtained ---
+    if creds:
+        drive_service = build_service("drive", "v3", creds)
+        sheets_service = build_service("sheets", "v4", creds)
+    else:
+        print("No valid Google credentials found after trying both Service Account and OAuth Client. Google API functionality will be limited.")
 
-        for col_idx in range(1, 10):
-            cell = ws_bank.cell(row=11, column=col_idx)
-            cell.fill = total_fill
-            cell.font = Font(bold=True)
-            cell.alignment = center_aligned_text
+    return drive_service, sheets_service
 
-        for row in ws_bank.iter_rows():
-            for c in row:
-                c.alignment = center_aligned_text
-                c.border = Border(left=thick_border,right=thick_border,top=thick_border,bottom=thick_border)
-
-        for r_idx, row in enumerate(ws_bank.iter_rows()):
-            for c_idx, c in enumerate(row):
-                if isinstance(c.value,str) and c.value.startswith("Attachment"):
-                    target_sheet_name = c.value.replace('Attachment - ', 'Attachment ')
-                    if target_sheet_name in wb.sheetnames:
-                        c.hyperlink=f"#'{target_sheet_name}'!A1"
-                        c.font=Font(color="0000FF",underline="single")
-
-        for col in range(1,10):
-            ws_bank.column_dimensions[get_column_letter(col)].width = 20
-
-        for sheet_name in attachment_info.keys():
-            ws=wb[sheet_name]
-            max_col = ws.max_column
-            ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=max_col)
-            ws["A1"].font=Font(bold=True,size=14)
-            ws["A1"].alignment = center_aligned_text
-            ws["A1"].fill = header_fill
-
-            if ws.max_row >= 6:
-                for col_idx in range(1, ws.max_column + 1):
-                    cell = ws.cell(row=5, column=col_idx)
-                    cell.fill = header_fill
-                    cell.font = Font(bold=True)
-                    cell.alignment = center_aligned_text
-
-            for row in ws.iter_rows():
-                for c in row:
-                    c.alignment = center_aligned_text
-                    c.border = Border(left=thick_border,right=thick_border,top=thick_border,bottom=thick_border)
-
-            last_row_num = ws.max_row
-            if last_row_num > 6 and ws.cell(row=last_row_num, column=1).value == "TOTAL":
-                for col_idx in range(1, max_col + 1):
-                    cell = ws.cell(row=last_row_num, column=col_idx)
-                    cell.fill = total_fill
-                    cell.font = Font(bold=True)
-                    cell.alignment = center_aligned_text
-
-            for col_idx in range(1, ws.max_column+1):
-                ws.column_dimensions[get_column_letter(col_idx)].width=20
 
-        for card_type in final_card_types:
-            att_un_bank = attachment_num_lookup.get((card_type, 'Merchant', 'Unreconciled'), None)
-            if att_un_bank:
-                sheet_name_bank = f"Attachment {att_un_bank}"
-                if sheet_name_bank in wb.sheetnames:
-                    ws_bank_un = wb[sheet_name_bank]
-                    bank_amount_cols = ["Gross Amount", "Commission", "Net Amount"]
-                    for col_name in bank_amount_cols:
-                        if col_name in BANK_COLUMNS_DYNAMIC:
-                            col_idx = BANK_COLUMNS_DYNAMIC.index(col_name) + 1
-                            for r in range(6, ws_bank_un.max_row+1):
-                                cell = ws_bank_un.cell(row=r, column=col_idx)
-                                if isinstance(cell.value,(int,float)):
-                                    cell.number_format = '#,##0.00'
-                            last_row = ws_bank_un.max_row
-                            total_cell = ws_bank_un.cell(row=last_row, column=col_idx)
-                            if isinstance(total_cell.value,(int,float)):
-                                total_cell.font = Font(bold=True)
-                                total_cell.number_format = '#,##0.00'
-
-                    last_row = ws_bank_un.max_row
-                    if last_row > 1 and ws_bank_un.cell(row=last_row, column=1).value == "TOTAL":
-                        ws_bank_un.cell(row=last_row, column=1).font = Font(bold=True)
-
-            att_un_hotel = attachment_num_lookup.get((card_type, 'Settlements', 'Unreconciled'), None)
-            if att_un_hotel:
-                sheet_name_hotel = f"Attachment {att_un_hotel}"
-                if sheet_name_hotel in wb.sheetnames:
-                    ws_hotel_un = wb[sheet_name_hotel]
-                    hotel_amount_cols = ["Amount"]
-                    for col_name in hotel_amount_cols:
-                        if col_name in HOTEL_COLUMNS_DYNAMIC:
-                            col_idx = HOTEL_COLUMNS_DYNAMIC.index(col_name) + 1
-                            for r in range(6, ws_hotel_un.max_row+1):
-                                cell = ws_hotel_un.cell(row=r, column=col_idx)
-                                if isinstance(cell.value,(int,float)):
-                                    cell.number_format = '#,##0.00'
-                            last_row = ws_hotel_un.max_row
-                            total_cell = ws_hotel_un.cell(row=last_row, column=col_idx)
-                            if isinstance(total_cell.value,(int,float)):
-                                total_cell.font = Font(bold=True)
-                                total_cell.number_format = '#,##0.00'
-
-                    last_row = ws_hotel_un.max_row
-                    if "Amount" in HOTEL_COLUMNS_DYNAMIC:
-                        amount_col_idx_hotel = HOTEL_COLUMNS_DYNAMIC.index("Amount")
-                        if amount_col_idx_hotel > 0:
-                            total_label_col_idx = amount_col_idx_hotel
-                            if last_row > 1 and ws_hotel_un.cell(row=last_row, column=total_label_col_idx).value == "TOTAL":
-                                ws_hotel_un.cell(row=last_row, column=total_label_col_idx).font = Font(bold=True)
-
-
-                # Excel file save
-        wb.save(path)
-
-        # ===========================
-        # Reconciliation Counts
-                # ===========================
-        # Reconciliation Counts
-        # ===========================
-        reconciledCount = len(rec_bank) + len(rec_hotel)
-        unreconciledCount = len(un_bank) + len(un_hotel)
-        totalEntries = len(bank) + len(hotel)
-
-        # ===========================
-        # Google Drive Configuration and Upload
-        # =====================
-        # Modify SCOPES for Google Drive
-        SCOPES = ["https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/spreadsheets"]
-        drive_file_preview_url = None
-        drive_file_download_url = None
-        google_sheet_link = None # Initialize new variable
-
-        drive_service = None
-        sheets_service = None # Initialize sheets_service here too
-        creds = None # Initialize creds to None
-
-        # --- Attempt Service Account Authentication First ---
+def create_report_sheet(drive_service):
+    """Create the run's Google Sheet; returns its link, or None."""
+    timestamp_for_sheet=datetime.now().strftime("%Y%m%d%H%M%S")
+
+    new_sheet_id = None
+    google_sheet_link_for_response = None
+
+    if drive_service:
         try:
-            # Check if GOOGLE_SERVICE_ACCOUNT_FILE exists and is valid
-            if os.path.exists(settings.GOOGLE_SERVICE_ACCOUNT_FILE):
-                creds = service_account.Credentials.from_service_account_file(
-                    settings.GOOGLE_SERVICE_ACCOUNT_FILE,
-                    scopes=SCOPES
-                )
-                print("Google Drive and Sheets connected successfully using Service Account authentication.")
-            else:
-                print("GOOGLE_SERVICE_ACCOUNT_FILE not found. Attempting OAuth Client authentication.")
+            file_metadata = {
+                'name': f"Credit Card Reconciliation Report {timestamp_for_sheet}",
+                'mimeType': 'application/vnd.google-apps.spreadsheet'
+            }
+
+            created_spreadsheet = drive_service.files().create(
+                body=file_metadata,
+                fields='id'
+            ).execute()
+            new_sheet_id = created_spreadsheet.get('id')
+            google_sheet_link_for_response = f"https://docs.google.com/spreadsheets/d/{new_sheet_id}"
+            print("New Google Sheet created:", google_sheet_link_for_response)
 
         except HttpError as err:
-            print(f"Service Account authentication failed (HttpError): {err}")
-            creds = None # Ensure creds is None if service account fails
+            print(f"Error creating Google Sheet using Drive API (HttpError): {err}")
+
+            google_sheet_link_for_response = None # Ensure it's None on error
         except Exception as e:
-            print(f"Service Account authentication failed (General Error): {e}")
-            creds = None # Ensure creds is None if service account fails
-
-        # --- If Service Account failed or not configured, attempt OAuth Client (user-based) from token.json ---
-        if not creds:
-            token_path = os.path.join(os.getcwd(), "token.json") # Assumes token.json is in the current working directory
-            if os.path.exists(token_path):
-                try:
-                    creds = Credentials.from_authorized_user_file(token_path, SCOPES)
-                    if creds and creds.expired and creds.refresh_token:
-                        creds.refresh(Request())
-                    print("Google Drive and Sheets connected successfully using OAuth Client (token.json).")
-                except Exception as e:
-                    print(f"OAuth Client authentication from token.json failed: {e}")
-                    creds = None # Reset creds if token fails
-            else:
-                print("token.json not found. OAuth client authentication not available (interactive flow not supported in API directly).")
-
-        # --- Build services if credentials obtained ---
-        if creds:
-            drive_service = build(
-                "drive",
-                "v3",
-                credentials=creds,
-                cache_discovery=False
-            )
-            sheets_service = build(
-                "sheets",
-                "v4",
-                credentials=creds,
-                cache_discovery=False
-            )
-        else:
-            print("No valid Google credentials found after trying both Service Account and OAuth Client. Google API functionality will be limited.")
-
-
-        # Assuming NGROK_PUBLIC_URL is provided by the user if ngrok is used
-        # For Colab environments, if you are running a Django app and exposing it via ngrok
-        # you would typically set this as an environment variable or retrieve it dynamically.
-        # For demonstration purposes, you might hardcode it if it's stable during a session.
-        # Example: NGROK_PUBLIC_URL = "https://your-ngrok-url.ngrok-free.app"
-        NGROK_PUBLIC_URL = os.environ.get('NGROK_PUBLIC_URL', '') # User should set this env var if using ngrok
-        # Hardcode your current ngrok URL here if it's easier for testing:
-        # NGROK_PUBLIC_URL = "https://212390913ce5.ngrok-free.app" # Replace with your actual ngrok URL
-
-
-        # ===========================
-        # Generate public URLs (for local files, if used) and prepare response
-        # ===========================
-        if request.META.get('HTTP_HOST'):
-            base_url = f"{request.scheme}://{request.META['HTTP_HOST']}"
-        elif NGROK_PUBLIC_URL: # Use provided ngrok URL if available and not from request
-            base_url = NGROK_PUBLIC_URL
-        else:
-            # This is a fallback/mock base_url. In a real deployed Django app,
-            # request.META.get('HTTP_HOST') would provide the actual host.
-            # For Colab, a local server or a public tunnel like ngrok would be needed to serve media.
-            base_url = "http://localhost:8000" # Placeholder, generally not accessible externally in Colab
-            print("Warning: base_url defaulted to localhost. For external access (e.g., from React frontend), consider setting NGROK_PUBLIC_URL or ensuring your Django app is publicly accessible.")
+            print(f"Error creating Google Sheet using Drive API (General Error): {e}")
+            google_sheet_link_for_response = None # Ensure it's None if service not initialized
+    else:
+        print("Google Drive service is not initialized. Cannot create Google Sheet in a specific folder.")
+        google_sheet_link_for_response = None # Ensure it's None if service not initialized
 
+    return google_sheet_link_for_response
 
-        local_file_url = f"{base_url}/media/{unique_folder_name}/{report_file_name}"
-        html_preview_file_url = f"{base_url}/media/{unique_folder_name}/{html_preview_file_name}"
 
-        # Determine final_download_url and final_preview_url based on local files if no Google Sheet is created
-        final_download_url = local_file_url
-        final_preview_url = local_file_url
+def sync_report_workbook(report, sheets_service):
+    """Update the client's living Google Sheet in place; returns its link, or None."""
+    if not sheets_service:
+        print("Google Sheets service is not initialized. Cannot sync the client workbook.")
+        return None
+    try:
+        tables = {name: sheet_rows(df) for name, df in report.report_sheets}
+        spreadsheet_id, stats = sync_workbook(sheets_service, report.client_name, tables, report.run)
+    except HttpError as err:
+        print(f"Error syncing the workbook of {report.client_name} (HttpError): {err}")
+        return None
+    except Exception as e:
+        print(f"Error syncing the workbook of {report.client_name} (General Error): {e}")
+        return None
+    print(f"Workbook of {report.client_name} synced: {stats}")
+    return SHEET_URL.format(spreadsheet_id)
+
+
+def publish_report_sheet(report, google_services):
+    drive_service, sheets_service = google_services()
+    with report.timer.stage("google"):
+        if getattr(settings, "RECON_GOOGLE_SHEET_MODE", "per_run") == "workbook":
+            return sync_report_workbook(report, sheets_service)
+        return create_report_sheet(drive_service)
+
+
+def render_outputs(report, google_services=None):
+    """
+    Write the run's artifacts together (see rendering.py) and return the
+    Google Sheet link, or None. ``google_services`` returns the
+    ``(drive, sheets)`` clients; by default they are built in the Google
+    thread. Only an Excel failure fails the run. The report's spill files
+    are removed once the last writer, background ones included, is done.
+    """
+    google_services = google_services or get_google_services
+    results, errors = render_artifacts(
+        {
+            "excel": partial(write_excel_output, report),
+            "html": partial(write_html_output, report),
+            "results": partial(write_result_files, report),
+        },
+        {"google": partial(publish_report_sheet, report, google_services)},
+        on_done=report.cleanup.close,
+    )
+    if "excel" in errors:
+        raise errors["excel"]
+    return results.get("google")
+
+
+def report_response(request, report, google_sheet_link):
+    # Assuming NGROK_PUBLIC_URL is provided by the user if ngrok is used
+    # For Colab environments, if you are running a Django app and exposing it via ngrok
+    # you would typically set this as an environment variable or retrieve it dynamically.
+    # For demonstration purposes, you might hardcode it if it's stable during a session.
+    # Example: NGROK_PUBLIC_URL = "https://your-ngrok-url.ngrok-free.app"
+    NGROK_PUBLIC_URL = os.environ.get('NGROK_PUBLIC_URL', '') # User should set this env var if using ngrok
+    # Hardcode your current ngrok URL here if it's easier for testing:
+    # NGROK_PUBLIC_URL = "https://212390913ce5.ngrok-free.app" # Replace with your actual ngrok URL
+
+
+    # ===========================
+    # Generate public URLs (for local files, if used) and prepare response
+    # ===========================
+    # No request for hot-folder runs (see hotfolder.py)
+    if request is not None and request.META.get('HTTP_HOST'):
+        base_url = f"{request.scheme}://{request.META['HTTP_HOST']}"
+    elif NGROK_PUBLIC_URL: # Use provided ngrok URL if available and not from request
+        base_url = NGROK_PUBLIC_URL
+    else:
+        # This is a fallback/mock base_url. In a real deployed Django app,
+        # request.META.get('HTTP_HOST') would provide the actual host.
+        # For Colab, a local server or a public tunnel like ngrok would be needed to serve media.
+        base_url = "http://localhost:8000" # Placeholder, generally not accessible externally in Colab
+        print("Warning: base_url defaulted to localhost. For external access (e.g., from React frontend), consider setting NGROK_PUBLIC_URL or ensuring your Django app is publicly accessible.")
+
+
+    local_file_url = f"{base_url}/media/{report.folder_name}/{report.report_file_name}"
+
+    # Determine final_download_url and final_preview_url based on local files if no Google Sheet is created
+    final_download_url = local_file_url
+    final_preview_url = local_file_url
+
+    # Update final_download_url and final_preview_url if a Google Sheet was successfully created
+    if google_sheet_link:
+        final_download_url = google_sheet_link
+        final_preview_url = google_sheet_link
+
+    return Response({
+        "status": "success",
+        "success": True,
+        "downloadUrl": final_download_url,
+        "previewUrl": final_preview_url,
+        "googleSheetLink": google_sheet_link,
+        "reconciledCount": report.reconciled_count,
+        "unreconciledCount": report.unreconciled_count,
+        "totalEntries": report.total_entries,
+        "bankFormat": report.bank_format.name if report.bank_format else report.bank_type,
+        "hotelFormat": report.hotel_format.name if report.hotel_format else report.hotel_type,
+        "bankExtraction": report.bank_extraction,
+        "hotelExtraction": report.hotel_extraction,
+        "runId": report.run.pk,
+        "clockSkew": report.clock_skew.as_dict() if report.clock_skew else None,
+        "matchPath": "streaming" if report.streamed else "in_memory",
+        "localFileUrl": local_file_url  # Optional
+    })
+
+
+def scheduler_busy_response(e):
+    return Response(
+        {"error": f"{e} Please retry later.", "retryAfter": e.retry_after},
+        status=503,
+        headers={"Retry-After": str(e.retry_after)},
+    )
 
-        # ===========================
-        # Create Google Sheet in specified folder
-        # ===========================
-        # Removed duplicate and incorrect Google Sheet creation logic from here.
-        # The correct logic using drive_service.files().create is already present above.
 
-        base_sheet_id=settings.MASTER_SHEET_ID # This is likely an existing sheet ID, not used for *creating* new one in a folder.
-        timestamp_for_sheet=datetime.now().strftime("%Y%m%d%H%M%S")
-        
+def idempotent_replay(request, client_name, content_hash):
+    """
+    ``(cache_key, replay)`` for a request with an Idempotency-Key header:
+    ``replay`` is the stored response of the same request, or None. Both
+    are None without the header.
+    """
+    idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+    if not idempotency_key:
+        return None, None
+    cache_key = idempotency_cache_key(idempotency_key.strip(), client_name, content_hash)
+    cached = get_cached_response(cache_key)
+    if not cached:
+        return cache_key, None
+    data, status_code = cached
+    return cache_key, Response(data, status=status_code, headers={"Idempotent-Replayed": "true"})
+
+
+def parse_reconcile_request(data, files):
+    """
+    Validate the reconcile form. Returns a 400 Response, or
+    ``(bank_file, hotel_file, client_name, threshold_minutes)``. Each file
+    is either uploaded in the request or given as the id of a finalized
+    resumable upload (``bank_upload_id`` / ``hotel_upload_id``).
+    """
+    try:
+        bank_file_obj = files.get("bank_file") or stored_upload(data.get("bank_upload_id"))
+        hotel_file_obj = files.get("hotel_file") or stored_upload(data.get("hotel_upload_id"))
+    except UploadNotReady as e:
+        return Response({"error": str(e)}, status=400)
+    client_name = (data.get("client_name") or "client").strip()
+    threshold_time_raw = data.get("threshold_time", 30)
+
+    if not bank_file_obj or not hotel_file_obj:
+        return Response({"error": "Please upload both Bank and Hotel files."},
+                        status=400)
+    if not client_name:
+        client_name = "client"
+    try:
+        threshold_minutes = int(threshold_time_raw)
+    except (TypeError, ValueError):
+        return Response({"error": "threshold_time must be an integer number of minutes."},
+                        status=400)
+    if threshold_minutes < 0:
+        return Response({"error": "threshold_time must be a non-negative integer."},
+                        status=400)
+    return bank_file_obj, hotel_file_obj, client_name, threshold_minutes
 
-        new_sheet_id = None
-        google_sheet_link_for_response = None # Use a new variable to avoid confusion with the one initialized earlier
 
-        if drive_service:
-            try:
-                # Use Drive API to create the spreadsheet directly in the specified folder
-                file_metadata = file_metadata = {
-            'name': f"Credit Card Reconciliation Report {timestamp_for_sheet}",
-            'mimeType': 'application/vnd.google-apps.spreadsheet'
-            # ❌ parents line REMOVE
-        }
-
-                created_spreadsheet = drive_service.files().create(
-            body=file_metadata,
-            fields='id'
-        ).execute()
-                new_sheet_id = created_spreadsheet.get('id')
-                google_sheet_link_for_response = "https://docs.google.com/spreadsheets/d/{new_sheet_id}"
-                print("New Google Sheet created in specified folder:", google_sheet_link_for_response)
-
-                # Now that the sheet is created, if we need to write data to it, we'd use sheets_service.
-                # This part is not in the error, but good to keep in mind.
-
-            except HttpError as err:
-                print(f"Error creating Google Sheet using Drive API (HttpError): {err}")
-
-                google_sheet_link_for_response = None # Ensure it's None on error
-            except Exception as e:
-                print(f"Error creating Google Sheet in folder {FOLDER_ID} using Drive API (General Error): {e}")
-                google_sheet_link_for_response = None # Ensure it's None if service not initialized
-        else:
-            print("Google Drive service is not initialized. Cannot create Google Sheet in a specific folder.")
-            google_sheet_link_for_response = None # Ensure it's None if service not initialized
+class ReconciliationAPIView(APIView):
+    parser_classes = [MultiPartParser, FormParser, JSONParser]
 
-        # Update final_download_url and final_preview_url if a Google Sheet was successfully created
-        if google_sheet_link_for_response:
-            final_download_url = google_sheet_link_for_response
-            final_preview_url = google_sheet_link_for_response
-
-        if not bank.empty:
-             try:
-                min_dt = bank["DT"].min()
-                max_dt = bank["DT"].max()
-                if not pd.isna(min_dt) and not pd.isna(max_dt):
-                    ReconciliationRecord.objects.create(
-                        client_name=client_name,
-                        min_date=min_dt.date(),
-                        max_date=max_dt.date(),
-                        total_transactions=len(bank),
-                        bank_filename=bank_file_obj.name,
-                        hotel_filename=hotel_file_obj.name,
+    def post(self, request, *args, **kwargs):
+        parsed = parse_reconcile_request(request.data, request.FILES)
+        if isinstance(parsed, Response):
+            return parsed
+        bank_file_obj, hotel_file_obj, client_name, threshold_minutes = parsed
+
+        content_hash = run_content_hash(
+            upload_sha256(bank_file_obj), upload_sha256(hotel_file_obj), threshold_minutes
+        )
+        # A replay needs no scheduler slot, so a retry is answered under load too
+        cache_key, replay = idempotent_replay(request, client_name, content_hash)
+        if replay:
+            return replay
+        try:
+            with get_scheduler().admit(client_name):
+                return self.reconcile(request, parsed, content_hash, cache_key)
+        except SchedulerBusy as e:
+            return scheduler_busy_response(e)
+
+    def reconcile(self, request, parsed, content_hash, cache_key):
+        bank_file_obj, hotel_file_obj, client_name, threshold_minutes = parsed
+        run, claimed = claim_run(client_name, content_hash, bank_file_obj.name, hotel_file_obj.name)
+        if not claimed:
+            response = attach_to_run(run)
+        else:
+            response = None
+            try:
+                with track_progress(run):
+                    response = self.run_reconciliation(
+                        request, run, client_name, threshold_minutes, bank_file_obj, hotel_file_obj
                     )
-             except Exception as e:
-                 print(f"Failed to save reconciliation record: {e}")
-
-        return Response({
-            "status": "success",
-            "success": True,
-            "downloadUrl": final_download_url,
-            "previewUrl": final_preview_url,
-            "googleSheetLink": google_sheet_link_for_response, # Use the new variable here
-            "reconciledCount": reconciledCount,
-            "unreconciledCount": unreconciledCount,
-            "totalEntries": totalEntries,
-            "localFileUrl": local_file_url  # Optional
-        })
-    
+            finally:
+                finish_run(run, response)
+
+        if cache_key:
+            store_response(cache_key, response)
+        return response
+
+    def run_reconciliation(self, request, run, client_name, threshold_minutes, bank_file_obj, hotel_file_obj):
+        bank_file_path, hotel_file_path = save_uploaded_files(bank_file_obj, hotel_file_obj)
+
+        report = build_report(
+            run, client_name, threshold_minutes, bank_file_path, hotel_file_path,
+            bank_file_obj, hotel_file_obj, request.data.get("streaming"),
+        )
+        if isinstance(report, Response):
+            return report
+
+        start_shadow_run(report)
+        return report_response(request, report, render_outputs(report))
+
+
+class ShadowReportAPIView(APIView):
+    """
+    Shadow-mode divergences: per client and engine totals, and the latest
+    runs whose candidate result differed. Filters: client_name, engine; limit.
+    """
+
+    def get(self, request, *args, **kwargs):
+        params = request.query_params
+        try:
+            limit = max(1, min(int(params.get("limit", 20)), 200))
+        except ValueError:
+            return Response({"error": "limit must be an integer."}, status=400)
+        return Response(divergence_report(params.get("client_name"), params.get("engine"), limit))
+
+
+class SchedulerStatusAPIView(APIView):
+    """Queue depth, running stages and wait times of the reconcile scheduler."""
+
+    def get(self, request, *args, **kwargs):
+        return Response(get_scheduler().snapshot())
+
+
+class ResultQueryAPIView(APIView):
+    """
+    Aggregates over the Parquet results of all runs, e.g.
+    ``?table=matched&group_by=client_name,card_type&metrics=count,amount``.
+    Filters: client_name, run_id, card_type, date_from, date_to; plus limit.
+    """
+
+    def get(self, request, *args, **kwargs):
+        params = request.query_params
+        try:
+            result = query_results(
+                params.get("table", "matched"),
+                group_by=params.get("group_by"),
+                metrics=params.get("metrics"),
+                client_name=params.get("client_name"),
+                run_id=params.get("run_id"),
+                card_type=params.get("card_type"),
+                date_from=params.get("date_from"),
+                date_to=params.get("date_to"),
+                limit=params.get("limit", 1000),
+            )
+        except InvalidResultQuery as e:
+            return Response({"error": str(e)}, status=400)
+        return Response(result)
+
+
+class RunHistoryAPIView(APIView):
+    """
+    Recent runs, newest first, with per-card-type totals and stage timings.
+    ``?client_name=&limit=&before=<id of the last run on the previous page>``
+    """
+
+    def get(self, request, *args, **kwargs):
+        params = request.query_params
+        try:
+            runs = run_history(params.get("client_name"), params.get("limit", 50), params.get("before"))
+        except InvalidHistoryQuery as e:
+            return Response({"error": str(e)}, status=400)
+        return Response({"runs": runs})
+
+
+class RollupHistoryAPIView(APIView):
+    """
+    Time series from the precomputed per-client rollups.
+    ``?client_name=&granularity=day|week|month&date_from=&date_to=&card_type=``
+    """
+
+    def get(self, request, *args, **kwargs):
+        params = request.query_params
+        try:
+            series = rollup_series(
+                client_name=params.get("client_name"),
+                granularity=params.get("granularity", "day"),
+                date_from=params.get("date_from"),
+                date_to=params.get("date_to"),
+                card_type=params.get("card_type"),
+            )
+        except InvalidHistoryQuery as e:
+            return Response({"error": str(e)}, status=400)
+        return Response({"series": series})
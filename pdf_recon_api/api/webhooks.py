@@ -0,0 +1,186 @@
+"""
+Signed completion webhooks.
+
+A finished run of a client with an active ClientWebhook is POSTed there
+as JSON. The delivery is recorded first (WebhookDelivery, with the time
+its next attempt is due). One sender thread per process sends whatever is
+due and sleeps until the next delivery falls due, so no thread is held
+per delivery through its retries. Retries follow
+RECON_WEBHOOK_RETRY_DELAYS. A receiver answering 5xx, 408 or 429, or not
+answering at all, is retried; other 4xx answers end the delivery.
+``manage.py recon_events`` sends whatever a restarted worker left due.
+Each attempt is claimed first, so the senders never repeat one.
+
+Each request carries:
+
+    X-Recon-Event: run.completed | run.failed
+    X-Recon-Delivery: <uuid>, identical across retries of one delivery
+    X-Recon-Signature: t=<unix time>,v1=<hex HMAC-SHA256>
+
+The HMAC uses the client's secret and covers ``"<t>.<raw body>"``.
+Receivers should recompute it, compare in constant time, and reject old
+``t`` values to stop replays.
+"""
+import hashlib
+import hmac
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Min
+from django.utils import timezone
+
+from .models import ClientWebhook, WebhookDelivery
+
+EVENT_HEADER = "X-Recon-Event"
+DELIVERY_HEADER = "X-Recon-Delivery"
+SIGNATURE_HEADER = "X-Recon-Signature"
+
+RETRYABLE_STATUS = {408, 429}
+
+# The sender looks for due deliveries at least this often (seconds), e.g.
+# for ones left behind by another worker
+SENDER_MAX_SLEEP = 60
+
+_sender = None
+_sender_lock = threading.Lock()
+_sender_wake = threading.Event()
+
+
+def sign(secret, timestamp, body):
+    """Hex HMAC-SHA256 of ``"<timestamp>.<body>"``; ``body`` is bytes."""
+    message = str(timestamp).encode() + b"." + body
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def signature_header(secret, body, timestamp=None):
+    timestamp = int(timestamp if timestamp is not None else time.time())
+    return f"t={timestamp},v1={sign(secret, timestamp, body)}"
+
+
+def _retry_delays():
+    return list(getattr(settings, "RECON_WEBHOOK_RETRY_DELAYS", [10, 60, 300, 1800, 7200]))
+
+
+def _claim(delivery_id, now):
+    """Take a due delivery for one attempt, so no other sender repeats it."""
+    lease = now + timedelta(seconds=2 * getattr(settings, "RECON_WEBHOOK_TIMEOUT", 10) + 5)
+    return WebhookDelivery.objects.filter(
+        pk=delivery_id, status=WebhookDelivery.Status.PENDING, next_attempt_at__lte=now,
+    ).update(next_attempt_at=lease) == 1
+
+
+def _post(url, body, headers):
+    """(status code, error text); status None when there was no answer."""
+    request = urllib.request.Request(url, data=body, headers=headers, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=getattr(settings, "RECON_WEBHOOK_TIMEOUT", 10)) as response:
+            return response.status, ""
+    except urllib.error.HTTPError as e:
+        return e.code, f"HTTP {e.code}"
+    except (urllib.error.URLError, OSError) as e:
+        return None, str(getattr(e, "reason", e))
+
+
+def attempt_delivery(delivery_id):
+    """
+    One attempt at a due delivery. Returns when the next attempt is due,
+    or None when the delivery is finished.
+    """
+    now = timezone.now()
+    if not _claim(delivery_id, now):
+        # Woken a little early: report the stored time to wait for again
+        return WebhookDelivery.objects.filter(
+            pk=delivery_id, status=WebhookDelivery.Status.PENDING, next_attempt_at__gt=now,
+        ).values_list("next_attempt_at", flat=True).first()
+    delivery = WebhookDelivery.objects.select_related("webhook").get(pk=delivery_id)
+    webhook = delivery.webhook
+    body = json.dumps(delivery.payload, separators=(",", ":"), default=str).encode()
+    status, error = _post(webhook.url, body, {
+        "Content-Type": "application/json",
+        EVENT_HEADER: delivery.event,
+        DELIVERY_HEADER: str(delivery.pk),
+        SIGNATURE_HEADER: signature_header(webhook.secret, body),
+    })
+
+    delivery.attempts += 1
+    delivery.last_status_code = status
+    delivery.last_error = error
+    delays = _retry_delays()
+    if status is not None and 200 <= status < 300:
+        delivery.status = WebhookDelivery.Status.DELIVERED
+        delivery.delivered_at = timezone.now()
+        delivery.next_attempt_at = None
+    elif (status is None or status >= 500 or status in RETRYABLE_STATUS) and delivery.attempts <= len(delays):
+        delivery.next_attempt_at = timezone.now() + timedelta(seconds=delays[delivery.attempts - 1])
+    else:
+        delivery.status = WebhookDelivery.Status.FAILED
+        delivery.next_attempt_at = None
+        print(f"Webhook {delivery.event} for run {delivery.run_id} to {webhook.url} failed "
+              f"after {delivery.attempts} attempt(s): {error or status}")
+    delivery.save(update_fields=[
+        "attempts", "last_status_code", "last_error", "status", "delivered_at", "next_attempt_at",
+    ])
+    return delivery.next_attempt_at
+
+
+def _next_due():
+    return WebhookDelivery.objects.filter(status=WebhookDelivery.Status.PENDING).aggregate(
+        due=Min("next_attempt_at")
+    )["due"]
+
+
+def _send_forever():
+    while True:
+        # Cleared before looking, so a delivery queued meanwhile wakes the next wait
+        _sender_wake.clear()
+        try:
+            deliver_due()
+            due = _next_due()
+        except Exception as e:
+            # Left pending; tried again on the next round
+            print(f"Error sending webhooks: {e}")
+            due = None
+        finally:
+            connection.close()
+        wait = SENDER_MAX_SLEEP if due is None else (due - timezone.now()).total_seconds()
+        _sender_wake.wait(min(max(wait, 0.0), SENDER_MAX_SLEEP))
+
+
+def wake_sender():
+    """Start this process's sender thread, or wake it to look for due deliveries."""
+    global _sender
+    with _sender_lock:
+        if _sender is None or not _sender.is_alive():
+            _sender = threading.Thread(target=_send_forever, name="webhook-sender", daemon=True)
+            _sender.start()
+    _sender_wake.set()
+
+
+def queue_run_webhook(run, event, payload):
+    """Record a webhook for a finished run, if the client has one, and wake the sender."""
+    webhook = ClientWebhook.objects.filter(client_name=run.client_name, active=True).first()
+    if webhook is None:
+        return None
+    delivery = WebhookDelivery.objects.create(
+        webhook=webhook, run=run, event=event, payload=payload, next_attempt_at=timezone.now(),
+    )
+    wake_sender()
+    return delivery
+
+
+def deliver_due(now=None):
+    """Attempt every pending delivery that is due; returns how many were tried."""
+    due = WebhookDelivery.objects.filter(
+        status=WebhookDelivery.Status.PENDING, next_attempt_at__lte=now or timezone.now(),
+    ).values_list("pk", flat=True)
+    tried = 0
+    for delivery_id in list(due):
+        attempt_delivery(delivery_id)
+        tried += 1
+    return tried
@@ -95,6 +95,162 @@ STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 MEDIA_ROOT = BASE_DIR / "media"
 MEDIA_URL = '/media/'
 
+# Streaming (bounded-memory) reconciliation: used when requested with
+# streaming=true or when either upload is at least this many bytes (None =
+# only on request). Bank rows are matched "first" in time order, not
+# statement order, and without clock-skew calibration (see api/streaming.py),
+# so the size rule is ignored when RECON_MATCH_MODE or RECON_CLOCK_SKEW ask
+# for more. The report is written from the spill files.
+RECON_STREAMING_MIN_FILE_SIZE = None
+RECON_STREAMING_RUN_SIZE = 50000  # rows per sorted run before spilling to disk
+RECON_SPILL_DIR = None  # None = system temp dir
+
+# Parallel matching: statements with at least this many rows (bank + hotel) are
+# split into independent time shards and matched on a process pool.
+# 0 or 1 worker keeps matching serial.
+RECON_MATCH_WORKERS = min(4, os.cpu_count() or 1)
+RECON_PARALLEL_MATCH_MIN_ROWS = 5000
+# "first": each bank row (in statement order) takes the first hotel row that
+# qualifies. "optimal": pairs are assigned per (amount, card) bucket to
+# reconcile the most rows with the least total time difference. The
+# streaming path always uses "first".
+RECON_MATCH_MODE = "first"
+
+# Clock-skew calibration (see api/clock_skew.py): the offset between each
+# terminal's clock and the PMS is estimated from anchor pairs (same card
+# last-4 and amount, unique within RECON_CLOCK_SKEW_MAX_MINUTES) and bank
+# rows are matched shifted by it, first within RECON_CLOCK_SKEW_WINDOW
+# minutes, then on their own times within the request's threshold. Off by
+# default: it changes which rows pair up, so compare it on live runs first
+# with RECON_SHADOW_ENGINE = "clock_skew".
+RECON_CLOCK_SKEW = False
+RECON_CLOCK_SKEW_MAX_MINUTES = 180
+RECON_CLOCK_SKEW_BIN_SECONDS = 60
+RECON_CLOCK_SKEW_MIN_ANCHORS = 10
+RECON_CLOCK_SKEW_MIN_SHARE = 0.6  # of a group's anchors that must sit around the histogram peak
+RECON_CLOCK_SKEW_WINDOW = 2
+
+# Rendering: the Excel workbook and the HTML preview are written on a process
+# pool of this many workers (0 = in the request's own process) while the
+# Parquet export and the Google calls run on threads. Once the local files are
+# written the response waits at most RECON_GOOGLE_WAIT seconds for Google.
+RECON_RENDER_WORKERS = min(2, os.cpu_count() or 1)
+RECON_GOOGLE_WAIT = 10
+# "per_run": every run creates a new spreadsheet. "workbook": each client has
+# one spreadsheet (Client workbooks in the admin) that runs update in place,
+# sending only the rows that changed since the last sync.
+RECON_GOOGLE_SHEET_MODE = "per_run"
+
+# Progress events (SSE at /api/runs/<id>/events/ and /api/runs/events/)
+RECON_EVENT_POLL = 0.5  # seconds between database polls of an open stream
+RECON_EVENT_KEEPALIVE = 15
+RECON_EVENT_STREAM_MAX = 300  # a stream is closed after this; EventSource reconnects
+RECON_PROGRESS_INTERVAL = 1.0  # at most one page event per document this often
+RECON_EVENT_TTL = 7 * 24 * 60 * 60  # pruned by `manage.py recon_events`
+
+# Completion webhooks (ClientWebhook per client, in the admin)
+RECON_WEBHOOK_TIMEOUT = 10
+RECON_WEBHOOK_RETRY_DELAYS = [10, 60, 300, 1800, 7200]  # seconds before each retry
+
+# OCR: pages are read at RECON_OCR_DPI, and lines whose weakest word has a
+# Tesseract confidence below RECON_OCR_MIN_CONFIDENCE (0-100) are read again
+# at RECON_OCR_RETRY_DPI. Above RECON_OCR_RETRY_PAGE_SHARE weak lines the
+# whole page is read again. The recognized text (not the page images) is
+# cached by page content hash in the "ocr" cache.
+RECON_OCR_DPI = 150
+RECON_OCR_RETRY_DPI = 300
+RECON_OCR_MIN_CONFIDENCE = 60
+RECON_OCR_RETRY_PAGE_SHARE = 0.5
+RECON_OCR_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Table regions: PDF text extraction and OCR only read the part of each page
+# that holds the transaction table. Regions are learned per document unless
+# a fixed (x0, top, x1, bottom) box in page fractions is given here, keyed by
+# "<kind>:<format name>", e.g. {"hotel:opera_cashier_report": (0, 0.1, 1, 0.92)}
+RECON_TABLE_REGIONS = {}
+RECON_LEARN_TABLE_REGIONS = True
+
+# Columnar (Parquet) copy of every run's results, queried with DuckDB at
+# GET /api/results/query/
+RECON_RESULTS_EXPORT = True
+RECON_RESULTS_DIR = MEDIA_ROOT / "results"
+
+# Content-addressed store for uploads and report files (deduplicated by
+# SHA-256). Retention is applied by `python manage.py recon_storage`.
+RECON_STORAGE_ROOT = MEDIA_ROOT / "store"
+RECON_UPLOAD_RETENTION_DAYS = 7  # uploads not re-sent within this are deleted
+RECON_ARTIFACT_RETENTION_DAYS = 90  # run folders older than this are deleted
+RECON_COMPRESS_AFTER_DAYS = 7  # older run folders are compressed with zstd
+
+# Resumable uploads (/api/uploads/): chunks are written to the store as they
+# arrive and the reconcile call references the finalized upload ids
+RECON_UPLOAD_MAX_SIZE = 2 * 1024 * 1024 * 1024
+RECON_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # suggested to clients
+RECON_UPLOAD_SESSION_TTL = 24 * 60 * 60  # unfinished uploads idle this long are deleted
+
+# Hot folders (`python manage.py recon_hotfolder`): bank and hotel statements
+# dropped into these directories are paired by client and date and reconciled
+# once each, results written next to them. Entries are paths or dicts with
+# "path", "client_name", "bank_pattern", "hotel_pattern", "threshold_time";
+# see api/hotfolder.py.
+RECON_HOT_FOLDERS = []
+RECON_HOT_FOLDER_POLL = 10  # seconds between scans
+RECON_HOT_FOLDER_SETTLE = 30  # a file must stay unchanged this long before it is read
+RECON_HOT_FOLDER_WORKERS = 2
+
+# Report downloads (/media/<run folder>/<file>) can be handed to the front
+# server: None (Django streams the file), "sendfile" (X-Sendfile) or "accel"
+# (nginx X-Accel-Redirect to an internal location aliased to MEDIA_ROOT)
+RECON_DOWNLOAD_OFFLOAD = None
+RECON_ACCEL_REDIRECT_PREFIX = "/protected-media/"
+
+# Shadow mode: a sample of runs is re-run in a background process with a
+# candidate engine ("reference", "sharded", "optimal", "clock_skew", "streaming" or a dotted
+# path to a callable) and diffed row by row; see GET /api/shadow/report/.
+# None disables it.
+RECON_SHADOW_ENGINE = None
+RECON_SHADOW_SAMPLE_RATE = 0.05
+RECON_SHADOW_CLIENTS = None  # None = every client
+RECON_SHADOW_WORKERS = 1
+RECON_SHADOW_MAX_PENDING = 4  # further samples are skipped while this many are queued
+RECON_SHADOW_MAX_DIFF_ROWS = 100  # differing rows kept per table and side
+
+# Admission control: requests beyond RECON_MAX_IN_FLIGHT (per worker process)
+# get 503 + Retry-After. Each CPU stage has RECON_STAGE_LIMITS slots across all
+# worker processes on the host, held as flocks on files in
+# RECON_STAGE_LOCK_DIR; with None the limits apply to each process separately.
+RECON_MAX_IN_FLIGHT = 8
+RECON_STAGE_LIMITS = {"extraction": 2, "ocr": 1, "excel": 2}
+RECON_STAGE_LOCK_DIR = BASE_DIR / "cache" / "stage_slots"
+RECON_STAGE_WAIT_TIMEOUT = 300  # seconds a request may wait for a stage slot
+RECON_RETRY_AFTER = 30  # Retry-After seconds until an average run time is known
+
+# Run locking: identical concurrent uploads attach to the run already in flight
+RECON_RUN_LOCK_TTL = 3600  # a RUNNING record older than this is treated as dead
+RECON_RUN_LOCK_WAIT = 600  # how long an attached request waits for the result
+RECON_RUN_LOCK_POLL = 1.0
+
+# Responses replayed for retried POSTs carrying the same Idempotency-Key.
+# A file cache is shared by all workers on the host.
+RECON_IDEMPOTENCY_TTL = 24 * 60 * 60
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "idempotency": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": BASE_DIR / "cache" / "idempotency",
+        "TIMEOUT": RECON_IDEMPOTENCY_TTL,
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+    "ocr": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": BASE_DIR / "cache" / "ocr",
+        "TIMEOUT": RECON_OCR_CACHE_TTL,
+        "OPTIONS": {"MAX_ENTRIES": 20000},
+    },
+}
+
 
 # CORS configuration for React frontend
 CORS_ALLOW_ALL_ORIGINS = True  # or specify origins like below
@@ -109,6 +265,9 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 APPEND_SLASH = False
 # Google Sheets credentials
 GOOGLE_SERVICE_ACCOUNT_FILE = BASE_DIR / "credentials" / "ethereal-terra-441812-d5-22d30c1611b9.json"
+# Base URL of a stand-in for Drive and Sheets, e.g. "http://127.0.0.1:8765" for
+# `python manage.py fake_google` during load tests. None = the real APIs.
+GOOGLE_API_ENDPOINT = None
 MASTER_SHEET_ID= "1Z_ZKrKohFPQA_J4OKGviPBtLl7FexyKQuSbq-Hsa8JQ"
 FOLDER_ID="1qAmDuqfK7oLzTBL04mdV2fA-ZbINBK-h"
 
@@ -1,20 +1,11 @@
 from django.contrib import admin
 from django.urls import path, include
 
-# ✅ ADD THESE TWO IMPORTS
-from django.conf import settings
-from django.conf.urls.static import static
+from api.downloads import ReportDownloadView
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/", include("api.urls")),
-]
-
-
-
-
-if settings.DEBUG:
-    urlpatterns += static(
-        settings.MEDIA_URL,
-        document_root=settings.MEDIA_ROOT
-    )
\ No newline at end of file
+    # Report files, with or without DEBUG (see api/downloads.py)
+    path("media/<str:folder>/<str:file_name>", ReportDownloadView.as_view(), name="report-download"),
+]
\ No newline at end of file